@@ -0,0 +1,529 @@
+'''
+The audit log.  Every AUTH result (and anything else that needs to be kept
+for audit) is appended to a local file, in a compact binary format, instead
+of being formatted as text.  Records are collected in memory and written in
+batches, and the file is rotated when it gets too big.
+
+Fields that contain sensitive data are redacted before they are written, as
+set by a policy (see L{K2_AUDIT_REDACT}, and the "Audit Log" section of
+docs/security.txt).
+
+The file starts with L{K2_AUDIT_MAGIC}, followed by records.  Each record is
+a 4-byte length, followed by that many bytes.  All numbers are in network
+byte order.  The record is:
+
+ - Version (unsigned char): L{K2_AUDIT_VERSION}
+ - Time (double): Seconds since the epoch
+ - Level (unsigned char): The logging level, such as 20 for INFO
+ - Field count (unsigned short)
+ - Module (string)
+ - Message (string)
+ - Each field's name and value (strings)
+
+Strings are a 2-byte length, followed by that many bytes of UTF-8.  Longer
+strings are cut short, at the end of a character.
+
+To read an audit log, run this module::
+
+    python -m k2ksm.audit [--json] FILE ...
+'''
+
+import json
+import logging
+from optparse import OptionParser
+import os
+from struct import calcsize, pack, unpack, unpack_from
+import sys
+from threading import Lock
+import time
+
+
+
+K2_AUDIT_MAGIC = 'K2AUDIT\n'
+'''The first bytes of every audit log file.'''
+
+K2_AUDIT_VERSION = 1
+'''The record format version written by this code.'''
+
+K2_AUDIT_MAX_BYTES = 64 * 1024 * 1024
+'''The default size at which the audit log is rotated.'''
+
+K2_AUDIT_BACKUPS = 10
+'''The default number of rotated audit logs to keep.'''
+
+K2_AUDIT_BATCH = 256
+'''The default number of records to collect before writing.'''
+
+K2_AUDIT_INTERVAL = 1.0
+'''The default longest time, in seconds, that a record waits to be written.'''
+
+K2_AUDIT_REDACTED = '[REDACTED]'
+'''What redacted values are replaced with.'''
+
+K2_AUDIT_REDACT = {'*': ('key', 'password', 'secret'),
+                   'AES': ('material',),
+                   'HOTP': ('code', 'counter'),
+                   'TOTP': ('code',),
+                   'YUBIOTP': ('otp', 'aesKey', 'privateID'),
+                   'USER': ('material',),
+                   }
+'''
+The default redaction policy, a hash of module ID to the names of the fields
+to redact for that module.  The fields listed under "*" are redacted for
+every module.  Field names are matched without regard to case, so "key"
+also redacts "Key" and "KEY".
+'''
+
+_HEADER = '>dBH'
+_HEADER_SIZE = calcsize(_HEADER)
+
+
+
+def _string(value):
+    # Encode a string field
+    if (isinstance(value, unicode)):
+        value = value.encode('utf-8')
+    elif (not isinstance(value, str)):
+        value = str(value)
+    if (len(value) > 0xFFFF):
+        # Don't cut a multi-byte character in half
+        end = 0xFFFF
+        while ((end > 0) and (ord(value[end]) & 0xC0 == 0x80)):
+            end -= 1
+        value = value[:end]
+    return pack('>H', len(value)) + value
+
+
+def encodeRecord(created, level, module, message, fields):
+    '''
+    Encode one record, including its length prefix.
+
+    @param created: The time of the event, in seconds since the epoch.
+    @type created: Float
+
+    @param level: The logging level.
+    @type level: Integer
+
+    @param module: The module the event came from.
+    @type module: String
+
+    @param message: The event.
+    @type message: String
+
+    @param fields: Extra fields, which should already be redacted.
+    @type fields: Hash
+
+    @rtype: String
+    '''
+    names = sorted(fields)
+    parts = [chr(K2_AUDIT_VERSION),
+             pack(_HEADER, created, min(level, 255), len(names)),
+             _string(module), _string(message)]
+    for name in names:
+        parts.append(_string(name))
+        parts.append(_string(fields[name]))
+    body = ''.join(parts)
+    return pack('>I', len(body)) + body
+
+
+def decodeRecord(body):
+    '''
+    Decode one record (without its length prefix).
+
+    @param body: The encoded record.
+    @type body: String
+
+    @rtype: Hash
+    @return: The record, with keys "time", "level", "module", "message" and
+    "fields".
+
+    @raise ValueError: Thrown if the record was written by an unsupported
+    version, or is corrupt.
+    '''
+    if (body[:1] != chr(K2_AUDIT_VERSION)):
+        raise ValueError('Unsupported audit record version')
+    try:
+        (created, level, count) = unpack_from(_HEADER, body, 1)
+        offset = 1 + _HEADER_SIZE
+        strings = []
+        for i in xrange(2 + 2 * count):
+            length = unpack_from('>H', body, offset)[0]
+            offset += 2
+            strings.append(body[offset:offset + length].decode('utf-8',
+                                                               'replace'))
+            offset += length
+    except Exception as e:
+        raise ValueError('Corrupt audit record: %s' % e)
+    if (offset != len(body)):
+        raise ValueError('Corrupt audit record: bad length')
+
+    fields = {}
+    for i in xrange(2, len(strings), 2):
+        fields[strings[i]] = strings[i + 1]
+    return {'time': created, 'level': level, 'module': strings[0],
+            'message': strings[1], 'fields': fields}
+
+
+def readRecords(auditFile, onError=None):
+    '''
+    Read records from an audit log.
+
+    @param auditFile: An open audit log file.
+    @type auditFile: File
+
+    @param onError: If given, a corrupt record is skipped, and this is called
+    with the record's offset in the file and the ValueError from
+    L{decodeRecord}.
+    @type onError: Function
+
+    @return: A generator of records, as returned by L{decodeRecord}.
+
+    @raise ValueError: Thrown if the file is not an audit log, or if a record
+    is corrupt and onError was not given.  A final record that was only
+    partly written is ignored.
+    '''
+    if (auditFile.read(len(K2_AUDIT_MAGIC)) != K2_AUDIT_MAGIC):
+        raise ValueError('Not an audit log')
+    offset = len(K2_AUDIT_MAGIC)
+    while True:
+        prefix = auditFile.read(4)
+        if (len(prefix) < 4):
+            return
+        length = unpack('>I', prefix)[0]
+        body = auditFile.read(length)
+        if (len(body) < length):
+            return
+        try:
+            record = decodeRecord(body)
+        except ValueError as e:
+            if (onError == None):
+                raise
+            onError(offset, e)
+        else:
+            yield record
+        offset += 4 + length
+
+
+def formatText(record):
+    '''
+    Format a record as one line of text.
+
+    @param record: A record from L{decodeRecord}.
+    @type record: Hash
+
+    @rtype: String
+    '''
+    when = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record['time']))
+    fields = ''.join([' %s=%s' % (name, record['fields'][name])
+                      for name in sorted(record['fields'])])
+    return u'%s.%03dZ %s %s: %s%s' % (when, int(record['time'] % 1 * 1000),
+                                       logging.getLevelName(record['level']),
+                                       record['module'], record['message'],
+                                       fields)
+
+
+
+class K2AuditLog(object):
+    '''
+    K2AuditLog appends records to a rotating audit log file.  It is safe to
+    use from multiple threads.
+
+    @ivar path: The path of the current audit log.  Rotated logs have ".1",
+    ".2", etc. appended.
+    @type path: String
+
+    @ivar policy: The redaction policy.  See L{K2_AUDIT_REDACT}.
+    @type policy: Hash
+    '''
+
+
+    def __init__(self, path, maxBytes=K2_AUDIT_MAX_BYTES,
+                 backupCount=K2_AUDIT_BACKUPS, batchSize=K2_AUDIT_BATCH,
+                 interval=K2_AUDIT_INTERVAL, policy=K2_AUDIT_REDACT,
+                 clock=time.time):
+        '''
+        Open (or create) the audit log.
+
+        @param path: The path of the audit log.
+        @type path: String
+
+        @param maxBytes: The size at which the log is rotated.
+        @type maxBytes: Integer
+
+        @param backupCount: How many rotated logs to keep.
+        @type backupCount: Integer
+
+        @param batchSize: How many records to collect before writing.
+        @type batchSize: Integer
+
+        @param interval: The most seconds that a record is kept before it is
+        written.  This is only checked when another record arrives, so
+        L{flush} should also be called periodically, and at shutdown.
+        @type interval: Float
+
+        @param policy: The redaction policy.
+        @type policy: Hash
+
+        @param clock: A function that returns the current time.
+
+        @raise IOError: Thrown if the log can not be opened.
+
+        @raise ValueError: Thrown if an existing file is not an audit log.
+        '''
+        self.path = path
+        self.policy = policy
+        self.__maxBytes = maxBytes
+        self.__backupCount = backupCount
+        self.__batchSize = batchSize
+        self.__interval = interval
+        self.__clock = clock
+        self.__lock = Lock()
+        self.__pending = []
+        self.__pendingBytes = 0
+        self.__lastFlush = clock()
+        self.__redact = {}
+        self.__file = None
+        self.__open()
+
+
+    def __open(self):
+        # Open the log for appending, writing the magic if it is new
+        self.__file = open(self.path, 'ab')
+        self.__file.seek(0, os.SEEK_END)
+        self.__size = self.__file.tell()
+        if (self.__size == 0):
+            self.__file.write(K2_AUDIT_MAGIC)
+            self.__file.flush()
+            self.__size = len(K2_AUDIT_MAGIC)
+        else:
+            checkFile = open(self.path, 'rb')
+            try:
+                if (checkFile.read(len(K2_AUDIT_MAGIC)) != K2_AUDIT_MAGIC):
+                    self.__file.close()
+                    raise ValueError('%s is not an audit log' % self.path)
+            finally:
+                checkFile.close()
+
+
+    def __redactedFields(self, module):
+        # Returns the set of fields redacted for a module, in lower case,
+        # building it once
+        try:
+            return self.__redact[module]
+        except KeyError:
+            fields = set()
+            for name in (tuple(self.policy.get('*', ()))
+                         + tuple(self.policy.get(module, ()))):
+                fields.add(name.lower())
+            self.__redact[module] = fields
+            return fields
+
+
+    def log(self, module, level, message, fields=None, created=None):
+        '''
+        Add a record to the audit log.  The record is written with the next
+        batch.
+
+        @param module: The module the event came from, such as "TOTP".
+        @type module: String
+
+        @param level: The logging level, such as logging.INFO.
+        @type level: Integer
+
+        @param message: The event, such as "AUTH OK".
+        @type message: String
+
+        @param fields: Extra fields, such as the username.  Fields named in
+        the redaction policy, in any case, are redacted.
+        @type fields: Hash
+
+        @param created: The time of the event.  Defaults to now.
+        @type created: Float
+        '''
+        if (created == None):
+            created = self.__clock()
+        if (fields):
+            redacted = self.__redactedFields(module)
+            names = [name for name in fields if (name.lower() in redacted)]
+            if (names):
+                fields = dict(fields)
+                for name in names:
+                    fields[name] = K2_AUDIT_REDACTED
+        else:
+            fields = {}
+        record = encodeRecord(created, level, module, message, fields)
+
+        self.__lock.acquire()
+        try:
+            self.__pending.append(record)
+            self.__pendingBytes += len(record)
+            if (   (len(self.__pending) >= self.__batchSize)
+                or (created - self.__lastFlush >= self.__interval)
+                ):
+                self.__flush()
+        finally:
+            self.__lock.release()
+
+
+    def flush(self):
+        '''
+        Write any records that are waiting.
+        '''
+        self.__lock.acquire()
+        try:
+            self.__flush()
+        finally:
+            self.__lock.release()
+
+
+    def __flush(self):
+        # Write the pending records.  Must be called with the lock held.
+        self.__lastFlush = self.__clock()
+        if (len(self.__pending) == 0):
+            return
+        if (   (self.__size > len(K2_AUDIT_MAGIC))
+            and (self.__size + self.__pendingBytes > self.__maxBytes)
+            ):
+            self.__rotate()
+        data = ''.join(self.__pending)
+        self.__pending = []
+        self.__pendingBytes = 0
+        self.__file.write(data)
+        self.__file.flush()
+        self.__size += len(data)
+
+
+    def __rotate(self):
+        # Move each log up by one, and start a new log
+        self.__file.close()
+        for i in xrange(self.__backupCount - 1, 0, -1):
+            source = '%s.%d' % (self.path, i)
+            if (os.path.exists(source)):
+                os.rename(source, '%s.%d' % (self.path, i + 1))
+        if (self.__backupCount > 0):
+            os.rename(self.path, self.path + '.1')
+        else:
+            os.unlink(self.path)
+        self.__open()
+
+
+    def close(self):
+        '''
+        Write any records that are waiting, and close the log.
+        '''
+        self.__lock.acquire()
+        try:
+            if (self.__file != None):
+                self.__flush()
+                self.__file.close()
+                self.__file = None
+        finally:
+            self.__lock.release()
+
+
+
+class K2AuditHandler(logging.Handler):
+    '''
+    A logging handler that sends records to a L{K2AuditLog}, so that it can
+    be used alongside the stderr and syslog handlers of L{K2Logger}.  Fields
+    are taken from the C{audit} attribute of the log record, which is set
+    using the C{extra} argument::
+
+        logger.info('AUTH OK', extra={'audit': {'user': username}})
+
+    Records without an C{audit} attribute are not audit events, and are
+    ignored.  The module is the first part of the logger's name after the
+    prefix, so the logger "k2ksm.TOTP.AUTH" is audited as "TOTP".  The
+    message is the format string, without its arguments, which are not
+    redacted; anything that varies belongs in the fields.
+    '''
+
+    def __init__(self, auditLog, prefix=None, level=logging.NOTSET):
+        '''
+        @param auditLog: The audit log to send records to.
+        @type auditLog: L{K2AuditLog}
+
+        @param prefix: The name of the top-level logger, as in
+        L{K2Logger.namePrefix}.  If not given, the first part of each
+        logger's name is taken to be the prefix.
+        @type prefix: String
+
+        @param level: The handler's level.
+        @type level: Integer
+        '''
+        logging.Handler.__init__(self, level)
+        self.auditLog = auditLog
+        self.prefix = prefix
+
+    def module(self, name):
+        '''
+        Get the module that a logger belongs to.
+
+        @param name: The logger's name.
+        @type name: String
+
+        @rtype: String
+        '''
+        if ((self.prefix != None) and name.startswith(self.prefix + '.')):
+            name = name[len(self.prefix) + 1:]
+        else:
+            name = name.split('.', 1)[-1]
+        return name.split('.', 1)[0]
+
+    def filter(self, record):
+        if (not hasattr(record, 'audit')):
+            return False
+        return logging.Handler.filter(self, record)
+
+    def emit(self, record):
+        try:
+            self.auditLog.log(self.module(record.name), record.levelno,
+                              record.msg, record.audit, record.created)
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        self.auditLog.flush()
+
+    def close(self):
+        self.auditLog.close()
+        logging.Handler.close(self)
+
+
+
+def main(argv=None):
+    '''
+    Print audit logs as text, or as JSON (one record per line).
+
+    @return: The exit status.
+    '''
+    parser = OptionParser(usage='%prog [--json] FILE ...')
+    parser.add_option('--json', action='store_true', default=False,
+                      help='Print each record as JSON')
+    (options, paths) = parser.parse_args(argv)
+    if (len(paths) == 0):
+        parser.error('No audit logs given')
+
+    status = [0]
+    for path in paths:
+        def badRecord(offset, e):
+            sys.stderr.write('%s at byte %d: %s\n' % (path, offset, e))
+            status[0] = 1
+        auditFile = open(path, 'rb')
+        try:
+            for record in readRecords(auditFile, badRecord):
+                if (options.json):
+                    print json.dumps(record, sort_keys=True)
+                else:
+                    print formatText(record).encode('utf-8')
+        except ValueError as e:
+            sys.stderr.write('%s: %s\n' % (path, e))
+            return 1
+        finally:
+            auditFile.close()
+    return status[0]
+
+
+# Allow the audit log decoder to be run as a program.
+if __name__ == "__main__":
+    sys.exit(main())
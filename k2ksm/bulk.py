@@ -0,0 +1,366 @@
+'''
+Bulk operations on users.  These are used by the USER IMPORT command, which
+lets a client create many users with a single command, and by the USER EXPORT
+command, which dumps users for audits and disaster-recovery testing (see
+docs/commands/USER.rst).
+'''
+
+from calendar import timegm
+import json
+import dateutil.parser
+from .db import K2DB
+from .logger import K2Logger
+
+
+
+K2_IMPORT_BATCH_SIZE = 1000
+'''
+The number of records that are committed to the database in one transaction
+during a bulk import.  This is also the most records that will be held in
+memory at once.
+'''
+
+
+
+class K2BulkImport(object):
+    '''
+    K2BulkImport creates users from a stream of JSON Lines records (one JSON
+    object per line), as sent by the client after a MORE response.
+
+    Records are numbered from 1, in the order they are received.  Blank lines
+    are ignored, and do not get a number.  Records are collected into batches
+    of L{batchSize}; each batch is stored in one transaction, along with the
+    number of the last record in the batch.  If the connection drops, the
+    client may re-send the same stream using the same import ID, and records
+    that were already committed will be skipped.
+
+    @ivar db: The database that users are written to.
+    @type db: K2DB
+
+    @ivar importID: The client-chosen ID of this import.
+    @type importID: String
+
+    @ivar batchSize: The number of records in each transaction.
+    @type batchSize: Integer
+
+    @ivar checkpoint: The last record committed before this import started.
+    @type checkpoint: Integer
+
+    @ivar logger: A Logger object that we can use.
+    @type logger: logging.Logger
+    '''
+
+
+    def __init__(self, logger, db, importID, batchSize=K2_IMPORT_BATCH_SIZE):
+        '''
+        Prepare a bulk import.
+
+        @param logger: A K2Logger object, which we can use to create a
+        logging.logger object for ourselves.
+        @type logger: K2Logger
+
+        @param db: The database that users will be written to.
+        @type db: K2DB
+
+        @param importID: The client-chosen ID of this import.  Re-using an ID
+        resumes the import from the last committed record.
+        @type importID: String
+
+        @param batchSize: The number of records to commit in each transaction.
+        @type batchSize: Integer
+
+        @raise TypeError: Thrown if logger is not a K2Logger object, or if db
+        is not a K2DB object.
+
+        @raise ValueError: Thrown if batchSize is less than 1.
+        '''
+        if (not isinstance(logger, K2Logger)):
+            raise TypeError('logger must be a K2Logger object')
+        if (not isinstance(db, K2DB)):
+            raise TypeError('db must be a K2DB object')
+        if (batchSize < 1):
+            raise ValueError('batchSize must be at least 1')
+
+        self.logger = logger.loggerForModule('USER')
+        self.db = db
+        self.importID = importID
+        self.batchSize = batchSize
+        self.checkpoint = db.importCheckpoint(importID)
+        self.logger.info('Import %s starting after record %d' % (
+                         importID, self.checkpoint))
+
+
+    def run(self, lines):
+        '''
+        Run the import.  This is a generator: it reads lines as they are
+        needed, and yields one JSON-encoded result line for each record as
+        soon as the record's batch has been committed.  A final summary line
+        is yielded at the end.
+
+        Reading stops at the end of C{lines}, or at a line containing a lone
+        ".", whichever comes first.
+
+        @param lines: An iterable of lines, such as a file or socket file.
+        @type lines: Iterable
+
+        @rtype: Generator
+        @return: JSON-encoded result lines, without line terminators.
+        '''
+        counts = {'Imported': 0, 'Failed': 0, 'Skipped': 0}
+        recordNum = 0
+        batch = []
+
+        for line in lines:
+            line = line.strip()
+            if (line == '.'):
+                break
+            if (line == ''):
+                continue
+
+            recordNum += 1
+            if (recordNum <= self.checkpoint):
+                counts['Skipped'] += 1
+                continue
+
+            batch.append((recordNum, self.parseRecord(line)))
+            if (len(batch) >= self.batchSize):
+                for result in self.commitBatch(batch, counts):
+                    yield result
+                batch = []
+
+        if (len(batch) > 0):
+            for result in self.commitBatch(batch, counts):
+                yield result
+
+        counts['LastRecord'] = recordNum
+        self.logger.info('Import %s complete: %d imported, %d failed, '
+                         '%d skipped' % (self.importID, counts['Imported'],
+                                         counts['Failed'], counts['Skipped']))
+        yield json.dumps(counts, sort_keys=True)
+
+
+    @staticmethod
+    def parseRecord(line):
+        '''
+        Parse and validate one JSON Lines record.
+
+        @param line: One line of JSON.
+        @type line: String
+
+        @return: A hash suitable for L{K2DB.createUsers}, or a string
+        explaining why the record is invalid.
+        '''
+        try:
+            record = json.loads(line)
+        except ValueError:
+            return 'Record is not valid JSON'
+        if (not isinstance(record, dict)):
+            return 'Record must be a JSON object'
+        username = record.get('Username')
+        if (   (not isinstance(username, basestring))
+            or (username == '')
+            or (' ' in username)
+            ):
+            return 'Record must have a Username without spaces'
+        for name in ('GivenName', 'Surname'):
+            if (not isinstance(record.get(name), (basestring, type(None)))):
+                return '%s must be a string' % name
+
+        # Usernames are not case-sensitive, and are stored lowercased
+        return {'Username': username.lower(),
+                'GivenName': record.get('GivenName'),
+                'Surname': record.get('Surname'),
+                }
+
+
+    def commitBatch(self, batch, counts):
+        '''
+        Store one batch of records, and return the result lines for it.
+
+        @param batch: A list of (record number, parsed record) tuples, as
+        made by L{run}.
+        @type batch: List
+
+        @param counts: The running totals, which will be updated.
+        @type counts: Hash
+
+        @rtype: List
+        @return: JSON-encoded result lines, one per record.
+        '''
+        users = [record for (recordNum, record) in batch
+                 if (isinstance(record, dict))]
+        uids = iter(self.db.createUsers(users, self.importID, batch[-1][0]))
+
+        results = []
+        for (recordNum, record) in batch:
+            result = {'Record': recordNum}
+            if (not isinstance(record, dict)):
+                result.update(module='USER', code='1', details=record)
+                counts['Failed'] += 1
+            else:
+                uid = uids.next()
+                if (uid == None):
+                    result.update(module='USER', code='2',
+                                  details='Username %s already exists'
+                                          % record['Username'])
+                    counts['Failed'] += 1
+                else:
+                    result['Username'] = record['Username']
+                    result['UID'] = str(uid)
+                    counts['Imported'] += 1
+            results.append(json.dumps(result, sort_keys=True))
+        return results
+
+
+
+class K2BulkExport(object):
+    '''
+    K2BulkExport produces a dump of users and the metadata of their keys, for
+    the USER EXPORT command.  Key material is never included.
+
+    The export is a generator of lines, each being one user encoded as a JSON
+    object.  Users are read from the database only as lines are asked for, so
+    the connection handler paces the export:  it should only ask for the next
+    line once the previous one has been written to the client.  The last line
+    is a summary, which includes the LSN to use for the next incremental
+    export.
+
+    @ivar db: The database that users are read from.
+    @type db: K2DB
+
+    @ivar module: If set, only users enrolled in this module are exported.
+    @type module: String
+
+    @ivar sinceLSN: If set, only users changed after this LSN are exported.
+    @type sinceLSN: Integer
+
+    @ivar sinceTime: If set, only users changed after this time are exported.
+    @type sinceTime: Float
+
+    @ivar logger: A Logger object that we can use.
+    @type logger: logging.Logger
+    '''
+
+
+    def __init__(self, logger, db, module=None, sinceLSN=None,
+                 sinceTime=None):
+        '''
+        Prepare an export.
+
+        @param logger: A K2Logger object, which we can use to create a
+        logging.logger object for ourselves.
+        @type logger: K2Logger
+
+        @param db: The database that users will be read from.
+        @type db: K2DB
+
+        @param module: If given, only users with a key linked to this module
+        are exported.
+        @type module: String
+
+        @param sinceLSN: If given, only users changed after this LSN are
+        exported.
+        @type sinceLSN: Integer
+
+        @param sinceTime: If given, only users changed after this time (in
+        seconds since the epoch) are exported.
+        @type sinceTime: Float
+
+        @raise TypeError: Thrown if logger is not a K2Logger object, or if db
+        is not a K2DB object.
+        '''
+        if (not isinstance(logger, K2Logger)):
+            raise TypeError('logger must be a K2Logger object')
+        if (not isinstance(db, K2DB)):
+            raise TypeError('db must be a K2DB object')
+
+        self.logger = logger.loggerForModule('USER')
+        self.db = db
+        self.module = module
+        self.sinceLSN = sinceLSN
+        self.sinceTime = sinceTime
+
+
+    @classmethod
+    def fromArguments(cls, logger, db, module, since=None):
+        '''
+        Prepare an export from the arguments of a USER EXPORT command.
+
+        @param logger: A K2Logger object.
+        @type logger: K2Logger
+
+        @param db: The database that users will be read from.
+        @type db: K2DB
+
+        @param module: The module name, or "*" to export all users.
+        @type module: String
+
+        @param since: If given, an LSN, or a time in ISO 8601 combined format.
+        @type since: String
+
+        @rtype: K2BulkExport
+        @return: A new export.
+
+        @raise ValueError: Thrown if C{since} is neither an LSN nor a time.
+        '''
+        if (module == '*'):
+            module = None
+        if (since == None):
+            return cls(logger, db, module)
+        if (since.isdigit()):
+            return cls(logger, db, module, sinceLSN=int(since))
+        sinceTime = dateutil.parser.parse(since)
+        if (sinceTime.tzinfo != None):
+            sinceTime = sinceTime - sinceTime.utcoffset()
+        return cls(logger, db, module,
+                   sinceTime=timegm(sinceTime.timetuple()))
+
+
+    def run(self):
+        '''
+        Run the export.  This is a generator, yielding one JSON-encoded line
+        per user, followed by a summary line.
+
+        @rtype: Generator
+        @return: JSON-encoded lines, without line terminators.
+        '''
+        # Anything written after this point will be picked up by the next
+        # incremental export, not this one.
+        untilLSN = self.db.currentLSN()
+        self.logger.info('Export starting at LSN %d' % untilLSN)
+
+        rows = self.db.exportUsers(self.module, self.sinceLSN, self.sinceTime,
+                                   untilLSN)
+        count = 0
+        user = None
+        for (uid, username, givenName, surname, lsn, modified,
+             keyID, keyType, created, modules) in rows:
+            if ((user == None) or (user['UID'] != str(uid))):
+                if (user != None):
+                    count += 1
+                    yield json.dumps(user, sort_keys=True)
+                user = {'UID': str(uid),
+                        'Username': username,
+                        'GivenName': givenName,
+                        'Surname': surname,
+                        'LSN': lsn,
+                        'Modified': modified,
+                        'Keys': [],
+                        }
+            if (keyID != None):
+                if (modules == None):
+                    modules = []
+                else:
+                    modules = modules.split(' ')
+                user['Keys'].append({'KeyID': str(keyID),
+                                     'Type': keyType,
+                                     'Created': created,
+                                     'Modules': modules,
+                                     })
+        if (user != None):
+            count += 1
+            yield json.dumps(user, sort_keys=True)
+
+        self.logger.info('Export complete: %d users' % count)
+        yield json.dumps({'Exported': count, 'LSN': untilLSN},
+                         sort_keys=True)
@@ -0,0 +1,367 @@
+'''
+A small, thread-safe cache with a size limit, a time limit and least-recently
+used (LRU) eviction.  Caches that hold sensitive data (keys, rendered QR
+codes, etc.) should store it in bytearrays, which are wiped when they leave
+the cache.  See the "RAM" section of docs/security.txt for the limits of this.
+'''
+
+from contextlib import contextmanager
+from threading import Lock
+from time import time
+
+
+
+def wipe(value):
+    '''
+    Overwrite a bytearray with zeroes, in place.  Values that are not
+    bytearrays are left alone, since Python gives us no way to wipe them.
+
+    @param value: The value to wipe.
+    '''
+    if (isinstance(value, bytearray)):
+        value[:] = bytearray(len(value))
+
+
+
+class _K2CacheEntry(object):
+    '''
+    One entry in a L{K2Cache}.  Entries form a circular doubly-linked list,
+    ordered from least- to most-recently used.
+    '''
+    __slots__ = ('prev', 'next', 'key', 'value', 'size', 'expires', 'pins',
+                 'dead')
+
+
+
+class K2Cache(object):
+    '''
+    K2Cache maps keys to values, up to a maximum number of entries and a
+    maximum total size.  When either limit is reached, the least-recently
+    used entries are evicted.  Entries also expire after a fixed time.
+
+    Every value that leaves the cache (by eviction, expiry, replacement,
+    L{discard} or L{clear}) is passed to the wipe function.  If a value is
+    being used through L{pinned} when it leaves the cache, the wipe is put off
+    until it is no longer in use.
+
+    @ivar maxEntries: The most entries the cache will hold.
+    @type maxEntries: Integer
+
+    @ivar maxBytes: The largest total size the cache will hold, or None for
+    no limit.
+    @type maxBytes: Integer
+
+    @ivar ttl: The number of seconds an entry stays valid.
+    @type ttl: Float
+
+    @ivar hits: The number of lookups that found a valid entry.
+    @type hits: Integer
+
+    @ivar misses: The number of lookups that did not.
+    @type misses: Integer
+
+    @ivar wipes: The number of values that have been wiped.
+    @type wipes: Integer
+    '''
+
+
+    def __init__(self, maxEntries, ttl, maxBytes=None, wipe=wipe, clock=time):
+        '''
+        Create a new, empty cache.
+
+        @param maxEntries: The most entries the cache will hold.
+        @type maxEntries: Integer
+
+        @param ttl: The number of seconds an entry stays valid.
+        @type ttl: Float
+
+        @param maxBytes: The largest total size the cache will hold.  If
+        given, the size of each value is taken as C{len(value)}.
+        @type maxBytes: Integer
+
+        @param wipe: Called with each value that leaves the cache.  Defaults
+        to L{wipe}.
+        @type wipe: Function
+
+        @param clock: Returns the current time, in seconds.  Used for testing.
+        @type clock: Function
+
+        @raise ValueError: Thrown if maxEntries is less than 1, or ttl is not
+        positive.
+        '''
+        if (maxEntries < 1):
+            raise ValueError('maxEntries must be at least 1')
+        if (ttl <= 0):
+            raise ValueError('ttl must be positive')
+
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.wipes = 0
+        self.__wipe = wipe
+        self.__clock = clock
+        self.__lock = Lock()
+        self.__entries = {}
+        self.__size = 0
+
+        # The root is a sentinel; root.next is the least-recently used entry
+        self.__root = _K2CacheEntry()
+        self.__root.prev = self.__root
+        self.__root.next = self.__root
+
+
+    def __len__(self):
+        '''
+        Returns the number of entries in the cache, including any which have
+        expired but have not been noticed yet.
+
+        @rtype: Integer
+        '''
+        return len(self.__entries)
+
+
+    @property
+    def size(self):
+        '''
+        The total size of the values in the cache.  Always 0 if the cache does
+        not have a maxBytes limit.
+        '''
+        return self.__size
+
+
+    def get(self, key):
+        '''
+        Look up a value.
+
+        @param key: The key to look up.
+
+        @return: The value, or None if the key is not in the cache or has
+        expired.
+        '''
+        self.__lock.acquire()
+        try:
+            entry = self.__lookup(key)
+            if (entry == None):
+                return None
+            return entry.value
+        finally:
+            self.__lock.release()
+
+
+    @contextmanager
+    def pinned(self, key):
+        '''
+        Look up a value, and keep it from being wiped while it is in use.
+        This is a context manager::
+
+            with cache.pinned(key) as value:
+                if (value != None):
+                    ...
+
+        The entry may still be evicted while pinned, but the value will not
+        be wiped until the C{with} block ends.
+
+        @param key: The key to look up.
+        '''
+        self.__lock.acquire()
+        try:
+            entry = self.__lookup(key)
+            if (entry != None):
+                entry.pins += 1
+        finally:
+            self.__lock.release()
+
+        if (entry == None):
+            yield None
+            return
+        try:
+            yield entry.value
+        finally:
+            self.__lock.acquire()
+            try:
+                entry.pins -= 1
+                if ((entry.pins == 0) and entry.dead):
+                    self.__wipeEntry(entry)
+            finally:
+                self.__lock.release()
+
+
+    def put(self, key, value):
+        '''
+        Add a value to the cache, replacing any existing value for the key.
+        Least-recently used entries are evicted to make room.  A value that is
+        larger than maxBytes is wiped immediately, and not stored.
+
+        @param key: The key to store the value under.
+
+        @param value: The value to store.
+        '''
+        self.__lock.acquire()
+        try:
+            self.__put(key, value)
+        finally:
+            self.__lock.release()
+
+
+    @contextmanager
+    def putPinned(self, key, value):
+        '''
+        Add a value to the cache (see L{put}), and keep it from being wiped
+        while it is in use, as if L{pinned} had been called.  This is a
+        context manager, which gives the value, or None if the value was too
+        large to store (in which case it has been wiped).
+
+        @param key: The key to store the value under.
+
+        @param value: The value to store.
+        '''
+        self.__lock.acquire()
+        try:
+            entry = self.__put(key, value)
+            if (entry != None):
+                entry.pins += 1
+        finally:
+            self.__lock.release()
+
+        if (entry == None):
+            yield None
+            return
+        try:
+            yield value
+        finally:
+            self.__lock.acquire()
+            try:
+                entry.pins -= 1
+                if ((entry.pins == 0) and entry.dead):
+                    self.__wipeEntry(entry)
+            finally:
+                self.__lock.release()
+
+
+    def __put(self, key, value):
+        # Store a value.  Must be called with the lock held.  Returns the new
+        # entry, or None if the value was too large.
+        if (self.maxBytes != None):
+            size = len(value)
+        else:
+            size = 0
+
+        if (key in self.__entries):
+            self.__remove(self.__entries[key])
+        if ((self.maxBytes != None) and (size > self.maxBytes)):
+            self.wipes += 1
+            self.__wipe(value)
+            return None
+
+        entry = _K2CacheEntry()
+        entry.key = key
+        entry.value = value
+        entry.size = size
+        entry.expires = self.__clock() + self.ttl
+        entry.pins = 0
+        entry.dead = False
+        self.__entries[key] = entry
+        self.__size += size
+        self.__link(entry)
+
+        # Evict from the least-recently-used end until we fit.  The new
+        # entry is the most-recently used, so it is only evicted if
+        # maxEntries was lowered to nothing.
+        while (   (len(self.__entries) > self.maxEntries)
+               or (    (self.maxBytes != None)
+                   and (self.__size > self.maxBytes))
+               ):
+            self.__remove(self.__root.next)
+        return entry
+
+
+    def discard(self, key):
+        '''
+        Remove and wipe a value, if it is in the cache.
+
+        @param key: The key to remove.
+        '''
+        self.__lock.acquire()
+        try:
+            if (key in self.__entries):
+                self.__remove(self.__entries[key])
+        finally:
+            self.__lock.release()
+
+
+    def expire(self):
+        '''
+        Remove and wipe every entry that has expired.  Expired entries are
+        also removed when they are looked up, so this only needs to be called
+        to make sure that sensitive data does not linger.
+        '''
+        now = self.__clock()
+        self.__lock.acquire()
+        try:
+            for entry in self.__entries.values():
+                if (entry.expires <= now):
+                    self.__remove(entry)
+        finally:
+            self.__lock.release()
+
+
+    def clear(self):
+        '''
+        Remove and wipe every entry.  This should be called at shutdown.
+        '''
+        self.__lock.acquire()
+        try:
+            for entry in self.__entries.values():
+                self.__remove(entry)
+        finally:
+            self.__lock.release()
+
+
+    def __lookup(self, key):
+        # Must be called with the lock held.  Returns a valid entry (moving it
+        # to the most-recently-used end), or None.
+        entry = self.__entries.get(key)
+        if (entry == None):
+            self.misses += 1
+            return None
+        if (entry.expires <= self.__clock()):
+            self.__remove(entry)
+            self.misses += 1
+            return None
+        self.__unlink(entry)
+        self.__link(entry)
+        self.hits += 1
+        return entry
+
+
+    def __link(self, entry):
+        # Add an entry at the most-recently-used end
+        last = self.__root.prev
+        entry.prev = last
+        entry.next = self.__root
+        last.next = entry
+        self.__root.prev = entry
+
+
+    @staticmethod
+    def __unlink(entry):
+        entry.prev.next = entry.next
+        entry.next.prev = entry.prev
+
+
+    def __remove(self, entry):
+        # Must be called with the lock held
+        self.__unlink(entry)
+        del self.__entries[entry.key]
+        self.__size -= entry.size
+        entry.dead = True
+        if (entry.pins == 0):
+            self.__wipeEntry(entry)
+
+
+    def __wipeEntry(self, entry):
+        self.wipes += 1
+        self.__wipe(entry.value)
+        entry.value = None
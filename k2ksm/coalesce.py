@@ -0,0 +1,147 @@
+'''
+Coalescing of duplicate AUTH requests, for the public component.  Clients
+with short timeouts (PAM modules, for example) often send the same
+C{AUTH module username code} again while the first attempt is still being
+checked.  Passing each copy to the private component wastes a verification,
+and the copies after the first would fail replay protection, so a user could
+be told NOK for a code that was accepted.
+
+Instead, identical requests that are in flight at the same time share one
+call to the private component, and every one of them gets its result.  Only
+requests that are in flight together are shared: once the call finishes, the
+next identical request goes to the private component as usual, so replay
+protection still applies.
+'''
+
+from .exceptions import K2TimeoutError
+from .logger import K2Logger
+from .metrics import K2Metrics
+from .singleflight import K2SingleFlight
+
+
+
+K2_COALESCE_MAX_IN_FLIGHT = 1024
+'''
+The default most distinct AUTH requests that can be in flight.  Requests
+beyond this are sent on their own.
+'''
+
+K2_COALESCE_TIMEOUT = 10
+'''The default most seconds a duplicate request waits for the first.'''
+
+
+
+class K2AuthCoalescer(object):
+    '''
+    K2AuthCoalescer sends AUTH requests to the private component, sharing the
+    result of identical requests that are in flight at the same time.  It is
+    safe to use from multiple threads.
+
+    @ivar flights: The table of requests in flight.
+    @type flights: K2SingleFlight
+
+    @ivar timeout: The most seconds a duplicate request waits for the first.
+    @type timeout: Float
+
+    @ivar logger: A Logger object that we can use.
+    @type logger: logging.Logger
+    '''
+
+
+    def __init__(self, logger, verify, maxInFlight=K2_COALESCE_MAX_IN_FLIGHT,
+                 timeout=K2_COALESCE_TIMEOUT, metrics=None):
+        '''
+        Create a coalescer.
+
+        @param logger: A K2Logger object, which we can use to create a
+        logging.logger object for ourselves.
+        @type logger: K2Logger
+
+        @param verify: The function that sends an AUTH request to the private
+        component.  It is given the module, the (lowercased) username and the
+        code, and returns the result.
+        @type verify: Function
+
+        @param maxInFlight: The most distinct requests that can be in flight.
+        @type maxInFlight: Integer
+
+        @param timeout: The most seconds a duplicate request waits for the
+        first.
+        @type timeout: Float
+
+        @param metrics: If provided, the number of requests that were sent,
+        shared, not shared because the table was full, and timed out, are
+        reported here.
+        @type metrics: K2Metrics
+
+        @raise TypeError: Thrown if logger is not a K2Logger object, or if
+        metrics is not a K2Metrics object.
+
+        @raise ValueError: Thrown if maxInFlight is less than 1.
+        '''
+        if (not isinstance(logger, K2Logger)):
+            raise TypeError('logger must be a K2Logger object')
+        self.logger = logger.loggerForModule('Coalesce')
+        self.flights = K2SingleFlight(maxInFlight)
+        self.timeout = timeout
+        self.__verify = verify
+
+        if (metrics != None):
+            if (not isinstance(metrics, K2Metrics)):
+                raise TypeError('metrics must be a K2Metrics object')
+            flights = self.flights
+            counter = metrics.counter('k2ksm_auth_coalescing_total',
+                                      'AUTH requests sent to the private '
+                                      'component, or shared with an '
+                                      'identical request.', ('result',))
+            counter.labels('sent').setFunction(lambda: flights.calls)
+            counter.labels('shared').setFunction(lambda: flights.shared)
+            counter.labels('overflow').setFunction(lambda: flights.overflows)
+            counter.labels('timeout').setFunction(lambda: flights.timeouts)
+            inFlight = metrics.gauge('k2ksm_auth_in_flight',
+                                     'Distinct AUTH requests in flight.')
+            inFlight.setFunction(lambda: len(flights))
+
+
+    def auth(self, module, username, code):
+        '''
+        Check an AUTH request.
+
+        @param module: The module, such as "TOTP".  Module names are
+        case-sensitive.
+        @type module: String
+
+        @param username: The username.  It is lowercased.
+        @type username: String
+
+        @param code: The code.
+        @type code: String
+
+        @return: The result from the private component.
+
+        @raise K2TimeoutError: Thrown if this was a duplicate request, and the
+        first request took longer than the timeout.
+        '''
+        username = username.lower()
+        verify = self.__verify
+        try:
+            return self.flights.do((module, username, code),
+                                   lambda: verify(module, username, code),
+                                   self.timeout)
+        except K2TimeoutError:
+            self.logger.warning('AUTH %s %s timed out' %
+                                (module, username))
+            raise
+
+
+    @property
+    def ratio(self):
+        '''
+        The fraction of AUTH requests that shared another request's result,
+        from 0 to 1.
+        '''
+        flights = self.flights
+        total = flights.calls + flights.shared
+        if (total == 0):
+            return 0.0
+        return float(flights.shared) / total
@@ -0,0 +1,430 @@
+'''
+K2DB is the storage layer used by the private component.  Everything is kept
+in a single SQLite database, which lives on the encrypted database image (see
+docs/security.txt).
+'''
+
+import sqlite3
+from time import time
+from .grants import K2GrantTable
+from .logger import K2Logger
+
+
+
+K2_DEFAULT_DB = ':memory:'
+'''
+This is the default database location.  The in-memory default is only useful
+for testing; the server should always be given a real path.
+'''
+
+
+
+class K2DB(object):
+    '''
+    K2DB wraps the SQLite connection used by the private component.  Methods
+    that write to the database handle their own transactions, so that callers
+    never see a half-committed change.
+
+    @ivar connection: The underlying sqlite3 connection.
+    @type connection: sqlite3.Connection
+
+    @ivar grants: Every link between a key and a module, kept in memory so
+    that they can be checked without a query.
+    @type grants: K2GrantTable
+
+    @ivar keyCache: If set, the user's cached key for a module is discarded
+    whenever a key is linked to or unlinked from that module, so a revoked
+    link takes effect at once.
+    @type keyCache: K2KeyCache
+
+    @ivar logger: A Logger object that we can use.
+    @type logger: logging.Logger
+
+    @ivar path: The path to the database file.
+    @type path: String
+    '''
+
+
+    def __init__(self, logger, path=K2_DEFAULT_DB):
+        '''
+        Open (and, if needed, create) the database.
+
+        @param logger: A K2Logger object, which we can use to create a
+        logging.logger object for ourselves.
+        @type logger: K2Logger
+
+        @param path: The path to the SQLite database file.  If not provided,
+        L{K2_DEFAULT_DB} is used.
+        @type path: String
+
+        @raise TypeError: Thrown if logger is not a K2Logger object.
+        '''
+        if (not isinstance(logger, K2Logger)):
+            raise TypeError('logger must be a K2Logger object')
+        self.logger = logger.loggerForModule('DB')
+
+        self.path = path
+        self.keyCache = None
+        self.connection = sqlite3.connect(self.path)
+        self.logger.info('Opened database ' + self.path)
+        self.createSchema()
+        self.grants = K2GrantTable(self.links())
+        self.logger.info('Loaded %d key links' % len(self.grants))
+
+
+    def createSchema(self):
+        '''
+        Create any tables that do not already exist.  This is safe to call on
+        a database that has already been set up.
+        '''
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+            INSERT OR IGNORE INTO counters (name, value) VALUES ('lsn', 0);
+            CREATE TABLE IF NOT EXISTS users (
+                uid INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT NOT NULL UNIQUE,
+                givenName TEXT,
+                surname TEXT,
+                lsn INTEGER NOT NULL,
+                modified REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS users_lsn ON users (lsn);
+            CREATE TABLE IF NOT EXISTS keys (
+                keyID INTEGER PRIMARY KEY AUTOINCREMENT,
+                uid INTEGER NOT NULL REFERENCES users (uid),
+                keyType TEXT NOT NULL,
+                created REAL NOT NULL,
+                material BLOB NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS keys_uid ON keys (uid);
+            CREATE TABLE IF NOT EXISTS links (
+                keyID INTEGER NOT NULL REFERENCES keys (keyID),
+                module TEXT NOT NULL,
+                PRIMARY KEY (keyID, module)
+            );
+            CREATE TABLE IF NOT EXISTS imports (
+                importID TEXT PRIMARY KEY,
+                lastRecord INTEGER NOT NULL
+            );
+        ''')
+        self.connection.commit()
+
+
+    def currentLSN(self):
+        '''
+        Returns the current log sequence number (LSN).  Every transaction that
+        changes a user, or one of the user's keys or links, gets a new LSN,
+        and the user's record is stamped with it.  Clients doing incremental
+        exports pass the LSN from their last export to get only the users that
+        have changed since then.
+
+        @rtype: Integer
+        @return: The most recently-assigned LSN, or 0 if nothing has been
+        written yet.
+        '''
+        return self.connection.execute(
+            "SELECT value FROM counters WHERE name = 'lsn'").fetchone()[0]
+
+
+    @staticmethod
+    def nextLSN(cursor):
+        '''
+        Assign a new LSN.  This must be called inside the transaction that
+        will use the LSN.
+
+        @param cursor: A cursor in the current transaction.
+        @type cursor: sqlite3.Cursor
+
+        @rtype: Integer
+        @return: The new LSN.
+        '''
+        cursor.execute("UPDATE counters SET value = value + 1 "
+                       "WHERE name = 'lsn'")
+        cursor.execute("SELECT value FROM counters WHERE name = 'lsn'")
+        return cursor.fetchone()[0]
+
+
+    def importCheckpoint(self, importID):
+        '''
+        Returns the number of the last record committed by a bulk import.
+
+        @param importID: The client-chosen ID of the import.
+        @type importID: String
+
+        @rtype: Integer
+        @return: The last committed record number, or 0 if nothing from this
+        import has been committed yet.
+        '''
+        row = self.connection.execute(
+            'SELECT lastRecord FROM imports WHERE importID = ?',
+            (importID,)).fetchone()
+        if (row == None):
+            return 0
+        return row[0]
+
+
+    def createUsers(self, users, importID=None, lastRecord=None):
+        '''
+        Create a batch of users in a single transaction.  If an import ID is
+        given, the import's checkpoint is moved forward in the same
+        transaction, so the checkpoint never runs ahead of (or behind) the
+        users that were actually stored.
+
+        A user that can not be stored (for example, because the username is
+        already taken) does not abort the batch; it is reported in the
+        results instead.
+
+        @param users: A sequence of hashes, each with the keys "Username",
+        and optionally "GivenName" and "Surname".
+        @type users: List
+
+        @param importID: If this batch is part of a bulk import, the ID of the
+        import.
+        @type importID: String
+
+        @param lastRecord: If this batch is part of a bulk import, the record
+        number of the last record in the batch.
+        @type lastRecord: Integer
+
+        @rtype: List
+        @return: One entry per user, in order.  Each entry is the new user's
+        UID, or None if the username was already taken.
+        '''
+        results = []
+        cursor = self.connection.cursor()
+        try:
+            lsn = self.nextLSN(cursor)
+            now = time()
+            for user in users:
+                try:
+                    cursor.execute(
+                        'INSERT INTO users (username, givenName, surname, '
+                        'lsn, modified) VALUES (?, ?, ?, ?, ?)',
+                        (user['Username'], user.get('GivenName'),
+                         user.get('Surname'), lsn, now))
+                    results.append(cursor.lastrowid)
+                except sqlite3.IntegrityError:
+                    results.append(None)
+            if (importID != None):
+                cursor.execute(
+                    'INSERT OR REPLACE INTO imports (importID, lastRecord) '
+                    'VALUES (?, ?)', (importID, lastRecord))
+            self.connection.commit()
+        except:
+            self.connection.rollback()
+            raise
+        self.logger.debug('Committed batch of %d users' % len(results))
+        return results
+
+
+    def createKey(self, uid, keyType, material):
+        '''
+        Store a new key for a user.
+
+        @param uid: The UID of the user who owns the key.
+        @type uid: Integer
+
+        @param keyType: The type of key, such as "AES128" or "AES256".
+        @type keyType: String
+
+        @param material: The key itself.
+        @type material: String
+
+        @rtype: Integer
+        @return: The new key's ID.
+        '''
+        cursor = self.connection.cursor()
+        try:
+            lsn = self.nextLSN(cursor)
+            now = time()
+            cursor.execute(
+                'INSERT INTO keys (uid, keyType, created, material) '
+                'VALUES (?, ?, ?, ?)',
+                (uid, keyType, now, sqlite3.Binary(material)))
+            keyID = cursor.lastrowid
+            self.touchUser(cursor, uid, lsn, now)
+            self.connection.commit()
+        except:
+            self.connection.rollback()
+            raise
+        return keyID
+
+
+    def linkKey(self, keyID, module):
+        '''
+        Associate a key with a module, so that the module may use the key.
+
+        @param keyID: The ID of the key.
+        @type keyID: Integer
+
+        @param module: The module ID, such as "TOTP".
+        @type module: String
+
+        @raise KeyError: Thrown if the key does not exist.
+        '''
+        cursor = self.connection.cursor()
+        try:
+            row = cursor.execute('SELECT uid FROM keys WHERE keyID = ?',
+                                 (keyID,)).fetchone()
+            if (row == None):
+                raise KeyError('Key %s does not exist' % keyID)
+            cursor.execute('INSERT OR IGNORE INTO links (keyID, module) '
+                           'VALUES (?, ?)', (keyID, module))
+            self.touchUser(cursor, row[0], self.nextLSN(cursor), time())
+            self.connection.commit()
+        except:
+            self.connection.rollback()
+            raise
+        self.grants.grant(keyID, module)
+        if (self.keyCache != None):
+            self.keyCache.discard(row[0], module)
+
+
+    def unlinkKey(self, keyID, module):
+        '''
+        Remove the association between a key and a module.  Removing an
+        association that does not exist is not an error.
+
+        @param keyID: The ID of the key.
+        @type keyID: Integer
+
+        @param module: The module ID, such as "TOTP".
+        @type module: String
+        '''
+        cursor = self.connection.cursor()
+        try:
+            row = cursor.execute('SELECT uid FROM keys WHERE keyID = ?',
+                                 (keyID,)).fetchone()
+            cursor.execute('DELETE FROM links WHERE keyID = ? AND module = ?',
+                           (keyID, module))
+            if (row != None):
+                self.touchUser(cursor, row[0], self.nextLSN(cursor), time())
+            self.connection.commit()
+        except:
+            self.connection.rollback()
+            raise
+        self.grants.revoke(keyID, module)
+        if ((self.keyCache != None) and (row != None)):
+            self.keyCache.discard(row[0], module)
+
+
+    def links(self):
+        '''
+        Read every link between a key and a module.
+
+        @rtype: Iterator
+        @return: (key ID, module) tuples.
+        '''
+        return self.connection.execute('SELECT keyID, module FROM links')
+
+
+    def keyMaterial(self, uid, module):
+        '''
+        Read the key that a user has linked to a module.  This checks both
+        that the key belongs to the user, and that it is linked to the module.
+        If the user has more than one such key, the newest is used.  Links
+        are checked in L{grants}, rather than in the database.
+
+        @param uid: The UID of the user.
+        @type uid: Integer
+
+        @param module: The module ID, such as "TOTP".
+        @type module: String
+
+        @rtype: bytearray
+        @return: The key, or None if the user has no key linked to the
+        module.
+        '''
+        granted = self.grants.granted
+        for (keyID,) in self.connection.execute(
+                'SELECT keyID FROM keys WHERE uid = ? '
+                'ORDER BY created DESC, keyID DESC', (uid,)):
+            if (granted(keyID, module)):
+                break
+        else:
+            return None
+        row = self.connection.execute(
+            'SELECT material FROM keys WHERE keyID = ?', (keyID,)).fetchone()
+        return bytearray(row[0])
+
+
+    @staticmethod
+    def touchUser(cursor, uid, lsn, now):
+        '''
+        Stamp a user with a new LSN and modification time, because the user
+        or something belonging to the user has changed.
+
+        @param cursor: A cursor in the current transaction.
+        @type cursor: sqlite3.Cursor
+        '''
+        cursor.execute('UPDATE users SET lsn = ?, modified = ? WHERE uid = ?',
+                       (lsn, now, uid))
+
+
+    def exportUsers(self, module=None, sinceLSN=None, sinceTime=None,
+                    untilLSN=None):
+        '''
+        Iterate over users and the metadata of their keys.  Key material is
+        never read.  Rows are produced straight from the database cursor, so
+        the full result is never held in memory.
+
+        One row is produced for each of the user's keys (or a single row,
+        with the key columns set to None, if the user has no keys), ordered by
+        UID and then key ID.  Each row has the columns uid, username,
+        givenName, surname, lsn, modified, keyID, keyType, created, and
+        modules (a space-separated list of the modules linked to the key).
+
+        @param module: If given, only users with at least one key linked to
+        this module are included.
+        @type module: String
+
+        @param sinceLSN: If given, only users changed after this LSN are
+        included.
+        @type sinceLSN: Integer
+
+        @param sinceTime: If given, only users changed after this time (in
+        seconds since the epoch) are included.
+        @type sinceTime: Float
+
+        @param untilLSN: If given, users changed after this LSN are left out.
+        This keeps an export consistent while writes are still happening.
+        @type untilLSN: Integer
+
+        @rtype: Iterator
+        @return: An iterator of row tuples.
+        '''
+        where = []
+        params = []
+        if (module != None):
+            where.append('u.uid IN (SELECT k2.uid FROM keys k2 JOIN links l2 '
+                         'ON l2.keyID = k2.keyID WHERE l2.module = ?)')
+            params.append(module)
+        if (sinceLSN != None):
+            where.append('u.lsn > ?')
+            params.append(sinceLSN)
+        if (sinceTime != None):
+            where.append('u.modified > ?')
+            params.append(sinceTime)
+        if (untilLSN != None):
+            where.append('u.lsn <= ?')
+            params.append(untilLSN)
+
+        query = ('SELECT u.uid, u.username, u.givenName, u.surname, u.lsn, '
+                 'u.modified, k.keyID, k.keyType, k.created, '
+                 "(SELECT group_concat(l.module, ' ') FROM links l "
+                 'WHERE l.keyID = k.keyID) '
+                 'FROM users u LEFT JOIN keys k ON k.uid = u.uid')
+        if (len(where) > 0):
+            query += ' WHERE ' + ' AND '.join(where)
+        query += ' ORDER BY u.uid, k.keyID'
+        return self.connection.cursor().execute(query, params)
+
+
+    def close(self):
+        '''
+        Close the database connection.
+        '''
+        self.connection.close()
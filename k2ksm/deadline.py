@@ -0,0 +1,156 @@
+'''
+Request deadlines.  When the public component passes a request to the private
+component, it stamps the request with an absolute deadline: the time it was
+received, plus the RequestTimeout setting of the K2KSM module.  The private
+component drops any request whose deadline has passed before it does any
+work (see L{K2Scheduler}), and the public component stops waiting at the
+deadline and answers the client with L{K2_TIMED_OUT}.
+
+Deadlines are times since the epoch, as returned by C{time.time()}.  Both
+components run on the same machine (see docs/security.txt), so they share a
+clock.
+
+A stamped request line starts with L{K2_DEADLINE_PREFIX} and the deadline,
+followed by a space and the request itself::
+
+    @1400000002.500000 AUTH TOTP smithj 123456
+'''
+
+from threading import Event
+from time import time
+from .protocol.encoder import register
+
+
+
+K2_DEADLINE_PREFIX = '@'
+'''The first character of a request line that carries a deadline.'''
+
+K2_TIMED_OUT = register('K2KSM', '1', 'The request was not finished in time.')
+'''The response to a request whose deadline passed.'''
+
+
+
+def deadlineFor(timeout, clock=time):
+    '''
+    Work out the deadline for a request that is being received now.
+
+    @param timeout: The number of seconds the request may take, normally the
+    RequestTimeout setting.
+    @type timeout: Float
+
+    @param clock: Returns the current time, in seconds.  Used for testing.
+    @type clock: Function
+
+    @rtype: Float
+    @return: The deadline.
+    '''
+    return clock() + float(timeout)
+
+
+def expired(deadline, clock=time):
+    '''
+    Check whether a deadline has passed.
+
+    @param deadline: The deadline, or None for no deadline.
+    @type deadline: Float
+
+    @param clock: Returns the current time, in seconds.  Used for testing.
+    @type clock: Function
+
+    @rtype: Boolean
+    '''
+    return ((deadline != None) and (clock() >= deadline))
+
+
+def stamp(line, deadline):
+    '''
+    Add a deadline to a request line.
+
+    @param line: The request line, without a newline.
+    @type line: String
+
+    @param deadline: The deadline.
+    @type deadline: Float
+
+    @rtype: String
+    @return: The stamped line.
+    '''
+    return '%s%.6f %s' % (K2_DEADLINE_PREFIX, deadline, line)
+
+
+def unstamp(line):
+    '''
+    Split the deadline from a request line.
+
+    @param line: The request line, which may or may not be stamped.
+    @type line: String
+
+    @rtype: Tuple
+    @return: The deadline (or None, if the line was not stamped) and the
+    request line.
+
+    @raise ValueError: Thrown if the line is stamped, but the deadline can
+    not be read.
+    '''
+    if (not line.startswith(K2_DEADLINE_PREFIX)):
+        return (None, line)
+    (deadline, sep, rest) = line[len(K2_DEADLINE_PREFIX):].partition(' ')
+    if (sep == ''):
+        raise ValueError('Stamped request has no command')
+    return (float(deadline), rest)
+
+
+
+class K2PendingReply(object):
+    '''
+    K2PendingReply is used by the public component to wait for the private
+    component's response to one request, up to the request's deadline.
+
+    @ivar deadline: The request's deadline.
+    @type deadline: Float
+    '''
+
+
+    def __init__(self, deadline, clock=time):
+        '''
+        Start waiting for a response.
+
+        @param deadline: The request's deadline.
+        @type deadline: Float
+
+        @param clock: Returns the current time, in seconds.  Used for testing.
+        @type clock: Function
+        '''
+        self.deadline = deadline
+        self.__clock = clock
+        self.__event = Event()
+        self.__response = None
+
+
+    def set(self, response):
+        '''
+        Record the response.  This is called by the thread reading from the
+        private component, and may be called after the deadline has passed,
+        in which case the response is thrown away.
+
+        @param response: The response.
+        @type response: String
+        '''
+        self.__response = response
+        self.__event.set()
+
+
+    def wait(self):
+        '''
+        Wait for the response.
+
+        @rtype: String
+        @return: The response, or L{K2_TIMED_OUT} if it did not arrive before
+        the deadline.
+        '''
+        remaining = self.deadline - self.__clock()
+        if ((remaining > 0) and (not self.__event.isSet())):
+            self.__event.wait(remaining)
+        if (not self.__event.isSet()):
+            return K2_TIMED_OUT
+        return self.__response
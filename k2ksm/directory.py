@@ -0,0 +1,502 @@
+'''
+Directory (AD or LDAP) lookups, for the internal component.  Opening a
+connection and binding for every lookup would hold up AUTH and USER commands,
+so connections are kept in a small pool and re-used.  Results are cached,
+including "no such user" results (for a shorter time), and identical
+lookups that arrive while one is already running share its result.  Every
+step has a short timeout, so that a slow or missing directory server fails
+quickly instead of tying up the component.
+
+Connections are made by a connect function, which is given the timeout, and
+returns an object with these methods:
+
+    - C{search(base, filter, attributes, timeout)}, which returns a list of
+      (DN, attributes) tuples, where the attributes are a hash of lists.  If
+      the search matches more than one entry, it may raise K2AmbiguousError
+      instead.
+    - C{close()}
+
+L{ldapConnector} makes a connect function that uses the python-ldap package.
+If python-ldap is not installed, its connections raise NotImplementedError.
+'''
+
+from contextlib import contextmanager
+from threading import Condition
+from time import time
+from .cache import K2Cache
+from .exceptions import K2AmbiguousError, K2DirectoryError, K2TimeoutError
+from .logger import K2Logger
+from .metrics import K2Metrics
+from .singleflight import K2SingleFlight
+
+try:
+    import ldap
+except ImportError:
+    ldap = None
+
+
+
+K2_DIRECTORY_POOL_SIZE = 4
+'''The default number of connections kept open to the directory server.'''
+
+K2_DIRECTORY_TIMEOUT = 2
+'''The default number of seconds to wait for a connection, bind or search.'''
+
+K2_DIRECTORY_POSITIVE_TTL = 300
+'''The default number of seconds that a found user stays cached.'''
+
+K2_DIRECTORY_NEGATIVE_TTL = 30
+'''The default number of seconds that a missing user stays cached.'''
+
+K2_DIRECTORY_CACHE_ENTRIES = 10000
+'''The default maximum number of cached lookups, of each kind.'''
+
+K2_DIRECTORY_USER_FILTER = '(sAMAccountName=%s)'
+'''The default search filter for users.  %s is replaced by the username.'''
+
+K2_DIRECTORY_ATTRIBUTES = ('givenName', 'sn', 'mail')
+'''The default attributes read for each user.'''
+
+
+
+def escapeFilter(value):
+    '''
+    Escape a value for use in an LDAP search filter, as described in RFC
+    4515.
+
+    @param value: The value to escape.
+    @type value: String
+
+    @rtype: String
+    @return: The escaped value.
+    '''
+    value = value.replace('\\', '\\5c')
+    for (char, escaped) in (('*', '\\2a'), ('(', '\\28'), (')', '\\29'),
+                            ('\0', '\\00')):
+        value = value.replace(char, escaped)
+    return value
+
+
+
+class _K2LDAPConnection(object):
+    '''
+    A connection to a directory server, made with python-ldap.
+    '''
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def search(self, base, filter, attributes, timeout):
+        try:
+            results = self.connection.search_ext_s(
+                base, ldap.SCOPE_SUBTREE, filter, list(attributes),
+                timeout=timeout, sizelimit=2)
+        except ldap.TIMEOUT:
+            raise K2TimeoutError('Directory search timed out')
+        except ldap.SIZELIMIT_EXCEEDED:
+            raise K2AmbiguousError('Search matched more than one entry')
+        except ldap.LDAPError as e:
+            raise K2DirectoryError(str(e))
+        return results
+
+    def close(self):
+        try:
+            self.connection.unbind_s()
+        except ldap.LDAPError:
+            pass
+
+
+def ldapConnector(uri, bindDN='', password=''):
+    '''
+    Make a connect function that connects to a directory server using the
+    python-ldap package.
+
+    @param uri: The server's URI, such as "ldaps://ad.example.com".
+    @type uri: String
+
+    @param bindDN: The DN to bind as.  If empty, an anonymous bind is done.
+    @type bindDN: String
+
+    @param password: The password for bindDN.
+    @type password: String
+
+    @rtype: Function
+    @return: A function which takes a timeout, and returns a connection.
+    '''
+    def connect(timeout):
+        if (ldap == None):
+            raise NotImplementedError('python-ldap is needed to connect to '
+                                      'a directory')
+        connection = ldap.initialize(uri)
+        connection.set_option(ldap.OPT_NETWORK_TIMEOUT, timeout)
+        connection.set_option(ldap.OPT_TIMEOUT, timeout)
+        connection.set_option(ldap.OPT_REFERRALS, 0)
+        try:
+            connection.simple_bind_s(bindDN, password)
+        except ldap.TIMEOUT:
+            raise K2TimeoutError('Timed out binding to ' + uri)
+        except ldap.LDAPError as e:
+            raise K2DirectoryError('Could not bind to %s: %s' % (uri, e))
+        return _K2LDAPConnection(connection)
+    return connect
+
+
+
+class K2DirectoryPool(object):
+    '''
+    K2DirectoryPool keeps up to a fixed number of connections to a directory
+    server.  Connections are opened as they are needed, and are kept open
+    for re-use, unless they were being used when an error happened.  It is
+    safe to use from multiple threads.
+
+    @ivar size: The most connections that can be open at once.
+    @type size: Integer
+
+    @ivar timeout: The most seconds to wait for a free connection.
+    @type timeout: Float
+
+    @ivar opened: The number of connections that have been opened.
+    @type opened: Integer
+
+    @ivar timeouts: The number of times no connection was free in time.
+    @type timeouts: Integer
+    '''
+
+
+    def __init__(self, connect, size=K2_DIRECTORY_POOL_SIZE,
+                 timeout=K2_DIRECTORY_TIMEOUT, clock=time):
+        '''
+        Create an empty pool.
+
+        @param connect: The function used to open a connection.  It is given
+        the timeout.
+        @type connect: Function
+
+        @param size: The most connections that can be open at once.
+        @type size: Integer
+
+        @param timeout: The most seconds to wait for a free connection.
+        @type timeout: Float
+
+        @param clock: Returns the current time, in seconds.  Used for testing.
+        @type clock: Function
+
+        @raise ValueError: Thrown if size is less than 1, or timeout is not
+        positive.
+        '''
+        if (size < 1):
+            raise ValueError('size must be at least 1')
+        if (timeout <= 0):
+            raise ValueError('timeout must be positive')
+        self.size = size
+        self.timeout = timeout
+        self.opened = 0
+        self.timeouts = 0
+        self.__connect = connect
+        self.__clock = clock
+        self.__condition = Condition()
+        self.__idle = []
+        self.__open = 0
+        self.__closed = False
+
+
+    @contextmanager
+    def connection(self):
+        '''
+        Get a connection for the length of a C{with} block.  If the block
+        raises an exception, the connection is closed rather than being put
+        back in the pool.
+
+        @raise K2TimeoutError: Thrown if no connection was free in time.
+
+        @raise K2DirectoryError: Thrown if the pool has been closed.
+        '''
+        deadline = self.__clock() + self.timeout
+        self.__condition.acquire()
+        try:
+            while (True):
+                if (self.__closed):
+                    raise K2DirectoryError('The directory pool is closed')
+                if ((len(self.__idle) > 0) or (self.__open < self.size)):
+                    break
+                remaining = deadline - self.__clock()
+                if (remaining <= 0):
+                    self.timeouts += 1
+                    raise K2TimeoutError('No directory connection free after '
+                                         '%s seconds' % self.timeout)
+                self.__condition.wait(remaining)
+            if (len(self.__idle) > 0):
+                connection = self.__idle.pop()
+            else:
+                connection = None
+                self.__open += 1
+        finally:
+            self.__condition.release()
+
+        if (connection == None):
+            try:
+                connection = self.__connect(self.timeout)
+            except:
+                self.__release(None)
+                raise
+            self.opened += 1
+
+        try:
+            yield connection
+        except:
+            self.__release(None)
+            try:
+                connection.close()
+            except Exception:
+                pass
+            raise
+        self.__release(connection)
+
+
+    def __release(self, connection):
+        # Put a connection back, or (if it is None) give up its slot.  Once
+        # the pool is closed, returned connections are closed instead.
+        self.__condition.acquire()
+        try:
+            if ((connection != None) and (not self.__closed)):
+                self.__idle.append(connection)
+                connection = None
+            else:
+                self.__open -= 1
+            self.__condition.notify()
+        finally:
+            self.__condition.release()
+        if (connection != None):
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+
+    def close(self):
+        '''
+        Close every idle connection.  Connections that are in use are closed
+        when they are returned, and no more connections are handed out.
+        '''
+        self.__condition.acquire()
+        try:
+            self.__closed = True
+            idle = self.__idle
+            self.__idle = []
+            self.__open -= len(idle)
+            self.__condition.notifyAll()
+        finally:
+            self.__condition.release()
+        for connection in idle:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+
+
+class K2Directory(object):
+    '''
+    K2Directory looks up users in a directory server.  It is safe to use from
+    multiple threads.
+
+    @ivar pool: The pool of connections to the directory server.
+    @type pool: K2DirectoryPool
+
+    @ivar found: Cached details of users who were found.
+    @type found: K2Cache
+
+    @ivar notFound: Cached usernames that were not found.
+    @type notFound: K2Cache
+
+    @ivar searches: The number of searches sent to the server.
+    @type searches: Integer
+
+    @ivar errors: The number of lookups that failed.
+    @type errors: Integer
+
+    @ivar logger: A Logger object that we can use.
+    @type logger: logging.Logger
+    '''
+
+
+    def __init__(self, logger, connect, base,
+                 userFilter=K2_DIRECTORY_USER_FILTER,
+                 attributes=K2_DIRECTORY_ATTRIBUTES,
+                 poolSize=K2_DIRECTORY_POOL_SIZE,
+                 timeout=K2_DIRECTORY_TIMEOUT,
+                 positiveTTL=K2_DIRECTORY_POSITIVE_TTL,
+                 negativeTTL=K2_DIRECTORY_NEGATIVE_TTL,
+                 maxEntries=K2_DIRECTORY_CACHE_ENTRIES,
+                 metrics=None, clock=time):
+        '''
+        Create a directory client.  No connections are made until the first
+        lookup.
+
+        @param logger: A K2Logger object, which we can use to create a
+        logging.logger object for ourselves.
+        @type logger: K2Logger
+
+        @param connect: The function used to open a connection, such as one
+        made by L{ldapConnector}.
+        @type connect: Function
+
+        @param base: The DN to search under.
+        @type base: String
+
+        @param userFilter: The search filter for users.  %s is replaced by the
+        (escaped) username.
+        @type userFilter: String
+
+        @param attributes: The attributes to read for each user.
+        @type attributes: Tuple
+
+        @param poolSize: The most connections to keep open.
+        @type poolSize: Integer
+
+        @param timeout: The most seconds to wait for a connection or search.
+        @type timeout: Float
+
+        @param positiveTTL: The number of seconds that a found user stays
+        cached.
+        @type positiveTTL: Float
+
+        @param negativeTTL: The number of seconds that a missing user stays
+        cached.
+        @type negativeTTL: Float
+
+        @param maxEntries: The most lookups to cache, of each kind.
+        @type maxEntries: Integer
+
+        @param metrics: If provided, lookup results are reported here.
+        @type metrics: K2Metrics
+
+        @param clock: Returns the current time, in seconds.  Used for testing.
+        @type clock: Function
+
+        @raise TypeError: Thrown if logger is not a K2Logger object, or if
+        metrics is not a K2Metrics object.
+        '''
+        if (not isinstance(logger, K2Logger)):
+            raise TypeError('logger must be a K2Logger object')
+        self.logger = logger.loggerForModule('Directory')
+        self.base = base
+        self.userFilter = userFilter
+        self.attributes = tuple(attributes)
+        self.pool = K2DirectoryPool(connect, poolSize, timeout, clock)
+        self.found = K2Cache(maxEntries, positiveTTL, clock=clock)
+        self.notFound = K2Cache(maxEntries, negativeTTL, clock=clock)
+        self.searches = 0
+        self.errors = 0
+        self.__flight = K2SingleFlight()
+
+        if (metrics != None):
+            if (not isinstance(metrics, K2Metrics)):
+                raise TypeError('metrics must be a K2Metrics object')
+            counter = metrics.counter('k2ksm_directory_lookups_total',
+                                      'Directory lookups, by how they were '
+                                      'answered.', ('result',))
+            flight = self.__flight
+            counter.labels('hit').setFunction(lambda: self.found.hits)
+            counter.labels('negative_hit').setFunction(
+                lambda: self.notFound.hits)
+            counter.labels('search').setFunction(lambda: self.searches)
+            counter.labels('shared').setFunction(lambda: flight.shared)
+            counter.labels('error').setFunction(lambda: self.errors)
+
+
+    def lookupUser(self, username):
+        '''
+        Look up a user.
+
+        @param username: The user's username.
+        @type username: String
+
+        @rtype: Hash
+        @return: The user's DN (as "dn"), and the first value of each of the
+        user's attributes.  Attributes the user does not have are left out.
+        Returns None if the user does not exist.
+
+        @raise K2TimeoutError: Thrown if the directory server did not answer
+        in time.
+
+        @raise K2DirectoryError: Thrown if the directory server could not be
+        reached, or returned an error.
+        '''
+        entry = self.found.get(username)
+        if (entry != None):
+            return dict(entry)
+        if (self.notFound.get(username) != None):
+            return None
+
+        # A waiting thread may sit behind both the wait for a connection and
+        # the search, so it gets both timeouts.
+        entry = self.__flight.do(username,
+                                 lambda: self.__search(username),
+                                 2 * self.pool.timeout)
+        if (entry == None):
+            return None
+        return dict(entry)
+
+
+    def __search(self, username):
+        # Search for a user, and cache the result
+        query = self.userFilter % escapeFilter(username)
+        try:
+            with self.pool.connection() as connection:
+                self.searches += 1
+                try:
+                    results = connection.search(self.base, query,
+                                                self.attributes,
+                                                self.pool.timeout)
+                except K2AmbiguousError:
+                    # The connection is still good
+                    results = None
+        except (K2TimeoutError, K2DirectoryError) as e:
+            self.errors += 1
+            self.logger.warning('Lookup of %s failed: %s' % (username, e))
+            raise
+
+        # Skip referrals, which have no DN.  A username that matches more
+        # than one entry is an error, and is never cached as missing.
+        if (results != None):
+            results = [result for result in results if (result[0] != None)]
+            if (len(results) == 0):
+                self.notFound.put(username, True)
+                return None
+        if ((results == None) or (len(results) > 1)):
+            self.errors += 1
+            self.logger.warning('Username %s matches more than one entry'
+                                % username)
+            return None
+
+        (dn, attributes) = results[0]
+        entry = {'dn': dn}
+        for name in self.attributes:
+            values = attributes.get(name)
+            if (values):
+                entry[name] = values[0]
+        self.found.put(username, entry)
+        return entry
+
+
+    def invalidate(self, username):
+        '''
+        Forget any cached lookup of a user.  This should be called when a
+        user is created or changed.
+
+        @param username: The user's username.
+        @type username: String
+        '''
+        self.found.discard(username)
+        self.notFound.discard(username)
+
+
+    def close(self):
+        '''
+        Empty the caches, and close the pool.  Lookups that are not answered
+        from the caches fail after this.
+        '''
+        self.found.clear()
+        self.notFound.clear()
+        self.pool.close()
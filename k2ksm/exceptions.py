@@ -12,3 +12,61 @@ class K2FinalizeError(Exception):
     and the server is now ready to do actual work.
     '''
     pass
+
+
+class K2SchemaError(TypeError):
+    '''
+    This exception is thrown when a module's settings schema is not valid.
+    Since schemas are compiled when the module's settings class is defined,
+    this is normally seen when the module is imported.
+    '''
+    pass
+
+
+class K2SettingsError(ValueError):
+    '''
+    This exception is thrown when a group of settings is loaded into a module,
+    and some of them are not valid.  Every problem found is reported, not just
+    the first one.
+    
+    @ivar moduleID: The ID of the module the settings were for, if known.
+    
+    @ivar errors: A list of (setting name, problem) tuples.
+    '''
+    
+    def __init__(self, errors, moduleID=None):
+        ValueError.__init__(self, errors)
+        self.errors = errors
+        self.moduleID = moduleID
+    
+    def __str__(self):
+        if (self.moduleID == None):
+            prefix = 'Invalid settings: '
+        else:
+            prefix = 'Invalid settings for %s: ' % self.moduleID
+        return prefix + '; '.join(['%s %s' % error for error in self.errors])
+
+
+class K2TimeoutError(Exception):
+    '''
+    This exception is thrown when an operation gives up because it could not
+    be finished in time.  Timeouts are kept short, so that one slow server
+    does not hold up every client.
+    '''
+    pass
+
+
+class K2DirectoryError(IOError):
+    '''
+    This exception is thrown when a directory (AD or LDAP) server can not be
+    reached, or returns an error.
+    '''
+    pass
+
+
+class K2AmbiguousError(K2DirectoryError):
+    '''
+    This exception is thrown by a directory search that matched more than one
+    entry, when the server stopped before returning them all.
+    '''
+    pass
@@ -0,0 +1,142 @@
+'''
+The grant table lets the private component check, without going to storage,
+whether a key has been linked to a module.  When (for example) TOTP asks AES
+for a user's key, AES must make sure that the key has been associated with
+TOTP (see docs/security.txt).  Those associations are managed by the LINK
+command group, and are kept in the database's links table.
+
+The whole links table is read into a K2GrantTable when the database is opened,
+and L{K2DB.linkKey} and L{K2DB.unlinkKey} update the table as soon as their
+transaction commits.  A check is then a single set lookup.
+
+To keep the table small enough for millions of links, each (key ID, module)
+pair is stored as one integer: the key ID, shifted left, with the module's
+index in the low bits.  On a 64-bit build this costs about 58 bytes per
+link; L{K2GrantTable.footprint} measures it.
+'''
+
+from sys import getsizeof
+from threading import Lock
+
+
+
+K2_GRANT_MODULE_BITS = 8
+'''
+The number of bits used for the module's index, so at most 256 different
+modules can be granted keys.
+'''
+
+
+
+class K2GrantTable(object):
+    '''
+    K2GrantTable holds every (key ID, module) link, for fast checking.  It is
+    safe to use from multiple threads.
+    '''
+
+
+    def __init__(self, links=()):
+        '''
+        Create a grant table.
+
+        @param links: The links to start with, as (key ID, module) tuples.
+        Normally this is L{K2DB.links}.
+        @type links: Iterable
+
+        @raise ValueError: Thrown if there are links for too many modules.
+        '''
+        # Module indexes are only ever added, so that a module's index never
+        # changes while grants using it exist.
+        self.__modules = {}
+        self.__lock = Lock()
+        self.__grants = set()
+        encode = self.__encode
+        self.__grants.update(encode(keyID, module)
+                             for (keyID, module) in links)
+
+
+    def __encode(self, keyID, module, add=True):
+        # Pack a key ID and module into one integer.  If add is False, returns
+        # None for a module that has never been granted anything.
+        try:
+            index = self.__modules[module]
+        except KeyError:
+            if (not add):
+                return None
+            self.__lock.acquire()
+            try:
+                if (module not in self.__modules):
+                    if (len(self.__modules) >= (1 << K2_GRANT_MODULE_BITS)):
+                        raise ValueError('Too many modules in the grant '
+                                         'table to add %s' % module)
+                    self.__modules[module] = len(self.__modules)
+                index = self.__modules[module]
+            finally:
+                self.__lock.release()
+        return (keyID << K2_GRANT_MODULE_BITS) | index
+
+
+    def __len__(self):
+        return len(self.__grants)
+
+
+    def granted(self, keyID, module):
+        '''
+        Check whether a key has been linked to a module.
+
+        @param keyID: The ID of the key.
+        @type keyID: Integer
+
+        @param module: The module ID, such as "TOTP".
+        @type module: String
+
+        @rtype: Boolean
+        @return: True if the key may be used by the module.
+        '''
+        grant = self.__encode(keyID, module, False)
+        return ((grant != None) and (grant in self.__grants))
+
+
+    def grant(self, keyID, module):
+        '''
+        Record a link between a key and a module.  Granting an existing link
+        is not an error.
+
+        @param keyID: The ID of the key.
+        @type keyID: Integer
+
+        @param module: The module ID, such as "TOTP".
+        @type module: String
+
+        @raise ValueError: Thrown if the module is new, and the table already
+        has the most modules it can hold.
+        '''
+        self.__grants.add(self.__encode(keyID, module))
+
+
+    def revoke(self, keyID, module):
+        '''
+        Remove a link between a key and a module.  Revoking a link that does
+        not exist is not an error.
+
+        @param keyID: The ID of the key.
+        @type keyID: Integer
+
+        @param module: The module ID, such as "TOTP".
+        @type module: String
+        '''
+        grant = self.__encode(keyID, module, False)
+        if (grant != None):
+            self.__grants.discard(grant)
+
+
+    def footprint(self):
+        '''
+        Measure the memory used by the table.  This walks every grant, so it
+        is slow for large tables, and is meant for benchmarks and diagnostics.
+
+        @rtype: Integer
+        @return: The number of bytes used by the set and the integers in it.
+        '''
+        return getsizeof(self.__grants) + sum(getsizeof(grant)
+                                              for grant in self.__grants)
@@ -0,0 +1,284 @@
+'''
+Handing a running server over to a new process, for upgrades without
+downtime.
+
+The old process creates a L{K2HandoffOffer}, which listens on a UNIX socket,
+and then starts the new process.  The new process calls L{acceptHandoff},
+which connects to that socket.  The old process then sends:
+
+ 1. A header: a 4-byte length (in network byte order), followed by that many
+    bytes of JSON, listing each socket being handed over as
+    C{[name, family, type, proto]}.
+ 2. Each socket's file descriptor, in the same order, using SCM_RIGHTS.
+ 3. The settings of each session, one JSON C{[sessionID, settings]} array per
+    line, ending with a line containing just ".".
+
+The new process replies "OK" once it has adopted everything.  The old process
+should then stop accepting connections, finish any commands in progress, and
+exit.  Since the listening sockets are never closed, new connections simply
+wait in the listen queue while the handoff happens, so clients see a delay
+instead of an error.
+
+The old process must not change any session settings while it is handing
+off, or the changes will be lost.
+'''
+
+import json
+import os
+from select import select
+import socket
+from struct import pack, unpack
+from .logger import K2Logger
+
+try:
+    from _multiprocessing import sendfd, recvfd
+except ImportError:
+    sendfd = None
+    recvfd = None
+
+
+
+K2_HANDOFF_TIMEOUT = 30
+'''The default number of seconds to wait for the other process.'''
+
+K2_HANDOFF_VERSION = 1
+'''The handoff protocol version.'''
+
+
+
+def _recvExactly(connection, length):
+    # Read exactly length bytes, without reading past them
+    data = []
+    while (length > 0):
+        chunk = connection.recv(length)
+        if (chunk == ''):
+            raise EOFError('Handoff connection closed early')
+        data.append(chunk)
+        length -= len(chunk)
+    return ''.join(data)
+
+
+def _waitFor(connection, write=False):
+    # A socket with a timeout is non-blocking underneath, so sendfd and recvfd
+    # (which use the raw descriptor) must wait for it to be ready themselves.
+    if (write):
+        ready = select([], [connection], [], connection.gettimeout())[1]
+    else:
+        ready = select([connection], [], [], connection.gettimeout())[0]
+    if (len(ready) == 0):
+        raise socket.timeout('Timed out passing a file descriptor')
+
+
+
+class K2HandoffOffer(object):
+    '''
+    The old process's side of a handoff.  Creating a K2HandoffOffer starts
+    listening for the new process; L{send} does the handoff.
+
+    @ivar path: The path of the UNIX socket that the new process connects to.
+    @type path: String
+
+    @ivar logger: A Logger object that we can use.
+    @type logger: logging.Logger
+    '''
+
+
+    def __init__(self, logger, path):
+        '''
+        Start listening for the new process.  The socket is only accessible
+        by our own user.
+
+        @param logger: A K2Logger object, which we can use to create a
+        logging.logger object for ourselves.
+        @type logger: K2Logger
+
+        @param path: Where to create the UNIX socket.
+        @type path: String
+
+        @raise TypeError: Thrown if logger is not a K2Logger object.
+
+        @raise NotImplementedError: Thrown if this platform can not pass file
+        descriptors between processes.
+
+        @raise socket.error: Thrown if the socket can not be created.
+        '''
+        if (not isinstance(logger, K2Logger)):
+            raise TypeError('logger must be a K2Logger object')
+        if (sendfd == None):
+            raise NotImplementedError('Passing file descriptors is not '
+                                      'supported on this platform')
+        self.logger = logger.loggerForModule('Handoff')
+        self.path = path
+
+        self.__listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        oldUmask = os.umask(0177)
+        try:
+            self.__listener.bind(path)
+        finally:
+            os.umask(oldUmask)
+        self.__listener.listen(1)
+        self.logger.info('Waiting for handoff on ' + path)
+
+
+    def send(self, sockets, settings, timeout=K2_HANDOFF_TIMEOUT):
+        '''
+        Wait for the new process to connect, and hand everything over.  The
+        listening socket is closed afterwards, whether or not the handoff
+        worked.
+
+        @param sockets: The sockets to hand over, keyed by a name that the new
+        process will recognize (for example "public" or "private").
+        @type sockets: Hash of socket objects
+
+        @param settings: The settings to send the sessions from.
+        @type settings: K2Settings
+
+        @param timeout: The most seconds to wait for each step.
+        @type timeout: Float
+
+        @rtype: Integer
+        @return: The number of sessions sent.
+
+        @raise socket.timeout: Thrown if the new process takes too long.
+
+        @raise IOError: Thrown if the new process does not accept the
+        handoff.
+        '''
+        self.__listener.settimeout(timeout)
+        try:
+            (connection, address) = self.__listener.accept()
+        finally:
+            self.close()
+
+        try:
+            connection.settimeout(timeout)
+            names = sorted(sockets)
+            header = json.dumps({'version': K2_HANDOFF_VERSION,
+                                 'sockets': [[name, sockets[name].family,
+                                              sockets[name].type,
+                                              sockets[name].proto]
+                                             for name in names],
+                                 })
+            connection.sendall(pack('>I', len(header)) + header)
+            for name in names:
+                _waitFor(connection, True)
+                sendfd(connection.fileno(), sockets[name].fileno())
+
+            count = 0
+            stream = connection.makefile('wb')
+            for sessionID in settings.sessionIDs():
+                stream.write(json.dumps([sessionID,
+                                         settings.sessionState(sessionID)]))
+                stream.write("\n")
+                count += 1
+            stream.write(".\n")
+            stream.close()
+
+            reply = connection.makefile('rb').readline().strip()
+            if (reply != 'OK'):
+                raise IOError('New process refused handoff: %r' % reply)
+        finally:
+            connection.close()
+
+        self.logger.info('Handed off %d sockets and %d sessions' %
+                         (len(names), count))
+        return count
+
+
+    def close(self):
+        '''
+        Stop listening, and remove the UNIX socket.
+        '''
+        if (self.__listener != None):
+            self.__listener.close()
+            self.__listener = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+
+
+def acceptHandoff(logger, path, settings, timeout=K2_HANDOFF_TIMEOUT):
+    '''
+    The new process's side of a handoff.  Connect to the old process, and
+    take over its sockets and sessions.
+
+    Sessions are validated with the new process's settings modules.  A
+    session that is not valid any more (for example, because a setting was
+    removed) is logged and dropped; the rest are kept.
+
+    @param logger: A K2Logger object, which we can use to create a
+    logging.logger object for ourselves.
+    @type logger: K2Logger
+
+    @param path: The path of the old process's UNIX socket.
+    @type path: String
+
+    @param settings: The settings to create the sessions in.  All of the
+    modules should already be registered.
+    @type settings: K2Settings
+
+    @param timeout: The most seconds to wait for each step.
+    @type timeout: Float
+
+    @rtype: Tuple
+    @return: A hash of the sockets, keyed by name; and the number of sessions
+    that were created.
+
+    @raise TypeError: Thrown if logger is not a K2Logger object.
+
+    @raise NotImplementedError: Thrown if this platform can not pass file
+    descriptors between processes.
+
+    @raise ValueError: Thrown if the old process uses a different version of
+    the handoff protocol.
+    '''
+    if (not isinstance(logger, K2Logger)):
+        raise TypeError('logger must be a K2Logger object')
+    if (recvfd == None):
+        raise NotImplementedError('Passing file descriptors is not '
+                                  'supported on this platform')
+    log = logger.loggerForModule('Handoff')
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.settimeout(timeout)
+        connection.connect(path)
+
+        # The header and descriptors are read without buffering, so that we
+        # do not read past them
+        length = unpack('>I', _recvExactly(connection, 4))[0]
+        header = json.loads(_recvExactly(connection, length))
+        if (header['version'] != K2_HANDOFF_VERSION):
+            raise ValueError('Handoff version %s is not supported' %
+                             header['version'])
+        sockets = {}
+        for (name, family, type, proto) in header['sockets']:
+            _waitFor(connection)
+            fd = recvfd(connection.fileno())
+            try:
+                sockets[str(name)] = socket.fromfd(fd, family, type, proto)
+            finally:
+                os.close(fd)
+
+        count = 0
+        stream = connection.makefile('rb')
+        for line in stream:
+            line = line.strip()
+            if (line == '.'):
+                break
+            (sessionID, overlay) = json.loads(line)
+            try:
+                settings.restoreSession(sessionID, overlay)
+                count += 1
+            except (KeyError, ValueError) as e:
+                log.warning('Dropping session %s: %s' % (sessionID, e))
+        stream.close()
+
+        connection.sendall("OK\n")
+    finally:
+        connection.close()
+
+    log.info('Took over %d sockets and %d sessions' % (len(sockets), count))
+    return (sockets, count)
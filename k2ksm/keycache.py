@@ -0,0 +1,188 @@
+'''
+A cache of users' keys, for the private component.  When a module such as
+TOTP needs a user's key, the key has to be read from storage, and checked to
+make sure that it belongs to the user and is linked to the module.  Repeat
+users are common, so keys are kept for a short time in a L{K2Cache}, keyed by
+(UID, module).
+
+Keys are kept in bytearrays, and are wiped when they leave the cache, or when
+the cache is cleared at shutdown.  See the "RAM" section of docs/security.txt.
+
+The cache's limits come from the KEYCACHE settings module (see
+L{k2ksm.settings.keycache}).
+'''
+
+from contextlib import contextmanager
+from .cache import K2Cache, wipe
+from .logger import K2Logger
+from .metrics import K2Metrics
+
+
+
+K2_KEYCACHE_ENTRIES = 4096
+'''The default maximum number of cached keys.'''
+
+K2_KEYCACHE_BYTES = 1024 * 1024
+'''The default maximum total size of cached keys.'''
+
+K2_KEYCACHE_TTL = 30
+'''The default number of seconds that a key stays cached.'''
+
+
+
+class K2KeyCache(object):
+    '''
+    K2KeyCache keeps recently-used keys, so that they do not have to be read
+    from storage on every authentication.  It is safe to use from multiple
+    threads.
+
+    @ivar cache: The cache of keys, keyed by (UID, module).
+    @type cache: K2Cache
+
+    @ivar logger: A Logger object that we can use.
+    @type logger: logging.Logger
+    '''
+
+
+    def __init__(self, logger, load, maxEntries=K2_KEYCACHE_ENTRIES,
+                 ttl=K2_KEYCACHE_TTL, maxBytes=K2_KEYCACHE_BYTES,
+                 metrics=None):
+        '''
+        Create an empty key cache.
+
+        @param logger: A K2Logger object, which we can use to create a
+        logging.logger object for ourselves.
+        @type logger: K2Logger
+
+        @param load: The function used to read a key from storage, on a cache
+        miss.  It is given a UID and module ID, and returns the key as a
+        bytearray, or None.  Normally this is L{K2DB.keyMaterial}.
+        @type load: Function
+
+        @param maxEntries: The most keys to cache.
+        @type maxEntries: Integer
+
+        @param ttl: The number of seconds a key stays cached.
+        @type ttl: Float
+
+        @param maxBytes: The largest total size of keys to cache.
+        @type maxBytes: Integer
+
+        @param metrics: If provided, the cache's hits, misses and wipes are
+        reported here.
+        @type metrics: K2Metrics
+
+        @raise TypeError: Thrown if logger is not a K2Logger object, or if
+        metrics is not a K2Metrics object.
+        '''
+        if (not isinstance(logger, K2Logger)):
+            raise TypeError('logger must be a K2Logger object')
+        self.logger = logger.loggerForModule('KeyCache')
+        self.cache = K2Cache(maxEntries, ttl, maxBytes)
+        self.__load = load
+
+        if (metrics != None):
+            if (not isinstance(metrics, K2Metrics)):
+                raise TypeError('metrics must be a K2Metrics object')
+            counter = metrics.counter('k2ksm_keycache_operations_total',
+                                      'Key cache hits, misses and wipes.',
+                                      ('result',))
+            cache = self.cache
+            counter.labels('hit').setFunction(lambda: cache.hits)
+            counter.labels('miss').setFunction(lambda: cache.misses)
+            counter.labels('wipe').setFunction(lambda: cache.wipes)
+
+
+    @contextmanager
+    def key(self, uid, module):
+        '''
+        Get a user's key for a module.  This is a context manager, and the key
+        must only be used inside the C{with} block::
+
+            with keyCache.key(uid, 'TOTP') as key:
+                if (key == None):
+                    ...
+
+        The key will not be wiped while the block is running, but it may be
+        wiped at any time after that, so it must not be kept.
+
+        @param uid: The UID of the user.
+        @type uid: Integer
+
+        @param module: The module ID.
+        @type module: String
+        '''
+        cacheKey = (uid, module)
+        with self.cache.pinned(cacheKey) as material:
+            if (material != None):
+                yield material
+                return
+
+        material = self.__load(uid, module)
+        if (material == None):
+            yield None
+            return
+
+        # A key too big to cache is used once, and then wiped
+        if (    (self.cache.maxBytes != None)
+            and (len(material) > self.cache.maxBytes)
+            ):
+            try:
+                yield material
+            finally:
+                wipe(material)
+            return
+
+        with self.cache.putPinned(cacheKey, material) as cached:
+            yield cached
+
+
+    def discard(self, uid, module):
+        '''
+        Remove and wipe a user's key for a module.  This should be called
+        whenever a key is changed, or linked or unlinked; L{K2DB} does this
+        for links if it is given the cache (see L{K2DB.keyCache}).
+
+        @param uid: The UID of the user.
+        @type uid: Integer
+
+        @param module: The module ID.
+        @type module: String
+        '''
+        self.cache.discard((uid, module))
+
+
+    def configure(self, maxEntries, ttl, maxBytes):
+        '''
+        Change the cache's limits.  If the cache is now too big, entries are
+        evicted the next time a key is added.
+
+        @param maxEntries: The most keys to cache.
+        @type maxEntries: Integer
+
+        @param ttl: The number of seconds a key stays cached.  This only
+        applies to keys that are added from now on.
+        @type ttl: Float
+
+        @param maxBytes: The largest total size of keys to cache.
+        @type maxBytes: Integer
+
+        @raise ValueError: Thrown if maxEntries is less than 1, or ttl is not
+        positive.
+        '''
+        if (maxEntries < 1):
+            raise ValueError('maxEntries must be at least 1')
+        if (ttl <= 0):
+            raise ValueError('ttl must be positive')
+        self.cache.maxEntries = maxEntries
+        self.cache.ttl = ttl
+        self.cache.maxBytes = maxBytes
+        self.logger.info('Key cache limits: %d keys, %d bytes, %s seconds' %
+                         (maxEntries, maxBytes, ttl))
+
+
+    def shutdown(self):
+        '''
+        Wipe every cached key.
+        '''
+        self.cache.clear()
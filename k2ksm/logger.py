@@ -7,7 +7,81 @@ Created on May 9, 2014
 import logging
 import logging.handlers
 from os import devnull
+from random import random
 from sys import platform, stderr
+from threading import Lock
+import time
+from .audit import K2AuditHandler, K2AuditLog
+
+
+class K2SampleFilter(logging.Filter):
+    '''
+    A filter that samples the log messages of one module, so that
+    high-volume messages (such as each AUTH result) do not flood the log.
+    Messages can be sampled at random, by rate, or both.  Messages more
+    severe than C{maxLevel} are never sampled out.
+    
+    Sampled-out messages are not dropped.  They are marked, so that the
+    stderr and syslog handlers skip them, but the audit log still gets the
+    audit events among them.
+    
+    @ivar rate: The fraction of messages to keep, or None.
+    @type rate: Float
+    
+    @ivar perSecond: The most messages to keep each second, or None.
+    @type perSecond: Float
+    
+    @ivar maxLevel: The most severe level that is sampled.
+    @type maxLevel: Integer
+    
+    @ivar dropped: The number of messages that have been sampled out.
+    @type dropped: Integer
+    '''
+    
+    def __init__(self, rate=None, perSecond=None, maxLevel=logging.INFO,
+                 clock=time.time):
+        logging.Filter.__init__(self)
+        self.rate = rate
+        self.perSecond = perSecond
+        self.maxLevel = maxLevel
+        self.dropped = 0
+        self.__clock = clock
+        self.__lock = Lock()
+        self.__tokens = perSecond
+        self.__last = clock()
+    
+    def filter(self, record):
+        if (record.levelno > self.maxLevel):
+            return True
+        keep = True
+        if ((self.rate != None) and (random() >= self.rate)):
+            keep = False
+        elif (self.perSecond != None):
+            # A token bucket, which holds up to a second's worth of messages
+            self.__lock.acquire()
+            try:
+                now = self.__clock()
+                self.__tokens = min(self.perSecond, self.__tokens
+                                    + (now - self.__last) * self.perSecond)
+                self.__last = now
+                if (self.__tokens >= 1):
+                    self.__tokens -= 1
+                else:
+                    keep = False
+            finally:
+                self.__lock.release()
+        if (not keep):
+            record.sampled = False
+            self.dropped += 1
+        return True
+
+
+
+class _K2SampledFilter(logging.Filter):
+    # Used by the stderr and syslog handlers, to skip sampled-out messages
+    def filter(self, record):
+        return getattr(record, 'sampled', True)
+
 
 
 class K2Logger(object):
@@ -58,7 +132,9 @@ class K2Logger(object):
         self.__logger.addHandler(self.__nullHandler)
         
         # Prepare for logging to stderr
+        sampledFilter = _K2SampledFilter()
         self.__logStderrHandler = logging.StreamHandler(stderr)
+        self.__logStderrHandler.addFilter(sampledFilter)
         self.__logger.addHandler(self.__logStderrHandler)
         
         # Prepare for logging to syslog/event log
@@ -69,6 +145,12 @@ class K2Logger(object):
                     self.__logSyslogHandler = None
         else:
             self.__logSyslogHandler = logging.handlers.SysLogHandler(None, logging.handlers.SysLogHandler.LOG_AUTHPRIV)
+        if (self.__logSyslogHandler != None):
+            self.__logSyslogHandler.addFilter(sampledFilter)
+        
+        # Modules with their own level or sampling
+        self.__moduleLevels = {}
+        self.__moduleSamplers = {}
         
         
     '''
@@ -161,6 +243,54 @@ class K2Logger(object):
             raise TypeError('logToSyslog must be a Boolean')
 
     
+    '''
+    @ivar audit: The L{K2AuditLog} that log messages are also sent to, or
+    None if there is no audit log.  Set using L{enableAudit}.
+    '''
+    __audit = None
+    __auditHandler = None
+    
+    @property
+    def audit(self):
+        return self.__audit
+    
+    
+    def enableAudit(self, path, **options):
+        '''
+        Start sending audit events to an audit log, in addition to stderr
+        and syslog.  Only messages logged with an C{audit} attribute (see
+        L{K2AuditHandler}) are audit events.  Code that only needs to record
+        an audit event (such as an AUTH result) can call the audit log
+        directly, using L{audit}, which skips text formatting entirely.
+        
+        @param path: The path of the audit log.
+        @type path: String
+        
+        @param options: Passed on to L{K2AuditLog}.
+        
+        @rtype: K2AuditLog
+        @return: The audit log.
+        
+        @raise IOError: Thrown if the audit log can not be opened.
+        '''
+        self.disableAudit()
+        self.__audit = K2AuditLog(path, **options)
+        self.__auditHandler = K2AuditHandler(self.__audit, self.__namePrefix)
+        self.__logger.addHandler(self.__auditHandler)
+        return self.__audit
+    
+    
+    def disableAudit(self):
+        '''
+        Stop sending log messages to the audit log, and close it.
+        '''
+        if (self.__auditHandler != None):
+            self.__logger.removeHandler(self.__auditHandler)
+            self.__auditHandler.close()
+            self.__auditHandler = None
+            self.__audit = None
+    
+    
     def loggerForModule(self, module):
         '''
         Returns a Logger object configured for a particular K2KSM module.
@@ -187,5 +317,104 @@ class K2Logger(object):
             return logging.getLogger(newName)
 
 
+    def setModuleLevel(self, module, level=None):
+        '''
+        Set the level of one module's logger, overriding the level of the
+        top-level logger.  For example, DEBUG messages can be logged for one
+        module, without logging them for every module.  This takes effect
+        immediately, even for Logger objects that have already been handed
+        out.
+        
+        @param module: The module name, as given to L{loggerForModule}.
+        @type module: String
+        
+        @param level: The level, as a number or a name (like "DEBUG").  If
+        None, the module goes back to using the top-level logger's level.
+        
+        @raise ValueError: Thrown if the level name is not recognized.
+        '''
+        if (isinstance(level, basestring)):
+            levelName = level.upper()
+            level = logging.getLevelName(levelName)
+            if (not isinstance(level, int)):
+                raise ValueError('Unknown log level %s' % levelName)
+        moduleLogger = self.loggerForModule(module)
+        if (level == None):
+            moduleLogger.setLevel(logging.NOTSET)
+            self.__moduleLevels.pop(module, None)
+        else:
+            moduleLogger.setLevel(level)
+            self.__moduleLevels[module] = level
+    
+    
+    def setModuleSampling(self, module, rate=None, perSecond=None,
+                          maxLevel=logging.INFO):
+        '''
+        Sample one module's log messages.  See L{K2SampleFilter}.
+        
+        Since a module name may contain dots, a high-volume message can be
+        given a logger of its own (like "TOTP.AUTH"), and sampled separately
+        from the rest of the module's messages.
+        
+        @param module: The module name, as given to L{loggerForModule}.
+        @type module: String
+        
+        @param rate: The fraction of messages to keep.
+        @type rate: Float
+        
+        @param perSecond: The most messages to keep each second.
+        @type perSecond: Float
+        
+        @param maxLevel: The most severe level that is sampled.
+        @type maxLevel: Integer
+        
+        @rtype: K2SampleFilter
+        @return: The filter, or None if C{rate} and C{perSecond} are both
+        None, which turns sampling off.
+        '''
+        moduleLogger = self.loggerForModule(module)
+        oldFilter = self.__moduleSamplers.pop(module, None)
+        if (oldFilter != None):
+            moduleLogger.removeFilter(oldFilter)
+        if ((rate == None) and (perSecond == None)):
+            return None
+        newFilter = K2SampleFilter(rate, perSecond, maxLevel)
+        moduleLogger.addFilter(newFilter)
+        self.__moduleSamplers[module] = newFilter
+        return newFilter
+    
+    
+    def configureModules(self, levels, sampling):
+        '''
+        Replace every module's level and sampling.  Modules that are not
+        listed go back to the defaults.
+        
+        @param levels: A hash of module name to level.
+        @type levels: Hash
+        
+        @param sampling: A hash of module name to a (rate, perSecond) tuple.
+        @type sampling: Hash
+        
+        @raise ValueError: Thrown if a level name is not recognized.  No
+        changes are made.
+        '''
+        for level in levels.values():
+            if (    isinstance(level, basestring)
+                and not isinstance(logging.getLevelName(level.upper()), int)
+                ):
+                raise ValueError('Unknown log level %s' % level)
+        for module in self.__moduleLevels.keys():
+            if (module not in levels):
+                self.setModuleLevel(module, None)
+        for module in levels:
+            self.setModuleLevel(module, levels[module])
+        for module in self.__moduleSamplers.keys():
+            if (module not in sampling):
+                self.setModuleSampling(module)
+        for module in sampling:
+            (rate, perSecond) = sampling[module]
+            self.setModuleSampling(module, rate, perSecond)
+
+
 if (__name__ == "__main__"):
     raise NotImplementedError('This file can not be run like a program!')
@@ -0,0 +1,549 @@
+'''
+Metrics for the K2KSM server: counters, gauges and latency histograms, which
+can be scraped in the Prometheus text exposition format over a local UNIX
+socket.
+
+Logging every event is slow, and (with debug logging) leaks secrets, so
+metrics only ever hold numbers.  Each thread records into its own shard, a
+list of numbers that is allocated up front, so recording a value is a single
+list update with no locking.  Shards are added together when the metrics are
+scraped.  When a thread exits, its shard is folded into a shared base shard,
+so short-lived threads (one per connection, for example) do not make the
+list of shards, or each scrape, grow without limit.
+'''
+
+from bisect import bisect_left
+import os
+import socket
+from threading import Lock, RLock, Thread, currentThread, local
+from weakref import ref
+
+
+
+K2_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                      0.25, 0.5, 1.0, 2.5)
+'''The default histogram buckets, in seconds.'''
+
+K2_AUTH_RESULTS = 'k2ksm_auth_results_total'
+'''The name of the counter of AUTH results, labelled by module and result.'''
+
+K2_AUTH_LATENCY = 'k2ksm_auth_latency_seconds'
+'''The name of the histogram of AUTH latency, labelled by module.'''
+
+
+
+class K2Metrics(object):
+    '''
+    K2Metrics is the registry of every metric in a server process.
+
+    Each metric has one or more children, one per combination of label
+    values.  Each child owns a fixed range of slots, which is the same in
+    every thread's shard.  Callers on a hot path should look up the child
+    once (with L{K2Metric.labels}) and keep it.
+    '''
+
+
+    def __init__(self):
+        # Re-entrant, since registering a metric allocates its first child
+        self.__lock = RLock()
+        self.__metrics = {}
+        self.__order = []
+        # Every thread's shard, with a weak reference to its thread
+        self.__shards = []
+        # The totals of the shards of threads that have exited
+        self.__base = []
+        self.__slots = 0
+        self.__local = local()
+
+
+    def shard(self):
+        '''
+        Returns the calling thread's shard, creating it if needed.
+
+        @rtype: List
+        '''
+        try:
+            return self.__local.shard
+        except AttributeError:
+            pass
+        self.__lock.acquire()
+        try:
+            self.prune()
+            shard = [0] * self.__slots
+            self.__shards.append((ref(currentThread()), shard))
+        finally:
+            self.__lock.release()
+        self.__local.shard = shard
+        return shard
+
+
+    def prune(self):
+        '''
+        Fold the shards of threads that have exited into the base shard.
+        This is done whenever a shard is created, and when the metrics are
+        scraped.
+        '''
+        self.__lock.acquire()
+        try:
+            live = []
+            base = self.__base
+            for (thread, shard) in self.__shards:
+                current = thread()
+                if ((current != None) and current.isAlive()):
+                    live.append((thread, shard))
+                    continue
+                for i in xrange(len(shard)):
+                    base[i] += shard[i]
+            self.__shards = live
+        finally:
+            self.__lock.release()
+
+
+    def shardCount(self):
+        '''
+        Returns the number of shards, not counting the base shard.
+
+        @rtype: Integer
+        '''
+        return len(self.__shards)
+
+
+    def allocate(self, count):
+        '''
+        Allocate slots in every shard.  Used when a new child is created.
+
+        @param count: The number of slots needed.
+        @type count: Integer
+
+        @rtype: Integer
+        @return: The index of the first slot.
+        '''
+        self.__lock.acquire()
+        try:
+            first = self.__slots
+            self.__slots += count
+            self.__base.extend([0] * count)
+            for (thread, shard) in self.__shards:
+                shard.extend([0] * count)
+            return first
+        finally:
+            self.__lock.release()
+
+
+    def total(self, index):
+        '''
+        Returns the sum of one slot across every shard.
+
+        @param index: The slot index.
+        @type index: Integer
+        '''
+        self.__lock.acquire()
+        try:
+            total = self.__base[index]
+            for (thread, shard) in self.__shards:
+                total += shard[index]
+            return total
+        finally:
+            self.__lock.release()
+
+
+    def __register(self, cls, name, description, labelNames, *args):
+        self.__lock.acquire()
+        try:
+            if (name in self.__metrics):
+                metric = self.__metrics[name]
+                if (   (not isinstance(metric, cls))
+                    or (metric.labelNames != tuple(labelNames))
+                    ):
+                    raise KeyError('Metric %s already registered differently'
+                                   % name)
+                return metric
+            metric = cls(self, name, description, labelNames, *args)
+            self.__metrics[name] = metric
+            self.__order.append(metric)
+            return metric
+        finally:
+            self.__lock.release()
+
+
+    def counter(self, name, description, labelNames=()):
+        '''
+        Register a counter, or return the existing counter with this name.
+
+        @param name: The metric name, such as "k2ksm_auth_results_total".
+        @type name: String
+
+        @param description: A human-readable description.
+        @type description: String
+
+        @param labelNames: The names of the labels, if any.
+        @type labelNames: Tuple
+
+        @rtype: K2Counter
+
+        @raise KeyError: Thrown if a different metric has this name.
+        '''
+        return self.__register(K2Counter, name, description, labelNames)
+
+
+    def gauge(self, name, description, labelNames=()):
+        '''
+        Register a gauge, or return the existing gauge with this name.  See
+        L{counter} for the parameters.
+
+        @rtype: K2Gauge
+        '''
+        return self.__register(K2Gauge, name, description, labelNames)
+
+
+    def histogram(self, name, description, labelNames=(),
+                  buckets=K2_LATENCY_BUCKETS):
+        '''
+        Register a histogram, or return the existing histogram with this
+        name.  See L{counter} for the other parameters.
+
+        @param buckets: The upper bounds of the buckets, in increasing order.
+        @type buckets: Tuple
+
+        @rtype: K2Histogram
+        '''
+        return self.__register(K2Histogram, name, description, labelNames,
+                               tuple(buckets))
+
+
+    def exposition(self):
+        '''
+        Returns every metric in the Prometheus text exposition format.
+
+        @rtype: String
+        '''
+        lines = []
+        self.__lock.acquire()
+        try:
+            self.prune()
+            for metric in list(self.__order):
+                lines.append('# HELP %s %s' % (metric.name,
+                                               metric.description))
+                lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+                metric.expose(lines)
+        finally:
+            self.__lock.release()
+        lines.append('')
+        return "\n".join(lines)
+
+
+
+class K2Metric(object):
+    '''
+    The base class of all metrics.  Every metric has a list of children,
+    each of which is bound to one set of label values.  A metric without
+    labels has a single child, and passes L{inc} etc. on to it.
+
+    @ivar name: The metric name.
+    @ivar description: The human-readable description.
+    @ivar labelNames: The names of the labels.
+    '''
+
+    #: The Prometheus metric type
+    kind = None
+
+    #: The number of slots each child uses
+    width = 1
+
+
+    def __init__(self, registry, name, description, labelNames):
+        self.registry = registry
+        self.name = name
+        self.description = description
+        self.labelNames = tuple(labelNames)
+        self.__lock = Lock()
+        self.__children = {}
+        self.__order = []
+        if (len(self.labelNames) == 0):
+            self.__default = self.labels()
+
+
+    def labels(self, *values):
+        '''
+        Returns the child for a set of label values, creating it if needed.
+
+        @param values: One value for each label name.
+
+        @raise ValueError: Thrown if the wrong number of values is given.
+        '''
+        if (len(values) != len(self.labelNames)):
+            raise ValueError('%s expects %d label values' % (
+                             self.name, len(self.labelNames)))
+        child = self.__children.get(values)
+        if (child != None):
+            return child
+        self.__lock.acquire()
+        try:
+            if (values not in self.__children):
+                first = self.registry.allocate(self.width)
+                self.__children[values] = self.childClass(self, first)
+                self.__order.append(values)
+            return self.__children[values]
+        finally:
+            self.__lock.release()
+
+
+    def formatLabels(self, values, extra=()):
+        '''
+        Returns the label part of an exposition line.
+        '''
+        pairs = zip(self.labelNames, values) + list(extra)
+        if (len(pairs) == 0):
+            return ''
+        return '{%s}' % ','.join(['%s="%s"' % (name, str(value).replace(
+                                  '\\', '\\\\').replace('"', '\\"'))
+                                  for (name, value) in pairs])
+
+
+    def expose(self, lines):
+        for values in list(self.__order):
+            self.__children[values].expose(lines, self.formatLabels, values)
+
+
+    def __getattr__(self, name):
+        # Pass inc, dec, observe etc. to the single child of an unlabelled
+        # metric
+        if (name.startswith('_')):
+            raise AttributeError(name)
+        if (len(self.labelNames) > 0):
+            raise AttributeError('%s has labels; use labels() first' %
+                                 self.name)
+        return getattr(self.__default, name)
+
+
+
+class K2CounterChild(object):
+    '''
+    One child of a L{K2Counter}.  A counter that is already kept somewhere
+    else, such as a cache's hit count, can be given a function with
+    L{setFunction} instead of being increased.
+    '''
+    __slots__ = ('metric', 'index', 'shard', 'function')
+
+    def __init__(self, metric, index):
+        self.metric = metric
+        self.index = index
+        self.shard = metric.registry.shard
+        self.function = None
+
+    def inc(self, amount=1):
+        '''
+        Increase the counter.
+        '''
+        self.shard()[self.index] += amount
+
+    def setFunction(self, function):
+        '''
+        Use a function to get the value at scrape time.  For a counter, the
+        function's result must never go down.
+        '''
+        self.function = function
+
+    def value(self):
+        '''
+        Returns the current value, summed over every thread.
+        '''
+        if (self.function != None):
+            return self.function()
+        return self.metric.registry.total(self.index)
+
+    def expose(self, lines, formatLabels, values):
+        lines.append('%s%s %s' % (self.metric.name, formatLabels(values),
+                                  self.value()))
+
+
+
+class K2Counter(K2Metric):
+    '''
+    A counter, which only goes up.
+    '''
+    kind = 'counter'
+    childClass = K2CounterChild
+
+
+
+class K2GaugeChild(K2CounterChild):
+    '''
+    One child of a L{K2Gauge}.  Since each thread only records changes,
+    gauges support L{inc} and L{dec}, but not setting a value directly.  A
+    gauge whose value comes from somewhere else can be given a function with
+    L{setFunction} instead.
+    '''
+    __slots__ = ()
+
+    def dec(self, amount=1):
+        '''
+        Decrease the gauge.
+        '''
+        self.shard()[self.index] -= amount
+
+
+
+class K2Gauge(K2Metric):
+    '''
+    A gauge, which can go up and down.
+    '''
+    kind = 'gauge'
+    childClass = K2GaugeChild
+
+
+
+class K2HistogramChild(object):
+    '''
+    One child of a L{K2Histogram}.  It uses one slot per bucket, plus one for
+    values above the last bucket, one for the sum and one for the count.
+    '''
+    __slots__ = ('metric', 'index', 'shard', 'buckets')
+
+    def __init__(self, metric, index):
+        self.metric = metric
+        self.index = index
+        self.shard = metric.registry.shard
+        self.buckets = metric.buckets
+
+    def observe(self, value):
+        '''
+        Record one value.
+        '''
+        shard = self.shard()
+        shard[self.index + bisect_left(self.buckets, value)] += 1
+        n = self.index + len(self.buckets) + 1
+        shard[n] += value
+        shard[n + 1] += 1
+
+    def expose(self, lines, formatLabels, values):
+        total = self.metric.registry.total
+        name = self.metric.name
+        cumulative = 0
+        for i in xrange(len(self.buckets)):
+            cumulative += total(self.index + i)
+            lines.append('%s_bucket%s %s' % (name, formatLabels(values,
+                         (('le', repr(self.buckets[i])),)), cumulative))
+        n = self.index + len(self.buckets)
+        cumulative += total(n)
+        lines.append('%s_bucket%s %s' % (name, formatLabels(values,
+                     (('le', '+Inf'),)), cumulative))
+        lines.append('%s_sum%s %s' % (name, formatLabels(values),
+                                      repr(float(total(n + 1)))))
+        lines.append('%s_count%s %s' % (name, formatLabels(values),
+                                        total(n + 2)))
+
+
+
+class K2Histogram(K2Metric):
+    '''
+    A histogram with fixed buckets, normally used for latencies.
+
+    @ivar buckets: The upper bounds of the buckets.
+    '''
+    kind = 'histogram'
+    childClass = K2HistogramChild
+
+    def __init__(self, registry, name, description, labelNames, buckets):
+        if (list(buckets) != sorted(buckets)):
+            raise ValueError('buckets must be in increasing order')
+        self.buckets = buckets
+        self.width = len(buckets) + 3
+        K2Metric.__init__(self, registry, name, description, labelNames)
+
+
+
+def authResults(metrics):
+    '''
+    Returns the counter of AUTH results.  Children are labelled by module
+    (such as "TOTP") and result ("OK" or "NOK").
+
+    @param metrics: The registry.
+    @type metrics: K2Metrics
+
+    @rtype: K2Counter
+    '''
+    return metrics.counter(K2_AUTH_RESULTS, 'AUTH results by module.',
+                           ('module', 'result'))
+
+
+def authLatency(metrics):
+    '''
+    Returns the histogram of AUTH latency.  Children are labelled by module.
+
+    @param metrics: The registry.
+    @type metrics: K2Metrics
+
+    @rtype: K2Histogram
+    '''
+    return metrics.histogram(K2_AUTH_LATENCY, 'AUTH latency by module.',
+                             ('module',))
+
+
+
+class K2MetricsServer(object):
+    '''
+    K2MetricsServer serves scrapes on a local UNIX socket.  Each connection
+    is sent the current exposition, and then closed.  The socket is made
+    readable only by the owner and group, the same as the socket between the
+    public and private components.
+
+    @ivar path: The path of the UNIX socket.
+    @type path: String
+    '''
+
+
+    def __init__(self, metrics, path):
+        '''
+        Create the socket, and start serving scrapes in a background thread.
+
+        @param metrics: The registry to serve.
+        @type metrics: K2Metrics
+
+        @param path: The path of the UNIX socket.  Any existing socket at this
+        path is removed.
+        @type path: String
+        '''
+        self.path = path
+        self.__metrics = metrics
+        if (os.path.exists(path)):
+            os.unlink(path)
+        self.__socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Create the socket with the right mode, so that it is never open to
+        # everyone, even briefly
+        oldUmask = os.umask(0117)
+        try:
+            self.__socket.bind(path)
+        finally:
+            os.umask(oldUmask)
+        self.__socket.listen(5)
+        self.__thread = Thread(target=self.__serve, name='k2ksm-metrics')
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+
+
+    def close(self):
+        '''
+        Stop serving, and remove the socket.
+        '''
+        try:
+            self.__socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.__socket.close()
+        self.__thread.join()
+        if (os.path.exists(self.path)):
+            os.unlink(self.path)
+
+
+    def __serve(self):
+        while True:
+            try:
+                (connection, address) = self.__socket.accept()
+            except socket.error:
+                return
+            try:
+                connection.sendall(self.__metrics.exposition())
+            except socket.error:
+                pass
+            connection.close()
@@ -0,0 +1,33 @@
+'''
+Support for the client protocol (see docs/protocol.txt).  Everything here is
+shared by the public component, which talks to clients, and the private
+component, which produces most of the responses.
+'''
+
+import json
+
+__all__ = ('nok',)
+
+
+
+def nok(module, code, details):
+    '''
+    Build a NOK response, with its JSON explanation.  The explanation is sent
+    one key per line, as shown in docs/protocol.txt.
+
+    @param module: The name of the module that raised the error.
+    @type module: String
+
+    @param code: The error code, which is unique to the module.
+    @type code: String
+
+    @param details: A human-readable explanation.
+    @type details: String
+
+    @rtype: String
+    @return: The response, including the final newline.
+    '''
+    return 'NOK\n{\n%s,\n%s,\n%s\n}\n' % (
+        '"module": ' + json.dumps(module),
+        '"code": ' + json.dumps(str(code)),
+        '"details": ' + json.dumps(details))
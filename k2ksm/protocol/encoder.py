@@ -0,0 +1,222 @@
+'''
+The response encoder for the client protocol (see docs/protocol.txt).  Almost
+every response is one of a few fixed lines (L{K2_READY}, L{K2_OK},
+L{K2_MORE} and L{K2_BYE}), or a NOK with one of a fixed set of explanations.
+These are all built once, when the module that sends them is imported, so
+answering a request only means picking the right strings.
+
+Each (module, code) pair that can be sent is registered with L{register},
+which returns the whole NOK response.  Registered responses can also be
+looked up with L{error}.
+
+The pieces of one request's response are gathered by a L{K2ResponseWriter}
+and sent with a single system call when the request is done.
+'''
+
+from . import nok
+from threading import Lock
+
+__all__ = ('K2_BYE', 'K2_MORE', 'K2_NOK', 'K2_OK', 'K2_READY',
+           'K2ResponseWriter', 'error', 'register')
+
+
+
+K2_READY = 'READY 1\n'
+'''Sent when the server is ready for the next command.'''
+
+K2_OK = 'OK\n'
+'''Sent when a command succeeds.'''
+
+K2_MORE = 'MORE\n'
+'''Sent when a command needs a block of data.'''
+
+K2_BYE = 'BYE\n'
+'''Sent just before the server closes the connection.'''
+
+K2_NOK = 'NOK\n'
+'''The first line of every NOK response.'''
+
+
+#: The registered NOK responses, keyed by (module, code), with their details
+_errors = {}
+_errorsLock = Lock()
+
+
+
+def register(module, code, details):
+    '''
+    Register a NOK response, and build it.  This is normally called once, at
+    import time, by the module that sends the response.
+
+    @param module: The name of the module that raises the error.
+    @type module: String
+
+    @param code: The error code, which is unique to the module.
+    @type code: String
+
+    @param details: A human-readable explanation.
+    @type details: String
+
+    @rtype: String
+    @return: The response, including the final newline.
+
+    @raise ValueError: Thrown if the (module, code) pair is already registered
+    with different details.
+    '''
+    key = (module, str(code))
+    _errorsLock.acquire()
+    try:
+        if (key in _errors):
+            if (_errors[key][0] != details):
+                raise ValueError('%s error %s is already registered' % key)
+            return _errors[key][1]
+        response = nok(module, code, details)
+        _errors[key] = (details, response)
+        return response
+    finally:
+        _errorsLock.release()
+
+
+def error(module, code, details=None):
+    '''
+    Get a NOK response.
+
+    @param module: The name of the module that raised the error.
+    @type module: String
+
+    @param code: The error code, which is unique to the module.
+    @type code: String
+
+    @param details: If given, and different from the registered explanation,
+    a new response is built with these details instead.
+    @type details: String
+
+    @rtype: String
+    @return: The response, including the final newline.
+
+    @raise KeyError: Thrown if details is not given and the (module, code)
+    pair is not registered.
+    '''
+    registered = _errors.get((module, str(code)))
+    if ((registered != None) and
+        ((details == None) or (details == registered[0]))):
+        return registered[1]
+    if (details == None):
+        raise KeyError('%s error %s is not registered' % (module, code))
+    return nok(module, code, details)
+
+
+
+class K2ResponseWriter(object):
+    '''
+    K2ResponseWriter gathers the pieces of one request's response, and sends
+    them together when L{flush} is called.  Where the socket has C{sendmsg},
+    the pieces are sent as they are; otherwise (as on Python 2) they are
+    joined and sent with one C{sendall}.  It is not safe to use from multiple
+    threads, but there is normally one writer per connection.
+
+    @ivar sock: The socket to send to.
+    @type sock: socket.socket
+    '''
+
+
+    def __init__(self, sock):
+        '''
+        Create a writer.
+
+        @param sock: The socket to send to.
+        @type sock: socket.socket
+        '''
+        self.sock = sock
+        self.__pieces = []
+
+
+    def __len__(self):
+        '''
+        Returns the number of bytes waiting to be sent.
+
+        @rtype: Integer
+        '''
+        return sum([len(piece) for piece in self.__pieces])
+
+
+    def write(self, data):
+        '''
+        Add data to the response.
+
+        @param data: The data, which should end with a newline.
+        @type data: String
+        '''
+        self.__pieces.append(data)
+
+
+    def ok(self, body=None):
+        '''
+        Add an OK, with an optional body.
+
+        @param body: The lines to send after the OK, ending with a newline.
+        @type body: String
+        '''
+        self.__pieces.append(K2_OK)
+        if (body != None):
+            self.__pieces.append(body)
+
+
+    def nok(self, module, code, details=None):
+        '''
+        Add a NOK.  See L{error}.
+        '''
+        self.__pieces.append(error(module, code, details))
+
+
+    def more(self):
+        '''
+        Add a MORE.
+        '''
+        self.__pieces.append(K2_MORE)
+
+
+    def ready(self):
+        '''
+        Add a READY.
+        '''
+        self.__pieces.append(K2_READY)
+
+
+    def bye(self):
+        '''
+        Add a BYE.
+        '''
+        self.__pieces.append(K2_BYE)
+
+
+    def flush(self):
+        '''
+        Send everything that has been added.
+
+        @rtype: Integer
+        @return: The number of bytes sent.
+
+        @raise socket.error: Thrown if sending fails.  The unsent data is
+        thrown away.
+        '''
+        pieces = self.__pieces
+        if (len(pieces) == 0):
+            return 0
+        self.__pieces = []
+        if ((len(pieces) == 1) or (not hasattr(self.sock, 'sendmsg'))):
+            data = ''.join(pieces)
+            self.sock.sendall(data)
+            return len(data)
+
+        total = 0
+        while (len(pieces) > 0):
+            sent = self.sock.sendmsg(pieces)
+            total += sent
+            # Drop what was sent, which may end part-way through a piece
+            while ((len(pieces) > 0) and (sent >= len(pieces[0]))):
+                sent -= len(pieces[0])
+                pieces.pop(0)
+            if (sent > 0):
+                pieces[0] = pieces[0][sent:]
+        return total
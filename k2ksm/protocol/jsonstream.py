@@ -0,0 +1,249 @@
+'''
+A streaming JSON decoder for the data that clients send after a MORE
+response.  Instead of waiting for the whole block and then parsing it, the
+decoder is given each line as it arrives (it is normally the consumer passed
+to L{K2Parser.expectBlock}), and hands each member of the top-level object
+(or each element of the top-level array) to the command's handler as soon as
+that member is complete.
+
+As shown in docs/protocol.txt, clients often put one member per line without
+commas between them::
+
+    {
+    "GivenName": "John"
+    "Surname": "Smith"
+    }
+
+This is accepted, along with ordinary JSON.  A member may span several
+lines, as long as each line break falls where JSON allows whitespace.
+
+To find where such a member ends, the pending text is decoded at the end of
+each non-blank line at the top level.  A valid member only fails to decode
+when the line ends after its key or its colon, so a member that fails more
+often than that is rejected straight away, instead of being decoded again
+on every line.  This keeps decoding linear in the size of the block.
+
+The total size of the block, and how deeply values may be nested, are
+limited by the PROTOCOL settings module (see L{k2ksm.settings.protocol}).
+'''
+
+import json
+import re
+from .encoder import register
+from .parser import K2_MAX_BLOCK_SIZE, K2ProtocolError
+
+__all__ = ('K2_MAX_JSON_DEPTH', 'K2JSONStream', 'jsonStreamFor')
+
+
+
+K2_MAX_JSON_DEPTH = 8
+'''
+The default deepest nesting allowed, counting the top-level object or array
+as 1.
+'''
+
+register('PROTOCOL', '3', 'Invalid JSON')
+register('PROTOCOL', '4', 'JSON nested too deeply')
+
+#: The characters that matter when looking for the end of a member
+_SIGNIFICANT = re.compile(r'[\[\]{}",\\]')
+
+_CLOSE = {'{': '}', '[': ']'}
+
+#: The most times a member may fail to decode before it is complete: once
+#: after its key, and once after its colon
+_MAX_ATTEMPTS = 2
+
+
+
+class K2JSONStream(object):
+    '''
+    K2JSONStream decodes one JSON object or array, a line at a time.  It is
+    not safe to use from multiple threads.
+
+    @ivar count: The number of members (or elements) decoded so far.
+    @type count: Integer
+
+    @ivar done: True once the top-level object or array has been closed.
+    @type done: Boolean
+    '''
+
+
+    def __init__(self, onItem, maxDepth=K2_MAX_JSON_DEPTH,
+                 maxSize=K2_MAX_BLOCK_SIZE):
+        '''
+        Create a decoder.
+
+        @param onItem: Called with each member as it is decoded.  For an
+        object, it is given the key and the value; for an array, it is given
+        the element's index and the element.
+        @type onItem: Function
+
+        @param maxDepth: The deepest nesting allowed, counting the top level
+        as 1.
+        @type maxDepth: Integer
+
+        @param maxSize: The most bytes that may be fed in, counting one
+        newline per line.
+        @type maxSize: Integer
+
+        @raise ValueError: Thrown if either limit is less than 1.
+        '''
+        if ((maxDepth < 1) or (maxSize < 1)):
+            raise ValueError('maxDepth and maxSize must be at least 1')
+        self.maxDepth = maxDepth
+        self.maxSize = maxSize
+        self.count = 0
+        self.done = False
+        self.__onItem = onItem
+        self.__container = None
+        self.__pending = []
+        self.__attempts = 0
+        self.__depth = 0
+        self.__size = 0
+
+
+    def feed(self, line):
+        '''
+        Decode one more line.
+
+        @param line: The line, without its newline.
+        @type line: String
+
+        @raise K2ProtocolError: Thrown if the data is not valid, or is too
+        large or too deeply nested.  Nothing more should be fed in afterwards.
+        '''
+        self.__size += len(line) + 1
+        if (self.__size > self.maxSize):
+            raise K2ProtocolError('2', 'Block too large')
+        if (self.done):
+            if (line.strip() != ''):
+                raise K2ProtocolError('3', 'Invalid JSON: data after the end')
+            return
+
+        pos = 0
+        if (self.__container == None):
+            stripped = line.lstrip()
+            if (stripped == ''):
+                return
+            if (stripped[0] not in _CLOSE):
+                raise K2ProtocolError('3', 'Invalid JSON: expected an object '
+                                      'or array')
+            self.__container = stripped[0]
+            pos = len(line) - len(stripped) + 1
+
+        inString = False
+        skip = -1
+        for match in _SIGNIFICANT.finditer(line, pos):
+            i = match.start()
+            char = match.group()
+            if (inString):
+                if (i == skip):
+                    continue
+                if (char == '"'):
+                    inString = False
+                elif (char == '\\'):
+                    skip = i + 1
+            elif (char == '"'):
+                inString = True
+            elif (char in '[{'):
+                self.__depth += 1
+                if (self.__depth + 1 > self.maxDepth):
+                    raise K2ProtocolError('4', 'JSON nested too deeply')
+            elif (char in ']}'):
+                if (self.__depth > 0):
+                    self.__depth -= 1
+                    continue
+                if (char != _CLOSE[self.__container]):
+                    raise K2ProtocolError('3', 'Invalid JSON: mismatched %s'
+                                          % char)
+                self.__pending.append(line[pos:i])
+                self.__finish(True)
+                self.done = True
+                if (line[i + 1:].strip() != ''):
+                    raise K2ProtocolError('3', 'Invalid JSON: data after the '
+                                          'end')
+                return
+            elif ((char == ',') and (self.__depth == 0)):
+                self.__pending.append(line[pos:i])
+                self.__finish(True)
+                pos = i + 1
+
+        if (inString):
+            raise K2ProtocolError('3', 'Invalid JSON: unterminated string')
+        rest = line[pos:]
+        if (rest.strip() == ''):
+            # Blank lines can't end a member, and are only whitespace
+            return
+        self.__pending.append(rest)
+        self.__pending.append('\n')
+        if (self.__depth == 0):
+            # Members may be separated by a newline instead of a comma
+            self.__finish(False)
+
+
+    def __finish(self, strict):
+        # Decode the pending member, if any.  If strict is False, a member
+        # that does not decode is kept, since it may continue on the next
+        # line, unless it has already failed _MAX_ATTEMPTS times.
+        text = ''.join(self.__pending)
+        if (text.strip() == ''):
+            self.__pending = []
+            self.__attempts = 0
+            return
+        try:
+            if (self.__container == '{'):
+                member = json.loads('{' + text + '}')
+                if (len(member) != 1):
+                    raise ValueError('Expected one member')
+                (key, value) = member.items()[0]
+            else:
+                key = self.count
+                value = json.loads(text)
+        except ValueError:
+            if ((not strict) and (self.__attempts < _MAX_ATTEMPTS)):
+                self.__attempts += 1
+                return
+            raise K2ProtocolError('3', 'Invalid JSON: %s' %
+                                  text.strip()[:40])
+        self.__pending = []
+        self.__attempts = 0
+        self.count += 1
+        self.__onItem(key, value)
+
+
+    def close(self):
+        '''
+        Finish decoding.  This is called once the whole block has arrived.
+
+        @rtype: Integer
+        @return: The number of members (or elements) decoded.
+
+        @raise K2ProtocolError: Thrown if the top-level object or array was
+        never closed.
+        '''
+        if (not self.done):
+            raise K2ProtocolError('3', 'Invalid JSON: incomplete')
+        return self.count
+
+
+
+def jsonStreamFor(k2settings, onItem, moduleID='PROTOCOL'):
+    '''
+    Create a decoder for a MORE block, using the current PROTOCOL settings.
+
+    @param k2settings: The settings, with the PROTOCOL module registered.
+    @type k2settings: K2Settings
+
+    @param onItem: Called with each member as it is decoded.
+    @type onItem: Function
+
+    @param moduleID: The module ID that the PROTOCOL settings are registered
+    as.
+    @type moduleID: String
+
+    @rtype: K2JSONStream
+    '''
+    return K2JSONStream(onItem,
+                        int(k2settings.settingGet(moduleID + '.MaxJSONDepth')),
+                        int(k2settings.settingGet(moduleID + '.MaxBlockSize')))
@@ -0,0 +1,396 @@
+'''
+An incremental parser for the client protocol (see docs/protocol.txt).  Data
+from the client is received into one bytearray, which is re-used for the
+life of the connection.  Line boundaries are found with C{bytearray.find},
+which searches the buffer in place, and a command line is only copied out
+once, when it is complete.  Only the verb is decoded up front; the arguments
+are split when a handler asks for them.
+
+The parser is normally in command mode, where each line is a command.  When
+the dispatcher answers a command with MORE, it calls L{K2Parser.expectBlock},
+and the lines that follow (up to a lone ".") are collected into a
+L{K2Block}, or passed one at a time to a consumer, such as the JSON decoder
+in L{k2ksm.protocol.jsonstream}.
+
+Lines longer than the MaxLineLength setting, and blocks larger than the
+MaxBlockSize setting, are rejected without being buffered: the parser raises
+L{K2ProtocolError} and then skips to the end of the line or block.  The
+limits come from the PROTOCOL settings module (see
+L{k2ksm.settings.protocol}).  The NOK responses for errors 1 and 2 are
+registered with L{k2ksm.protocol.encoder}.
+'''
+
+from .encoder import error, register
+
+# Python 2.6 doesn't have memoryview, so it can't receive into part of the
+# buffer
+try:
+    _view = memoryview
+except NameError:
+    _view = None
+
+__all__ = ('K2_MAX_BLOCK_SIZE', 'K2_MAX_LINE_LENGTH', 'K2Block', 'K2Command',
+           'K2Parser', 'K2ProtocolError', 'parserFor')
+
+
+
+K2_MAX_LINE_LENGTH = 4096
+'''The default longest line, in bytes, not counting the newline.'''
+
+K2_MAX_BLOCK_SIZE = 1024 * 1024
+'''
+The default largest MORE block, in bytes, counting each line's newline but
+not the final ".".
+'''
+
+K2_RECV_SIZE = 16 * 1024
+'''The most bytes read from the client at once.'''
+
+register('PROTOCOL', '1', 'Line too long')
+register('PROTOCOL', '2', 'Block too large')
+
+
+
+def _bytes(buffer, start, end):
+    # Copy part of the buffer into a string, with only one copy if we can
+    if (_view == None):
+        return str(buffer[start:end])
+    return _view(buffer)[start:end].tobytes()
+
+
+
+class K2ProtocolError(ValueError):
+    '''
+    This exception is thrown when the client sends something that can not be
+    parsed.  The parser can keep being used afterwards.
+
+    @ivar response: The NOK response to send to the client.
+    @type response: String
+    '''
+
+    def __init__(self, code, details):
+        ValueError.__init__(self, details)
+        self.response = error('PROTOCOL', code, details)
+
+
+
+class K2Command(object):
+    '''
+    One command line.
+
+    @ivar verb: The first word of the line, in upper case, such as "AUTH".
+    @type verb: String
+
+    @ivar rest: Everything after the verb, with surrounding spaces removed.
+    @type rest: String
+    '''
+    __slots__ = ('verb', 'rest', '_args')
+
+    def __init__(self, verb, rest):
+        self.verb = verb
+        self.rest = rest
+        self._args = None
+
+    @property
+    def args(self):
+        '''
+        The words after the verb, as a list.  They are split the first time
+        this is used.
+        '''
+        if (self._args == None):
+            self._args = self.rest.split()
+        return self._args
+
+    @property
+    def line(self):
+        '''
+        The whole command line, with the verb in upper case.
+        '''
+        if (self.rest == ''):
+            return self.verb
+        return self.verb + ' ' + self.rest
+
+    def __repr__(self):
+        return 'K2Command(%r, %r)' % (self.verb, self.rest)
+
+
+
+class K2Block(object):
+    '''
+    The lines sent after a MORE response.
+
+    @ivar lines: The lines, without newlines, or None if they were given to
+    a consumer instead.
+    @type lines: List
+
+    @ivar size: The total size of the lines, in bytes, counting one byte for
+    each line's newline.
+    @type size: Integer
+    '''
+    __slots__ = ('lines', 'size')
+
+    def __init__(self, lines, size):
+        self.lines = lines
+        self.size = size
+
+    def __repr__(self):
+        return 'K2Block(%d bytes)' % self.size
+
+
+
+class K2Parser(object):
+    '''
+    K2Parser turns the bytes received from one client into commands and
+    blocks.  It is not safe to use from multiple threads, but there is
+    normally one parser per connection.
+
+    Data is added with L{feed} or L{receive}, and parsed items are taken with
+    L{next} (or by iterating over the parser, which stops when more data is
+    needed).
+
+    @ivar maxLine: The longest line, in bytes.
+    @type maxLine: Integer
+
+    @ivar maxBlock: The largest block, in bytes.
+    @type maxBlock: Integer
+    '''
+
+
+    def __init__(self, maxLine=K2_MAX_LINE_LENGTH, maxBlock=K2_MAX_BLOCK_SIZE):
+        '''
+        Create a parser, in command mode.
+
+        @param maxLine: The longest line, in bytes.
+        @type maxLine: Integer
+
+        @param maxBlock: The largest block, in bytes.
+        @type maxBlock: Integer
+
+        @raise ValueError: Thrown if either limit is less than 1.
+        '''
+        if ((maxLine < 1) or (maxBlock < 1)):
+            raise ValueError('maxLine and maxBlock must be at least 1')
+        self.maxLine = maxLine
+        self.maxBlock = maxBlock
+        self.__buffer = bytearray(maxLine + 1 + K2_RECV_SIZE)
+        self.__start = 0
+        self.__end = 0
+        self.__skipLine = False
+        self.__block = None
+        self.__consumer = None
+        self.__blockSize = 0
+        self.__skipBlock = False
+
+
+    def __len__(self):
+        '''
+        Returns the number of bytes received but not parsed yet.
+
+        @rtype: Integer
+        '''
+        return self.__end - self.__start
+
+
+    def __makeRoom(self, size):
+        # Make sure there are at least size free bytes after the end, by
+        # moving unparsed data to the front, and growing if that is not
+        # enough.
+        buffer = self.__buffer
+        if (len(buffer) - self.__end >= size):
+            return
+        pending = self.__end - self.__start
+        if (self.__start > 0):
+            buffer[0:pending] = buffer[self.__start:self.__end]
+            self.__start = 0
+            self.__end = pending
+        if (len(buffer) - self.__end < size):
+            buffer.extend(bytearray(size - (len(buffer) - self.__end)))
+
+
+    def feed(self, data):
+        '''
+        Add data received from the client.
+
+        @param data: The data.
+        @type data: String
+        '''
+        self.__makeRoom(len(data))
+        self.__buffer[self.__end:self.__end + len(data)] = data
+        self.__end += len(data)
+
+
+    def receive(self, sock, size=K2_RECV_SIZE):
+        '''
+        Receive data from a socket, straight into the buffer.
+
+        @param sock: The socket to read from.
+        @type sock: socket.socket
+
+        @param size: The most bytes to read.
+        @type size: Integer
+
+        @rtype: Integer
+        @return: The number of bytes read, or 0 if the client closed the
+        connection.
+        '''
+        if (_view == None):
+            data = sock.recv(size)
+            self.feed(data)
+            return len(data)
+        self.__makeRoom(size)
+        count = sock.recv_into(_view(self.__buffer)[self.__end:], size)
+        self.__end += count
+        return count
+
+
+    def expectBlock(self, consumer=None):
+        '''
+        Switch to block mode.  This is called when the server sends MORE.
+        The block ends at the next line containing a lone ".", after which the
+        parser returns to command mode.
+
+        @param consumer: If given, each line of the block (without the
+        newline) is passed to this function as soon as it arrives, and the
+        L{K2Block} that ends the block has no lines.  If the consumer raises
+        K2ProtocolError, the rest of the block is skipped.
+        @type consumer: Function
+        '''
+        self.__block = []
+        self.__consumer = consumer
+        self.__blockSize = 0
+        self.__skipBlock = False
+
+
+    def __iter__(self):
+        item = self.next()
+        while (item != None):
+            yield item
+            item = self.next()
+
+
+    def next(self):
+        '''
+        Parse the next command or block.
+
+        @rtype: K2Command or K2Block
+        @return: The next item, or None if more data is needed.
+
+        @raise K2ProtocolError: Thrown if a line or block is too long, or if
+        the block's consumer rejected a line.  The bad line or block is
+        skipped, so the parser can be used again straight away.
+        '''
+        buffer = self.__buffer
+        while (True):
+            start = self.__start
+            newline = buffer.find('\n', start, self.__end)
+            if (newline == -1):
+                # A trailing carriage return may belong to the line ending
+                limit = self.maxLine
+                if ((self.__end > start) and (buffer[self.__end - 1] == 13)):
+                    limit += 1
+                if (self.__skipLine):
+                    # Still in a long line that has already been reported
+                    self.__start = self.__end
+                elif (self.__end - start > limit):
+                    # Throw away what we have, and skip the rest of the line
+                    self.__start = self.__end
+                    self.__skipLine = True
+                    self.__tooLong()
+                return None
+            self.__start = newline + 1
+
+            if (self.__skipLine):
+                self.__skipLine = False
+                continue
+            end = newline
+            if ((end > start) and (buffer[end - 1] == 13)):
+                end -= 1
+            if (end - start > self.maxLine):
+                self.__tooLong()
+                continue
+
+            if (self.__block == None):
+                item = self.__command(buffer, start, end)
+            else:
+                item = self.__blockLine(buffer, start, end)
+            if (item != None):
+                return item
+
+
+    def __tooLong(self):
+        # Reject a long line.  In block mode, the whole block is rejected.
+        if (self.__block != None):
+            self.__rejectBlock(K2ProtocolError('2', 'Block too large'))
+        else:
+            raise K2ProtocolError('1', 'Line too long')
+
+
+    def __rejectBlock(self, error):
+        # Skip the rest of the block, and report the error once
+        if (not self.__skipBlock):
+            self.__skipBlock = True
+            self.__block = []
+            raise error
+
+
+    def __command(self, buffer, start, end):
+        # Parse a command line, skipping blank lines
+        while ((start < end) and (buffer[start] == 32)):
+            start += 1
+        if (start == end):
+            return None
+        space = buffer.find(' ', start, end)
+        if (space == -1):
+            return K2Command(_bytes(buffer, start, end).upper(), '')
+        return K2Command(_bytes(buffer, start, space).upper(),
+                         _bytes(buffer, space + 1, end).strip())
+
+
+    def __blockLine(self, buffer, start, end):
+        # Add a line to the block, or finish it
+        if ((end - start == 1) and (buffer[start] == 46)):
+            block = K2Block(self.__block, self.__blockSize)
+            if (self.__consumer != None):
+                block.lines = None
+            self.__block = None
+            self.__consumer = None
+            if (self.__skipBlock):
+                self.__skipBlock = False
+                return None
+            return block
+        if (self.__skipBlock):
+            return None
+
+        # Count the newline, so that a block of blank lines has a size
+        self.__blockSize += end - start + 1
+        if (self.__blockSize > self.maxBlock):
+            self.__rejectBlock(K2ProtocolError('2', 'Block too large'))
+            return None
+        line = _bytes(buffer, start, end)
+        if (self.__consumer == None):
+            self.__block.append(line)
+            return None
+        try:
+            self.__consumer(line)
+        except K2ProtocolError as e:
+            self.__rejectBlock(e)
+        return None
+
+
+
+def parserFor(k2settings, moduleID='PROTOCOL'):
+    '''
+    Create a parser for a new connection, using the current PROTOCOL
+    settings.
+
+    @param k2settings: The settings, with the PROTOCOL module registered.
+    @type k2settings: K2Settings
+
+    @param moduleID: The module ID that the PROTOCOL settings are registered
+    as.
+    @type moduleID: String
+
+    @rtype: K2Parser
+    '''
+    return K2Parser(int(k2settings.settingGet(moduleID + '.MaxLineLength')),
+                    int(k2settings.settingGet(moduleID + '.MaxBlockSize')))
@@ -0,0 +1,359 @@
+'''
+Provisioning support for the HOTP and TOTP modules.  When a key is enrolled,
+the user is given an otpauth:// URI as a QR code, which they scan with their
+authenticator app.
+
+Rendering a QR code takes a lot of CPU time, so it is done by a pool of
+worker threads instead of the thread running the protocol.  Rendered images
+are kept in a short-lived cache, so that a client which retries (or shows the
+code again) does not cause another render.  Since each image contains a
+secret key, images are kept in bytearrays and are wiped when they leave the
+cache.  The cache is keyed by a hash of the URI, since the URI contains the
+secret too.
+
+The qrcode and Pillow packages are needed to render QR codes.  If they are
+not installed, L{renderPNG} raises NotImplementedError.
+'''
+
+from base64 import b32encode
+from hashlib import sha256
+from Queue import Queue
+from threading import Event, Lock, Thread
+from urllib import quote, urlencode
+from .cache import K2Cache
+from .logger import K2Logger
+
+try:
+    import qrcode
+except ImportError:
+    qrcode = None
+
+# Python 2.6 doesn't have memoryview
+try:
+    _view = memoryview
+except NameError:
+    def _view(data):
+        return buffer(data)
+
+
+
+K2_QR_WORKERS = 2
+'''The default number of QR code rendering threads.'''
+
+K2_QR_CACHE_ENTRIES = 64
+'''The default maximum number of rendered QR codes to cache.'''
+
+K2_QR_CACHE_BYTES = 4 * 1024 * 1024
+'''The default maximum total size of rendered QR codes to cache.'''
+
+K2_QR_CACHE_TTL = 120
+'''The default number of seconds that a rendered QR code stays cached.'''
+
+K2_QR_CHUNK_SIZE = 16 * 1024
+'''The default chunk size used by L{K2QRRenderer.stream}.'''
+
+
+
+def otpauthURI(kind, account, secret, issuer='k2ksm', digits=6, counter=0,
+               period=30):
+    '''
+    Build an otpauth:// URI, in the format understood by Google Authenticator
+    and other authenticator apps.
+
+    @param kind: Either "hotp" or "totp".
+    @type kind: String
+
+    @param account: The account name shown to the user, usually the username.
+    @type account: String
+
+    @param secret: The key.
+    @type secret: String
+
+    @param issuer: The issuer shown to the user.
+    @type issuer: String
+
+    @param digits: The number of digits in each code, 6 or 8.
+    @type digits: Integer
+
+    @param counter: The initial counter.  Only used for HOTP.
+    @type counter: Integer
+
+    @param period: The number of seconds each code is valid.  Only used for
+    TOTP.
+    @type period: Integer
+
+    @rtype: String
+    @return: The URI.
+
+    @raise ValueError: Thrown if kind or digits is not valid.
+    '''
+    if (kind not in ('hotp', 'totp')):
+        raise ValueError('kind must be hotp or totp')
+    if (digits not in (6, 8)):
+        raise ValueError('digits must be 6 or 8')
+
+    params = [('secret', b32encode(str(secret)).rstrip('=')),
+              ('issuer', issuer),
+              ('digits', digits),
+              ]
+    if (kind == 'hotp'):
+        params.append(('counter', counter))
+    else:
+        params.append(('period', period))
+    return 'otpauth://%s/%s:%s?%s' % (kind, quote(issuer), quote(account),
+                                      urlencode(params))
+
+
+def _cacheKey(uri):
+    # The cache key for a URI.  The URI itself is never used as a key, since
+    # keys are not wiped.
+    return sha256(uri).digest()
+
+
+class _BytearrayWriter(object):
+    '''
+    A minimal file-like object that writes into a bytearray.  Pillow writes
+    PNG data straight into the bytearray, so the image never exists as an
+    immutable (and un-wipeable) string.
+    '''
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data.extend(data)
+
+    def flush(self):
+        pass
+
+
+def renderPNG(uri):
+    '''
+    Render a URI as a QR code, in PNG format.
+
+    @param uri: The URI to encode.
+    @type uri: String
+
+    @rtype: bytearray
+    @return: The PNG image.
+
+    @raise NotImplementedError: Thrown if qrcode and Pillow are not
+    installed.
+    '''
+    if (qrcode == None):
+        raise NotImplementedError('Could not render QR code, qrcode and '
+                                  'Pillow are needed.')
+    writer = _BytearrayWriter()
+    qrcode.make(uri).save(writer, 'PNG')
+    return writer.data
+
+
+
+class K2QRRender(object):
+    '''
+    A pending (or finished) QR code render, as returned by
+    L{K2QRRenderer.submit}.
+
+    @ivar uri: The URI being rendered.
+    @type uri: String
+
+    @ivar error: If rendering failed, the exception that was raised.
+    '''
+
+    def __init__(self, uri):
+        self.uri = uri
+        self.error = None
+        self.__done = Event()
+
+    def finish(self, error=None):
+        '''
+        Mark the render as finished.  Called by the worker thread.
+        '''
+        self.error = error
+        self.__done.set()
+
+    def wait(self, timeout=None):
+        '''
+        Wait for the render to finish.
+
+        @param timeout: The most seconds to wait, or None to wait forever.
+        @type timeout: Float
+
+        @rtype: Boolean
+        @return: True if the render has finished.
+        '''
+        self.__done.wait(timeout)
+        return self.__done.isSet()
+
+
+
+class K2QRRenderer(object):
+    '''
+    K2QRRenderer renders QR codes on a pool of worker threads, and caches the
+    results.
+
+    Rendered images are not handed out directly.  Instead, L{stream} yields
+    the image in chunks, each of which is a view onto the cached image (so no
+    copies are made), and the image is kept from being wiped until the last
+    chunk has been consumed.
+
+    @ivar cache: The cache of rendered images, keyed by the SHA-256 hash of
+    the URI.
+    @type cache: K2Cache
+
+    @ivar logger: A Logger object that we can use.
+    @type logger: logging.Logger
+    '''
+
+
+    def __init__(self, logger, workers=K2_QR_WORKERS,
+                 cacheEntries=K2_QR_CACHE_ENTRIES,
+                 cacheBytes=K2_QR_CACHE_BYTES, cacheTTL=K2_QR_CACHE_TTL,
+                 render=renderPNG):
+        '''
+        Create the cache, and start the worker threads.
+
+        @param logger: A K2Logger object, which we can use to create a
+        logging.logger object for ourselves.
+        @type logger: K2Logger
+
+        @param workers: The number of rendering threads.
+        @type workers: Integer
+
+        @param cacheEntries: The most rendered images to cache.
+        @type cacheEntries: Integer
+
+        @param cacheBytes: The largest total size of rendered images to cache.
+        @type cacheBytes: Integer
+
+        @param cacheTTL: The number of seconds a rendered image stays cached.
+        @type cacheTTL: Float
+
+        @param render: The function that does the rendering.  It takes a URI,
+        and returns a bytearray.  Defaults to L{renderPNG}.
+        @type render: Function
+
+        @raise TypeError: Thrown if logger is not a K2Logger object.
+
+        @raise ValueError: Thrown if workers is less than 1.
+        '''
+        if (not isinstance(logger, K2Logger)):
+            raise TypeError('logger must be a K2Logger object')
+        if (workers < 1):
+            raise ValueError('workers must be at least 1')
+
+        self.logger = logger.loggerForModule('Provision')
+        self.cache = K2Cache(cacheEntries, cacheTTL, cacheBytes)
+        self.__render = render
+        self.__queue = Queue()
+        self.__pending = {}
+        self.__lock = Lock()
+        self.__workers = []
+        for i in xrange(workers):
+            worker = Thread(target=self.__work, name='k2ksm-qr-%d' % i)
+            worker.setDaemon(True)
+            worker.start()
+            self.__workers.append(worker)
+
+
+    def submit(self, uri):
+        '''
+        Start rendering a URI, unless it is already cached or being rendered.
+
+        @param uri: The URI to render.
+        @type uri: String
+
+        @rtype: K2QRRender
+        @return: An object that can be used to wait for the render.
+        '''
+        key = _cacheKey(uri)
+        self.__lock.acquire()
+        try:
+            if (key in self.__pending):
+                return self.__pending[key]
+            job = K2QRRender(uri)
+            if (self.cache.get(key) != None):
+                job.finish()
+                return job
+            self.__pending[key] = job
+        finally:
+            self.__lock.release()
+
+        self.__queue.put(job)
+        return job
+
+
+    def stream(self, uri, chunkSize=K2_QR_CHUNK_SIZE):
+        '''
+        Yield a rendered image in chunks.  The image should have been
+        rendered already (see L{submit}); if it is not cached (because it has
+        expired since, for example), it is rendered again, and this waits for
+        the render.  The chunks are views onto the cached image, so each one
+        must be written out before the next one is asked for.
+
+        @param uri: The URI that was rendered.
+        @type uri: String
+
+        @param chunkSize: The most bytes in each chunk.
+        @type chunkSize: Integer
+
+        @raise KeyError: Thrown if the image could not be rendered again.
+        '''
+        key = _cacheKey(uri)
+        with self.cache.pinned(key) as image:
+            if (image != None):
+                for chunk in self.__chunks(image, chunkSize):
+                    yield chunk
+                return
+
+        self.logger.debug('QR code expired before it was sent, rendering '
+                          'again')
+        job = self.submit(uri)
+        job.wait()
+        with self.cache.pinned(key) as image:
+            if (image == None):
+                raise KeyError('QR code for URI could not be rendered')
+            for chunk in self.__chunks(image, chunkSize):
+                yield chunk
+
+
+    @staticmethod
+    def __chunks(image, chunkSize):
+        view = _view(image)
+        for offset in xrange(0, len(image), chunkSize):
+            yield view[offset:offset + chunkSize]
+
+
+    def shutdown(self):
+        '''
+        Stop the worker threads, and wipe the cache.
+        '''
+        for worker in self.__workers:
+            self.__queue.put(None)
+        for worker in self.__workers:
+            worker.join()
+        self.__workers = []
+        self.cache.clear()
+
+
+    def __work(self):
+        # The main loop of each worker thread
+        while True:
+            job = self.__queue.get()
+            if (job == None):
+                return
+
+            error = None
+            key = _cacheKey(job.uri)
+            try:
+                image = self.__render(job.uri)
+                self.cache.put(key, image)
+            except Exception as e:
+                self.logger.error('Failed to render QR code: %s' % e)
+                error = e
+
+            self.__lock.acquire()
+            try:
+                del self.__pending[key]
+            finally:
+                self.__lock.release()
+            job.finish(error)
@@ -0,0 +1,424 @@
+'''
+The request scheduler for the private component.  Requests are sorted into
+classes: AUTH commands, which clients are waiting on to log someone in;
+administrative commands (USER, LINK, key generation, etc.); and bulk
+commands (USER IMPORT and USER EXPORT).  Each class has its own queue.
+
+Worker threads take requests from the queues using smooth weighted
+round-robin, so that each class gets a share of the workers in proportion to
+its weight.  AUTH has the largest weight, but bulk work still gets its
+share, and is never starved completely.  When two classes are due at the same
+time, the more important class goes first.
+
+Each queue also has a length limit.  A request that arrives when its queue
+is full is rejected straight away with a NOK "overloaded" response, instead
+of waiting behind work that the server has no time for.  The limits come
+from the SCHEDULER settings module (see L{k2ksm.settings.scheduler}).
+
+Requests may carry a deadline (see L{k2ksm.deadline}).  A request whose
+deadline has passed by the time a worker takes it is answered with
+L{K2_TIMED_OUT}, without being run, since the client has stopped waiting.
+'''
+
+from collections import deque
+from threading import Condition, Thread
+from time import time
+from .deadline import K2_TIMED_OUT, expired
+from .logger import K2Logger
+from .metrics import K2Metrics
+from .protocol.encoder import register
+
+
+
+K2_CLASS_AUTH = 'AUTH'
+'''The class of AUTH commands.'''
+
+K2_CLASS_ADMIN = 'ADMIN'
+'''The class of administrative commands.'''
+
+K2_CLASS_BULK = 'BULK'
+'''The class of bulk commands.'''
+
+K2_SCHEDULER_CLASSES = (K2_CLASS_AUTH, K2_CLASS_ADMIN, K2_CLASS_BULK)
+'''Every class, from most to least important.'''
+
+K2_SCHEDULER_WEIGHTS = {K2_CLASS_AUTH: 16,
+                        K2_CLASS_ADMIN: 4,
+                        K2_CLASS_BULK: 1,
+                        }
+'''The default weight of each class.'''
+
+K2_SCHEDULER_LIMITS = {K2_CLASS_AUTH: 1024,
+                       K2_CLASS_ADMIN: 64,
+                       K2_CLASS_BULK: 4,
+                       }
+'''The default most requests that can wait in each class's queue.'''
+
+K2_SCHEDULER_WORKERS = 4
+'''The default number of worker threads.'''
+
+K2_OVERLOADED = register('SCHEDULER', '1',
+                         'The server is overloaded.  Try again later.')
+'''The response to a request that was rejected.'''
+
+K2_INTERNAL_ERROR = register('SCHEDULER', '2',
+                             'The server had an internal error.')
+'''The response to a request whose command raised an exception.'''
+
+K2_SHUTTING_DOWN = register('SCHEDULER', '3',
+                            'The server is shutting down.')
+'''The response to requests still waiting when the scheduler stops.'''
+
+
+
+def commandClass(command):
+    '''
+    Work out the class of a command.
+
+    @param command: The command line, such as "AUTH TOTP smithj 123456".
+    @type command: String
+
+    @rtype: String
+    @return: One of the L{K2_SCHEDULER_CLASSES}.
+    '''
+    words = command.split(None, 2)
+    if (len(words) == 0):
+        return K2_CLASS_ADMIN
+    group = words[0].upper()
+    if (group == 'AUTH'):
+        return K2_CLASS_AUTH
+    if (    (group == 'USER')
+        and (len(words) > 1)
+        and (words[1].upper() in ('IMPORT', 'EXPORT'))
+        ):
+        return K2_CLASS_BULK
+    return K2_CLASS_ADMIN
+
+
+
+class K2Scheduler(object):
+    '''
+    K2Scheduler queues requests for the private component's dispatcher, and
+    runs them on a pool of worker threads.  It is safe to use from multiple
+    threads.
+
+    @ivar weights: The weight of each class.
+    @type weights: Hash
+
+    @ivar limits: The most requests that can wait in each class's queue.
+    @type limits: Hash
+
+    @ivar rejected: The number of requests rejected in each class.
+    @type rejected: Hash
+
+    @ivar expired: The number of requests in each class that were dropped
+    because their deadline had passed.
+    @type expired: Hash
+
+    @ivar logger: A Logger object that we can use.
+    @type logger: logging.Logger
+    '''
+
+
+    def __init__(self, logger, dispatch, weights=K2_SCHEDULER_WEIGHTS,
+                 limits=K2_SCHEDULER_LIMITS, metrics=None, clock=time):
+        '''
+        Create a scheduler.  No workers are started until L{start} is called.
+
+        @param logger: A K2Logger object, which we can use to create a
+        logging.logger object for ourselves.
+        @type logger: K2Logger
+
+        @param dispatch: The function that runs a command.  It is given the
+        command line and the command's data (or None), and returns the
+        response.
+        @type dispatch: Function
+
+        @param weights: The weight of each class.
+        @type weights: Hash
+
+        @param limits: The most requests that can wait in each class's queue.
+        @type limits: Hash
+
+        @param metrics: If provided, queue lengths and the number of
+        requests run, rejected and expired are reported here.
+        @type metrics: K2Metrics
+
+        @param clock: Returns the current time, in seconds, for checking
+        deadlines.  Used for testing.
+        @type clock: Function
+
+        @raise TypeError: Thrown if logger is not a K2Logger object, or if
+        metrics is not a K2Metrics object.
+
+        @raise ValueError: Thrown if a class is missing a weight or limit, or
+        a weight is less than 1.
+        '''
+        if (not isinstance(logger, K2Logger)):
+            raise TypeError('logger must be a K2Logger object')
+        self.logger = logger.loggerForModule('Scheduler')
+        self.__dispatch = dispatch
+        self.__clock = clock
+        self.__condition = Condition()
+        self.__queues = {}
+        self.__credit = {}
+        self.rejected = {}
+        self.expired = {}
+        for name in K2_SCHEDULER_CLASSES:
+            if (weights.get(name, 0) < 1):
+                raise ValueError('%s must have a weight of at least 1' % name)
+            self.__queues[name] = deque()
+            self.__credit[name] = 0
+            self.rejected[name] = 0
+            self.expired[name] = 0
+        self.weights = dict(weights)
+        self.limits = {}
+        self.configure(limits)
+        self.__workers = []
+        self.__running = False
+        self.__stopped = False
+
+        self.__dispatched = None
+        self.__rejectedCounter = None
+        self.__expiredCounter = None
+        if (metrics != None):
+            if (not isinstance(metrics, K2Metrics)):
+                raise TypeError('metrics must be a K2Metrics object')
+            queued = metrics.gauge('k2ksm_scheduler_queued',
+                                   'Requests waiting, by class.', ('class',))
+            for name in K2_SCHEDULER_CLASSES:
+                queue = self.__queues[name]
+                queued.labels(name).setFunction(lambda queue=queue:
+                                                    len(queue))
+            self.__dispatched = metrics.counter(
+                'k2ksm_scheduler_dispatched_total', 'Requests run, by class.',
+                ('class',))
+            self.__rejectedCounter = metrics.counter(
+                'k2ksm_scheduler_rejected_total',
+                'Requests rejected because their queue was full, by class.',
+                ('class',))
+            self.__expiredCounter = metrics.counter(
+                'k2ksm_scheduler_expired_total',
+                'Requests dropped because their deadline passed, by class.',
+                ('class',))
+
+
+    def configure(self, limits):
+        '''
+        Change the queue length limits.  Requests already waiting are not
+        affected.
+
+        @param limits: The most requests that can wait in each class's queue.
+        @type limits: Hash
+
+        @raise ValueError: Thrown if a class is missing a limit, or a limit is
+        less than 1.
+        '''
+        for name in K2_SCHEDULER_CLASSES:
+            if (limits.get(name, 0) < 1):
+                raise ValueError('%s must have a limit of at least 1' % name)
+        self.__condition.acquire()
+        try:
+            self.limits = dict(limits)
+        finally:
+            self.__condition.release()
+
+
+    def __len__(self):
+        '''
+        Returns the number of requests waiting, in every class.
+
+        @rtype: Integer
+        '''
+        return sum([len(queue) for queue in self.__queues.values()])
+
+
+    def submit(self, command, reply, data=None, deadline=None):
+        '''
+        Queue a request.  If its class's queue is full, the request is
+        rejected, and the reply function is called straight away with
+        L{K2_OVERLOADED}.  If its deadline has already passed, the reply
+        function is called straight away with L{K2_TIMED_OUT}, and if the
+        scheduler has been stopped, with L{K2_SHUTTING_DOWN}.
+
+        @param command: The command line.
+        @type command: String
+
+        @param reply: The function to call with the response.
+        @type reply: Function
+
+        @param data: The command's data, if any.
+
+        @param deadline: The time by which the response is needed, or None
+        for no deadline.
+        @type deadline: Float
+
+        @rtype: Boolean
+        @return: True if the request was queued.
+        '''
+        name = commandClass(command)
+        if (self.__expire(name, deadline, reply)):
+            return False
+        self.__condition.acquire()
+        try:
+            stopped = self.__stopped
+            queue = self.__queues[name]
+            admitted = ((not stopped) and (len(queue) < self.limits[name]))
+            if (admitted):
+                queue.append((command, data, reply, deadline))
+                self.__condition.notify()
+            elif (not stopped):
+                self.rejected[name] += 1
+        finally:
+            self.__condition.release()
+
+        if (stopped):
+            self.__reply(reply, K2_SHUTTING_DOWN)
+        elif (not admitted):
+            if (self.__rejectedCounter != None):
+                self.__rejectedCounter.labels(name).inc()
+            self.logger.warning('Rejected %s request: queue is full' % name)
+            self.__reply(reply, K2_OVERLOADED)
+        return admitted
+
+
+    def __reply(self, reply, response):
+        # Call a reply function.  It belongs to the caller, so a failure is
+        # logged, and does not stop the worker.
+        try:
+            reply(response)
+        except Exception:
+            self.logger.exception('Reply function failed')
+
+
+    def __expire(self, name, deadline, reply):
+        # Drop a request if its deadline has passed
+        if (not expired(deadline, self.__clock)):
+            return False
+        self.__condition.acquire()
+        try:
+            self.expired[name] += 1
+        finally:
+            self.__condition.release()
+        if (self.__expiredCounter != None):
+            self.__expiredCounter.labels(name).inc()
+        self.logger.debug('Dropped %s request: deadline passed' % name)
+        self.__reply(reply, K2_TIMED_OUT)
+        return True
+
+
+    def __next(self):
+        # Pick the next request, using smooth weighted round-robin over the
+        # classes that have work.  Must be called with the lock held.
+        best = None
+        total = 0
+        for name in K2_SCHEDULER_CLASSES:
+            if (len(self.__queues[name]) > 0):
+                self.__credit[name] += self.weights[name]
+                total += self.weights[name]
+                if ((best == None) or
+                    (self.__credit[name] > self.__credit[best])):
+                    best = name
+        if (best == None):
+            return None
+        self.__credit[best] -= total
+        queue = self.__queues[best]
+        request = queue.popleft()
+        if (len(queue) == 0):
+            # An idle class does not save up credit
+            self.__credit[best] = 0
+        return (best, request)
+
+
+    def step(self):
+        '''
+        Run the next request, in the calling thread.  This is what each
+        worker does in a loop; it may also be called directly.
+
+        @rtype: Boolean
+        @return: True if a request was run, or False if none were waiting.
+        '''
+        self.__condition.acquire()
+        try:
+            item = self.__next()
+        finally:
+            self.__condition.release()
+        if (item == None):
+            return False
+        self.__run(*item)
+        return True
+
+
+    def __run(self, name, request):
+        (command, data, reply, deadline) = request
+        if (self.__expire(name, deadline, reply)):
+            return
+        if (self.__dispatched != None):
+            self.__dispatched.labels(name).inc()
+        try:
+            response = self.__dispatch(command, data)
+        except Exception:
+            verb = command.split(None, 1)[:1] or ['(blank)']
+            self.logger.exception('%s command %s failed' % (name, verb[0]))
+            response = K2_INTERNAL_ERROR
+        self.__reply(reply, response)
+
+
+    def __work(self):
+        # The worker thread's loop
+        while (True):
+            self.__condition.acquire()
+            try:
+                item = self.__next()
+                while ((item == None) and self.__running):
+                    self.__condition.wait()
+                    item = self.__next()
+            finally:
+                self.__condition.release()
+            if (item == None):
+                return
+            self.__run(*item)
+
+
+    def start(self, workers=K2_SCHEDULER_WORKERS):
+        '''
+        Start the worker threads.
+
+        @param workers: The number of worker threads.
+        @type workers: Integer
+        '''
+        self.__condition.acquire()
+        try:
+            self.__running = True
+            self.__stopped = False
+        finally:
+            self.__condition.release()
+        for i in xrange(workers):
+            worker = Thread(target=self.__work, name='k2ksm-scheduler-%d' % i)
+            worker.setDaemon(True)
+            worker.start()
+            self.__workers.append(worker)
+
+
+    def stop(self):
+        '''
+        Stop the worker threads, once they finish their current requests.
+        Requests that are still waiting, and any submitted until the
+        scheduler is started again, are answered with L{K2_SHUTTING_DOWN}.
+        '''
+        self.__condition.acquire()
+        try:
+            self.__running = False
+            self.__stopped = True
+            waiting = []
+            for name in K2_SCHEDULER_CLASSES:
+                waiting.extend(self.__queues[name])
+                self.__queues[name].clear()
+            self.__condition.notifyAll()
+        finally:
+            self.__condition.release()
+        for worker in self.__workers:
+            worker.join()
+        self.__workers = []
+        for (command, data, reply, deadline) in waiting:
+            self.__reply(reply, K2_SHUTTING_DOWN)
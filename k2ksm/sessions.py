@@ -0,0 +1,222 @@
+'''
+Session IDs.  Each session is given a small integer ID, made of a slot
+number and a generation::
+
+    sessionID = (generation << K2_SESSION_SLOT_BITS) | slot
+
+Slots are handed out from a free list, so the slot numbers in use stay close
+to the number of sessions, and anything kept per session can live in a
+plain list indexed by slot, instead of a hash keyed by session ID::
+
+    slot = sessions.slot(sessionID)
+    state = table[slot]
+
+Each time a slot is released its generation goes up, so an ID kept after its
+session ended (by a slow thread, for example) does not match the slot's new
+session: L{K2SessionIDs.slot} raises KeyError for it, just as a hash would
+for a missing key.
+
+Slot 0 is never handed out, so no session has ID 0.  L{K2Settings} keeps its
+server-wide settings there.
+'''
+
+from threading import Lock
+
+__all__ = ('K2_SESSION_SLOT_BITS', 'K2SessionIDs')
+
+
+
+K2_SESSION_SLOT_BITS = 20
+'''
+The number of bits of a session ID used for the slot number.  This limits the
+number of sessions open at once to a little over a million.
+'''
+
+
+
+class K2SessionIDs(object):
+    '''
+    K2SessionIDs allocates session IDs.  Allocating and releasing IDs is safe
+    from multiple threads; looking up slots does not take a lock.
+
+    Iterating over the allocator gives the ID of every open session, in slot
+    order.
+
+    @ivar slotBits: The number of bits of each ID used for the slot.
+    @type slotBits: Integer
+
+    @ivar mask: The bits of an ID that hold the slot.  C{sessionID & mask}
+    is the slot of a session that is known to be open.
+    @type mask: Integer
+    '''
+
+
+    def __init__(self, slotBits=K2_SESSION_SLOT_BITS):
+        '''
+        Create an allocator, with no sessions.
+
+        @param slotBits: The number of bits of each ID used for the slot.
+        @type slotBits: Integer
+
+        @raise ValueError: Thrown if slotBits is less than 1.
+        '''
+        if (slotBits < 1):
+            raise ValueError('slotBits must be at least 1')
+        self.slotBits = slotBits
+        self.mask = (1 << slotBits) - 1
+        self.__lock = Lock()
+        # The ID in each slot, or 0 if the slot is free
+        self.__ids = [0]
+        # Each slot's generation, kept while the slot is free
+        self.__generations = [0]
+        # Free slots, most recently released last.  Slots taken by claim()
+        # are left here, and skipped when they come up.
+        self.__free = []
+        self.__count = 0
+
+
+    def __len__(self):
+        '''
+        Returns the number of sessions.
+
+        @rtype: Integer
+        '''
+        return self.__count
+
+
+    def __iter__(self):
+        ids = self.__ids
+        for slot in xrange(1, len(ids)):
+            if (ids[slot] != 0):
+                yield ids[slot]
+
+
+    def __contains__(self, sessionID):
+        try:
+            self.slot(sessionID)
+        except KeyError:
+            return False
+        return True
+
+
+    @property
+    def capacity(self):
+        '''
+        The number of slots, including slot 0.  A list indexed by slot needs
+        to be this long.
+        '''
+        return len(self.__ids)
+
+
+    def slot(self, sessionID):
+        '''
+        Get the slot of a session.
+
+        @param sessionID: The session's ID.
+        @type sessionID: Integer
+
+        @rtype: Integer
+
+        @raise KeyError: Thrown if C{sessionID} is not the ID of a session,
+        including if its session has ended.
+        '''
+        try:
+            slot = sessionID & self.mask
+            if ((slot != 0) and (self.__ids[slot] == sessionID)):
+                return slot
+        except (TypeError, IndexError):
+            pass
+        raise KeyError('Session ID %s does not exist' % str(sessionID))
+
+
+    def allocate(self):
+        '''
+        Allocate an ID for a new session.
+
+        @rtype: Integer
+
+        @raise OverflowError: Thrown if every slot is in use.
+        '''
+        ids = self.__ids
+        free = self.__free
+        with self.__lock:
+            while (free):
+                slot = free.pop()
+                if (ids[slot] == 0):
+                    break
+            else:
+                slot = len(ids)
+                if (slot > self.mask):
+                    raise OverflowError('No session IDs are free')
+                ids.append(0)
+                self.__generations.append(0)
+            sessionID = (self.__generations[slot] << self.slotBits) | slot
+            ids[slot] = sessionID
+            self.__count += 1
+        return sessionID
+
+
+    def claim(self, sessionID):
+        '''
+        Take a particular ID, such as one carried over from another process
+        (see L{k2ksm.handoff}).  This is slower than L{allocate} when the ID
+        is well past the slots in use.
+
+        @param sessionID: The ID.
+        @type sessionID: Integer
+
+        @rtype: Integer
+        @return: The ID's slot.
+
+        @raise KeyError: Thrown if C{sessionID} is 0, is not a non-negative
+        integer, or its slot is in use.
+        '''
+        if ((not isinstance(sessionID, (int, long))) or (sessionID < 0)):
+            raise KeyError('Session ID %s is not valid' % str(sessionID))
+        slot = sessionID & self.mask
+        if (slot == 0):
+            raise KeyError('Session ID %s is not valid' % str(sessionID))
+        with self.__lock:
+            ids = self.__ids
+            if (slot >= len(ids)):
+                # Every slot skipped over is free
+                self.__free.extend(xrange(slot - 1, len(ids) - 1, -1))
+                ids.extend([0] * (slot + 1 - len(ids)))
+                self.__generations.extend(
+                    [0] * (slot + 1 - len(self.__generations)))
+            if (ids[slot] != 0):
+                raise KeyError('Session ID %s already exists' %
+                               str(sessionID))
+            ids[slot] = sessionID
+            self.__generations[slot] = sessionID >> self.slotBits
+            self.__count += 1
+        return slot
+
+
+    def release(self, sessionID):
+        '''
+        Release a session's ID, when the session ends.  Its slot is re-used
+        with a new generation.
+
+        @param sessionID: The session's ID.
+        @type sessionID: Integer
+
+        @rtype: Integer
+        @return: The slot that was released.
+
+        @raise KeyError: Thrown if C{sessionID} is not the ID of a session.
+        '''
+        ids = self.__ids
+        with self.__lock:
+            try:
+                slot = sessionID & self.mask
+                if ((slot == 0) or (ids[slot] != sessionID)):
+                    raise IndexError(slot)
+            except (TypeError, IndexError):
+                raise KeyError('Session ID %s does not exist' %
+                               str(sessionID))
+            ids[slot] = 0
+            self.__generations[slot] = (sessionID >> self.slotBits) + 1
+            self.__free.append(slot)
+            self.__count -= 1
+        return slot
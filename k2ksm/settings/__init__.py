@@ -1,9 +1,15 @@
 
 from abc import ABCMeta, abstractmethod
 from ConfigParser import RawConfigParser
-from sys import argv
-from ..exceptions import K2FinalizeError
+from logging import DEBUG
+from sys import argv, modules
+from ..exceptions import K2FinalizeError, K2SettingsError
 from ..logger import K2Logger
+from ..metrics import K2Metrics
+from ..sessions import K2SessionIDs
+from .view import K2SessionSettings
+from .snapshot import readSnapshot, sourceStamp, sourcesCurrent, \
+                      writeSnapshot
 
 
 
@@ -46,10 +52,29 @@ class K2Settings(object):
     more instances of K2SettingsModule objects.  This normally happens when
     we need to store session-specific settings.
 
-    @ivar __moduleSettings: A hash of a hash of K2SettingsModule objects.  The first key is
-    the session ID (to store session-specific settings) or zero (to store
-    server-wide settings); the second key is the module ID (such as "K2KSM" or
-    "TOTP").
+    @ivar __moduleSettings: A list of hashes of K2SettingsModule objects.  The
+    list is indexed by session slot (to store session-specific settings), or
+    zero (to store server-wide settings); the hash key is the module ID (such
+    as "K2KSM" or "TOTP").  Slots with no session, or whose session has no
+    session-specific settings yet, hold None.
+
+    @ivar __views: A list of L{K2SessionSettings} views, indexed by session
+    slot.
+
+    @ivar __generation: A one-item list, holding a counter that is incremented
+    whenever a server-wide setting changes.  Views use this to notice that
+    their cached values may be out of date.
+
+    @ivar __moduleGenerations: A hash of counters, keyed by module ID, each
+    incremented whenever one of the module's server-wide settings changes.
+
+    @ivar __watchers: A hash of lists of functions, keyed by module ID, to
+    call when one of the module's server-wide settings changes.
+
+    @ivar sessions: The allocator for session IDs, which maps each session
+    to its slot.  Other per-session structures can use it to keep their state
+    in lists indexed by slot.
+    @type sessions: K2SessionIDs
 
     @ivar finalized: Set to true once all modules have been registered.
     @type finalized: Boolean
@@ -66,10 +91,18 @@ class K2Settings(object):
     This is set when loadConfig is called.  If set to None, then loadConfig()
     was never called.
     @type configPath: String
+
+    @ivar sources: The paths of the configuration file and argfiles that
+    settings have been loaded from.
+    @type sources: List
+
+    @ivar metrics: If set, the registry that we record session counts and
+    setting reads/writes in.
+    @type metrics: K2Metrics
     '''
 
     
-    def __init__(self, logger):
+    def __init__(self, logger, metrics=None):
         '''
         Create a new K2Settings object for settings storage.
         
@@ -77,29 +110,57 @@ class K2Settings(object):
         logging.logger object for ourselves.
         @type logger: K2Logger
         
+        @param metrics: If provided, session counts and setting reads/writes
+        will be recorded here.
+        @type metrics: K2Metrics
+        
         @rtype: K2Logger
         @return: A new empty K2Logger object.
         
-        @raise TypeError: Thrown if logger is not a K2Logger object.
+        @raise TypeError: Thrown if logger is not a K2Logger object, or if
+        metrics is not a K2Metrics object.
         '''
         
         # Initialize everything
         self.__unusedSettings = {}
         self.__moduleClasses = {}
-        self.__moduleSettings = {}
+        self.__moduleSettings = [{}]
+        self.__views = [None]
+        self.sessions = K2SessionIDs()
+        self.__generation = [0]
+        self.__moduleGenerations = {}
+        self.__watchers = {}
         self.finalized = False
         self.logger = None
         self.configArgs = None
         self.configPath = None
+        self.sources = []
         
         # Set up the logger
         if (not isinstance(logger, K2Logger)):
             raise TypeError('logger must be a K2Logger object')
         self.logger = logger.loggerForModule('Settings')
         self.logger.debug('K2Settings instantiated')
+        
+        # Set up metrics.  We keep the children, so the hot paths don't
+        # need to look them up.
+        self.metrics = metrics
+        self.__metricReads = None
+        self.__metricWrites = None
+        if (metrics != None):
+            if (not isinstance(metrics, K2Metrics)):
+                raise TypeError('metrics must be a K2Metrics object')
+            sessions = self.sessions
+            metrics.gauge('k2ksm_settings_sessions',
+                'Sessions with settings storage.').setFunction(
+                    lambda: len(sessions))
+            self.__metricReads = metrics.counter('k2ksm_settings_reads_total',
+                'Calls to settingGet.').labels()
+            self.__metricWrites = metrics.counter(
+                'k2ksm_settings_writes_total', 'Calls to settingSet.').labels()
     
     
-    def loadArgs(self, args=argv):
+    def loadArgs(self, args=None):
         '''
         Load settings from a list of arguments.
         A list of arguments can be provided for parsing, otherwise sys.argv
@@ -112,9 +173,27 @@ class K2Settings(object):
         That means the total number of arguments will be 2 times the number of
         settings.
         
-        If called without args being specified, C{sys.argv} will be used.
+        An argument of the form C{@path} (in place of a setting name) reads
+        more settings from the file at C{path}.  The file is read one line at
+        a time, so it may be very large.  Each line has one setting, in the
+        form::
+        
+            moduleName.settingName settingValue
         
-        @param args: An even-numbered list of arguments.
+        Blank lines, and lines starting with "#", are ignored.
+        
+        All of the arguments are parsed, grouped by module and checked before
+        any are stored; so if the arguments can not be parsed, or the settings
+        for any registered module are not valid, no settings are changed.
+        Settings for modules that have already registered are given straight
+        to the module's L{K2SettingsModule}.  Other settings are kept until
+        the module registers.
+        
+        If called without args being specified, C{sys.argv} (minus the
+        program name) will be used.
+        
+        @param args: An even-numbered list of arguments, not counting
+        C{@path} arguments.
         @type args: List
         
         @raise K2FinalizeError: Thrown if the L{K2Settings} instance has
@@ -122,31 +201,122 @@ class K2Settings(object):
         
         @raise IndexError: Thrown if an odd-numbered list of arguments
         is provided.
+        
+        @raise IOError: Thrown if an argfile can not be read.
+        
+        @raise ValueError: Thrown if an argfile has a line without a value.
+        
+        @raise K2SettingsError: Thrown if a registered module does not
+        recognize some settings, or some values are invalid.  Every problem
+        for the module is listed.
         '''
         if (self.finalized):
             raise K2FinalizeError('Can not load new arguments, ' \
                                   + 'settings finalized')
         
         self.logger.info('Parsing command-line arguments')
+        if (args == None):
+            args = argv[1:]
         self.configArgs = args
-        if (len(self.configArgs) % 2 != 0):
-            raise IndexError('args must have an even number of items')
         
+        # Group the settings by module, in a single pass
+        grouped = {}
         i = 0
-        while (i < len(self.configArgs)):
-            lvalue = self.configArgs[i]
-            settingValue = self.configArgs[i + 1]
-            moduleName, settingName = lvalue.split('.', 1)
-            
-            if (moduleName not in self.__unusedSettings):
-                self.__unusedSettings[moduleName] = {}
-                
-            self.__unusedSettings[moduleName][settingName] = settingValue
-            self.logger.debug('Added setting %s.%s=%s' % (
-                             moduleName, settingName, settingValue
-                             ))
+        count = len(args)
+        while (i < count):
+            lvalue = args[i]
+            if (lvalue[:1] == '@'):
+                self.__loadArgfile(lvalue[1:], grouped)
+                i += 1
+                continue
+            if (i + 1 == count):
+                raise IndexError('args must have an even number of items')
             
+            moduleName, settingName = lvalue.split('.', 1)
+            moduleSettings = grouped.get(moduleName)
+            if (moduleSettings == None):
+                moduleSettings = grouped[moduleName] = {}
+            moduleSettings[settingName] = args[i + 1]
             i += 2
+        
+        self.__storeGrouped(grouped)
+    
+    
+    def __loadArgfile(self, path, grouped):
+        '''
+        Stream settings from an argfile (see L{loadArgs}) into a hash of
+        settings grouped by module.
+        
+        @param path: The path to the argfile.
+        @type path: String
+        
+        @param grouped: The hash to add settings to.  The outer key is the
+        module name, and the inner key is the setting name.
+        @type grouped: Hash of hashes
+        '''
+        self.logger.info('Reading arguments from ' + path)
+        argfile = open(path)
+        self.sources.append(path)
+        try:
+            lineNum = 0
+            for line in argfile:
+                lineNum += 1
+                line = line.strip()
+                if ((line == '') or (line[0] == '#')):
+                    continue
+                parts = line.split(None, 1)
+                if (len(parts) != 2):
+                    raise ValueError('Line %d of %s has no value' % (lineNum,
+                                                                    path))
+                moduleName, settingName = parts[0].split('.', 1)
+                moduleSettings = grouped.get(moduleName)
+                if (moduleSettings == None):
+                    moduleSettings = grouped[moduleName] = {}
+                moduleSettings[settingName] = parts[1]
+        finally:
+            argfile.close()
+    
+    
+    def __storeGrouped(self, grouped):
+        '''
+        Store settings that have been grouped by module.  Settings for
+        registered modules go straight to the module; the rest are kept in
+        L{__unusedSettings} until the module registers.  The settings for
+        every registered module are checked first, so if any are not valid,
+        nothing is stored.
+        
+        @param grouped: The settings.  The outer key is the module name, and
+        the inner key is the setting name.
+        @type grouped: Hash of hashes
+        
+        @raise K2SettingsError: Thrown if a registered module does not
+        recognize some settings, or some values are invalid.
+        '''
+        for moduleName in sorted(grouped):
+            if (moduleName in self.__moduleSettings[0]):
+                try:
+                    self.__moduleSettings[0][moduleName].check(
+                        grouped[moduleName])
+                except K2SettingsError as e:
+                    e.moduleID = moduleName
+                    raise
+        
+        debug = self.logger.isEnabledFor(DEBUG)
+        for moduleName in grouped:
+            moduleSettings = grouped[moduleName]
+            if (moduleName in self.__moduleSettings[0]):
+                self.__moduleSettings[0][moduleName].update(moduleSettings)
+                self.invalidate(moduleName)
+                if (debug):
+                    self.logger.debug('Loaded %d settings for %s' % (
+                                      len(moduleSettings), moduleName))
+            else:
+                if (moduleName not in self.__unusedSettings):
+                    self.__unusedSettings[moduleName] = {}
+                self.__unusedSettings[moduleName].update(moduleSettings)
+                if (debug):
+                    self.logger.debug('Added %d settings for %s' % (
+                                      len(moduleSettings), moduleName))
     
     
     def loadConfig(self, config=K2_DEFAULT_CONFIG):
@@ -160,6 +330,9 @@ class K2Settings(object):
         
         @raise K2FinalizeError: Thrown if the L{K2Settings} instance has
         already been finalized.
+        
+        @raise K2SettingsError: Thrown if a registered module does not
+        recognize some settings, or some values are invalid.
         '''
         if (self.finalized):
             raise K2FinalizeError('Can not load new configuration, ' \
@@ -168,21 +341,19 @@ class K2Settings(object):
         
         self.logger.info('Loading configuration from path ' + config)
         self.configPath = config
+        self.sources.append(config)
         
         # Read in our configuration
         parser = RawConfigParser()
         parser.read(self.configPath)
         self.logger.debug('ConfigParser complete')
         
-        # Each section is a module name; the options in the section are
-        # settings to be copied into __unusedSettings, and then processed
+        # Each section is a module name, and the options in the section are
+        # its settings
+        grouped = {}
         for section in parser.sections():
-            if (section not in self.__unusedSettings):
-                self.__unusedSettings[section] = {}
-            for setting in parser.options(section):
-                self.__unusedSettings[section][setting] = parser.get(section, \
-                                                                     setting)
-            self.processUnused(section)
+            grouped[section] = dict(parser.items(section))
+        self.__storeGrouped(grouped)
     
     
     @classmethod
@@ -221,59 +392,50 @@ class K2Settings(object):
     
     def processUnused(self, moduleID=None):
         '''
-        Look through L{__unusedSettings}, and see if we can find any settings
-        that have not yet been given to a registered module.  Although public,
-        this method will not normally need to be called by anything outside
-        of the class.
-        
-        @param moduleID: The unique, human-readable ID of a module.  If given,
-        we will only look for settings related to this module.  Used when a
-        module has just been registered.
+        Give a registered module any settings that were loaded before it
+        registered.  Settings are kept in L{__unusedSettings} by module, so
+        this only touches the module's own settings.  Although public, this
+        method will not normally need to be called by anything outside of the
+        class, as L{register} does it.
+        
+        @param moduleID: The unique, human-readable ID of a module.  If not
+        given, every registered module is checked.  Since L{register} always
+        processes a module's settings, that will normally find nothing to do.
         @type moduleID: String
         
         @raise K2FinalizeError: Thrown if this method is called after
         L{finalize} has been called.  If this is raised, something is wrong.
         
-        @raise KeyError: Thrown if we find a setting for a registered module,
-        but the module does not recognize the setting.
-        
-        @raise ValueError: Thrown if we find a setting for a registered module,
-        but the setting's value is invalid.
+        @raise K2SettingsError: Thrown if the module does not recognize some
+        of the settings, or if some of the values are invalid.  Every problem
+        is listed, and none of the module's settings are changed.
         '''
         
         if (self.finalized):
             raise K2FinalizeError('Can not load process unused ' \
                                   + 'configuration, settings finalized')
         
-        # Do we search through all of the modules with unused settings, or just
-        # one?
         if (moduleID == None):
-            searchList = self.__unusedSettings.keys()
+            searchList = [module for module in self.__unusedSettings
+                          if module in self.__moduleSettings[0]]
+        elif (moduleID in self.__moduleSettings[0]):
+            searchList = (moduleID,)
         else:
-            if (moduleID in self.__unusedSettings):
-                searchList = (moduleID,)
-            else:
-                self.logger.debug('Processing unused settings for %s, but' \
-                                  "it doesn't have any unused settings" % \
-                                  moduleID)
-                searchList = ()
-        self.logger.debug('Processing unused settings in: ' + str(searchList))
+            searchList = ()
         
-        # Check each module in the searchList to see if it's been registered
         for module in searchList:
-            if (module not in self.__moduleSettings):
-                self.logger.debug('Module %s not registered' % module)
+            pending = self.__unusedSettings.get(module)
+            if (pending == None):
                 continue
-            
-            # We have a registered module!  Load the settings
-            for setting in self.__unusedSettings[module]:
-                self.logger.debug('Loading setting %s.%s' % (module, setting))
-                self.__moduleSettings[0][module][setting] = \
-                    self.__unusedSettings[module][setting]
-                
-            # At this point, the unused settings have been loaded, so clean up
+            try:
+                self.__moduleSettings[0][module].update(pending)
+            except K2SettingsError as e:
+                e.moduleID = module
+                raise
             del self.__unusedSettings[module]
-            
+            self.logger.debug('Loaded %d settings for %s' % (len(pending),
+                                                             module))
+        
         
     def register(self, moduleID, settingsClass, settings=None):
         '''
@@ -300,6 +462,10 @@ class K2Settings(object):
         @raise TypeError: Thrown if C{settingsClass} is not a subclass of
         L{K2SettingsModule}, or if C{settings} is not an instance of
         C{settingsClass} (that is, assuming C{settings} is not C{None}).
+        
+        @raise K2SettingsError: Thrown if settings were loaded for the module
+        before it registered, and some of them are not valid.  The module is
+        not registered.
         '''
         self.logger.debug('Module %s is registering settings' % moduleID)
         
@@ -316,17 +482,30 @@ class K2Settings(object):
             if (not isinstance(settings, settingsClass)):
                 raise TypeError('settings must be instance of settingsClass')
         
-        # Record the settings class, and create an instance for server-side
-        self.__moduleClasses[moduleID] = settingsClass
+        # Create an instance for server-side settings
         if (settings == None):
             self.logger.debug('Creating fresh settings for %s' % moduleID)
-            self.__moduleSettings[0][moduleID] = settingsClass()
+            settings = settingsClass()
         else:
             self.logger.debug('Using provided settings for %s' % moduleID)
-            self.__moduleSettings[0][moduleID] = settings
-            
-        # Check to see if we can now use some loaded, but unused, settings
-        self.processUnused(moduleID)
+        
+        # Give the instance any settings that were loaded for it already.
+        # This is done before the module is recorded, so that a module with
+        # invalid settings is not left half-registered.
+        pending = self.__unusedSettings.get(moduleID)
+        if (pending != None):
+            try:
+                settings.update(pending)
+            except K2SettingsError as e:
+                e.moduleID = moduleID
+                raise
+            del self.__unusedSettings[moduleID]
+            self.logger.debug('Loaded %d settings for %s' % (len(pending),
+                                                             moduleID))
+        
+        self.__moduleClasses[moduleID] = settingsClass
+        self.__moduleSettings[0][moduleID] = settings
+        self.__moduleGenerations[moduleID] = 0
         
         
     def finalize(self):
@@ -338,16 +517,231 @@ class K2Settings(object):
         
         self.logger.debug(  'K2Settings setup complete.  '
                           + 'Deleting unused settings.')
-        self.processUnused()
-        for moduleName in self.__unusedSettings:
+        # Registering a module takes its settings out of __unusedSettings, so
+        # everything left over is for a module that was never loaded
+        for moduleName in sorted(self.__unusedSettings):
             self.logger.warning('Module ' + moduleName
                                 + ' had settings defined, but ' + moduleName
                                 + ' was not loaded.')
-        self.__unusedSettings = []
+        self.__unusedSettings = {}
         self.finalized = True
         
+    
+    def state(self, sessions=False):
+        '''
+        Returns the settings state, in a form that can be saved as JSON.  This
+        is used by L{snapshot}.
+        
+        @param sessions: If True, session-specific settings are included.
+        @type sessions: Boolean
+        
+        @rtype: Hash
+        @return: The arguments and sources that settings were loaded from,
+        each registered module's class and server-wide settings, and
+        (optionally) each session's settings.
+        
+        @raise K2FinalizeError: Thrown if the L{K2Settings} instance has not
+        been finalized yet.
         
-    def newSession(self, sessionID):
+        @raise ValueError: Thrown if a module's settings class can not be
+        found again by its module and class name.
+        '''
+        if (not self.finalized):
+            raise K2FinalizeError('Can not save settings state, settings ' \
+                                  + 'not finalized')
+        
+        moduleList = []
+        for moduleID in sorted(self.__moduleClasses):
+            settingsClass = self.__moduleClasses[moduleID]
+            if (getattr(modules.get(settingsClass.__module__),
+                        settingsClass.__name__, None) is not settingsClass):
+                raise ValueError('Settings class for %s can not be found by '
+                                 'name' % moduleID)
+            moduleList.append([moduleID, settingsClass.__module__,
+                               settingsClass.__name__,
+                               self.__moduleSettings[0][moduleID].settings])
+        
+        state = {'args': list(self.configArgs or ()),
+                 'sources': [sourceStamp(path) for path in self.sources],
+                 'config': self.configPath,
+                 'modules': moduleList,
+                 'sessions': None,
+                 }
+        if (sessions):
+            state['sessions'] = [[sessionID, self.sessionState(sessionID)]
+                                 for sessionID in self.sessionIDs()]
+        return state
+    
+    
+    def sessionIDs(self):
+        '''
+        Returns the IDs of every session.
+        
+        @rtype: List
+        '''
+        return list(self.sessions)
+    
+    
+    def sessionState(self, sessionID):
+        '''
+        Returns a session's settings, in a form that can be saved as JSON, and
+        given to L{restoreSession}.
+        
+        @param sessionID: The unique ID of the session.
+        
+        @rtype: Hash
+        @return: The session-specific settings that are not at their default
+        values, as a hash of module ID to a hash of settings.
+        
+        @raise KeyError: Thrown if C{sessionID} does not exist.
+        '''
+        session = self.__moduleSettings[self.sessions.slot(sessionID)] or {}
+        overlay = {}
+        for moduleID in session:
+            overlay[moduleID] = session[moduleID].settings
+        return overlay
+    
+    
+    def restoreSession(self, sessionID, overlay, validate=True):
+        '''
+        Create a session, with settings from L{sessionState}.  This is used to
+        carry sessions over to a new process.
+        
+        @param sessionID: The unique ID of the session.  It must B{NOT} be 0.
+        
+        @param overlay: The session's settings.
+        @type overlay: Hash of hashes
+        
+        @param validate: If False, the settings are not validated.  Only use
+        this if they come from this same version of the server.
+        @type validate: Boolean
+        
+        @raise KeyError: Thrown if C{sessionID} already exists, or if one of
+        the modules is not registered.
+        
+        @raise K2SettingsError: Thrown if some settings are not valid.  The
+        session is not created.
+        '''
+        instances = {}
+        for moduleID in overlay:
+            instance = self.__moduleClasses[str(moduleID)]()
+            if (validate):
+                try:
+                    instance.update(overlay[moduleID])
+                except K2SettingsError as e:
+                    e.moduleID = moduleID
+                    raise
+            else:
+                for name in overlay[moduleID]:
+                    instance.settings[str(name)] = overlay[moduleID][name]
+            instances[str(moduleID)] = instance
+        self.newSession(sessionID)
+        if (len(instances) > 0):
+            self.__moduleSettings[self.sessions.slot(sessionID)] = instances
+    
+    
+    def snapshot(self, path, sessions=False):
+        '''
+        Save the settings state to a snapshot file, which can be used by
+        L{restore} the next time the server starts.  See
+        L{k2ksm.settings.snapshot} for the file format.
+        
+        @param path: Where to write the snapshot.
+        @type path: String
+        
+        @param sessions: If True, session-specific settings are saved too.
+        @type sessions: Boolean
+        
+        @raise K2FinalizeError: Thrown if the L{K2Settings} instance has not
+        been finalized yet.
+        
+        @raise ValueError: Thrown if a module's settings class can not be
+        found by name.
+        
+        @raise TypeError: Thrown if a setting value can not be saved.
+        '''
+        writeSnapshot(path, self.state(sessions))
+        self.logger.info('Saved settings snapshot to ' + path)
+    
+    
+    @classmethod
+    def restore(cls, logger, path, args=None, metrics=None):
+        '''
+        Create a finalized L{K2Settings} object from a snapshot, instead of
+        loading arguments and configuration and registering modules.  Values
+        in a snapshot were validated when the snapshot was taken, so they are
+        not validated again.
+        
+        The snapshot is only used if it was made with the same arguments, and
+        the configuration file and argfiles have the same modification times
+        and hashes as when it was made.  Otherwise, C{None} is returned, and
+        the server should start up normally (see L{load}).
+        
+        @param logger: A L{K2Logger} object, which we can use to create a
+        logging.logger object for ourselves.
+        @type logger: L{K2Logger}
+        
+        @param path: The path to the snapshot.
+        @type path: String
+        
+        @param args: The command-line arguments.  If not specified, sys.argv
+        (minus the program name) will be used.
+        @type args: List
+        
+        @param metrics: Passed on to the new object.
+        @type metrics: K2Metrics
+        
+        @rtype: K2Settings
+        @return: The restored settings, or None if the snapshot could not be
+        read, or is stale.
+        
+        @raise TypeError: Thrown if logger is not a L{K2Logger} object.
+        '''
+        x = cls(logger, metrics)
+        try:
+            state = readSnapshot(path)
+        except (IOError, ValueError) as e:
+            x.logger.warning('Not using settings snapshot: %s' % e)
+            return None
+        
+        if (args == None):
+            args = argv[1:]
+        if (   (list(args) != state['args'])
+            or (not sourcesCurrent(state['sources']))
+            ):
+            x.logger.info('Settings snapshot %s is stale' % path)
+            return None
+        
+        # Find all of the classes before changing anything
+        classes = {}
+        try:
+            for (moduleID, modulePath, className, values) in state['modules']:
+                settingsModule = __import__(modulePath, fromlist=[className])
+                classes[str(moduleID)] = getattr(settingsModule, className)
+        except (ImportError, AttributeError) as e:
+            x.logger.warning('Not using settings snapshot: %s' % e)
+            return None
+        
+        for (moduleID, modulePath, className, values) in state['modules']:
+            moduleID = str(moduleID)
+            instance = classes[moduleID]()
+            for name in values:
+                instance.settings[str(name)] = values[name]
+            x.__moduleClasses[moduleID] = classes[moduleID]
+            x.__moduleSettings[0][moduleID] = instance
+            x.__moduleGenerations[moduleID] = 0
+        for (sessionID, overlay) in (state['sessions'] or ()):
+            x.restoreSession(sessionID, overlay, validate=False)
+        
+        x.configArgs = args
+        x.configPath = state['config']
+        x.sources = [stamp[0] for stamp in state['sources']]
+        x.finalized = True
+        x.logger.info('Restored settings from snapshot ' + path)
+        return x
+    
+    
+    def newSession(self, sessionID=None):
         '''
         Prepare to store settings for a new session.
         
@@ -355,17 +749,107 @@ class K2Settings(object):
         need to store session-specific settings.  Creating new instances is
         done lazily, in order to do things quickly.
         
-        @param sessionID: The unique ID of the session.  It must B{NOT} be 0.
+        @param sessionID: The unique ID of the session.  If not given, a new
+        ID is allocated (see L{k2ksm.sessions}), which is the normal case.
+        An ID is only given when a session is carried over from another
+        process.  It must B{NOT} be 0.
+        @type sessionID: Integer
+        
+        @rtype: K2SessionSettings
+        @return: A view of the session's settings, for the code handling the
+        session to read settings from.  The view's C{sessionID} is the
+        session's ID.
         
-        @raise KeyError: Thrown if C{sessionID} already exists, or if it is 0.
+        @raise KeyError: Thrown if C{sessionID} already exists, or if it is 0
+        or not an integer.
+        
+        @raise OverflowError: Thrown if no more session IDs are free.
         '''
         
-        # Validation
-        if (sessionID in self.__moduleSettings):
-            raise KeyError('Session ID %s already exists' % str(sessionID))
+        # Allocate or claim the ID, which also validates it
+        if (sessionID == None):
+            sessionID = self.sessions.allocate()
+            slot = sessionID & self.sessions.mask
+        else:
+            slot = self.sessions.claim(sessionID)
+        
+        # Be lazy.  Only create instances (and the hash to keep them in) when
+        # we actually need to
+        view = K2SessionSettings(self, sessionID, self.__generation,
+                                 self.__moduleGenerations)
+        while (len(self.__views) <= slot):
+            self.__moduleSettings.append(None)
+            self.__views.append(None)
+        self.__moduleSettings[slot] = None
+        self.__views[slot] = view
+        return view
+    
+    
+    def sessionView(self, sessionID):
+        '''
+        Returns the view of a session's settings that L{newSession} returned.
+        
+        @param sessionID: The unique ID of the session.
         
-        # Be lazy.  Only create instances when we actually need to
-        self.__moduleSettings[sessionID] = {}
+        @rtype: K2SessionSettings
+        
+        @raise KeyError: Thrown if C{sessionID} does not exist.
+        '''
+        return self.__views[self.sessions.slot(sessionID)]
+    
+    
+    def invalidate(self, moduleID=None):
+        '''
+        Tell session views that a module's server-wide settings have changed,
+        so that they stop using cached values.  L{settingSet} does this
+        itself; this only needs to be called if a module's L{K2SettingsModule}
+        is changed directly, such as when settings are reloaded.
+        
+        @param moduleID: The module whose settings have changed.  If not
+        given, every module is invalidated.
+        '''
+        if (moduleID == None):
+            moduleIDs = self.__moduleGenerations.keys()
+        elif (moduleID in self.__moduleGenerations):
+            moduleIDs = (moduleID,)
+        else:
+            moduleIDs = ()
+        for moduleID in moduleIDs:
+            self.__moduleGenerations[moduleID] += 1
+        self.__generation[0] += 1
+        for moduleID in moduleIDs:
+            for callback in self.__watchers.get(moduleID, ()):
+                callback(moduleID)
+    
+    
+    def moduleClass(self, moduleID):
+        '''
+        Returns the settings class that a module registered, or None if the
+        module has not registered.  Settings restored from a snapshot (see
+        L{restore}) already have every module that was in the snapshot.
+        
+        @param moduleID: The module ID.
+        @type moduleID: String
+        
+        @rtype: Class
+        '''
+        return self.__moduleClasses.get(moduleID)
+    
+    
+    def watch(self, moduleID, callback):
+        '''
+        Call a function whenever one of a module's server-wide settings is
+        changed, by L{settingSet}, by loading more settings, or by
+        L{invalidate}.  This lets settings that configure other parts of the
+        server (such as log levels) take effect at runtime.
+        
+        @param moduleID: The module to watch.
+        @type moduleID: String
+        
+        @param callback: The function to call.  It is given the module ID.
+        @type callback: Function
+        '''
+        self.__watchers.setdefault(moduleID, []).append(callback)
         
     
     def delSession(self, sessionID):
@@ -386,7 +870,9 @@ class K2Settings(object):
         if (sessionID == 0):
             raise ValueError('Session ID 0 may not be deleted')
         
-        del self.__moduleSettings[sessionID]
+        slot = self.sessions.release(sessionID)
+        self.__moduleSettings[slot] = None
+        self.__views[slot] = None
         
         
     def settingGet(self, name, sessionID=None):
@@ -408,16 +894,19 @@ class K2Settings(object):
         @raise AttributeError: Thrown if the setting name is invalid.
         '''
         
+        if (self.__metricReads != None):
+            self.__metricReads.inc()
+        
         # Split out the moduleID and settingName, and validate
         moduleID, settingName = name.split('.', 1)
-        if (moduleID not in self.__moduleSettings):
+        if (moduleID not in self.__moduleSettings[0]):
             raise KeyError('Module %s is not registered' % moduleID)
         if (not self.__moduleSettings[0][moduleID].nameValid(settingName)):
             raise AttributeError('Module %s does not have a setting %s' \
                                  % (moduleID, settingName))
         
         # If the setting is server-wide, get it now
-        if (self.__moduleSettings[0][moduleID].perSession(settingName)):
+        if (not self.__moduleSettings[0][moduleID].perSession(settingName)):
             return self.__moduleSettings[0][moduleID][settingName]
             
         # If the setting is session-specific, but we don't have a sessionID,
@@ -425,14 +914,15 @@ class K2Settings(object):
         # session-specific instance of the module's K2SettingsModule yet.
         # (Remember, we are creating session-specific K2SettingsModule
         # instances lazily.)
-        if (   (sessionID == None)
-            or (moduleID not in self.__moduleSettings[sessionID])
-            ):
+        if (sessionID == None):
+            return self.__moduleSettings[0][moduleID].default(settingName)
+        session = self.__moduleSettings[self.sessions.slot(sessionID)]
+        if ((session == None) or (moduleID not in session)):
             return self.__moduleSettings[0][moduleID].default(settingName)
         
         # If we've gotten this far, then that means our sessionID actually has
         # had settings stored for it.
-        return self.__moduleSettings[sessionID][moduleID][settingName]
+        return session[moduleID][settingName]
         
         
     def settingSet(self, name, value, sessionID=None):
@@ -457,9 +947,12 @@ class K2Settings(object):
         @raise ValueError: Thrown is the setting's value is invalid.
         '''
         
+        if (self.__metricWrites != None):
+            self.__metricWrites.inc()
+        
         # Split out the moduleID and settingName, and validate
         moduleID, settingName = name.split('.', 1)
-        if (moduleID not in self.__moduleSettings):
+        if (moduleID not in self.__moduleSettings[0]):
             raise KeyError('Module %s is not registered' % moduleID)
         if (not self.__moduleSettings[0][moduleID].nameValid(settingName)):
             raise AttributeError('Module %s does not have a setting %s' \
@@ -467,17 +960,23 @@ class K2Settings(object):
         
         # Is the setting server-wide, or session-specific ?
         if (not self.__moduleSettings[0][moduleID].perSession(settingName)):
-            # Server-wide.  This is easier.
+            # Server-wide.  This is easier, but every view needs to know.
             self.__moduleSettings[0][moduleID][settingName] = value
+            self.invalidate(moduleID)
         else:
             # Session-specific.  We create instances lazily, so we might need
             # to do so now.
-            if (not moduleID in self.__moduleSettings[sessionID]):
+            slot = self.sessions.slot(sessionID)
+            session = self.__moduleSettings[slot]
+            if (session == None):
+                session = {}
+                self.__moduleSettings[slot] = session
+            if (not moduleID in session):
                 # Instantiate an appropriate K2SettingsModule object to hold
                 # session-specific settings.
-                self.__moduleSettings[sessionID][moduleID] = \
-                    self.__moduleClasses[moduleID]()
-            self.__moduleSettings[sessionID][moduleID][settingName] = value
+                session[moduleID] = self.__moduleClasses[moduleID]()
+            session[moduleID][settingName] = value
+            self.__views[slot].discard(moduleID, settingName)
         
         
 
@@ -694,11 +1193,58 @@ class K2SettingsModule(object):
             # TODO
             pass
         # Checking for validity is what raises the KeyError
-        if (self.valid(key, value)):
+        if (self.settingValid(key, value)):
             if (value != self.default(key)):
                 self.settings[key] = value
+            else:
+                # Going back to the default drops any earlier value
+                self.settings.pop(key, None)
         else:
             raise ValueError("Value %s is invalid for key %s" % (value, key))
+    
+    
+    def check(self, values):
+        '''
+        Checks several settings, without changing any of them.
+        
+        @param values: The new values, keyed by setting name.
+        @type values: Hash
+        
+        @raise K2SettingsError: Thrown if any of the setting names are not
+        recognized, or any of the values are invalid.  Every problem is
+        listed in the exception.
+        '''
+        errors = []
+        for key in values:
+            if (not self.nameValid(key)):
+                errors.append((key, 'is not a recognized setting'))
+            elif (not self.settingValid(key, values[key])):
+                errors.append((key, 'has invalid value %s' % (values[key],)))
+        if (len(errors) > 0):
+            errors.sort()
+            raise K2SettingsError(errors)
+    
+    
+    def update(self, values):
+        '''
+        Changes several settings at once.  Every value is checked (see
+        L{check}) before any setting is changed, so either all of the
+        settings are changed, or none of them are.
+        
+        @param values: The new values, keyed by setting name.
+        @type values: Hash
+        
+        @raise K2SettingsError: Thrown if any of the setting names are not
+        recognized, or any of the values are invalid.  Every problem is
+        listed in the exception.
+        '''
+        self.check(values)
+        for key in values:
+            value = values[key]
+            if (value != self.default(key)):
+                self.settings[key] = value
+            else:
+                self.settings.pop(key, None)
 
     def __delitem__(self, key):
         '''
@@ -3,7 +3,7 @@ All of the settings for the K2KSM module are defined here.
 '''
 
 import dateutil.parser
-from . import K2SettingsModule
+from .schema import K2SchemaSettingsModule
 
 __all__ = ('K2KSMSettings',)
 
@@ -40,6 +40,30 @@ def _counter_validator(value):
         return True
 
 
+def _rate_validator(value):
+    # The value must be a number from 0 to 1
+    try:
+        value = float(value)
+    except:
+        return False
+    if ((value < 0) or (value > 1)):
+        return False
+    else:
+        return True
+
+
+def _timeout_validator(value):
+    # The value must be a number of seconds, above 0
+    try:
+        value = float(value)
+    except:
+        return False
+    if (value <= 0):
+        return False
+    else:
+        return True
+
+
 def _datetime_validator(value):
     # If the parser can parse it, then we'll accept it
     try:
@@ -126,145 +150,55 @@ settings['OverrideTimer']['description'] = \
     + "format (for example: 2014-05-15T20:00:00Z).  This setting may only " \
     + "be set if the server is in test mode."
 
-
-class K2KSMSettings(K2SettingsModule):
+settings['TraceSampleRate'] = {'perSession': False,
+                               'mutable': True,
+                               'default': 0,
+                               'validator': _rate_validator
+                               }
+settings['TraceSampleRate']['description'] = \
+    "The fraction of commands to trace, from 0 (none) to 1 (all).  Traces " \
+    + "record how long each step of a command takes, and can be exported " \
+    + "using the TRACE DUMP command."
+
+settings['RequestTimeout'] = {'perSession': True,
+                              'mutable': True,
+                              'default': 5,
+                              'validator': _timeout_validator
+                              }
+settings['RequestTimeout']['description'] = \
+    "The number of seconds that the public component waits for the " \
+    + "private component to answer a request.  After this, the client is " \
+    + "told that the request timed out, and the private component drops the " \
+    + "request if it has not started it yet.  Clients that give up sooner " \
+    + "should set this to match."
+
+
+class K2KSMSettings(K2SchemaSettingsModule):
     '''
     K2KSMSettings provides access to all of the settings for the K2KSM server.
     The work of storing settings is handled by the L{K2SettingsModule}
-    superclass.  We just provide the list of settings and their properties.
+    superclass, and the accessors are generated from the L{settings} schema by
+    L{K2SchemaSettingsModule}.
     '''
+    schema = settings
 
 
-    @staticmethod
-    def settingsList():
-        '''
-        Returns a list of all of the setting names that this module recognizes.
-        
-        @rtype: List
-        @return: A sequence of strings.
-        '''
-        return settings.keys()
-    
-    
-    @staticmethod
-    def nameValid(name):
-        '''
-        Returns true if the name provided is a valid setting name.
-        
-        @param name: The name of the setting.
-        @type name: A string.
-        
-        @rtype: Boolean
-        @return: True if the setting is recognized, false otherwise.
-        '''
-        return (name in settings)
-    
-    
-    @staticmethod
-    def description(name):
-        '''
-        Returns a human-readable description of the named setting.
-        
-        @param name: The name of the setting.
-        @type name: A string.
-        
-        @rtype: String
-        @return: A human-readable description of the named setting.
-        
-        @raise KeyError: Thrown if the setting name is not recognized.
-        '''
-        return settings[name]['description']
-    
-    
-    @staticmethod
-    def perSession(name):
-        '''
-        Returns true if the setting is session-specific, false otherwise.
-        
-        @param name: The name of the setting.
-        @type name: A string.
-        
-        @rtype: Boolean
-        @return: True if the setting is session-specific, false otherwise.
-        
-        @raise KeyError: Thrown if the setting name is not recognized.
+    @classmethod
+    def attach(cls, tracer, k2settings, moduleID='K2KSM'):
         '''
-        return settings[name]['perSession']
-    
-    
-    @staticmethod
-    def mutable(name):
-        '''
-        Returns true of the setting can be changed after server start.
-        
-        @param name: The name of the setting.
-        @type name: String
-        
-        @rtype: Boolean
-        @return: True if the setting can be changed after server
-        start; false otherwise.
-        
-        @raise KeyError: Thrown if the setting name is not recognized.
-        '''
-        return settings[name]['mutable']
-    
-    
-    @staticmethod
-    def required(name):
-        '''
-        Returns true if the setting must be set before settings are finalized.
-        
-        NOTE: Settings that are required should not have a default.
-        
-        @param name: The name of the setting.
-        @type name: A string.
-        
-        @rtype: Boolean
-        @return: True if the setting can be changed after server
-        start; false otherwise.
-        
-        @raise KeyError: Thrown if the setting name is not recognized.
-        '''
-        # I'm not requiring the required key in my settings hashes
-        if ('required' in settings[name]):
-            return settings[name]['required']
-        else:
-            return False
-    
-    
-    @staticmethod
-    def default(name):
-        '''
-        Returns the default value for a setting, or None if the setting does
-        not have a default value.
-        
-        @param name: The name of the setting.
-        @type name: A string.
-        
-        @return: The default value for the setting (which might be None).
-        
-        @raise KeyError: Thrown if the setting name is not recognized.
-        '''
-        # I'm not requiring the default key in my hashes
-        if ('default' in settings[name]):
-            return settings[name]['default']
-        else:
-            return None
-    
-    @staticmethod
-    def settingValid(name, value):
-        '''
-        Returns true if the value provided for the named setting is valid.
-        
-        @param name: The name of the setting.
-        @type name: A string.
-        
-        @param value: The proposed value for the setting.
-        
-        @rtype: Boolean
-        @return: True if the value provided is valid for the
-        setting; false otherwise.
-        
-        @raise KeyError: Thrown if the setting name is not recognized.
+        Register the K2KSM settings, and apply the TraceSampleRate setting to
+        a tracer now and whenever it changes.
+
+        @param tracer: The tracer to configure.
+        @type tracer: K2Tracer
+
+        @param k2settings: The settings to register with.
+        @type k2settings: K2Settings
+
+        @param moduleID: The module ID to register as.
+        @type moduleID: String
         '''
-        return settings[name]['validator'](value)
+        def apply(moduleID):
+            tracer.sampleRate = float(k2settings.settingGet(
+                moduleID + '.TraceSampleRate'))
+        cls.attachApply(k2settings, moduleID, apply)
@@ -0,0 +1,83 @@
+'''
+All of the settings for the KEYCACHE module are defined here.  They set the
+limits of the private component's key cache (see L{k2ksm.keycache}), and may
+be changed while the server is running.
+'''
+
+from ..keycache import K2_KEYCACHE_BYTES, K2_KEYCACHE_ENTRIES, \
+                       K2_KEYCACHE_TTL
+from .schema import K2SchemaSettingsModule, positiveIntValidator
+
+__all__ = ('K2KeyCacheSettings',)
+
+
+
+def _positive_validator(value):
+    # The value must be a number above 0
+    try:
+        value = float(value)
+    except:
+        return False
+    return (value > 0)
+
+
+#: settings is a hash that details what the KEYCACHE module's settings are.
+settings = {}
+
+settings['Entries'] = {'perSession': False,
+                       'mutable': True,
+                       'default': K2_KEYCACHE_ENTRIES,
+                       'validator': positiveIntValidator,
+                       }
+settings['Entries']['description'] = \
+    "The most keys to keep in the key cache.  When the cache is full, the " \
+    + "least-recently used key is wiped."
+
+settings['Bytes'] = {'perSession': False,
+                     'mutable': True,
+                     'default': K2_KEYCACHE_BYTES,
+                     'validator': positiveIntValidator,
+                     }
+settings['Bytes']['description'] = \
+    "The most bytes of keys to keep in the key cache."
+
+settings['TTL'] = {'perSession': False,
+                   'mutable': True,
+                   'default': K2_KEYCACHE_TTL,
+                   'validator': _positive_validator,
+                   }
+settings['TTL']['description'] = \
+    "The number of seconds that a key is kept in the key cache.  Shorter " \
+    + "times mean that keys spend less time in memory, but more keys are " \
+    + "read from storage."
+
+
+class K2KeyCacheSettings(K2SchemaSettingsModule):
+    '''
+    K2KeyCacheSettings holds the settings for the KEYCACHE module.  Use
+    L{attach} to register it, and to have changes take effect.
+    '''
+    schema = settings
+
+
+    @classmethod
+    def attach(cls, keyCache, k2settings, moduleID='KEYCACHE'):
+        '''
+        Register the KEYCACHE settings, and apply them to a key cache now and
+        whenever they change.
+
+        @param keyCache: The key cache to configure.
+        @type keyCache: K2KeyCache
+
+        @param k2settings: The settings to register with.
+        @type k2settings: K2Settings
+
+        @param moduleID: The module ID to register as.
+        @type moduleID: String
+        '''
+        def apply(moduleID):
+            keyCache.configure(
+                int(k2settings.settingGet(moduleID + '.Entries')),
+                float(k2settings.settingGet(moduleID + '.TTL')),
+                int(k2settings.settingGet(moduleID + '.Bytes')))
+        cls.attachApply(k2settings, moduleID, apply)
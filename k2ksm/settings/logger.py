@@ -0,0 +1,141 @@
+'''
+All of the settings for the LOGGER module are defined here.  They control the
+log level and sampling of individual modules, and may be changed while the
+server is running.
+'''
+
+import logging
+from .schema import K2SchemaSettingsModule
+
+__all__ = ('K2LoggerSettings', 'parseLevels', 'parseSampling')
+
+
+
+def _pairs(value):
+    # Split "A=x B=y" into a list of (A, x) tuples
+    pairs = []
+    for item in str(value).split():
+        (module, sep, spec) = item.partition('=')
+        if ((module == '') or (sep == '') or (spec == '')):
+            raise ValueError('%s is not in the form Module=value' % item)
+        pairs.append((module, spec))
+    return pairs
+
+
+def parseLevels(value):
+    '''
+    Parse the ModuleLevels setting.
+
+    @param value: Space-separated items, like "TOTP=DEBUG Settings=WARNING".
+    @type value: String
+
+    @rtype: Hash
+    @return: Module names and level numbers.
+
+    @raise ValueError: Thrown if the value can not be parsed.
+    '''
+    levels = {}
+    for (module, levelName) in _pairs(value):
+        level = logging.getLevelName(levelName.upper())
+        if (not isinstance(level, int)):
+            raise ValueError('Unknown log level %s' % levelName)
+        levels[module] = level
+    return levels
+
+
+def parseSampling(value):
+    '''
+    Parse the ModuleSampling setting.
+
+    @param value: Space-separated items, like "TOTP.AUTH=0.1 HOTP=50/s".  A
+    number from 0 to 1 is the fraction of messages to keep; a number followed
+    by "/s" is the most messages to keep each second.
+    @type value: String
+
+    @rtype: Hash
+    @return: Module names and (rate, perSecond) tuples.
+
+    @raise ValueError: Thrown if the value can not be parsed.
+    '''
+    sampling = {}
+    for (module, spec) in _pairs(value):
+        if (spec.endswith('/s')):
+            perSecond = float(spec[:-2])
+            if (perSecond <= 0):
+                raise ValueError('%s must be more than 0/s' % spec)
+            sampling[module] = (None, perSecond)
+        else:
+            rate = float(spec)
+            if ((rate < 0) or (rate > 1)):
+                raise ValueError('%s must be from 0 to 1' % spec)
+            sampling[module] = (rate, None)
+    return sampling
+
+
+def _parses(parser):
+    # Make a validator from a parser
+    def validator(value):
+        try:
+            parser(value)
+        except (ValueError, TypeError):
+            return False
+        return True
+    return validator
+
+
+#: settings is a hash that details what the LOGGER module's settings are.
+settings = {}
+
+settings['ModuleLevels'] = {'perSession': False,
+                            'mutable': True,
+                            'default': '',
+                            'validator': _parses(parseLevels),
+                            }
+settings['ModuleLevels']['description'] = \
+    "Log levels for individual modules, which override the server's log " \
+    + "level, as space-separated Module=LEVEL items.  For example, " \
+    + "\"TOTP=DEBUG Settings=WARNING\" logs everything from TOTP, but only " \
+    + "warnings and errors from Settings."
+
+settings['ModuleSampling'] = {'perSession': False,
+                              'mutable': True,
+                              'default': '',
+                              'validator': _parses(parseSampling),
+                              }
+settings['ModuleSampling']['description'] = \
+    "Sampling of INFO and DEBUG messages from individual modules, as " \
+    + "space-separated Module=sample items.  The sample is either the " \
+    + "fraction of messages to log (like \"TOTP.AUTH=0.1\"), or the most " \
+    + "messages to log each second (like \"TOTP.AUTH=50/s\").  Sampled " \
+    + "audit events are still written to the audit log."
+
+
+class K2LoggerSettings(K2SchemaSettingsModule):
+    '''
+    K2LoggerSettings holds the settings for the LOGGER module.  Use
+    L{attach} to register it, and to have changes take effect.
+    '''
+    schema = settings
+
+
+    @classmethod
+    def attach(cls, k2logger, k2settings, moduleID='LOGGER'):
+        '''
+        Register the LOGGER settings, and apply them to a K2Logger now and
+        whenever they change.
+
+        @param k2logger: The logger to configure.
+        @type k2logger: K2Logger
+
+        @param k2settings: The settings to register with.
+        @type k2settings: K2Settings
+
+        @param moduleID: The module ID to register as.
+        @type moduleID: String
+        '''
+        def apply(moduleID):
+            k2logger.configureModules(
+                parseLevels(k2settings.settingGet(moduleID + '.ModuleLevels')),
+                parseSampling(k2settings.settingGet(moduleID
+                                                    + '.ModuleSampling')))
+        cls.attachApply(k2settings, moduleID, apply)
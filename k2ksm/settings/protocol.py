@@ -0,0 +1,52 @@
+'''
+All of the settings for the PROTOCOL module are defined here.  They limit
+what a client may send (see L{k2ksm.protocol.parser}).  Changes apply to
+connections made after the change.
+'''
+
+from ..protocol.jsonstream import K2_MAX_JSON_DEPTH
+from ..protocol.parser import K2_MAX_BLOCK_SIZE, K2_MAX_LINE_LENGTH
+from .schema import K2SchemaSettingsModule, positiveIntValidator
+
+__all__ = ('K2ProtocolSettings',)
+
+
+
+#: settings is a hash that details what the PROTOCOL module's settings are.
+settings = {}
+
+settings['MaxLineLength'] = {'perSession': False,
+                             'mutable': True,
+                             'default': K2_MAX_LINE_LENGTH,
+                             'validator': positiveIntValidator,
+                             }
+settings['MaxLineLength']['description'] = \
+    "The longest line, in bytes, that a client may send.  Longer lines are " \
+    + "rejected with a PROTOCOL error, without being stored."
+
+settings['MaxBlockSize'] = {'perSession': False,
+                            'mutable': True,
+                            'default': K2_MAX_BLOCK_SIZE,
+                            'validator': positiveIntValidator,
+                            }
+settings['MaxBlockSize']['description'] = \
+    "The most bytes that a client may send after a MORE response.  Larger " \
+    + "blocks are rejected with a PROTOCOL error."
+
+settings['MaxJSONDepth'] = {'perSession': False,
+                            'mutable': True,
+                            'default': K2_MAX_JSON_DEPTH,
+                            'validator': positiveIntValidator,
+                            }
+settings['MaxJSONDepth']['description'] = \
+    "How deeply the JSON data sent after a MORE response may be nested.  " \
+    + "The top-level object counts as 1."
+
+
+class K2ProtocolSettings(K2SchemaSettingsModule):
+    '''
+    K2ProtocolSettings holds the settings for the PROTOCOL module.  Parsers
+    for new connections are made with L{k2ksm.protocol.parser.parserFor},
+    and JSON decoders with L{k2ksm.protocol.jsonstream.jsonStreamFor}.
+    '''
+    schema = settings
@@ -0,0 +1,82 @@
+'''
+All of the settings for the SCHEDULER module are defined here.  They set how
+many requests of each class may wait for the private component (see
+L{k2ksm.scheduler}), and may be changed while the server is running.
+'''
+
+from ..scheduler import K2_CLASS_ADMIN, K2_CLASS_AUTH, K2_CLASS_BULK, \
+                        K2_SCHEDULER_LIMITS
+from .schema import K2SchemaSettingsModule, positiveIntValidator
+
+__all__ = ('K2SchedulerSettings',)
+
+
+
+#: Each setting, and the class whose queue it limits.
+_queues = (('AuthQueue', K2_CLASS_AUTH),
+           ('AdminQueue', K2_CLASS_ADMIN),
+           ('BulkQueue', K2_CLASS_BULK),
+           )
+
+
+#: settings is a hash that details what the SCHEDULER module's settings are.
+settings = {}
+
+settings['AuthQueue'] = {'perSession': False,
+                         'mutable': True,
+                         'default': K2_SCHEDULER_LIMITS[K2_CLASS_AUTH],
+                         'validator': positiveIntValidator,
+                         }
+settings['AuthQueue']['description'] = \
+    "The most AUTH requests that may wait to be run.  Once this many are " \
+    + "waiting, new AUTH requests are answered with an \"overloaded\" error."
+
+settings['AdminQueue'] = {'perSession': False,
+                          'mutable': True,
+                          'default': K2_SCHEDULER_LIMITS[K2_CLASS_ADMIN],
+                          'validator': positiveIntValidator,
+                          }
+settings['AdminQueue']['description'] = \
+    "The most administrative requests (such as USER CREATE) that may wait " \
+    + "to be run."
+
+settings['BulkQueue'] = {'perSession': False,
+                         'mutable': True,
+                         'default': K2_SCHEDULER_LIMITS[K2_CLASS_BULK],
+                         'validator': positiveIntValidator,
+                         }
+settings['BulkQueue']['description'] = \
+    "The most bulk requests (USER IMPORT and USER EXPORT) that may wait to " \
+    + "be run."
+
+
+class K2SchedulerSettings(K2SchemaSettingsModule):
+    '''
+    K2SchedulerSettings holds the settings for the SCHEDULER module.  Use
+    L{attach} to register it, and to have changes take effect.
+    '''
+    schema = settings
+
+
+    @classmethod
+    def attach(cls, scheduler, k2settings, moduleID='SCHEDULER'):
+        '''
+        Register the SCHEDULER settings, and apply them to a scheduler now and
+        whenever they change.
+
+        @param scheduler: The scheduler to configure.
+        @type scheduler: K2Scheduler
+
+        @param k2settings: The settings to register with.
+        @type k2settings: K2Settings
+
+        @param moduleID: The module ID to register as.
+        @type moduleID: String
+        '''
+        def apply(moduleID):
+            limits = {}
+            for (name, queueClass) in _queues:
+                limits[queueClass] = int(k2settings.settingGet(moduleID + '.'
+                                                               + name))
+            scheduler.configure(limits)
+        cls.attachApply(k2settings, moduleID, apply)
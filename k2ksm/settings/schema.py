@@ -0,0 +1,265 @@
+'''
+A declarative way to define a module's settings.
+
+Instead of implementing every method of L{K2SettingsModule}, a module can
+describe its settings in a hash, and subclass L{K2SchemaSettingsModule}::
+
+    class AESSettings(K2SchemaSettingsModule):
+        schema = {'KeyLength': {'perSession': False,
+                                'mutable': False,
+                                'default': 256,
+                                'validator': _keylength_validator,
+                                'description': 'The AES key length.',
+                                },
+                  }
+
+When the class is defined, each entry of the schema is checked and compiled
+into an immutable L{K2SettingSpec}, and the accessor methods (perSession,
+default, settingValid, etc.) are generated from the specs.  This means that
+mistakes in a schema are caught when the module is imported, and that the
+accessors do not have to look for optional keys on every call.
+'''
+
+from abc import ABCMeta
+from ..exceptions import K2SchemaError
+from . import K2SettingsModule
+
+__all__ = ('K2SettingSpec', 'K2SchemaMeta', 'K2SchemaSettingsModule',
+           'positiveIntValidator')
+
+
+
+class K2SettingSpec(object):
+    '''
+    The compiled, read-only definition of one setting.
+
+    @ivar name: The name of the setting.
+    @ivar description: A human-readable description of the setting.
+    @ivar perSession: True if the setting is session-specific.
+    @ivar mutable: True if the setting can be changed after server start.
+    @ivar required: True if the setting must be set before settings are
+    finalized.
+    @ivar default: The default value, which might be None.
+    @ivar validator: A function that takes a value, and returns True if it is
+    valid.
+    '''
+    __slots__ = ('name', 'description', 'perSession', 'mutable', 'required',
+                 'default', 'validator')
+
+    #: The keys that every schema entry must have.
+    requiredKeys = ('description', 'perSession', 'mutable', 'validator')
+
+    #: The keys that a schema entry may leave out, with their defaults.
+    optionalKeys = {'required': False, 'default': None}
+
+
+    def __init__(self, name, description, perSession, mutable, validator,
+                 required=False, default=None):
+        '''
+        Create a setting spec.
+
+        @raise K2SchemaError: Thrown if any of the properties have the wrong
+        type.
+        '''
+        if (not isinstance(name, basestring)):
+            raise K2SchemaError('Setting name %r is not a string' % (name,))
+        if (not isinstance(description, basestring)):
+            raise K2SchemaError('Setting %s has no description' % name)
+        for (key, value) in (('perSession', perSession),
+                             ('mutable', mutable),
+                             ('required', required)):
+            if (not isinstance(value, bool)):
+                raise K2SchemaError('Setting %s: %s must be True or False'
+                                    % (name, key))
+        if (not callable(validator)):
+            raise K2SchemaError('Setting %s: validator is not callable'
+                                % name)
+
+        setField = object.__setattr__
+        setField(self, 'name', name)
+        setField(self, 'description', description)
+        setField(self, 'perSession', perSession)
+        setField(self, 'mutable', mutable)
+        setField(self, 'required', required)
+        setField(self, 'default', default)
+        setField(self, 'validator', validator)
+
+
+    @classmethod
+    def fromDict(cls, name, entry):
+        '''
+        Compile one schema entry.
+
+        @param name: The name of the setting.
+        @type name: String
+
+        @param entry: The setting's properties.  See L{requiredKeys} and
+        L{optionalKeys}.
+        @type entry: Hash
+
+        @rtype: K2SettingSpec
+
+        @raise K2SchemaError: Thrown if the entry is missing a key, has a key
+        that is not recognized, or has a property with the wrong type.
+        '''
+        if (not isinstance(entry, dict)):
+            raise K2SchemaError('Setting %s is not defined by a hash' % name)
+        for key in cls.requiredKeys:
+            if (key not in entry):
+                raise K2SchemaError('Setting %s is missing %s' % (name, key))
+        for key in entry:
+            if ((key not in cls.requiredKeys)
+                and (key not in cls.optionalKeys)):
+                raise K2SchemaError('Setting %s has unknown key %s'
+                                    % (name, key))
+        return cls(name, **entry)
+
+
+    def __setattr__(self, name, value):
+        raise AttributeError('K2SettingSpec objects are read-only')
+
+
+    def __delattr__(self, name):
+        raise AttributeError('K2SettingSpec objects are read-only')
+
+
+    def __repr__(self):
+        return '<K2SettingSpec %s>' % self.name
+
+
+
+class K2SchemaMeta(ABCMeta):
+    '''
+    The metaclass of L{K2SchemaSettingsModule}.  When a class with a C{schema}
+    hash is defined, the schema is compiled into the class's C{specs} hash,
+    and accessors are generated for any of the L{K2SettingsModule} methods
+    that the class does not define itself.
+
+    @undocumented: __new__
+    '''
+
+    def __new__(mcs, name, bases, namespace):
+        if ('schema' in namespace):
+            specs = {}
+            for settingName in namespace['schema']:
+                specs[settingName] = K2SettingSpec.fromDict(
+                    settingName, namespace['schema'][settingName])
+            namespace['specs'] = specs
+            accessors = mcs.accessors(specs)
+            for accessor in accessors:
+                if (accessor not in namespace):
+                    namespace[accessor] = accessors[accessor]
+        return ABCMeta.__new__(mcs, name, bases, namespace)
+
+
+    @staticmethod
+    def accessors(specs):
+        '''
+        Generate the accessor methods for a set of specs.  Each property is
+        copied into its own hash, so that most accessors are just a bound
+        dict method, with no Python code run on each call.  As with a
+        hand-written module, the accessors throw KeyError for unknown names.
+
+        @param specs: The compiled settings, keyed by name.
+        @type specs: Hash of K2SettingSpec
+
+        @rtype: Hash
+        @return: The accessors, keyed by method name.
+        '''
+        names = tuple(sorted(specs))
+        descriptions = {}
+        perSession = {}
+        mutable = {}
+        required = {}
+        defaults = {}
+        validators = {}
+        for name in names:
+            spec = specs[name]
+            descriptions[name] = spec.description
+            perSession[name] = spec.perSession
+            mutable[name] = spec.mutable
+            required[name] = spec.required
+            defaults[name] = spec.default
+            validators[name] = spec.validator
+
+        def settingValid(name, value):
+            return validators[name](value)
+
+        return {'settingsList': staticmethod(lambda: list(names)),
+                'nameValid': staticmethod(specs.__contains__),
+                'description': staticmethod(descriptions.__getitem__),
+                'perSession': staticmethod(perSession.__getitem__),
+                'mutable': staticmethod(mutable.__getitem__),
+                'required': staticmethod(required.__getitem__),
+                'default': staticmethod(defaults.__getitem__),
+                'settingValid': staticmethod(settingValid),
+                }
+
+
+
+def positiveIntValidator(value):
+    '''
+    A validator for settings that must be an integer, at least 1.
+
+    @param value: The value to check.
+    @type value: String or Integer
+    @rtype: Boolean
+    '''
+    try:
+        value = int(value)
+    except:
+        return False
+    return (value >= 1)
+
+
+
+class K2SchemaSettingsModule(K2SettingsModule):
+    '''
+    A L{K2SettingsModule} whose settings are defined by a schema.  Subclasses
+    only need to set C{schema}, a hash of setting name to properties.  Each
+    setting's properties are a hash with these keys:
+
+     - description: A human-readable description (required).
+     - perSession: True if the setting is session-specific (required).
+     - mutable: True if the setting can be changed after server start
+       (required).
+     - validator: A function that takes a value, and returns True if it is
+       valid (required).
+     - required: True if the setting must be set (optional, default False).
+     - default: The default value (optional, default None).
+
+    @cvar specs: The compiled schema, a hash of setting name to
+    L{K2SettingSpec}.  This is set when the subclass is defined.
+
+    @undocumented: __metaclass__
+    '''
+    __metaclass__ = K2SchemaMeta
+
+
+    @classmethod
+    def attachApply(cls, k2settings, moduleID, apply):
+        '''
+        Register the module, and call a function now and whenever the
+        module's settings change.  This is the work of each module's
+        C{attach} method.  If the module is already registered (as it is in
+        settings restored from a snapshot), it is not registered again.
+
+        @param k2settings: The settings to register with.
+        @type k2settings: K2Settings
+
+        @param moduleID: The module ID to register as.
+        @type moduleID: String
+
+        @param apply: The function, which is given the module ID.
+        @type apply: Function
+
+        @raise KeyError: Thrown if the module ID is registered to a
+        different class.
+        '''
+        registered = k2settings.moduleClass(moduleID)
+        if (registered == None):
+            k2settings.register(moduleID, cls)
+        elif (not issubclass(registered, cls)):
+            raise KeyError('moduleID %s already registered' % moduleID)
+        k2settings.watch(moduleID, apply)
+        apply(moduleID)
@@ -0,0 +1,184 @@
+'''
+Snapshots of the K2Settings state, used for fast warm restarts.
+
+Starting the private component means parsing the configuration, importing
+every module and validating every setting, and AUTH requests queue up on the
+public component until that is done.  Instead, a finalized L{K2Settings} can
+be written to a snapshot with L{K2Settings.snapshot}, and the next start can
+use L{K2Settings.restore}, which reads the snapshot back without parsing or
+validating anything.
+
+A snapshot records every file that settings were loaded from (the
+configuration file, plus any argfiles), with its modification time and
+SHA-256 hash.  A file that did not exist (the configuration file is
+optional) is recorded as absent.  If any of them has changed, or an absent
+file has appeared, the snapshot is stale, and the server should start
+normally.
+
+A snapshot file is a fixed header, followed by a JSON payload.  The header
+has these fields, in network byte order:
+
+ - Magic (8 bytes): "K2KSMSNP"
+ - Version (unsigned short): L{K2_SNAPSHOT_VERSION}
+ - Flags (unsigned short): L{K2_SNAPSHOT_SESSIONS} if session settings are
+   included.
+ - Length (unsigned long long): The length of the payload.
+ - Checksum (32 bytes): The SHA-256 hash of the payload.
+'''
+
+from hashlib import sha256
+import json
+from mmap import mmap, ACCESS_READ
+import os
+from struct import calcsize, pack, unpack_from
+
+__all__ = ('K2_SNAPSHOT_VERSION', 'K2_SNAPSHOT_SESSIONS', 'sourceStamp',
+           'sourcesCurrent', 'writeSnapshot', 'readSnapshot')
+
+
+
+K2_SNAPSHOT_MAGIC = 'K2KSMSNP'
+'''The first bytes of every snapshot file.'''
+
+K2_SNAPSHOT_VERSION = 1
+'''The snapshot format version written by this code.'''
+
+K2_SNAPSHOT_SESSIONS = 0x0001
+'''The header flag that is set when session settings are included.'''
+
+_HEADER = '>8sHHQ32s'
+_HEADER_SIZE = calcsize(_HEADER)
+
+_READ_SIZE = 64 * 1024
+
+
+
+def sourceStamp(path):
+    '''
+    Identify the current contents of a file.
+
+    @param path: The path to the file.
+    @type path: String
+
+    @rtype: List
+    @return: The path, modification time, and SHA-256 hash (in hex).  If
+    the file does not exist, the modification time and hash are None.
+
+    @raise IOError: Thrown if the file can not be read.
+    '''
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        if (os.path.lexists(path)):
+            raise
+        return [path, None, None]
+    digest = sha256()
+    sourceFile = open(path, 'rb')
+    try:
+        while True:
+            data = sourceFile.read(_READ_SIZE)
+            if (data == ''):
+                break
+            digest.update(data)
+    finally:
+        sourceFile.close()
+    return [path, mtime, digest.hexdigest()]
+
+
+def sourcesCurrent(stamps):
+    '''
+    Check if files are unchanged since they were stamped.
+
+    @param stamps: A list of stamps made by L{sourceStamp}.
+    @type stamps: List
+
+    @rtype: Boolean
+    @return: True if every file has the same modification time and hash,
+    and every file that was absent still does not exist.
+    '''
+    for (path, mtime, digest) in stamps:
+        if (mtime == None):
+            if (os.path.lexists(path)):
+                return False
+            continue
+        try:
+            if (os.stat(path).st_mtime != mtime):
+                return False
+            if (sourceStamp(path)[2] != digest):
+                return False
+        except (IOError, OSError):
+            return False
+    return True
+
+
+def writeSnapshot(path, state):
+    '''
+    Write a snapshot.  The snapshot is written to a temporary file which is
+    then renamed, so a snapshot that is being read is never half-written.
+
+    @param path: Where to write the snapshot.
+    @type path: String
+
+    @param state: The state to save, from L{K2Settings.state}.  All of the
+    setting values must be JSON-serializable.
+    @type state: Hash
+
+    @raise TypeError: Thrown if a setting value can not be serialized.
+    '''
+    payload = json.dumps(state, sort_keys=True)
+    flags = 0
+    if (state.get('sessions') != None):
+        flags |= K2_SNAPSHOT_SESSIONS
+    header = pack(_HEADER, K2_SNAPSHOT_MAGIC, K2_SNAPSHOT_VERSION, flags,
+                  len(payload), sha256(payload).digest())
+
+    tempPath = '%s.%d.tmp' % (path, os.getpid())
+    snapshotFile = open(tempPath, 'wb')
+    try:
+        snapshotFile.write(header)
+        snapshotFile.write(payload)
+        snapshotFile.flush()
+        os.fsync(snapshotFile.fileno())
+    finally:
+        snapshotFile.close()
+    os.rename(tempPath, path)
+
+
+def readSnapshot(path):
+    '''
+    Read a snapshot.  The file is memory-mapped, and the payload is checked
+    against the checksum before it is decoded.
+
+    @param path: The path to the snapshot.
+    @type path: String
+
+    @rtype: Hash
+    @return: The state that was saved.
+
+    @raise IOError: Thrown if the file can not be read.
+    @raise ValueError: Thrown if the file is not a snapshot, was written by
+    an unsupported version, or is corrupt.
+    '''
+    snapshotFile = open(path, 'rb')
+    try:
+        size = os.fstat(snapshotFile.fileno()).st_size
+        if (size < _HEADER_SIZE):
+            raise ValueError('%s is too short to be a snapshot' % path)
+        data = mmap(snapshotFile.fileno(), 0, access=ACCESS_READ)
+    finally:
+        snapshotFile.close()
+
+    try:
+        (magic, version, flags, length, checksum) = unpack_from(_HEADER, data)
+        if (magic != K2_SNAPSHOT_MAGIC):
+            raise ValueError('%s is not a snapshot' % path)
+        if (version != K2_SNAPSHOT_VERSION):
+            raise ValueError('%s is snapshot version %d, not %d'
+                             % (path, version, K2_SNAPSHOT_VERSION))
+        if (_HEADER_SIZE + length != size):
+            raise ValueError('%s is truncated' % path)
+        if (sha256(buffer(data, _HEADER_SIZE)).digest() != checksum):
+            raise ValueError('%s has a bad checksum' % path)
+        return json.loads(data[_HEADER_SIZE:])
+    finally:
+        data.close()
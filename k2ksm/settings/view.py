@@ -0,0 +1,167 @@
+'''
+Per-session views of settings, for use by the code handling a connection.
+
+L{K2Settings.newSession} returns a L{K2SessionSettings} for the new session.
+Settings are read from it with attribute access::
+
+    view = settings.newSession()
+    ...
+    if (view.K2KSM.testMode):
+        ...
+
+The first time a setting is read, it is looked up with
+L{K2Settings.settingGet}, and the value is kept as an ordinary attribute of the
+module's view, so later reads do not call any Python code at all.
+
+Cached values are thrown away when they might have changed.  Changes to the
+session's own settings clear just that setting.  Changes to server-wide
+settings bump a generation counter for the module, which is checked each time
+a module's view is fetched from the session view; so a handler that keeps a
+module's view in a local variable will see a consistent set of values until
+it fetches the module's view again.
+'''
+
+__all__ = ('K2SessionSettings',)
+
+
+
+class _K2ModuleView(object):
+    '''
+    The settings of one module, as seen by one session.  Cached values are
+    stored in the instance dict.
+    '''
+    __slots__ = ('_view', '_moduleID', '_generation', '__dict__')
+
+    def __init__(self, view, moduleID, generation):
+        self._view = view
+        self._moduleID = moduleID
+        self._generation = generation
+
+    def __getattr__(self, name):
+        if (name[:1] == '_'):
+            raise AttributeError(name)
+        view = self._view
+        value = view.settings.settingGet(self._moduleID + '.' + name,
+                                         view.sessionID)
+        self.__dict__[name] = value
+        return value
+
+    def __getitem__(self, name):
+        try:
+            return self.__dict__[name]
+        except KeyError:
+            return self.__getattr__(name)
+
+    def __repr__(self):
+        return '<settings for %s in session %s>' % (self._moduleID,
+                                                    self._view.sessionID)
+
+
+
+class K2SessionSettings(object):
+    '''
+    A read-only view of the settings for one session.  Each registered module
+    is an attribute of the view, and each setting is an attribute of the
+    module; settings may also be read with their full name, like
+    C{view['K2KSM.testMode']}.
+
+    @ivar settings: The settings this is a view of.
+    @type settings: K2Settings
+
+    @ivar sessionID: The session's unique ID.
+    @type sessionID: Integer
+    '''
+    __slots__ = ('settings', 'sessionID', '__generation', '__seen',
+                 '__moduleGenerations', '__modules')
+
+
+    def __init__(self, settings, sessionID, generation, moduleGenerations):
+        '''
+        Create a view.  This is done by L{K2Settings.newSession}.
+
+        @param settings: The settings to view.
+        @type settings: K2Settings
+
+        @param sessionID: The session's unique ID.
+
+        @param generation: A one-item list, holding a counter that is
+        incremented whenever any server-wide setting changes.
+        @type generation: List
+
+        @param moduleGenerations: The per-module generation counters, keyed
+        by module ID.  Every registered module has one.
+        @type moduleGenerations: Hash
+        '''
+        self.settings = settings
+        self.sessionID = sessionID
+        self.__generation = generation
+        self.__seen = generation[0]
+        self.__moduleGenerations = moduleGenerations
+        self.__modules = {}
+
+
+    def __getattr__(self, moduleID):
+        if (moduleID[:1] == '_'):
+            raise AttributeError(moduleID)
+        if (self.__generation[0] != self.__seen):
+            self.__refresh()
+        try:
+            return self.__modules[moduleID]
+        except KeyError:
+            pass
+        if (moduleID not in self.__moduleGenerations):
+            raise AttributeError('Module %s is not registered' % moduleID)
+        module = _K2ModuleView(self, moduleID,
+                               self.__moduleGenerations[moduleID])
+        self.__modules[moduleID] = module
+        return module
+
+
+    def __getitem__(self, name):
+        '''
+        Get a setting's value, by its full name.
+
+        @param name: The fully-qualified name of the setting, in the form
+        "moduleID.settingName".
+
+        @raise KeyError: Thrown if the module is not registered.
+
+        @raise AttributeError: Thrown if the setting name is invalid.
+        '''
+        moduleID, settingName = name.split('.', 1)
+        try:
+            module = self.__getattr__(moduleID)
+        except AttributeError:
+            raise KeyError('Module %s is not registered' % moduleID)
+        return module[settingName]
+
+
+    def discard(self, moduleID, settingName=None):
+        '''
+        Forget cached values.  This is called by L{K2Settings.settingSet}
+        when one of the session's own settings changes.
+
+        @param moduleID: The module whose values should be forgotten.
+
+        @param settingName: The setting to forget.  If not given, all of the
+        module's values are forgotten.
+        '''
+        module = self.__modules.get(moduleID)
+        if (module == None):
+            return
+        if (settingName == None):
+            module.__dict__.clear()
+        else:
+            module.__dict__.pop(settingName, None)
+
+
+    def __refresh(self):
+        # Some server-wide setting has changed.  Forget the values of the
+        # modules whose generation has moved on.
+        self.__seen = self.__generation[0]
+        for moduleID in self.__modules:
+            module = self.__modules[moduleID]
+            current = self.__moduleGenerations[moduleID]
+            if (module._generation != current):
+                module.__dict__.clear()
+                module._generation = current
@@ -0,0 +1,150 @@
+'''
+Single-flight calls: when several threads ask for the same thing at the same
+time, only the first one does the work, and the rest wait for its result.
+This is used where a slow call (a directory search, a trip to the private
+component) may be asked for again before the first call has finished.
+'''
+
+import sys
+from threading import Event, Lock
+from .exceptions import K2TimeoutError
+
+
+
+class _K2Call(object):
+    '''
+    One call in progress.  The waiters are woken by the event once the result
+    (or the exception info) has been set.
+    '''
+    __slots__ = ('event', 'result', 'error')
+
+
+
+class K2SingleFlight(object):
+    '''
+    K2SingleFlight runs calls, making sure that only one call for each key is
+    running at a time.  It is safe to use from multiple threads.
+
+    @ivar maxKeys: The most calls that can be in progress at once, or None
+    for no limit.  Once the limit is reached, new calls are run without being
+    shared.
+    @type maxKeys: Integer
+
+    @ivar calls: The number of calls that were run.
+    @type calls: Integer
+
+    @ivar shared: The number of calls that used the result of another call.
+    @type shared: Integer
+
+    @ivar overflows: The number of calls that could not be shared, because
+    maxKeys calls were already in progress.  These are included in L{calls}.
+    @type overflows: Integer
+
+    @ivar timeouts: The number of waiting calls that gave up.
+    @type timeouts: Integer
+    '''
+
+
+    def __init__(self, maxKeys=None):
+        '''
+        Create a new single-flight table.
+
+        @param maxKeys: The most calls that can be in progress at once, or
+        None for no limit.
+        @type maxKeys: Integer
+
+        @raise ValueError: Thrown if maxKeys is less than 1.
+        '''
+        if ((maxKeys != None) and (maxKeys < 1)):
+            raise ValueError('maxKeys must be at least 1')
+        self.maxKeys = maxKeys
+        self.calls = 0
+        self.shared = 0
+        self.overflows = 0
+        self.timeouts = 0
+        self.__lock = Lock()
+        self.__calls = {}
+
+
+    def __len__(self):
+        '''
+        Returns the number of calls in progress.
+
+        @rtype: Integer
+        '''
+        return len(self.__calls)
+
+
+    def do(self, key, function, timeout=None):
+        '''
+        Run a function, unless a call with the same key is already running,
+        in which case wait for that call and return its result instead.  If
+        the call raises an exception, the same exception is raised in every
+        thread that was waiting for it.
+
+        @param key: Identifies the call.  Must be hashable.
+
+        @param function: The function to run.  It takes no arguments.
+        @type function: Function
+
+        @param timeout: The most seconds to wait for another thread's call,
+        or None to wait for as long as it takes.  This does not limit the
+        call itself.
+        @type timeout: Float
+
+        @return: The function's result.
+
+        @raise K2TimeoutError: Thrown if another thread's call took longer
+        than the timeout.
+        '''
+        self.__lock.acquire()
+        try:
+            call = self.__calls.get(key)
+            if (call != None):
+                self.shared += 1
+                leader = False
+            elif (    (self.maxKeys != None)
+                  and (len(self.__calls) >= self.maxKeys)
+                  ):
+                self.calls += 1
+                self.overflows += 1
+                leader = None
+            else:
+                call = _K2Call()
+                call.event = Event()
+                call.result = None
+                call.error = None
+                self.__calls[key] = call
+                self.calls += 1
+                leader = True
+        finally:
+            self.__lock.release()
+
+        if (leader == None):
+            return function()
+
+        if (not leader):
+            call.event.wait(timeout)
+            if (not call.event.isSet()):
+                self.__lock.acquire()
+                self.timeouts += 1
+                self.__lock.release()
+                raise K2TimeoutError('Gave up waiting after %s seconds'
+                                     % timeout)
+            if (call.error != None):
+                raise call.error[0], call.error[1], call.error[2]
+            return call.result
+
+        try:
+            call.result = function()
+        except:
+            call.error = sys.exc_info()
+        self.__lock.acquire()
+        try:
+            del self.__calls[key]
+        finally:
+            self.__lock.release()
+        call.event.set()
+        if (call.error != None):
+            raise call.error[0], call.error[1], call.error[2]
+        return call.result
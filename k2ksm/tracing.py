@@ -0,0 +1,326 @@
+'''
+Lightweight tracing of protocol commands.  A trace is a tree of timed spans
+(for example: an AUTH command, the hop to the private component, the crypto
+and the counter write).  Only a sample of traces is recorded, as set by the
+K2KSM.TraceSampleRate setting, so that tracing costs almost nothing when it is
+turned off.
+
+Finished spans go into a fixed-size ring buffer per thread, so the most recent
+spans are always available.  The rings of threads that have exited are kept
+until their spans have been exported (up to L{K2_TRACE_DEAD_THREADS} of them),
+and then thrown away.  The TRACE DUMP command (see
+docs/commands/TRACE.rst) exports them in the Chrome trace event JSON format,
+which can be loaded into chrome://tracing or converted into a flame graph.
+
+A span's context can be passed from the public component to the private
+component using L{K2Tracer.header}, so that both halves of a request end up in
+the same trace, with the same session ID.
+'''
+
+import json
+import os
+from random import getrandbits, random
+from threading import Lock, currentThread, local
+import time
+from weakref import ref
+
+# Use a monotonic clock if we have one (Python 3.3+)
+_clock = getattr(time, 'monotonic', time.time)
+
+
+
+K2_TRACE_BUFFER = 4096
+'''The default number of finished spans kept per thread.'''
+
+K2_TRACE_DEAD_THREADS = 16
+'''
+The most ring buffers of exited threads that are kept until the next export.
+'''
+
+
+
+class _K2TraceState(object):
+    '''
+    The tracing state of one thread.
+    '''
+    __slots__ = ('ring', 'index', 'current', 'unsampled', 'null', 'thread',
+                 'owner')
+
+    def __init__(self, size):
+        self.ring = [None] * size
+        self.index = 0
+        self.current = None
+        self.unsampled = 0
+        self.null = _K2NullSpan(self)
+        self.thread = currentThread().getName()
+        self.owner = ref(currentThread())
+
+    def alive(self):
+        # Returns True if the thread that owns this state is still running
+        owner = self.owner()
+        return ((owner != None) and owner.isAlive())
+
+
+
+class _K2NullSpan(object):
+    '''
+    The span returned when a trace is not being sampled.  It records nothing,
+    but makes sure that spans inside it are not sampled either.
+    '''
+    __slots__ = ('state',)
+
+    def __init__(self, state):
+        self.state = state
+
+    def __enter__(self):
+        self.state.unsampled += 1
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.state.unsampled -= 1
+        return False
+
+    sampled = False
+
+
+
+class K2Span(object):
+    '''
+    One timed span.  Spans are context managers; timing starts when the
+    C{with} block is entered, and the span is recorded when it ends.
+
+    @ivar name: The name of the span, such as "AUTH" or "counter-write".
+    @ivar traceID: The ID of the trace this span is part of.
+    @ivar spanID: The ID of this span.
+    @ivar parentID: The ID of the parent span, or None.
+    @ivar sessionID: The session ID, if any.
+    @ivar start: The start time, in seconds.
+    @ivar end: The end time, in seconds.
+    '''
+    __slots__ = ('state', 'parent', 'name', 'traceID', 'spanID', 'parentID',
+                 'sessionID', 'start', 'end')
+
+    sampled = True
+
+    def __init__(self, state, name, traceID, parentID, sessionID):
+        self.state = state
+        self.parent = None
+        self.name = name
+        self.traceID = traceID
+        self.spanID = getrandbits(64)
+        self.parentID = parentID
+        self.sessionID = sessionID
+        self.start = None
+        self.end = None
+
+    def __enter__(self):
+        state = self.state
+        self.parent = state.current
+        state.current = self
+        self.start = _clock()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.end = _clock()
+        state = self.state
+        state.current = self.parent
+        self.parent = None
+        state.ring[state.index] = self
+        state.index = (state.index + 1) % len(state.ring)
+        return False
+
+
+
+class K2Tracer(object):
+    '''
+    K2Tracer hands out spans, and keeps the ring buffers of finished spans.
+
+    @ivar sampleRate: The fraction of traces to record, from 0 (none) to 1
+    (all).  This may be changed at any time.
+    @type sampleRate: Float
+
+    @ivar bufferSize: The number of finished spans kept per thread.
+    @type bufferSize: Integer
+    '''
+
+
+    def __init__(self, sampleRate=0.0, bufferSize=K2_TRACE_BUFFER):
+        '''
+        Create a new tracer.
+
+        @param sampleRate: The fraction of traces to record.  This should
+        normally come from the K2KSM.TraceSampleRate setting.
+        @type sampleRate: Float
+
+        @param bufferSize: The number of finished spans kept per thread.
+        @type bufferSize: Integer
+
+        @raise ValueError: Thrown if bufferSize is less than 1.
+        '''
+        if (bufferSize < 1):
+            raise ValueError('bufferSize must be at least 1')
+        self.sampleRate = float(sampleRate)
+        self.bufferSize = bufferSize
+        self.__local = local()
+        self.__lock = Lock()
+        self.__states = []
+
+
+    def __state(self):
+        try:
+            return self.__local.state
+        except AttributeError:
+            pass
+        state = _K2TraceState(self.bufferSize)
+        self.__lock.acquire()
+        try:
+            self.__prune(False)
+            self.__states.append(state)
+        finally:
+            self.__lock.release()
+        self.__local.state = state
+        return state
+
+
+    def __prune(self, collected):
+        # Drop the states of exited threads.  Unless their spans have just
+        # been collected, only the most recent K2_TRACE_DEAD_THREADS states
+        # with spans are kept.  Must be called with the lock held.
+        kept = []
+        dead = 0
+        for state in reversed(self.__states):
+            if (not state.alive()):
+                if (   collected
+                    or (state.ring[state.index - 1] == None)
+                    or (dead >= K2_TRACE_DEAD_THREADS)
+                    ):
+                    continue
+                dead += 1
+            kept.append(state)
+        kept.reverse()
+        self.__states = kept
+
+
+    def threadCount(self):
+        '''
+        Returns the number of ring buffers held, including those of exited
+        threads whose spans have not been exported.
+
+        @rtype: Integer
+        '''
+        return len(self.__states)
+
+
+    def span(self, name, sessionID=None, header=None):
+        '''
+        Returns a new span, which should be used as a context manager::
+
+            with tracer.span('AUTH', sessionID):
+                ...
+
+        If there is already a span open in this thread, the new span is its
+        child.  Otherwise, the new span starts a new trace, which is sampled
+        according to L{sampleRate}; or, if a header is given, the new span
+        continues the trace that the header came from.
+
+        @param name: The name of the span.
+        @type name: String
+
+        @param sessionID: The session ID.  If not given, the session ID is
+        taken from the parent span or header.
+
+        @param header: A header made by L{header}, in another thread or
+        process.
+        @type header: String
+
+        @return: A K2Span, or an object that acts like one but records
+        nothing.
+        '''
+        state = self.__state()
+        if (state.unsampled):
+            return state.null
+        parent = state.current
+        if (parent != None):
+            if (sessionID == None):
+                sessionID = parent.sessionID
+            return K2Span(state, name, parent.traceID, parent.spanID,
+                          sessionID)
+        if (header != None):
+            (traceID, parentID, headerSession) = header.split(':', 2)
+            if (sessionID == None):
+                sessionID = headerSession
+            return K2Span(state, name, int(traceID, 16), int(parentID, 16),
+                          sessionID)
+        if (random() >= self.sampleRate):
+            return state.null
+        return K2Span(state, name, getrandbits(64), None, sessionID)
+
+
+    def header(self):
+        '''
+        Returns a header that carries the current span's context to another
+        thread or process, to be passed to L{span} there.
+
+        @rtype: String
+        @return: The header, or None if there is no sampled span open.
+        '''
+        current = self.__state().current
+        if (current == None):
+            return None
+        sessionID = current.sessionID
+        if (sessionID == None):
+            sessionID = ''
+        return '%x:%x:%s' % (current.traceID, current.spanID, sessionID)
+
+
+    def spans(self):
+        '''
+        Returns every finished span still held in the ring buffers, oldest
+        first within each thread.  The ring buffers of threads that have
+        exited are then thrown away, so their spans are only returned once.
+
+        @rtype: List
+        @return: A list of (thread name, K2Span) tuples.
+        '''
+        self.__lock.acquire()
+        try:
+            states = list(self.__states)
+            self.__prune(True)
+        finally:
+            self.__lock.release()
+
+        results = []
+        for state in states:
+            index = state.index
+            for span in state.ring[index:] + state.ring[:index]:
+                if (span != None):
+                    results.append((state.thread, span))
+        return results
+
+
+    def dump(self):
+        '''
+        Export the finished spans as JSON, in the Chrome trace event format.
+
+        @rtype: String
+        '''
+        pid = os.getpid()
+        events = []
+        for (thread, span) in self.spans():
+            args = {'trace': '%x' % span.traceID,
+                    'span': '%x' % span.spanID,
+                    }
+            if (span.parentID != None):
+                args['parent'] = '%x' % span.parentID
+            if (span.sessionID != None):
+                args['session'] = str(span.sessionID)
+            events.append({'name': span.name,
+                           'cat': 'k2ksm',
+                           'ph': 'X',
+                           'ts': int(span.start * 1000000),
+                           'dur': int((span.end - span.start) * 1000000),
+                           'pid': pid,
+                           'tid': thread,
+                           'args': args,
+                           })
+        return json.dumps({'traceEvents': events}, sort_keys=True)
@@ -1,3 +1,3 @@
 # All we do here is list the different test modules that we have.
 # This is really used by the top-level test script, to make importing easier.
-__all__ = ['logger', 'settings']
+__all__ = ['audit', 'bench', 'bulk', 'cache', 'coalesce', 'deadline', 'directory', 'grants', 'handoff', 'keycache', 'logger', 'metrics', 'protocol', 'provision', 'scheduler', 'schema', 'sessions', 'settings', 'singleflight', 'tracing', 'workload']
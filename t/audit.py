@@ -0,0 +1,220 @@
+'''
+This module contains all of the tests for everything in the k2ksm.audit
+Python module.
+'''
+
+import json
+import logging
+import os
+from StringIO import StringIO
+import sys
+from tempfile import mkdtemp
+import unittest
+
+# If we're being run directly, then we need to add the parent dir to path
+try:
+    from k2ksm import audit, logger
+    from t._util import canSkipOrFail
+except:
+    from sys import path
+    path.append('..')
+    from k2ksm import audit, logger
+    from t._util import canSkipOrFail
+
+
+
+class K2AuditLogTests(unittest.TestCase):
+    # All of the tests of K2AuditLog are in this class.
+
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.path = os.path.join(self.dir, 'audit.log')
+        self.now = 1400000000.0
+        self.a = audit.K2AuditLog(self.path, batchSize=3,
+                                  clock=lambda: self.now)
+
+    def tearDown(self):
+        self.a.close()
+        for name in os.listdir(self.dir):
+            os.unlink(os.path.join(self.dir, name))
+        os.rmdir(self.dir)
+
+    def read(self, path=None):
+        auditFile = open(path or self.path, 'rb')
+        try:
+            return list(audit.readRecords(auditFile))
+        finally:
+            auditFile.close()
+
+    def test_roundTrip(self):
+        self.a.log('TOTP', logging.INFO, 'AUTH OK', {'user': u'smithj\xe9'})
+        self.a.flush()
+        self.assertEqual(self.read(), [{'time': self.now,
+                                        'level': logging.INFO,
+                                        'module': 'TOTP',
+                                        'message': 'AUTH OK',
+                                        'fields': {'user': u'smithj\xe9'}}])
+
+    def test_batch(self):
+        # Nothing is written until the batch is full, or time has passed
+        self.a.log('TOTP', logging.INFO, 'one')
+        self.a.log('TOTP', logging.INFO, 'two')
+        self.assertEqual(self.read(), [])
+        self.a.log('TOTP', logging.INFO, 'three')
+        self.assertEqual(len(self.read()), 3)
+        self.a.log('TOTP', logging.INFO, 'four')
+        self.now += audit.K2_AUDIT_INTERVAL
+        self.a.log('TOTP', logging.INFO, 'five')
+        self.assertEqual(len(self.read()), 5)
+
+    def test_redact(self):
+        self.a.log('TOTP', logging.INFO, 'AUTH',
+                   {'code': '123456', 'secret': 'x', 'user': 'smithj'})
+        self.a.log('AES', logging.INFO, 'AUTH', {'code': '123456'})
+        self.a.flush()
+        (totp, aes) = self.read()
+        self.assertEqual(totp['fields'],
+                         {'code': audit.K2_AUDIT_REDACTED,
+                          'secret': audit.K2_AUDIT_REDACTED,
+                          'user': 'smithj'})
+        self.assertEqual(aes['fields'], {'code': '123456'})
+
+    def test_redact_case(self):
+        # Field names are matched in any case
+        self.a.log('USER', logging.INFO, 'KEY CREATE',
+                   {'Key': 'k', 'Password': 'p', 'Material': 'm',
+                    'Username': 'smithj'})
+        self.a.log('HOTP', logging.INFO, 'AUTH', {'Code': '1', 'COUNTER': 2})
+        self.a.flush()
+        (user, hotp) = self.read()
+        self.assertEqual(user['fields'],
+                         {'Key': audit.K2_AUDIT_REDACTED,
+                          'Password': audit.K2_AUDIT_REDACTED,
+                          'Material': audit.K2_AUDIT_REDACTED,
+                          'Username': 'smithj'})
+        self.assertEqual(hotp['fields'],
+                         {'Code': audit.K2_AUDIT_REDACTED,
+                          'COUNTER': audit.K2_AUDIT_REDACTED})
+
+    def test_rotate(self):
+        self.a.close()
+        self.a = audit.K2AuditLog(self.path, maxBytes=100, backupCount=2,
+                                  batchSize=1)
+        for i in xrange(10):
+            self.a.log('TOTP', logging.INFO, 'AUTH %d' % i)
+        self.assertEqual(sorted(os.listdir(self.dir)),
+                         ['audit.log', 'audit.log.1', 'audit.log.2'])
+        self.assertEqual(self.read()[-1]['message'], 'AUTH 9')
+        self.assertTrue(os.path.getsize(self.path) <= 100)
+
+    def test_logger(self):
+        # K2Logger sends audit events to the audit log as well, but not
+        # other messages, or the message's arguments
+        l = logger.K2Logger('audit-test')
+        l.logToStderr = False
+        l.logger.setLevel(logging.INFO)
+        l.enableAudit(self.path + '2')
+        l.loggerForModule('TOTP').info('Not audited')
+        l.loggerForModule('TOTP').info('AUTH %s', '123456',
+                                       extra={'audit': {'code': '1'}})
+        l.disableAudit()
+        records = self.read(self.path + '2')
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['module'], 'TOTP')
+        self.assertEqual(records[0]['message'], 'AUTH %s')
+        self.assertEqual(records[0]['fields'],
+                         {'code': audit.K2_AUDIT_REDACTED})
+
+    def test_logger_subLogger(self):
+        # Records from a module's sub-loggers are redacted for the module
+        l = logger.K2Logger('audit.test')
+        l.logToStderr = False
+        l.logger.setLevel(logging.INFO)
+        l.enableAudit(self.path + '2')
+        sub = logging.getLogger(l.loggerForModule('TOTP').name + '.AUTH')
+        sub.info('AUTH OK', extra={'audit': {'code': '1'}})
+        l.disableAudit()
+        records = self.read(self.path + '2')
+        self.assertEqual(records[0]['module'], 'TOTP')
+        self.assertEqual(records[0]['fields'],
+                         {'code': audit.K2_AUDIT_REDACTED})
+        handler = audit.K2AuditHandler(self.a)
+        self.assertEqual(handler.module('k2ksm.TOTP.AUTH'), 'TOTP')
+        self.assertEqual(handler.module('TOTP'), 'TOTP')
+
+    def test_truncate(self):
+        # Long strings are cut at the end of a character
+        self.a.log('TOTP', logging.INFO, u'x' + u'\xe9' * 0x8000)
+        self.a.flush()
+        message = self.read()[0]['message']
+        self.assertEqual(message, u'x' + u'\xe9' * 0x7FFF)
+
+    def test_main(self):
+        self.a.log('TOTP', logging.INFO, 'AUTH OK', {'user': 'smithj'})
+        self.a.flush()
+        output = StringIO()
+        oldStdout = sys.stdout
+        sys.stdout = output
+        try:
+            self.assertEqual(audit.main(['--json', self.path]), 0)
+            audit.main([self.path])
+        finally:
+            sys.stdout = oldStdout
+        lines = output.getvalue().splitlines()
+        self.assertEqual(json.loads(lines[0])['fields'], {'user': 'smithj'})
+        self.assertEqual(lines[1],
+                         '2014-05-13T16:53:20.000Z INFO TOTP: AUTH OK '
+                         'user=smithj')
+
+    if canSkipOrFail:
+        def test_main_badRecord(self):
+            # A corrupt record is reported, and the rest are still read
+            self.a.log('TOTP', logging.INFO, 'one')
+            self.a.log('TOTP', logging.INFO, 'two')
+            self.a.log('TOTP', logging.INFO, 'three')
+            self.a.flush()
+            auditFile = open(self.path, 'r+b')
+            auditFile.seek(len(audit.K2_AUDIT_MAGIC) + 4)
+            auditFile.write(chr(audit.K2_AUDIT_VERSION + 1))
+            auditFile.close()
+            self.assertRaises(ValueError, self.read)
+            output = StringIO()
+            errors = StringIO()
+            (oldStdout, oldStderr) = (sys.stdout, sys.stderr)
+            (sys.stdout, sys.stderr) = (output, errors)
+            try:
+                self.assertEqual(audit.main(['--json', self.path]), 1)
+            finally:
+                (sys.stdout, sys.stderr) = (oldStdout, oldStderr)
+            self.assertEqual([json.loads(line)['message']
+                              for line in output.getvalue().splitlines()],
+                             ['two', 'three'])
+            self.assertEqual(len(errors.getvalue().splitlines()), 1)
+
+    if canSkipOrFail:
+        def test_notAuditLog(self):
+            otherFile = open(self.path + '2', 'w')
+            otherFile.write('hello')
+            otherFile.close()
+            self.assertRaises(ValueError, audit.K2AuditLog, self.path + '2')
+
+
+
+# List the tests and create a test suite, for use by the top-level test script.
+tests = ('test_roundTrip', 'test_batch', 'test_redact', 'test_redact_case',
+         'test_rotate',
+         'test_logger', 'test_logger_subLogger', 'test_truncate',
+         'test_main',
+         )
+skippedTests = ('test_main_badRecord', 'test_notAuditLog',
+                )
+if canSkipOrFail:
+    K2AuditLogTestSuite = unittest.TestSuite(map(K2AuditLogTests,
+                                                 (tests + skippedTests)))
+else:
+    K2AuditLogTestSuite = unittest.TestSuite(map(K2AuditLogTests, tests))
+
+
+# Allow this set of test cases to be run by themselves.
+if __name__ == "__main__":
+    unittest.main()
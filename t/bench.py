@@ -0,0 +1,467 @@
+'''
+This module contains the benchmarks for K2KSM.  Benchmarks are run by the
+top-level test script, using the --bench option.
+
+Each benchmark is timed in batches of operations, and the per-operation time
+of each batch is one sample.  Results are reported as JSON, with percentiles
+of the samples, and the memory used by benchmarks that measure it.  If a
+baseline (the JSON output of an earlier run) is given, any benchmark whose
+median has slowed down by more than the threshold is reported as a
+regression.
+'''
+
+from binascii import unhexlify
+import hmac
+import json
+import logging
+from hashlib import sha1
+from math import ceil
+from os import close, unlink
+import random
+from struct import pack, unpack
+from tempfile import mkstemp
+from time import time
+import unittest
+
+# If we're being run directly, then we need to add the parent dir to path
+try:
+    from k2ksm import audit, grants, logger, scheduler, settings
+    from k2ksm.protocol import encoder, parser
+    from t import workload
+except:
+    from sys import path
+    path.append('..')
+    from k2ksm import audit, grants, logger, scheduler, settings
+    from k2ksm.protocol import encoder, parser
+    from t import workload
+
+
+
+#: The random seed used by every benchmark, so runs are reproducible.
+SEED = 20140515
+
+#: The number of samples taken for each benchmark.
+SAMPLES = 30
+
+#: The default regression threshold: 10% slower than the baseline.
+THRESHOLD = 0.10
+
+#: The number of links in the grant table used by grant_check.
+GRANT_LINKS = 1000000
+
+#: The percentiles reported for each benchmark.
+PERCENTILES = (50, 90, 99)
+
+
+class BenchSettings(settings.K2SettingsModule):
+    '''
+    A settings module with a configurable number of settings, named
+    "setting0", "setting1", etc.  Even-numbered settings are server-wide, and
+    odd-numbered settings are per-session.  Any integer is a valid value.
+    '''
+    count = 1000
+
+    @classmethod
+    def settingsList(cls):
+        return ['setting%d' % i for i in xrange(cls.count)]
+
+    @classmethod
+    def nameValid(cls, name):
+        return (    name.startswith('setting')
+                and name[7:].isdigit()
+                and (int(name[7:]) < cls.count))
+
+    @staticmethod
+    def description(name):
+        return 'A benchmark setting'
+
+    @staticmethod
+    def perSession(name):
+        return (int(name[7:]) % 2 == 1)
+
+    @staticmethod
+    def mutable(name):
+        return True
+
+    @staticmethod
+    def required(name):
+        return False
+
+    @staticmethod
+    def default(name):
+        return 0
+
+    @staticmethod
+    def settingValid(name, value):
+        try:
+            int(value)
+        except:
+            return False
+        return True
+
+
+def quietLogger():
+    '''
+    Returns a K2Logger that does not write anywhere.
+    '''
+    l = logger.K2Logger('bench')
+    l.logToStderr = False
+    l.logger.setLevel(logging.INFO)
+    return l
+
+
+def hotp(key, counter, digits=6):
+    '''
+    A reference HOTP (RFC 4226) implementation, used to benchmark OTP
+    verification until the HOTP module exists.
+    '''
+    digest = hmac.new(key, pack('>Q', counter), sha1).digest()
+    offset = ord(digest[-1]) & 0x0F
+    value = unpack('>I', digest[offset:offset + 4])[0] & 0x7FFFFFFF
+    return '%0*d' % (digits, value % (10 ** digits))
+
+
+
+# Each benchmark takes the batch size, does any setup that is needed, and
+# returns a function that runs one batch of operations.
+
+def bench_settings_load(batch):
+    # Load 1,000 settings across 20 modules, from arguments and a file
+    args = []
+    for i in xrange(500):
+        args.extend(['module%d.setting%d' % (i % 20, i), str(i)])
+    (fileNum, filePath) = mkstemp(text=True)
+    close(fileNum)
+    configFile = open(filePath, 'w')
+    for module in xrange(20):
+        configFile.write("[module%d]\n" % module)
+        for i in xrange(500, 1000):
+            if (i % 20 == module):
+                configFile.write("setting%d=%d\n" % (i, i))
+    configFile.close()
+    l = quietLogger()
+
+    def run():
+        for i in xrange(batch):
+            settings.K2Settings.load(l, args, filePath)
+    run.cleanup = lambda: unlink(filePath)
+    return run
+
+
+def bench_settings_argfile(batch):
+    # Load 10,000 settings for 100 modules from an argfile, with half of the
+    # modules already registered
+    w = workload.Workload(SEED, 100, 100)
+    (fileNum, filePath) = mkstemp(text=True)
+    close(fileNum)
+    w.writeArgfile(filePath)
+    modules = w.modules()[:50]
+    l = quietLogger()
+
+    def run():
+        for i in xrange(batch):
+            s = settings.K2Settings(l)
+            for (name, cls) in modules:
+                s.register(name, cls)
+            s.loadArgs(['@' + filePath])
+    run.cleanup = lambda: unlink(filePath)
+    return run
+
+
+def _registered():
+    s = settings.K2Settings(quietLogger())
+    s.register('BENCH', BenchSettings)
+    s.finalize()
+    s.newSession(1)
+    return s
+
+
+def bench_settings_get(batch):
+    s = _registered()
+    names = ['BENCH.setting%d' % random.randint(0, BenchSettings.count - 1)
+             for i in xrange(batch)]
+    def run():
+        for name in names:
+            s.settingGet(name, 1)
+    return run
+
+
+def bench_settings_view(batch):
+    # The same reads as settings_get, through a session view
+    s = _registered()
+    module = s.sessionView(1).BENCH
+    names = ['setting%d' % random.randint(0, BenchSettings.count - 1)
+             for i in xrange(batch)]
+    def run():
+        for name in names:
+            getattr(module, name)
+    return run
+
+
+def bench_settings_set(batch):
+    s = _registered()
+    names = ['BENCH.setting%d' % random.randint(0, BenchSettings.count - 1)
+             for i in xrange(batch)]
+    def run():
+        for name in names:
+            s.settingSet(name, 5, 1)
+    return run
+
+
+def bench_session_churn(batch):
+    s = _registered()
+    def run():
+        for i in xrange(batch):
+            sessionID = s.newSession().sessionID
+            s.settingSet('BENCH.setting1', 5, sessionID)
+            s.delSession(sessionID)
+    return run
+
+
+def bench_logger_throughput(batch):
+    l = quietLogger()
+    moduleLogger = l.loggerForModule('Bench')
+    def run():
+        for i in xrange(batch):
+            moduleLogger.info('AUTH %s %s', 'TOTP', 'OK')
+    return run
+
+
+def bench_audit_throughput(batch):
+    # Record AUTH results directly in the audit log
+    (fileNum, filePath) = mkstemp()
+    close(fileNum)
+    unlink(filePath)
+    auditLog = audit.K2AuditLog(filePath)
+    def run():
+        for i in xrange(batch):
+            auditLog.log('TOTP', logging.INFO, 'AUTH OK',
+                         {'user': 'smithj', 'code': '123456'})
+        auditLog.flush()
+    def cleanup():
+        auditLog.close()
+        unlink(filePath)
+    run.cleanup = cleanup
+    return run
+
+
+def bench_grant_check(batch):
+    # Check links in a table of GRANT_LINKS, about a third of them granted
+    modules = ('AES', 'TOTP', 'HOTP')
+    table = grants.K2GrantTable((keyID, modules[keyID % 3])
+                                for keyID in xrange(GRANT_LINKS))
+    checks = [(random.randint(0, GRANT_LINKS - 1), random.choice(modules))
+              for i in xrange(batch)]
+    def run():
+        granted = table.granted
+        for (keyID, module) in checks:
+            granted(keyID, module)
+    run.footprint = table.footprint
+    return run
+
+
+def bench_parser_commands(batch):
+    # Parse AUTH commands, arriving in 16K chunks as from a busy client
+    data = ''.join(['AUTH TOTP user%d %06d\n' % (random.randint(0, 9999),
+                                                 random.randint(0, 999999))
+                    for i in xrange(batch)])
+    chunks = [data[i:i + parser.K2_RECV_SIZE]
+              for i in xrange(0, len(data), parser.K2_RECV_SIZE)]
+    p = parser.K2Parser()
+    def run():
+        for chunk in chunks:
+            p.feed(chunk)
+            for command in p:
+                command.args
+    return run
+
+
+class _NullSocket(object):
+    # Throws away what is sent
+    def sendall(self, data):
+        pass
+
+
+def bench_response_encode(batch):
+    # Answer AUTH requests, one in ten with a NOK
+    results = [random.randint(0, 9) for i in xrange(batch)]
+    w = encoder.K2ResponseWriter(_NullSocket())
+    def run():
+        for result in results:
+            if (result == 0):
+                w.write(scheduler.K2_OVERLOADED)
+            else:
+                w.ok()
+            w.ready()
+            w.flush()
+    return run
+
+
+def bench_otp_verify(batch):
+    # Verify a code against a window of 3 counters, as the HOTP module will
+    key = unhexlify('3132333435363738393031323334353637383930')
+    codes = [hotp(key, random.randint(0, 1000)) for i in xrange(batch)]
+    def run():
+        for code in codes:
+            for counter in xrange(500, 503):
+                if (hotp(key, counter) == code):
+                    break
+    return run
+
+
+#: Every benchmark, with the batch size to use.
+BENCHMARKS = (
+    ('settings_load', bench_settings_load, 2),
+    ('settings_argfile', bench_settings_argfile, 1),
+    ('settings_get', bench_settings_get, 2000),
+    ('settings_view', bench_settings_view, 2000),
+    ('settings_set', bench_settings_set, 2000),
+    ('session_churn', bench_session_churn, 500),
+    ('logger_throughput', bench_logger_throughput, 2000),
+    ('audit_throughput', bench_audit_throughput, 2000),
+    ('grant_check', bench_grant_check, 2000),
+    ('parser_commands', bench_parser_commands, 2000),
+    ('response_encode', bench_response_encode, 2000),
+    ('otp_verify', bench_otp_verify, 500),
+)
+
+
+
+def percentile(samples, p):
+    '''
+    Returns the p'th percentile of a sorted list, using the nearest-rank
+    method.
+    '''
+    rank = int(ceil(p * len(samples) / 100.0)) - 1
+    return samples[max(0, min(rank, len(samples) - 1))]
+
+
+def runBenchmark(function, batch, samples=SAMPLES):
+    '''
+    Run one benchmark, and return its results.
+
+    @return: A hash with the per-operation times (in seconds) at each of the
+    L{PERCENTILES}, plus the operations per second at the median.  If the
+    benchmark can measure its memory use, that is included (in bytes) too.
+    '''
+    random.seed(SEED)
+    run = function(batch)
+    footprint = None
+    try:
+        # One batch to warm up
+        run()
+        times = []
+        for i in xrange(samples):
+            start = time()
+            run()
+            times.append((time() - start) / batch)
+        if (hasattr(run, 'footprint')):
+            footprint = run.footprint()
+    finally:
+        if (hasattr(run, 'cleanup')):
+            run.cleanup()
+
+    times.sort()
+    result = {'batch': batch, 'samples': samples,
+              'min': times[0], 'max': times[-1]}
+    for p in PERCENTILES:
+        result['p%d' % p] = percentile(times, p)
+    if (result['p50'] > 0):
+        result['ops_per_sec'] = 1.0 / result['p50']
+    else:
+        result['ops_per_sec'] = None
+    if (footprint != None):
+        result['bytes'] = footprint
+    return result
+
+
+def runAll(samples=SAMPLES, only=None):
+    '''
+    Run every benchmark (or just the named ones).
+
+    @return: A hash of benchmark name to results.
+    '''
+    results = {}
+    for (name, function, batch) in BENCHMARKS:
+        if ((only != None) and (name not in only)):
+            continue
+        results[name] = runBenchmark(function, batch, samples)
+    return results
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    '''
+    Compare results against a baseline.
+
+    @return: A list of (name, baseline median, new median) for every
+    benchmark whose median is more than C{threshold} slower.
+    '''
+    regressions = []
+    for name in sorted(results):
+        if (name not in baseline):
+            continue
+        old = baseline[name]['p50']
+        new = results[name]['p50']
+        if (new > old * (1 + threshold)):
+            regressions.append((name, old, new))
+    return regressions
+
+
+def main(output=None, baselinePath=None, threshold=THRESHOLD,
+         samples=SAMPLES):
+    '''
+    Run the benchmarks, write the results as JSON, and compare them to a
+    baseline if one was given.  Called by the top-level test script.
+
+    @return: True if there were no regressions.
+    '''
+    results = runAll(samples)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if (output == None):
+        print text
+    else:
+        outputFile = open(output, 'w')
+        outputFile.write(text + "\n")
+        outputFile.close()
+
+    if (baselinePath == None):
+        return True
+    baselineFile = open(baselinePath)
+    baseline = json.load(baselineFile)
+    baselineFile.close()
+    regressions = compare(results, baseline, threshold)
+    for (name, old, new) in regressions:
+        print 'REGRESSION: %s median %.3gs -> %.3gs (+%.0f%%)' % (
+            name, old, new, (new / old - 1) * 100)
+    return (len(regressions) == 0)
+
+
+class BenchTests(unittest.TestCase):
+    # The tests of the functions that report on benchmark results.
+
+    def test_percentile(self):
+        samples = range(1, 11)
+        self.assertEqual([percentile(samples, p) for p in (0, 50, 90, 100)],
+                         [1, 5, 9, 10])
+        self.assertEqual(percentile([7], 99), 7)
+
+    def test_compare(self):
+        # Only medians slower by more than the threshold are regressions
+        baseline = {'a': {'p50': 1.0}, 'b': {'p50': 1.0},
+                    'c': {'p50': 1.0}, 'gone': {'p50': 1.0}}
+        results = {'a': {'p50': 1.1}, 'b': {'p50': 1.2},
+                   'c': {'p50': 0.5}, 'new': {'p50': 9.0}}
+        self.assertEqual(compare(results, baseline), [('b', 1.0, 1.2)])
+        self.assertEqual(compare(results, baseline, 0.5), [])
+        self.assertEqual(compare(results, baseline, 0.05),
+                         [('a', 1.0, 1.1), ('b', 1.0, 1.2)])
+
+
+tests = ('test_percentile', 'test_compare',
+         )
+BenchTestSuite = unittest.TestSuite(map(BenchTests, tests))
+
+
+# Allow the benchmarks to be run by themselves.
+if __name__ == "__main__":
+    main()
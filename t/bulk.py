@@ -0,0 +1,207 @@
+'''
+This module contains all of the tests for everything in the k2ksm.bulk
+Python module.
+'''
+
+import json
+import unittest
+
+# If we're being run directly, then we need to add the parent dir to path
+try:
+    from k2ksm import bulk, db, logger
+    from t._util import canSkipOrFail
+except:
+    from sys import path
+    path.append('..')
+    from k2ksm import bulk, db, logger
+    from t._util import canSkipOrFail
+
+
+
+class K2BulkImportTests(unittest.TestCase):
+    # All of the tests of K2BulkImport are in this class.
+
+    @staticmethod
+    def makeLines(count, start=0):
+        '''
+        Make JSON Lines records for C{count} users, followed by a terminator.
+        '''
+        lines = []
+        for i in xrange(start, start + count):
+            lines.append(json.dumps({'Username': 'User%d' % i,
+                                     'GivenName': 'Given%d' % i,
+                                     'Surname': 'Surname%d' % i,
+                                     }) + "\n")
+        lines.append(".\n")
+        return lines
+
+    def setUp(self):
+        self.l = logger.K2Logger('')
+        self.db = db.K2DB(self.l)
+
+    def tearDown(self):
+        self.db.close()
+        self.db = None
+
+    def test_import(self):
+        # Every record gets a result line, plus a summary line
+        i = bulk.K2BulkImport(self.l, self.db, 'test', batchSize=3)
+        results = [json.loads(x) for x in i.run(self.makeLines(10))]
+        self.assertEqual(len(results), 11)
+        self.assertEqual(results[0]['Username'], 'user0')
+        self.assertEqual(results[-1], {'Imported': 10, 'Failed': 0,
+                                       'Skipped': 0, 'LastRecord': 10})
+        self.assertEqual(self.db.importCheckpoint('test'), 10)
+
+    def test_import_badRecords(self):
+        # Bad records and duplicates fail without stopping the import
+        lines = ['{"Username": "smithj"}', 'not json', '[1, 2]',
+                 '{"Username": "has space"}', '{"Username": "SmithJ"}',
+                 '{"Username": "bellr", "GivenName": {"a": 1}}',
+                 '{"Username": "bellr", "Surname": ["Bell"]}',
+                 '{"Username": "bellr", "GivenName": null}',
+                 '.']
+        i = bulk.K2BulkImport(self.l, self.db, 'test', batchSize=2)
+        results = [json.loads(x) for x in i.run(lines)]
+        self.assertEqual([r.get('code') for r in results[:-1]],
+                         [None, '1', '1', '1', '2', '1', '1', None])
+        self.assertEqual(results[-1]['Imported'], 2)
+        self.assertEqual(results[-1]['Failed'], 6)
+
+    def test_import_resume(self):
+        # Abandon an import part-way through, then resume it
+        lines = self.makeLines(10)
+        i = bulk.K2BulkImport(self.l, self.db, 'test', batchSize=4)
+        stream = i.run(lines)
+        for x in xrange(5):
+            stream.next()
+        stream.close()
+        self.assertEqual(self.db.importCheckpoint('test'), 8)
+
+        i = bulk.K2BulkImport(self.l, self.db, 'test', batchSize=4)
+        results = [json.loads(x) for x in i.run(lines)]
+        self.assertEqual(results[0]['Record'], 9)
+        self.assertEqual(results[-1]['Skipped'], 8)
+        self.assertEqual(results[-1]['Imported'], 2)
+
+    def test_import_streaming(self):
+        # Results for a batch come out before later lines are read
+        consumed = []
+        def lines():
+            for line in self.makeLines(6):
+                consumed.append(line)
+                yield line
+        i = bulk.K2BulkImport(self.l, self.db, 'test', batchSize=2)
+        i.run(lines()).next()
+        self.assertEqual(len(consumed), 2)
+
+    if canSkipOrFail:
+        def test_create_badBatchSize(self):
+            self.assertRaises(ValueError, bulk.K2BulkImport, self.l,
+                              self.db, 'test', 0)
+
+
+
+class K2BulkExportTests(unittest.TestCase):
+    # All of the tests of K2BulkExport are in this class.
+
+    def setUp(self):
+        self.l = logger.K2Logger('')
+        self.db = db.K2DB(self.l)
+        lines = K2BulkImportTests.makeLines(3)
+        for x in bulk.K2BulkImport(self.l, self.db, 'setup').run(lines):
+            pass
+        self.key = self.db.createKey(1, 'AES128', 'secret material')
+        self.db.linkKey(self.key, 'TOTP')
+
+    def tearDown(self):
+        self.db.close()
+        self.db = None
+
+    def export(self, *args, **kwargs):
+        e = bulk.K2BulkExport.fromArguments(self.l, self.db, *args, **kwargs)
+        return [json.loads(x) for x in e.run()]
+
+    def test_export(self):
+        results = self.export('*')
+        self.assertEqual(len(results), 4)
+        self.assertEqual(results[0]['Username'], 'user0')
+        self.assertEqual(results[0]['Keys'][0]['Modules'], ['TOTP'])
+        self.assertEqual(results[1]['Keys'], [])
+        self.assertEqual(results[-1], {'Exported': 3,
+                                       'LSN': self.db.currentLSN()})
+        self.assertTrue('secret' not in repr(results))
+
+    def test_export_module(self):
+        results = self.export('TOTP')
+        self.assertEqual([r.get('Username') for r in results],
+                         ['user0', None])
+        self.assertEqual(self.export('HOTP')[-1]['Exported'], 0)
+
+    def test_export_since(self):
+        lsn = str(self.export('*')[-1]['LSN'])
+        self.assertEqual(self.export('*', lsn)[-1]['Exported'], 0)
+        self.db.linkKey(self.key, 'HOTP')
+        results = self.export('*', lsn)
+        self.assertEqual(results[0]['Keys'][0]['Modules'], ['HOTP', 'TOTP'])
+        self.assertEqual(results[-1]['Exported'], 1)
+        self.assertEqual(self.export('*', '2000-01-01T00:00:00Z')[-1]
+                         ['Exported'], 3)
+        self.assertEqual(self.export('*', '2999-01-01T00:00:00Z')[-1]
+                         ['Exported'], 0)
+
+    def test_export_streaming(self):
+        # Writes made during an export are left for the next export
+        stream = bulk.K2BulkExport(self.l, self.db).run()
+        stream.next()
+        self.db.createUsers([{'Username': 'late'}])
+        results = list(stream)
+        self.assertEqual(json.loads(results[-1])['Exported'], 3)
+
+    if canSkipOrFail:
+        def test_export_badSince(self):
+            self.assertRaises(ValueError, bulk.K2BulkExport.fromArguments,
+                              self.l, self.db, '*', 'yesterday-ish')
+
+
+
+# List the tests and create a test suite, for use by the top-level test script.
+tests = {}
+tests['K2BulkImport'] = (
+    'test_import', 'test_import_badRecords', 'test_import_resume',
+    'test_import_streaming',
+)
+tests['K2BulkExport'] = (
+    'test_export', 'test_export_module', 'test_export_since',
+    'test_export_streaming',
+)
+
+skippableTests = {}
+skippableTests['K2BulkImport'] = (
+    'test_create_badBatchSize',
+)
+skippableTests['K2BulkExport'] = (
+    'test_export_badSince',
+)
+
+if canSkipOrFail:
+    K2BulkImportTestSuite = unittest.TestSuite(\
+        map(K2BulkImportTests, (tests['K2BulkImport']
+                                + skippableTests['K2BulkImport'])
+            )
+        )
+    K2BulkExportTestSuite = unittest.TestSuite(\
+        map(K2BulkExportTests, (tests['K2BulkExport']
+                                + skippableTests['K2BulkExport'])
+            )
+        )
+else:
+    K2BulkImportTestSuite = unittest.TestSuite(\
+        map(K2BulkImportTests, tests['K2BulkImport']))
+    K2BulkExportTestSuite = unittest.TestSuite(\
+        map(K2BulkExportTests, tests['K2BulkExport']))
+
+
+# Allow this set of test cases to be run by themselves.
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+'''
+This module contains all of the tests for everything in the k2ksm.cache
+Python module.
+'''
+
+import unittest
+
+# If we're being run directly, then we need to add the parent dir to path
+try:
+    from k2ksm import cache
+    from t._util import canSkipOrFail
+except:
+    from sys import path
+    path.append('..')
+    from k2ksm import cache
+    from t._util import canSkipOrFail
+
+
+
+class K2CacheTests(unittest.TestCase):
+    # All of the tests of K2Cache are in this class.
+
+    def setUp(self):
+        self.now = 1000.0
+        self.c = cache.K2Cache(3, 10, maxBytes=12, clock=lambda: self.now)
+
+    def tearDown(self):
+        self.c = None
+
+    def test_getPut(self):
+        self.assertEqual(self.c.get('a'), None)
+        self.c.put('a', bytearray('1234'))
+        self.assertEqual(self.c.get('a'), bytearray('1234'))
+        self.assertEqual((self.c.hits, self.c.misses), (1, 1))
+
+    def test_evictEntries(self):
+        # The least-recently used entry goes first, and is wiped
+        values = [bytearray('x') for i in xrange(4)]
+        for i in xrange(3):
+            self.c.put(i, values[i])
+        self.c.get(0)
+        self.c.put(3, values[3])
+        self.assertEqual(self.c.get(1), None)
+        self.assertEqual(values[1], bytearray('\0'))
+        self.assertEqual(self.c.get(0), bytearray('x'))
+        self.assertEqual(len(self.c), 3)
+
+    def test_evictBytes(self):
+        self.c.put('a', bytearray('12345678'))
+        self.c.put('b', bytearray('12345678'))
+        self.assertEqual(self.c.get('a'), None)
+        self.assertEqual(self.c.size, 8)
+        self.c.put('c', bytearray('1' * 13))
+        self.assertEqual(self.c.get('c'), None)
+        self.assertEqual(self.c.wipes, 2)
+
+    def test_expire(self):
+        value = bytearray('secret')
+        self.c.put('a', value)
+        self.now += 11
+        self.c.expire()
+        self.assertEqual(len(self.c), 0)
+        self.assertEqual(value, bytearray(6))
+
+    def test_pinned(self):
+        # A pinned value is not wiped until it is released
+        value = bytearray('secret')
+        self.c.put('a', value)
+        with self.c.pinned('a') as pinned:
+            self.c.clear()
+            self.assertEqual(pinned, bytearray('secret'))
+        self.assertEqual(value, bytearray(6))
+        with self.c.pinned('a') as pinned:
+            self.assertEqual(pinned, None)
+
+    def test_putPinned(self):
+        value = bytearray('secret')
+        with self.c.putPinned('a', value) as pinned:
+            self.assertEqual((self.c.hits, self.c.misses), (0, 0))
+            self.c.clear()
+            self.assertEqual(pinned, bytearray('secret'))
+        self.assertEqual(value, bytearray(6))
+
+    if canSkipOrFail:
+        def test_create_badLimits(self):
+            self.assertRaises(ValueError, cache.K2Cache, 0, 10)
+            self.assertRaises(ValueError, cache.K2Cache, 1, 0)
+
+
+
+# List the tests and create a test suite, for use by the top-level test script.
+tests = ('test_getPut', 'test_evictEntries', 'test_evictBytes',
+         'test_expire', 'test_pinned', 'test_putPinned',
+         )
+skippedTests = ('test_create_badLimits',
+                )
+if canSkipOrFail:
+    K2CacheTestSuite = unittest.TestSuite(map(K2CacheTests,
+                                              (tests + skippedTests)))
+else:
+    K2CacheTestSuite = unittest.TestSuite(map(K2CacheTests, tests))
+
+
+# Allow this set of test cases to be run by themselves.
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+'''
+This module contains all of the tests for everything in the k2ksm.coalesce
+Python module.
+'''
+
+from threading import Event, Thread
+import unittest
+
+# If we're being run directly, then we need to add the parent dir to path
+try:
+    from k2ksm import coalesce, logger, metrics
+    from k2ksm.exceptions import K2TimeoutError
+    from t._util import canSkipOrFail
+except:
+    from sys import path
+    path.append('..')
+    from k2ksm import coalesce, logger, metrics
+    from k2ksm.exceptions import K2TimeoutError
+    from t._util import canSkipOrFail
+
+
+
+class K2AuthCoalescerTests(unittest.TestCase):
+    # All of the tests of K2AuthCoalescer are in this class.
+
+    def setUp(self):
+        self.l = logger.K2Logger(self.id())
+        self.l.logToStderr = False
+        self.metrics = metrics.K2Metrics()
+        self.verified = []
+        self.started = Event()
+        self.gate = Event()
+        self.gate.set()
+        self.c = coalesce.K2AuthCoalescer(self.l, self.verify,
+                                          metrics=self.metrics)
+
+    def verify(self, module, username, code):
+        # A private component that only accepts each code once
+        self.verified.append((module, username, code))
+        self.started.set()
+        self.gate.wait(5)
+        if (self.verified.count((module, username, code)) > 1):
+            return 'NOK'
+        return 'OK'
+
+    def duplicates(self, count):
+        # Send the same AUTH count times at once
+        results = []
+        threads = [Thread(target=lambda: results.append(
+                              self.c.auth('TOTP', 'SmithJ', '123456')))
+                   for i in xrange(count)]
+        self.gate.clear()
+        threads[0].start()
+        self.started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        while (self.c.flights.shared < count - 1):
+            self.started.wait(0.01)
+        self.gate.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_auth(self):
+        self.assertEqual(self.c.auth('TOTP', 'smithj', '123456'), 'OK')
+        self.assertEqual(self.verified, [('TOTP', 'smithj', '123456')])
+        self.assertEqual(self.c.ratio, 0.0)
+
+    def test_coalesce(self):
+        # Retries share the first attempt's result, instead of replaying it
+        self.assertEqual(self.duplicates(3), ['OK', 'OK', 'OK'])
+        self.assertEqual(len(self.verified), 1)
+        self.assertEqual(self.c.ratio, 2 / 3.0)
+        exposition = self.metrics.exposition()
+        self.assertTrue('k2ksm_auth_coalescing_total{result="shared"} 2'
+                        in exposition)
+        self.assertTrue('k2ksm_auth_in_flight 0' in exposition)
+
+    def test_notInFlight(self):
+        # Once the first attempt is finished, the code can not be re-used
+        self.c.auth('TOTP', 'smithj', '123456')
+        self.assertEqual(self.c.auth('TOTP', 'SMITHJ', '123456'), 'NOK')
+
+    def test_different(self):
+        # Only identical requests are shared
+        self.c.auth('TOTP', 'smithj', '123456')
+        self.c.auth('HOTP', 'smithj', '123456')
+        self.c.auth('TOTP', 'smithj', '654321')
+        self.c.auth('TOTP', 'bellr', '123456')
+        self.assertEqual(len(self.verified), 4)
+
+    def test_timeout(self):
+        self.c.timeout = 0.01
+        self.gate.clear()
+        thread = Thread(target=self.c.auth,
+                        args=('TOTP', 'smithj', '123456'))
+        thread.start()
+        self.started.wait(5)
+        self.assertRaises(K2TimeoutError, self.c.auth, 'TOTP', 'smithj',
+                          '123456')
+        self.gate.set()
+        thread.join()
+        self.assertEqual(len(self.verified), 1)
+
+    if canSkipOrFail:
+        def test_create_badLogger(self):
+            self.assertRaises(TypeError, coalesce.K2AuthCoalescer, None,
+                              self.verify)
+
+
+
+# List the tests and create a test suite, for use by the top-level test script.
+tests = ('test_auth', 'test_coalesce', 'test_notInFlight', 'test_different',
+         'test_timeout',
+         )
+skippedTests = ('test_create_badLogger',
+                )
+if canSkipOrFail:
+    K2AuthCoalescerTestSuite = unittest.TestSuite(map(K2AuthCoalescerTests,
+                                                      (tests + skippedTests)))
+else:
+    K2AuthCoalescerTestSuite = unittest.TestSuite(map(K2AuthCoalescerTests,
+                                                      tests))
+
+
+# Allow this set of test cases to be run by themselves.
+if __name__ == "__main__":
+    unittest.main()
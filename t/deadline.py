@@ -0,0 +1,111 @@
+'''
+This module contains all of the tests for everything in the k2ksm.deadline
+Python module.  Time is simulated with a virtual clock, so that no test has
+to sleep.
+'''
+
+import unittest
+
+# If we're being run directly, then we need to add the parent dir to path
+try:
+    from k2ksm import deadline, logger, scheduler
+    from k2ksm.settings.k2ksm import K2KSMSettings
+    from t._util import canSkipOrFail
+except:
+    from sys import path
+    path.append('..')
+    from k2ksm import deadline, logger, scheduler
+    from k2ksm.settings.k2ksm import K2KSMSettings
+    from t._util import canSkipOrFail
+
+
+
+class K2DeadlineTests(unittest.TestCase):
+    # All of the tests of request deadlines are in this class.
+
+    def setUp(self):
+        self.now = 1400000000.0
+        self.clock = lambda: self.now
+        self.l = logger.K2Logger(self.id())
+        self.l.logToStderr = False
+        self.run = []
+        self.s = scheduler.K2Scheduler(self.l, self.dispatch,
+                                       clock=self.clock)
+
+    def dispatch(self, command, data):
+        self.run.append(command)
+        return 'OK\n'
+
+    def send(self, command, timeout=2):
+        # Pass a request from the public side to the private side
+        pending = deadline.K2PendingReply(
+            deadline.deadlineFor(timeout, self.clock), self.clock)
+        line = deadline.stamp(command, pending.deadline)
+        (requestDeadline, command) = deadline.unstamp(line)
+        self.s.submit(command, pending.set, deadline=requestDeadline)
+        return pending
+
+    def test_stamp(self):
+        line = deadline.stamp('AUTH TOTP smithj 123456', 1400000002.5)
+        self.assertEqual(line, '@1400000002.500000 AUTH TOTP smithj 123456')
+        self.assertEqual(deadline.unstamp(line),
+                         (1400000002.5, 'AUTH TOTP smithj 123456'))
+        self.assertEqual(deadline.unstamp('QUIT'), (None, 'QUIT'))
+
+    def test_inTime(self):
+        pending = self.send('AUTH TOTP smithj 1')
+        self.now += 1
+        self.s.step()
+        self.assertEqual(pending.wait(), 'OK\n')
+        self.assertEqual(self.run, ['AUTH TOTP smithj 1'])
+
+    def test_expiredInQueue(self):
+        # The private side drops work that nobody is waiting for
+        pending = self.send('AUTH TOTP smithj 1')
+        self.now += 2
+        self.s.step()
+        self.assertEqual(self.run, [])
+        self.assertEqual(pending.wait(), deadline.K2_TIMED_OUT)
+        self.assertEqual(self.s.expired['AUTH'], 1)
+
+    def test_expiredOnArrival(self):
+        self.send('USER CREATE smithj', 0)
+        self.assertEqual(len(self.s), 0)
+        self.assertEqual(self.s.expired['ADMIN'], 1)
+
+    def test_publicTimeout(self):
+        # The public side answers NOK at the deadline, and ignores a late
+        # response
+        pending = self.send('AUTH TOTP smithj 1')
+        self.now += 2.5
+        self.assertEqual(pending.wait(), deadline.K2_TIMED_OUT)
+        self.assertEqual(deadline.K2_TIMED_OUT.splitlines()[0], 'NOK')
+
+    def test_setting(self):
+        self.assertTrue(K2KSMSettings.perSession('RequestTimeout'))
+        self.assertTrue(K2KSMSettings.settingValid('RequestTimeout', '0.5'))
+        self.assertFalse(K2KSMSettings.settingValid('RequestTimeout', 0))
+
+    if canSkipOrFail:
+        def test_unstamp_bad(self):
+            self.assertRaises(ValueError, deadline.unstamp, '@soon AUTH')
+            self.assertRaises(ValueError, deadline.unstamp, '@1400000000')
+
+
+
+# List the tests and create a test suite, for use by the top-level test script.
+tests = ('test_stamp', 'test_inTime', 'test_expiredInQueue',
+         'test_expiredOnArrival', 'test_publicTimeout', 'test_setting',
+         )
+skippedTests = ('test_unstamp_bad',
+                )
+if canSkipOrFail:
+    K2DeadlineTestSuite = unittest.TestSuite(map(K2DeadlineTests,
+                                                 (tests + skippedTests)))
+else:
+    K2DeadlineTestSuite = unittest.TestSuite(map(K2DeadlineTests, tests))
+
+
+# Allow this set of test cases to be run by themselves.
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,242 @@
+'''
+This module contains all of the tests for everything in the k2ksm.directory
+Python module.  The tests run against L{FakeDirectory}, an in-process stand-in
+for an AD or LDAP server.
+'''
+
+from threading import Event, Thread
+from time import sleep
+import unittest
+
+# If we're being run directly, then we need to add the parent dir to path
+try:
+    from k2ksm import directory, logger, metrics
+    from k2ksm.exceptions import K2AmbiguousError, K2DirectoryError, \
+                                 K2TimeoutError
+    from t._util import canSkipOrFail
+except:
+    from sys import path
+    path.append('..')
+    from k2ksm import directory, logger, metrics
+    from k2ksm.exceptions import K2AmbiguousError, K2DirectoryError, \
+                                 K2TimeoutError
+    from t._util import canSkipOrFail
+
+
+
+def _unescape(value):
+    # Undo directory.escapeFilter
+    for (char, escaped) in (('*', '\\2a'), ('(', '\\28'), (')', '\\29'),
+                            ('\0', '\\00'), ('\\', '\\5c')):
+        value = value.replace(escaped, char)
+    return value
+
+
+class FakeDirectory(object):
+    '''
+    An in-process directory server.  It only understands filters of the form
+    "(attribute=value)".  Searches can be held up with the gate, and the
+    server can be taken down.  If sizeLimit is set, searches that match at
+    least that many entries raise K2AmbiguousError, as the python-ldap
+    connection does.
+    '''
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.sizeLimit = None
+        self.binds = 0
+        self.searches = 0
+        self.closed = 0
+        self.down = False
+        self.searching = Event()
+        self.gate = Event()
+        self.gate.set()
+
+    def connect(self, timeout):
+        if (self.down):
+            raise K2DirectoryError('Server is down')
+        self.binds += 1
+        return _FakeConnection(self)
+
+
+class _FakeConnection(object):
+
+    def __init__(self, server):
+        self.server = server
+
+    def search(self, base, query, attributes, timeout):
+        server = self.server
+        server.searches += 1
+        server.searching.set()
+        server.gate.wait(timeout)
+        if (server.down):
+            raise K2DirectoryError('Server is down')
+        (name, sep, value) = query[1:-1].partition('=')
+        results = []
+        for (dn, entry) in server.entries.items():
+            if (dn.endswith(base) and (_unescape(value) in entry.get(name, ()))):
+                results.append((dn, dict((key, entry[key])
+                                         for key in attributes
+                                         if key in entry)))
+        if ((server.sizeLimit != None) and (len(results) >= server.sizeLimit)):
+            raise K2AmbiguousError('Size limit exceeded')
+        return results
+
+    def close(self):
+        self.server.closed += 1
+
+
+
+class K2DirectoryTests(unittest.TestCase):
+    # All of the tests of K2Directory are in this class.
+
+    def setUp(self):
+        self.now = 1000.0
+        self.server = FakeDirectory({
+            'CN=John Smith,DC=example,DC=com': {
+                'sAMAccountName': ['smithj'],
+                'givenName': ['John'],
+                'sn': ['Smith'],
+            },
+            'CN=Star,DC=example,DC=com': {
+                'sAMAccountName': ['st*r'],
+            },
+        })
+        self.metrics = metrics.K2Metrics()
+        self.l = logger.K2Logger(self.id())
+        self.l.logToStderr = False
+        self.d = directory.K2Directory(self.l,
+                                       self.server.connect,
+                                       'DC=example,DC=com', poolSize=2,
+                                       timeout=0.5, metrics=self.metrics,
+                                       clock=lambda: self.now)
+
+    def tearDown(self):
+        self.server.gate.set()
+        self.d.close()
+
+    def test_lookup(self):
+        user = {'dn': 'CN=John Smith,DC=example,DC=com',
+                'givenName': 'John', 'sn': 'Smith'}
+        self.assertEqual(self.d.lookupUser('smithj'), user)
+        self.assertEqual(self.d.lookupUser('smithj'), user)
+        self.assertEqual(self.server.searches, 1)
+        self.assertEqual(self.d.lookupUser('st*r')['dn'],
+                         'CN=Star,DC=example,DC=com')
+        self.assertEqual(self.server.binds, 1)
+        self.assertTrue('k2ksm_directory_lookups_total{result="hit"} 1'
+                        in self.metrics.exposition())
+
+    def test_notFound(self):
+        # Missing users are cached, for less time than found users
+        self.assertEqual(self.d.lookupUser('nobody'), None)
+        self.assertEqual(self.d.lookupUser('nobody'), None)
+        self.assertEqual(self.server.searches, 1)
+        self.now += directory.K2_DIRECTORY_NEGATIVE_TTL + 1
+        self.assertEqual(self.d.lookupUser('nobody'), None)
+        self.assertEqual(self.server.searches, 2)
+
+    def test_invalidate(self):
+        self.d.lookupUser('smithj')
+        self.d.invalidate('smithj')
+        self.d.lookupUser('smithj')
+        self.assertEqual(self.server.searches, 2)
+
+    def test_singleFlight(self):
+        # Identical lookups share one search
+        self.server.gate.clear()
+        results = []
+        threads = [Thread(target=lambda: results.append(
+                              self.d.lookupUser('smithj')))
+                   for i in xrange(3)]
+        threads[0].start()
+        self.server.searching.wait(1)
+        for thread in threads[1:]:
+            thread.start()
+        while (self.metrics.exposition().find(
+                   'k2ksm_directory_lookups_total{result="shared"} 2') == -1):
+            sleep(0.01)
+        self.server.gate.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.server.searches, 1)
+        self.assertEqual([user['sn'] for user in results], ['Smith'] * 3)
+
+    def test_timeout(self):
+        # With every connection busy, lookups fail quickly
+        self.d.close()
+        self.d = directory.K2Directory(self.l,
+                                       self.server.connect,
+                                       'DC=example,DC=com', poolSize=1,
+                                       timeout=0.05)
+        with self.d.pool.connection():
+            self.assertRaises(K2TimeoutError, self.d.lookupUser, 'smithj')
+        self.assertEqual(self.d.pool.timeouts, 1)
+        self.assertEqual(self.d.lookupUser('smithj')['sn'], 'Smith')
+
+    def test_error(self):
+        # Errors are not cached, and broken connections are not re-used
+        self.d.lookupUser('st*r')
+        self.server.down = True
+        self.assertRaises(K2DirectoryError, self.d.lookupUser, 'smithj')
+        self.assertEqual(self.server.closed, 1)
+        self.server.down = False
+        self.assertEqual(self.d.lookupUser('smithj')['sn'], 'Smith')
+        self.assertEqual(self.server.binds, 2)
+        self.assertEqual(self.d.errors, 1)
+
+    def test_closePool(self):
+        # A connection in use when the pool is closed is closed when it is
+        # returned, and no more are handed out
+        with self.d.pool.connection():
+            self.d.lookupUser('smithj')
+            self.d.close()
+            self.assertEqual(self.server.closed, 1)
+        self.assertEqual(self.server.closed, 2)
+        self.assertRaises(K2DirectoryError, self.d.lookupUser, 'smithj')
+
+    def test_ambiguous(self):
+        # A username that matches more than one entry is not found, but is
+        # not cached as missing either
+        for name in ('One', 'Two'):
+            self.server.entries['CN=%s,DC=example,DC=com' % name] = {
+                'sAMAccountName': ['twins']}
+        for sizeLimit in (None, 2):
+            self.server.sizeLimit = sizeLimit
+            self.assertEqual(self.d.lookupUser('twins'), None)
+            self.assertEqual(self.d.notFound.get('twins'), None)
+        self.assertEqual(self.server.searches, 2)
+        self.assertEqual(self.d.errors, 2)
+        self.assertEqual((self.server.binds, self.server.closed), (1, 0))
+
+    def test_escapeFilter(self):
+        self.assertEqual(directory.escapeFilter('a*(b)\\'),
+                         'a\\2a\\28b\\29\\5c')
+
+    if canSkipOrFail:
+        def test_create_badPool(self):
+            self.assertRaises(ValueError, directory.K2DirectoryPool,
+                              self.server.connect, 0)
+            self.assertRaises(ValueError, directory.K2DirectoryPool,
+                              self.server.connect, 1, 0)
+
+
+
+# List the tests and create a test suite, for use by the top-level test script.
+tests = ('test_lookup', 'test_notFound', 'test_invalidate',
+         'test_singleFlight', 'test_timeout', 'test_error', 'test_closePool',
+         'test_ambiguous',
+         'test_escapeFilter',
+         )
+skippedTests = ('test_create_badPool',
+                )
+if canSkipOrFail:
+    K2DirectoryTestSuite = unittest.TestSuite(map(K2DirectoryTests,
+                                                  (tests + skippedTests)))
+else:
+    K2DirectoryTestSuite = unittest.TestSuite(map(K2DirectoryTests, tests))
+
+
+# Allow this set of test cases to be run by themselves.
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+'''
+This module contains all of the tests for everything in the k2ksm.grants
+Python module.
+'''
+
+import unittest
+
+# If we're being run directly, then we need to add the parent dir to path
+try:
+    from k2ksm import db, grants, logger
+    from t._util import canSkipOrFail
+except:
+    from sys import path
+    path.append('..')
+    from k2ksm import db, grants, logger
+    from t._util import canSkipOrFail
+
+
+
+class K2GrantTableTests(unittest.TestCase):
+    # All of the tests of K2GrantTable are in this class.
+
+    def setUp(self):
+        self.g = grants.K2GrantTable([(1, 'TOTP'), (2, 'HOTP')])
+
+    def test_granted(self):
+        self.assertTrue(self.g.granted(1, 'TOTP'))
+        self.assertFalse(self.g.granted(1, 'HOTP'))
+        self.assertFalse(self.g.granted(2, 'TOTP'))
+        self.assertFalse(self.g.granted(1, 'YUBIOTP'))
+        self.assertEqual(len(self.g), 2)
+
+    def test_grantRevoke(self):
+        self.g.grant(3, 'YUBIOTP')
+        self.g.grant(3, 'YUBIOTP')
+        self.assertTrue(self.g.granted(3, 'YUBIOTP'))
+        self.g.revoke(3, 'YUBIOTP')
+        self.g.revoke(3, 'YUBIOTP')
+        self.g.revoke(3, 'AES')
+        self.assertFalse(self.g.granted(3, 'YUBIOTP'))
+        self.assertEqual(len(self.g), 2)
+
+    def test_footprint(self):
+        # Bigger tables take more room
+        small = self.g.footprint()
+        for keyID in xrange(1000):
+            self.g.grant(keyID, 'TOTP')
+        self.assertTrue(self.g.footprint() > small)
+
+    def test_db(self):
+        # The database's table is loaded at startup, and kept up to date
+        l = logger.K2Logger('')
+        d = db.K2DB(l)
+        d.createUsers([{'Username': 'smithj'}])
+        keyID = d.createKey(1, 'AES128', 'secret material')
+        d.linkKey(keyID, 'TOTP')
+        self.assertTrue(d.grants.granted(keyID, 'TOTP'))
+        d.grants = grants.K2GrantTable(d.links())
+        self.assertTrue(d.grants.granted(keyID, 'TOTP'))
+        d.unlinkKey(keyID, 'TOTP')
+        self.assertFalse(d.grants.granted(keyID, 'TOTP'))
+        self.assertEqual(d.keyMaterial(1, 'TOTP'), None)
+        d.close()
+
+    if canSkipOrFail:
+        def test_tooManyModules(self):
+            for i in xrange(1 << grants.K2_GRANT_MODULE_BITS):
+                try:
+                    self.g.grant(1, 'M%d' % i)
+                except ValueError:
+                    break
+            else:
+                self.fail('No limit on modules')
+            self.assertFalse(self.g.granted(1, 'M%d' % i))
+
+
+
+# List the tests and create a test suite, for use by the top-level test script.
+tests = ('test_granted', 'test_grantRevoke', 'test_footprint', 'test_db',
+         )
+skippedTests = ('test_tooManyModules',
+                )
+if canSkipOrFail:
+    K2GrantTableTestSuite = unittest.TestSuite(map(K2GrantTableTests,
+                                                   (tests + skippedTests)))
+else:
+    K2GrantTableTestSuite = unittest.TestSuite(map(K2GrantTableTests, tests))
+
+
+# Allow this set of test cases to be run by themselves.
+if __name__ == "__main__":
+    unittest.main()
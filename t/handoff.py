@@ -0,0 +1,94 @@
+'''
+This module contains all of the tests for everything in the k2ksm.handoff
+Python module.
+'''
+
+import os
+import socket
+import stat
+from tempfile import mkdtemp
+import unittest
+
+# If we're being run directly, then we need to add the parent dir to path
+try:
+    from k2ksm import handoff, logger, settings
+    from t._util import canSkipOrFail
+    from t.settings import TestSettings
+except:
+    from sys import path
+    path.append('..')
+    from k2ksm import handoff, logger, settings
+    from t._util import canSkipOrFail
+    from t.settings import TestSettings
+
+
+
+def makeSettings():
+    s = settings.K2Settings(logger.K2Logger(''))
+    s.register('TEST', TestSettings)
+    s.finalize()
+    return s
+
+
+
+class K2HandoffTests(unittest.TestCase):
+    # All of the tests of the handoff are in this class.  The new process is
+    # a forked child.
+
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.path = os.path.join(self.dir, 'handoff')
+        self.offer = handoff.K2HandoffOffer(logger.K2Logger(''), self.path)
+
+    def tearDown(self):
+        self.offer.close()
+        os.rmdir(self.dir)
+
+    def test_offerPermissions(self):
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0600)
+
+    def test_handoff(self):
+        # The child takes over the listening socket and the session, and
+        # answers a connection that was made to the parent's socket
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        s = makeSettings()
+        s.newSession(1)
+        s.settingSet('TEST.session', 7, 1)
+
+        pid = os.fork()
+        if (pid == 0):
+            status = 1
+            try:
+                newSettings = makeSettings()
+                (sockets, count) = handoff.acceptHandoff(
+                    logger.K2Logger(''), self.path, newSettings)
+                (client, address) = sockets['public'].accept()
+                client.sendall('READY %d %s\n' % (
+                    count, newSettings.settingGet('TEST.session', 1)))
+                client.close()
+                status = 0
+            finally:
+                os._exit(status)
+
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.connect(listener.getsockname())
+        self.assertEqual(self.offer.send({'public': listener}, s), 1)
+        listener.close()
+        self.assertEqual(client.makefile().readline(), "READY 1 7\n")
+        client.close()
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertFalse(os.path.exists(self.path))
+
+
+
+# List the tests and create a test suite, for use by the top-level test script.
+tests = ('test_offerPermissions', 'test_handoff',
+         )
+K2HandoffTestSuite = unittest.TestSuite(map(K2HandoffTests, tests))
+
+
+# Allow this set of test cases to be run by themselves.
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+'''
+This module contains all of the tests for everything in the k2ksm.keycache
+Python module.
+'''
+
+import unittest
+
+# If we're being run directly, then we need to add the parent dir to path
+try:
+    from k2ksm import db, keycache, logger, metrics, settings
+    from k2ksm.settings.keycache import K2KeyCacheSettings
+    from t._util import canSkipOrFail
+except:
+    from sys import path
+    path.append('..')
+    from k2ksm import db, keycache, logger, metrics, settings
+    from k2ksm.settings.keycache import K2KeyCacheSettings
+    from t._util import canSkipOrFail
+
+
+
+class K2KeyCacheTests(unittest.TestCase):
+    # All of the tests of K2KeyCache are in this class.
+
+    def setUp(self):
+        self.l = logger.K2Logger('')
+        self.db = db.K2DB(self.l)
+        self.db.createUsers([{'Username': 'smithj'}])
+        self.keyID = self.db.createKey(1, 'AES128', 'secret material')
+        self.db.linkKey(self.keyID, 'TOTP')
+        self.loads = 0
+        self.metrics = metrics.K2Metrics()
+        self.k = keycache.K2KeyCache(self.l, self.load, metrics=self.metrics)
+
+    def tearDown(self):
+        self.k.shutdown()
+        self.db.close()
+
+    def load(self, uid, module):
+        self.loads += 1
+        return self.db.keyMaterial(uid, module)
+
+    def test_key(self):
+        # The second lookup comes from the cache
+        for i in xrange(2):
+            with self.k.key(1, 'TOTP') as key:
+                self.assertEqual(key, bytearray('secret material'))
+        self.assertEqual(self.loads, 1)
+        self.assertEqual((self.k.cache.hits, self.k.cache.misses), (1, 1))
+        self.assertTrue('k2ksm_keycache_operations_total{result="hit"} 1'
+                        in self.metrics.exposition())
+
+    def test_key_notLinked(self):
+        # Keys are only given to modules they are linked to
+        with self.k.key(1, 'HOTP') as key:
+            self.assertEqual(key, None)
+        with self.k.key(2, 'TOTP') as key:
+            self.assertEqual(key, None)
+
+    def test_key_unlinked(self):
+        # Unlinking a key takes it out of the cache
+        self.db.keyCache = self.k
+        with self.k.key(1, 'TOTP') as key:
+            self.assertEqual(key, bytearray('secret material'))
+        self.db.unlinkKey(self.keyID, 'TOTP')
+        with self.k.key(1, 'TOTP') as key:
+            self.assertEqual(key, None)
+        self.db.linkKey(self.keyID, 'TOTP')
+        with self.k.key(1, 'TOTP') as key:
+            self.assertEqual(key, bytearray('secret material'))
+        self.assertEqual(self.loads, 3)
+
+    def test_discard(self):
+        with self.k.key(1, 'TOTP') as key:
+            pass
+        self.k.discard(1, 'TOTP')
+        self.assertEqual(key, bytearray(len('secret material')))
+        self.assertEqual(self.k.cache.wipes, 1)
+
+    def test_shutdown(self):
+        with self.k.key(1, 'TOTP') as key:
+            self.k.shutdown()
+            self.assertEqual(key, bytearray('secret material'))
+        self.assertEqual(key, bytearray(len('secret material')))
+
+    def test_tooBig(self):
+        # A key bigger than the cache is used, and then wiped
+        self.k.configure(10, 30, 4)
+        with self.k.key(1, 'TOTP') as key:
+            self.assertEqual(key, bytearray('secret material'))
+        self.assertEqual(key, bytearray(len('secret material')))
+        self.assertEqual(len(self.k.cache), 0)
+
+    def test_settings(self):
+        s = settings.K2Settings(self.l)
+        s.loadArgs(('KEYCACHE.Entries', '5'))
+        K2KeyCacheSettings.attach(self.k, s)
+        self.assertEqual(self.k.cache.maxEntries, 5)
+        s.settingSet('KEYCACHE.TTL', 2)
+        self.assertEqual(self.k.cache.ttl, 2)
+
+    if canSkipOrFail:
+        def test_settings_invalid(self):
+            s = settings.K2Settings(self.l)
+            K2KeyCacheSettings.attach(self.k, s)
+            self.assertRaises(ValueError, s.settingSet, 'KEYCACHE.TTL', 0)
+            self.assertRaises(ValueError, s.settingSet, 'KEYCACHE.Entries',
+                              'many')
+
+
+
+# List the tests and create a test suite, for use by the top-level test script.
+tests = ('test_key', 'test_key_notLinked', 'test_key_unlinked',
+         'test_discard', 'test_shutdown',
+         'test_tooBig', 'test_settings',
+         )
+skippedTests = ('test_settings_invalid',
+                )
+if canSkipOrFail:
+    K2KeyCacheTestSuite = unittest.TestSuite(map(K2KeyCacheTests,
+                                                 (tests + skippedTests)))
+else:
+    K2KeyCacheTestSuite = unittest.TestSuite(map(K2KeyCacheTests, tests))
+
+
+# Allow this set of test cases to be run by themselves.
+if __name__ == "__main__":
+    unittest.main()
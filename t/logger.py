@@ -3,21 +3,37 @@ Created on May 9, 2014
 
 @author: akkornel
 '''
+from os import close, unlink
+from tempfile import mkstemp
 import unittest
 import logging
 
 # If we're being run directly, then we need to add the parent dir to path
 try:
-    from k2ksm import logger
+    from k2ksm import logger, settings
+    from k2ksm.settings.logger import K2LoggerSettings
     from ._util import canSkipOrFail, nonStr
 except:
     from sys import path
     path.append('..')
-    from k2ksm import logger
+    from k2ksm import logger, settings
+    from k2ksm.settings.logger import K2LoggerSettings
     from t._util import canSkipOrFail, nonStr
     
 
 
+class _RecordHandler(logging.Handler):
+    # Keeps every record that would be written (that is, not sampled out)
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+    
+    def emit(self, record):
+        if (getattr(record, 'sampled', True)):
+            self.records.append(record)
+
+
+
 class K2LoggerTests(unittest.TestCase):
     # All of the tests of the K2Logger are in this class.
     
@@ -102,6 +118,93 @@ class K2LoggerTests(unittest.TestCase):
             # Creating a logger with something non-str()able should fail
             nonstr = nonStr()
             self.assertRaises(TypeError, logger.K2Logger, nonstr)
+    
+    def captured(self):
+        # Log to a capturing handler, instead of stderr.  Each test gets its
+        # own logger, so that the handlers of other tests are not used.
+        self.l = logger.K2Logger(self.id())
+        self.l.logToStderr = False
+        self.l.logger.setLevel(logging.INFO)
+        handler = _RecordHandler()
+        self.l.logger.addHandler(handler)
+        return handler
+    
+    def test_moduleLevel(self):
+        handler = self.captured()
+        lm = self.l.loggerForModule('levels')
+        lm.debug('hidden')
+        self.l.setModuleLevel('levels', 'DEBUG')
+        lm.debug('shown')
+        self.l.loggerForModule('other').debug('hidden')
+        self.l.setModuleLevel('levels', None)
+        lm.debug('hidden')
+        self.assertEqual([r.getMessage() for r in handler.records],
+                         ['shown'])
+    
+    def test_moduleSampling(self):
+        handler = self.captured()
+        lm = self.l.loggerForModule('sampled')
+        sampler = self.l.setModuleSampling('sampled', rate=0.0)
+        for i in xrange(10):
+            lm.info('AUTH OK')
+        lm.warning('not sampled')
+        self.assertEqual([r.getMessage() for r in handler.records],
+                         ['not sampled'])
+        self.assertEqual(sampler.dropped, 10)
+    
+    def test_sampleFilter_perSecond(self):
+        now = [1000.0]
+        f = logger.K2SampleFilter(perSecond=2, clock=lambda: now[0])
+        def kept():
+            record = logging.LogRecord('x', logging.INFO, '', 0, '', (), None)
+            f.filter(record)
+            return getattr(record, 'sampled', True)
+        self.assertEqual([kept() for i in xrange(3)], [True, True, False])
+        now[0] += 0.5
+        self.assertEqual([kept() for i in xrange(2)], [True, False])
+    
+    def test_settings(self):
+        # The LOGGER settings module configures modules, even at runtime
+        self.captured()
+        s = settings.K2Settings(self.l)
+        s.loadArgs(('LOGGER.ModuleLevels', 'fromArgs=DEBUG'))
+        K2LoggerSettings.attach(self.l, s)
+        self.assertEqual(self.l.loggerForModule('fromArgs').level,
+                         logging.DEBUG)
+        s.settingSet('LOGGER.ModuleLevels', 'fromSet=WARNING')
+        s.settingSet('LOGGER.ModuleSampling', 'fromSet=10/s')
+        self.assertEqual(self.l.loggerForModule('fromArgs').level,
+                         logging.NOTSET)
+        lm = self.l.loggerForModule('fromSet')
+        self.assertEqual(lm.level, logging.WARNING)
+        self.assertEqual(lm.filters[0].perSecond, 10)
+        self.assertRaises(ValueError, s.settingSet, 'LOGGER.ModuleSampling',
+                          'fromSet=2')
+        
+        
+    def test_settings_restored(self):
+        # Settings restored from a snapshot already have the module
+        (fileNum, snapshotPath) = mkstemp()
+        close(fileNum)
+        try:
+            s = settings.K2Settings(self.l)
+            s.loadArgs(('LOGGER.ModuleLevels', 'fromArgs=DEBUG'))
+            K2LoggerSettings.attach(self.l, s)
+            s.finalize()
+            s.snapshot(snapshotPath)
+            other = logger.K2Logger(self.id() + '.restored')
+            other.logToStderr = False
+            r = settings.K2Settings.restore(other, snapshotPath,
+                                            ('LOGGER.ModuleLevels',
+                                             'fromArgs=DEBUG'))
+            K2LoggerSettings.attach(other, r)
+        finally:
+            unlink(snapshotPath)
+        self.assertEqual(other.loggerForModule('fromArgs').level,
+                         logging.DEBUG)
+        r.settingSet('LOGGER.ModuleLevels', 'fromArgs=ERROR')
+        self.assertEqual(other.loggerForModule('fromArgs').level,
+                         logging.ERROR)
         
         
 # List the tests and create a test suite, for use by the top-level test script.
@@ -111,6 +214,9 @@ tests = ('test_create',
          'test_logStderr_false',
          'test_logSyslog_true', 'test_logSyslog_tf',
          'test_loggerForModule',
+         'test_moduleLevel', 'test_moduleSampling',
+         'test_sampleFilter_perSecond', 'test_settings',
+         'test_settings_restored',
          )
 skippedTests = ('test_create_badName',
                 'test_namePrefix_set', 'test_namePrefix_delete',
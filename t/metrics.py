@@ -0,0 +1,147 @@
+'''
+This module contains all of the tests for everything in the k2ksm.metrics
+Python module.
+'''
+
+from os import path as osPath, rmdir, stat
+import socket
+from tempfile import mkdtemp
+from threading import Thread
+import unittest
+
+# If we're being run directly, then we need to add the parent dir to path
+try:
+    from k2ksm import logger, metrics, settings
+    from t._util import canSkipOrFail
+except:
+    from sys import path
+    path.append('..')
+    from k2ksm import logger, metrics, settings
+    from t._util import canSkipOrFail
+
+
+
+class K2MetricsTests(unittest.TestCase):
+    # All of the tests of K2Metrics are in this class.
+
+    def setUp(self):
+        self.m = metrics.K2Metrics()
+
+    def tearDown(self):
+        self.m = None
+
+    def test_counter(self):
+        c = self.m.counter('test_total', 'A test.')
+        c.inc()
+        c.inc(2)
+        self.assertEqual(c.value(), 3)
+        self.assertTrue(self.m.counter('test_total', 'A test.') is c)
+
+    def test_counter_threads(self):
+        # Each thread records into its own shard; scraping adds them up
+        child = metrics.authResults(self.m).labels('TOTP', 'OK')
+        def work():
+            for i in xrange(1000):
+                child.inc()
+        threads = [Thread(target=work) for i in xrange(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(child.value(), 4000)
+        self.assertTrue('k2ksm_auth_results_total{module="TOTP",result="OK"}'
+                        ' 4000' in self.m.exposition())
+
+    def test_shards_pruned(self):
+        # Shards of threads that have exited are folded into the base shard
+        child = self.m.counter('test_total', 'A test.').labels()
+        child.inc()
+        def work():
+            child.inc(2)
+        for i in xrange(50):
+            t = Thread(target=work)
+            t.start()
+            t.join()
+        self.assertEqual(child.value(), 101)
+        self.assertTrue('test_total 101' in self.m.exposition())
+        self.assertEqual(self.m.shardCount(), 1)
+        self.m.counter('late_total', 'Added after the threads.').inc(3)
+        self.assertEqual(self.m.counter('late_total', '').value(), 3)
+        self.m.counter('kept_total', 'Kept elsewhere.').setFunction(lambda: 7)
+        self.assertTrue('kept_total 7' in self.m.exposition())
+
+    def test_gauge(self):
+        g = self.m.gauge('test', 'A test.', ('kind',))
+        g.labels('a').inc(5)
+        g.labels('a').dec(2)
+        g.labels('b').setFunction(lambda: 42)
+        self.assertEqual(g.labels('a').value(), 3)
+        self.assertTrue('test{kind="b"} 42' in self.m.exposition())
+
+    def test_histogram(self):
+        h = self.m.histogram('test_seconds', 'A test.', buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 0.5, 5):
+            h.observe(value)
+        lines = self.m.exposition().splitlines()
+        self.assertEqual(lines[2:], ['test_seconds_bucket{le="0.1"} 1',
+                                     'test_seconds_bucket{le="1.0"} 3',
+                                     'test_seconds_bucket{le="+Inf"} 4',
+                                     'test_seconds_sum 6.05',
+                                     'test_seconds_count 4'])
+
+    def test_settings(self):
+        s = settings.K2Settings(logger.K2Logger(''), self.m)
+        s.newSession(1)
+        s.newSession(2)
+        s.delSession(1)
+        self.assertTrue('k2ksm_settings_sessions 1' in self.m.exposition())
+
+    def test_server(self):
+        directory = mkdtemp()
+        socketPath = osPath.join(directory, 'metrics')
+        self.m.counter('test_total', 'A test.').inc()
+        server = metrics.K2MetricsServer(self.m, socketPath)
+        try:
+            self.assertEqual(stat(socketPath).st_mode & 0777, 0660)
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.connect(socketPath)
+            data = ''
+            while True:
+                chunk = client.recv(4096)
+                if (chunk == ''):
+                    break
+                data += chunk
+            client.close()
+        finally:
+            server.close()
+            rmdir(directory)
+        self.assertEqual(data, self.m.exposition())
+
+    if canSkipOrFail:
+        def test_labels_wrongCount(self):
+            c = self.m.counter('test_total', 'A test.', ('a', 'b'))
+            self.assertRaises(ValueError, c.labels, 'x')
+
+        def test_register_conflict(self):
+            self.m.counter('test', 'A test.')
+            self.assertRaises(KeyError, self.m.gauge, 'test', 'A test.')
+
+
+
+# List the tests and create a test suite, for use by the top-level test script.
+tests = ('test_counter', 'test_counter_threads', 'test_shards_pruned',
+         'test_gauge',
+         'test_histogram', 'test_settings', 'test_server',
+         )
+skippedTests = ('test_labels_wrongCount', 'test_register_conflict',
+                )
+if canSkipOrFail:
+    K2MetricsTestSuite = unittest.TestSuite(map(K2MetricsTests,
+                                                (tests + skippedTests)))
+else:
+    K2MetricsTestSuite = unittest.TestSuite(map(K2MetricsTests, tests))
+
+
+# Allow this set of test cases to be run by themselves.
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,386 @@
+'''
+This module contains all of the tests for everything in the
+k2ksm.protocol package.
+'''
+
+import socket
+from time import time
+import unittest
+
+# If we're being run directly, then we need to add the parent dir to path
+try:
+    from k2ksm import logger, protocol, settings
+    from k2ksm.protocol import encoder, jsonstream, parser
+    from k2ksm.settings.protocol import K2ProtocolSettings
+    from t._util import canSkipOrFail
+except:
+    from sys import path
+    path.append('..')
+    from k2ksm import logger, protocol, settings
+    from k2ksm.protocol import encoder, jsonstream, parser
+    from k2ksm.settings.protocol import K2ProtocolSettings
+    from t._util import canSkipOrFail
+
+
+
+class K2ParserTests(unittest.TestCase):
+    # All of the tests of K2Parser are in this class.
+
+    def setUp(self):
+        self.p = parser.K2Parser(maxLine=20, maxBlock=30)
+
+    def items(self, data=''):
+        self.p.feed(data)
+        return list(self.p)
+
+    def test_commands(self):
+        (auth, quit) = self.items('auth TOTP  smithj 12\r\n\n  QUIT\n')
+        self.assertEqual(auth.verb, 'AUTH')
+        self.assertEqual(auth.args, ['TOTP', 'smithj', '12'])
+        self.assertEqual(auth.line, 'AUTH TOTP  smithj 12')
+        self.assertEqual((quit.verb, quit.args), ('QUIT', []))
+
+    def test_incremental(self):
+        # Lines may arrive in pieces
+        self.assertEqual(self.items('USER CRE'), [])
+        self.assertEqual(len(self.p), 8)
+        self.assertEqual(self.items('ATE smithj\nQU')[0].line,
+                         'USER CREATE smithj')
+        self.assertEqual(self.items('IT\n')[0].verb, 'QUIT')
+        self.assertEqual(len(self.p), 0)
+
+    def test_block(self):
+        self.p.feed('USER CREATE smithj\n{\n"GivenName": "John"\n')
+        self.assertEqual(self.p.next().verb, 'USER')
+        self.p.expectBlock()
+        self.assertEqual(self.p.next(), None)
+        (block, quit) = self.items('}\n.\nQUIT\n')
+        self.assertEqual(block.lines, ['{', '"GivenName": "John"', '}'])
+        self.assertEqual(block.size, 24)
+        self.assertEqual(quit.verb, 'QUIT')
+
+    def test_consumer(self):
+        lines = []
+        self.p.expectBlock(lines.append)
+        block = self.items('a\nb\n.\n')[0]
+        self.assertEqual(lines, ['a', 'b'])
+        self.assertEqual(block.lines, None)
+
+    def test_lineTooLong(self):
+        # The long line is skipped, even if it arrives in pieces
+        self.p.feed('A' * 25)
+        self.assertRaises(parser.K2ProtocolError, self.p.next)
+        self.assertEqual(len(self.p), 0)
+        self.assertEqual(self.items('AAAA\nQUIT\n')[0].verb, 'QUIT')
+        # The error is raised once, however long the line is
+        self.p.feed('A' * 25)
+        self.assertRaises(parser.K2ProtocolError, self.p.next)
+        self.assertEqual(self.items('A' * 25), [])
+        self.assertEqual(len(self.p), 0)
+        self.assertEqual(self.items('A' * 25 + '\nQUIT\n')[0].verb, 'QUIT')
+        self.p.feed('B' * 21 + '\nQUIT\n')
+        try:
+            self.p.next()
+            self.fail('Long line was accepted')
+        except parser.K2ProtocolError as e:
+            self.assertTrue(e.response.startswith('NOK\n'))
+        self.assertEqual(self.p.next().verb, 'QUIT')
+
+    def test_splitLineEnding(self):
+        # A carriage return does not count towards the line's length, even
+        # if its newline has not arrived yet
+        self.p = parser.K2Parser(maxLine=4)
+        self.assertEqual(self.items('ABCD\r'), [])
+        self.assertEqual(self.items('\n')[0].verb, 'ABCD')
+
+    def test_blockTooLarge(self):
+        # The error is raised once, and the rest of the block is skipped
+        self.p.expectBlock()
+        self.p.feed('0123456789\n' * 4 + '.\nQUIT\n')
+        self.assertRaises(parser.K2ProtocolError, self.p.next)
+        self.assertEqual(self.p.next().verb, 'QUIT')
+
+    def test_blankBlockTooLarge(self):
+        # Blank lines count towards the block's size
+        self.p.expectBlock()
+        self.p.feed('\n' * 31 + '.\nQUIT\n')
+        self.assertRaises(parser.K2ProtocolError, self.p.next)
+        self.assertEqual(self.p.next().verb, 'QUIT')
+
+    def test_consumerError(self):
+        def consumer(line):
+            raise parser.K2ProtocolError('3', 'Bad line')
+        self.p.expectBlock(consumer)
+        self.p.feed('a\nb\n.\nQUIT\n')
+        self.assertRaises(parser.K2ProtocolError, self.p.next)
+        self.assertEqual(self.p.next().verb, 'QUIT')
+
+    def test_receive(self):
+        (a, b) = socket.socketpair()
+        a.sendall('AUTH TOTP smithj 123456\nQUIT\n')
+        a.close()
+        self.p = parser.K2Parser()
+        while (self.p.receive(b, 7) > 0):
+            pass
+        b.close()
+        self.assertEqual([command.verb for command in self.p],
+                         ['AUTH', 'QUIT'])
+
+    def test_settings(self):
+        s = settings.K2Settings(logger.K2Logger(''))
+        s.loadArgs(('PROTOCOL.MaxLineLength', '100'))
+        s.register('PROTOCOL', K2ProtocolSettings)
+        p = parser.parserFor(s)
+        self.assertEqual((p.maxLine, p.maxBlock),
+                         (100, parser.K2_MAX_BLOCK_SIZE))
+
+    if canSkipOrFail:
+        def test_create_badLimits(self):
+            self.assertRaises(ValueError, parser.K2Parser, 0)
+
+
+
+class K2JSONStreamTests(unittest.TestCase):
+    # All of the tests of K2JSONStream are in this class.
+
+    def setUp(self):
+        self.items = []
+        self.j = jsonstream.K2JSONStream(self.onItem, maxDepth=3,
+                                         maxSize=200)
+
+    def onItem(self, key, value):
+        self.items.append((key, value))
+
+    def feed(self, text):
+        for line in text.split('\n'):
+            self.j.feed(line)
+        return self.j.close()
+
+    def test_newlineSeparated(self):
+        # The style shown in docs/protocol.txt
+        self.assertEqual(self.feed('{\n"GivenName": "John"\n'
+                                   '"Surname": "Smith"\n}'), 2)
+        self.assertEqual(self.items, [(u'GivenName', u'John'),
+                                      (u'Surname', u'Smith')])
+
+    def test_json(self):
+        # Ordinary JSON, with members split over lines and commas in strings
+        self.feed('{"a": 1, "b": "x,}{\\"y",\n"c":\n  [1,\n   {"d": 2}]}')
+        self.assertEqual(self.items, [(u'a', 1), (u'b', u'x,}{"y'),
+                                      (u'c', [1, {u'd': 2}])])
+
+    def test_array(self):
+        self.feed('[\n{"Username": "smithj"}\n{"Username": "bellr"}\n]')
+        self.assertEqual([item[0] for item in self.items], [0, 1])
+        self.assertEqual(self.items[1][1], {u'Username': u'bellr'})
+
+    def test_incremental(self):
+        # Members are handed over before the block ends
+        self.j.feed('{')
+        self.j.feed('"GivenName": "John"')
+        self.assertEqual(self.items, [(u'GivenName', u'John')])
+        self.assertFalse(self.j.done)
+        self.assertRaises(parser.K2ProtocolError, self.j.close)
+
+    def test_parser(self):
+        # As the consumer of a MORE block
+        p = parser.K2Parser()
+        p.expectBlock(self.j.feed)
+        p.feed('{\n"GivenName": "John"\n}\n.\n')
+        self.assertEqual(p.next().lines, None)
+        self.assertEqual(self.j.close(), 1)
+
+    def test_invalid(self):
+        for text in ('"a"', '{"a" 1}', '{"a": 1]', '{"a": "b}', '{"a": 1} x',
+                     '{"a": 1 "b": 2}'):
+            self.setUp()
+            self.assertRaises(parser.K2ProtocolError, self.feed, text)
+
+    def test_splitMember(self):
+        # A member may be split after its key and its colon, but a member
+        # that still does not decode after that is rejected
+        self.feed('{\n"a"\n\n:\n"b"\n"c":\n[\n1]\n}')
+        self.assertEqual(self.items, [(u'a', u'b'), (u'c', [1])])
+        self.setUp()
+        for line in ('{', '"a":', '1 2'):
+            self.j.feed(line)
+        self.assertRaises(parser.K2ProtocolError, self.j.feed, '3')
+
+    def test_linear(self):
+        # A member is not decoded again for each blank line or nested line
+        # that arrives after its key
+        def run(lines):
+            best = None
+            for attempt in xrange(3):
+                j = jsonstream.K2JSONStream(self.onItem, maxSize=10 ** 8)
+                start = time()
+                j.feed('{')
+                j.feed('"a":')
+                for i in xrange(lines):
+                    j.feed('')
+                j.feed('[')
+                for i in xrange(lines):
+                    j.feed('1,')
+                j.feed('1]}')
+                elapsed = time() - start
+                if ((best == None) or (elapsed < best)):
+                    best = elapsed
+            return best
+        small = run(2000)
+        self.assertTrue(run(16000) < 20 * small + 0.01)
+
+    def test_limits(self):
+        self.feed('{"a": [[1]]}')
+        self.setUp()
+        self.assertRaises(parser.K2ProtocolError, self.feed,
+                          '{"a": [[[1]]]}')
+        self.setUp()
+        try:
+            self.feed('{"a": "%s"}' % ('x' * 200))
+            self.fail('Large block was accepted')
+        except parser.K2ProtocolError as e:
+            self.assertTrue('"code": "2"' in e.response)
+
+    def test_settings(self):
+        s = settings.K2Settings(logger.K2Logger(''))
+        s.loadArgs(('PROTOCOL.MaxJSONDepth', '2'))
+        s.register('PROTOCOL', K2ProtocolSettings)
+        j = jsonstream.jsonStreamFor(s, self.onItem)
+        self.assertEqual((j.maxDepth, j.maxSize),
+                         (2, parser.K2_MAX_BLOCK_SIZE))
+
+
+
+class FakeSocket(object):
+    # Records what is sent, taking at most limit bytes per sendmsg
+
+    def __init__(self, limit=None):
+        self.calls = []
+        self.limit = limit
+
+    def sendall(self, data):
+        self.calls.append(data)
+
+    def sendmsg(self, pieces):
+        data = ''.join(pieces)[:self.limit]
+        self.calls.append(data)
+        return len(data)
+
+
+class FakeStream(object):
+    # A socket without sendmsg, as on Python 2
+
+    def __init__(self):
+        self.calls = []
+
+    def sendall(self, data):
+        self.calls.append(data)
+
+
+class K2EncoderTests(unittest.TestCase):
+    # All of the tests of the response encoder are in this class.
+
+    def test_register(self):
+        response = encoder.register('TEST', 1, 'Test error')
+        self.assertEqual(response, protocol.nok('TEST', '1', 'Test error'))
+        self.assertTrue(encoder.register('TEST', '1', 'Test error')
+                        is response)
+        self.assertRaises(ValueError, encoder.register, 'TEST', '1', 'Other')
+
+    def test_error(self):
+        response = encoder.register('TEST', '2', 'Test error')
+        self.assertTrue(encoder.error('TEST', 2) is response)
+        self.assertTrue(encoder.error('TEST', '2', 'Test error') is response)
+        self.assertEqual(encoder.error('TEST', '2', 'Other'),
+                         protocol.nok('TEST', '2', 'Other'))
+        self.assertRaises(KeyError, encoder.error, 'TEST', '3')
+
+    def test_registered(self):
+        # Responses built elsewhere come from the registry
+        self.assertTrue(parser.K2ProtocolError('1', 'Line too long').response
+                        is encoder.error('PROTOCOL', '1'))
+        self.assertTrue('"details": "Invalid JSON: x"' in
+                        parser.K2ProtocolError('3', 'Invalid JSON: x').response)
+
+    def test_writer(self):
+        sock = FakeStream()
+        w = encoder.K2ResponseWriter(sock)
+        self.assertEqual(w.flush(), 0)
+        w.ok('{\n"UID": "345234"\n}\n')
+        w.ready()
+        self.assertEqual(len(w), 31)
+        self.assertEqual(sock.calls, [])
+        self.assertEqual(w.flush(), 31)
+        self.assertEqual(sock.calls,
+                         ['OK\n{\n"UID": "345234"\n}\nREADY 1\n'])
+        self.assertEqual(len(w), 0)
+
+    def test_sendmsg(self):
+        # Partial sends carry on from where they stopped
+        sock = FakeSocket(limit=5)
+        w = encoder.K2ResponseWriter(sock)
+        w.more()
+        w.nok('PROTOCOL', '2')
+        w.bye()
+        expected = encoder.K2_MORE + encoder.error('PROTOCOL', '2') + 'BYE\n'
+        self.assertEqual(w.flush(), len(expected))
+        self.assertEqual(''.join(sock.calls), expected)
+        self.assertEqual(len(sock.calls[0]), 5)
+
+    def test_socket(self):
+        (a, b) = socket.socketpair()
+        try:
+            w = encoder.K2ResponseWriter(a)
+            w.ok()
+            w.ready()
+            w.flush()
+            self.assertEqual(b.recv(100), 'OK\nREADY 1\n')
+        finally:
+            a.close()
+            b.close()
+
+
+
+# List the tests and create a test suite, for use by the top-level test script.
+tests = {}
+tests['K2Parser'] = (
+    'test_commands', 'test_incremental', 'test_block', 'test_consumer',
+    'test_lineTooLong', 'test_splitLineEnding', 'test_blockTooLarge',
+    'test_blankBlockTooLarge',
+    'test_consumerError',
+    'test_receive', 'test_settings',
+)
+tests['K2JSONStream'] = (
+    'test_newlineSeparated', 'test_json', 'test_array', 'test_incremental',
+    'test_parser', 'test_invalid', 'test_splitMember', 'test_linear',
+    'test_limits', 'test_settings',
+)
+
+tests['K2Encoder'] = (
+    'test_register', 'test_error', 'test_registered', 'test_writer',
+    'test_sendmsg', 'test_socket',
+)
+
+skippableTests = {}
+skippableTests['K2Parser'] = (
+    'test_create_badLimits',
+)
+
+if canSkipOrFail:
+    K2ParserTestSuite = unittest.TestSuite(\
+        map(K2ParserTests, (tests['K2Parser']
+                            + skippableTests['K2Parser'])
+            )
+        )
+else:
+    K2ParserTestSuite = unittest.TestSuite(\
+        map(K2ParserTests, tests['K2Parser']))
+K2JSONStreamTestSuite = unittest.TestSuite(\
+    map(K2JSONStreamTests, tests['K2JSONStream']))
+K2EncoderTestSuite = unittest.TestSuite(\
+    map(K2EncoderTests, tests['K2Encoder']))
+
+
+# Allow this set of test cases to be run by themselves.
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+'''
+This module contains all of the tests for everything in the k2ksm.provision
+Python module.
+'''
+
+from threading import Event
+import unittest
+
+# If we're being run directly, then we need to add the parent dir to path
+try:
+    from k2ksm import logger, provision
+    from t._util import canSkipOrFail
+except:
+    from sys import path
+    path.append('..')
+    from k2ksm import logger, provision
+    from t._util import canSkipOrFail
+
+
+
+class K2QRRendererTests(unittest.TestCase):
+    # All of the tests of K2QRRenderer are in this class.  We use a fake
+    # renderer, so that qrcode and Pillow are not needed.
+
+    def render(self, uri):
+        self.renders += 1
+        self.release.wait()
+        return bytearray('PNG:' + uri)
+
+    def setUp(self):
+        self.renders = 0
+        self.release = Event()
+        self.release.set()
+        self.r = provision.K2QRRenderer(logger.K2Logger(''),
+                                        render=self.render)
+
+    def tearDown(self):
+        self.r.shutdown()
+        self.r = None
+
+    def test_otpauthURI(self):
+        uri = provision.otpauthURI('totp', 'smithj', '12345')
+        self.assertEqual(uri, 'otpauth://totp/k2ksm:smithj?'
+                         'secret=GEZDGNBV&issuer=k2ksm&digits=6&period=30')
+
+    def test_render(self):
+        job = self.r.submit('otpauth://x')
+        self.assertTrue(job.wait(5))
+        self.assertEqual(job.error, None)
+        chunks = list(self.r.stream('otpauth://x', chunkSize=4))
+        self.assertEqual(''.join(c.tobytes() for c in chunks),
+                         'PNG:otpauth://x')
+        self.assertEqual(len(chunks), 4)
+
+    def test_render_cached(self):
+        # Repeated and concurrent submits only render once
+        self.release.clear()
+        jobs = [self.r.submit('otpauth://x') for i in xrange(3)]
+        self.release.set()
+        for job in jobs:
+            self.assertTrue(job.wait(5))
+        self.assertTrue(self.r.submit('otpauth://x').wait(0))
+        self.assertEqual(self.renders, 1)
+
+    def test_shutdown(self):
+        # Shutting down wipes the cache
+        self.r.submit('otpauth://x').wait(5)
+        image = self.r.cache.get(provision._cacheKey('otpauth://x'))
+        self.r.shutdown()
+        self.assertEqual(image, bytearray(len(image)))
+
+    def test_stream_expired(self):
+        # An image that expires between submit and stream is rendered again
+        self.r.submit('otpauth://x').wait(5)
+        self.assertEqual(self.r.cache.get('otpauth://x'), None)
+        self.r.cache.clear()
+        chunks = list(self.r.stream('otpauth://x'))
+        self.assertEqual(''.join(c.tobytes() for c in chunks),
+                         'PNG:otpauth://x')
+        self.assertEqual(self.renders, 2)
+
+    if canSkipOrFail:
+        def test_stream_renderFails(self):
+            def fail(uri):
+                raise ValueError('Bad URI')
+            r = provision.K2QRRenderer(logger.K2Logger(''), render=fail)
+            try:
+                self.assertRaises(KeyError, list, r.stream('otpauth://y'))
+            finally:
+                r.shutdown()
+
+        def test_otpauthURI_badKind(self):
+            self.assertRaises(ValueError, provision.otpauthURI, 'motp',
+                              'smithj', '12345')
+
+
+
+# List the tests and create a test suite, for use by the top-level test script.
+tests = ('test_otpauthURI', 'test_render', 'test_render_cached',
+         'test_shutdown', 'test_stream_expired',
+         )
+skippedTests = ('test_stream_renderFails', 'test_otpauthURI_badKind',
+                )
+if canSkipOrFail:
+    K2QRRendererTestSuite = unittest.TestSuite(map(K2QRRendererTests,
+                                                   (tests + skippedTests)))
+else:
+    K2QRRendererTestSuite = unittest.TestSuite(map(K2QRRendererTests, tests))
+
+
+# Allow this set of test cases to be run by themselves.
+if __name__ == "__main__":
+    unittest.main()
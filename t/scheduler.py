@@ -0,0 +1,181 @@
+'''
+This module contains all of the tests for everything in the k2ksm.scheduler
+Python module.
+'''
+
+import json
+from threading import Event
+import unittest
+
+# If we're being run directly, then we need to add the parent dir to path
+try:
+    from k2ksm import logger, metrics, protocol, scheduler, settings
+    from k2ksm.settings.scheduler import K2SchedulerSettings
+    from t._util import canSkipOrFail
+except:
+    from sys import path
+    path.append('..')
+    from k2ksm import logger, metrics, protocol, scheduler, settings
+    from k2ksm.settings.scheduler import K2SchedulerSettings
+    from t._util import canSkipOrFail
+
+
+
+class K2SchedulerTests(unittest.TestCase):
+    # All of the tests of K2Scheduler are in this class.
+
+    def setUp(self):
+        self.l = logger.K2Logger(self.id())
+        self.l.logToStderr = False
+        self.metrics = metrics.K2Metrics()
+        self.run = []
+        self.replies = []
+        self.s = scheduler.K2Scheduler(self.l, self.dispatch,
+                                       metrics=self.metrics)
+
+    def tearDown(self):
+        self.s.stop()
+
+    def dispatch(self, command, data):
+        if (command in ('FAIL', ' ')):
+            raise RuntimeError('failed')
+        self.run.append(command)
+        return 'OK\n'
+
+    def submit(self, command, count=1):
+        for i in xrange(count):
+            self.s.submit(command, self.replies.append)
+
+    def test_commandClass(self):
+        self.assertEqual(scheduler.commandClass('AUTH TOTP smithj 123456'),
+                         scheduler.K2_CLASS_AUTH)
+        self.assertEqual(scheduler.commandClass('user import abc'),
+                         scheduler.K2_CLASS_BULK)
+        self.assertEqual(scheduler.commandClass('USER CREATE smithj'),
+                         scheduler.K2_CLASS_ADMIN)
+        self.assertEqual(scheduler.commandClass(''),
+                         scheduler.K2_CLASS_ADMIN)
+
+    def test_weights(self):
+        # Each class gets its share, and ties go to the more important class
+        self.s = scheduler.K2Scheduler(self.l, self.dispatch,
+                                       weights={'AUTH': 2, 'ADMIN': 1,
+                                                'BULK': 1})
+        self.submit('USER EXPORT *', 4)
+        self.submit('USER CREATE smithj', 4)
+        self.submit('AUTH TOTP smithj 1', 8)
+        for i in xrange(8):
+            self.assertTrue(self.s.step())
+        self.assertEqual(self.run[0], 'AUTH TOTP smithj 1')
+        self.assertEqual([scheduler.commandClass(command)
+                          for command in self.run].count('AUTH'), 4)
+        self.assertEqual(self.run.count('USER EXPORT *'), 2)
+
+    def test_noStarvation(self):
+        # Bulk work still runs while AUTH requests keep arriving
+        self.submit('USER IMPORT abc')
+        for i in xrange(21):
+            self.submit('AUTH TOTP smithj 1')
+            self.s.step()
+        self.assertTrue('USER IMPORT abc' in self.run)
+        while (self.s.step()):
+            pass
+        self.assertFalse(self.s.step())
+        self.assertEqual(len(self.replies), 22)
+
+    def test_overloaded(self):
+        self.s.configure({'AUTH': 10, 'ADMIN': 10, 'BULK': 1})
+        self.assertTrue(self.s.submit('USER IMPORT a', self.replies.append))
+        self.assertFalse(self.s.submit('USER IMPORT b', self.replies.append))
+        self.assertEqual(self.replies, [scheduler.K2_OVERLOADED])
+        self.assertEqual(self.s.rejected['BULK'], 1)
+        exposition = self.metrics.exposition()
+        self.assertTrue('k2ksm_scheduler_rejected_total{class="BULK"} 1'
+                        in exposition)
+        self.assertTrue('k2ksm_scheduler_queued{class="BULK"} 1'
+                        in exposition)
+
+    def test_workers(self):
+        done = Event()
+        self.s.start(2)
+        self.s.submit('AUTH TOTP smithj 1', lambda response: done.set())
+        done.wait(5)
+        self.assertTrue(done.isSet())
+        self.assertEqual(self.run, ['AUTH TOTP smithj 1'])
+
+    def test_error(self):
+        self.submit('FAIL')
+        self.s.step()
+        self.assertEqual(self.replies, [scheduler.K2_INTERNAL_ERROR])
+
+    def test_error_blank(self):
+        # A blank command that fails, and a reply function that fails, are
+        # both logged
+        def badReply(response):
+            raise RuntimeError('reply failed')
+        self.submit(' ')
+        self.s.submit('AUTH TOTP smithj 1', badReply)
+        self.submit('AUTH TOTP smithj 2')
+        for i in xrange(3):
+            self.assertTrue(self.s.step())
+        self.assertEqual(sorted(self.replies),
+                         sorted([scheduler.K2_INTERNAL_ERROR, 'OK\n']))
+
+    def test_stop(self):
+        self.submit('AUTH TOTP smithj 1', 2)
+        self.s.stop()
+        self.assertEqual(self.replies, [scheduler.K2_SHUTTING_DOWN] * 2)
+        self.assertEqual(len(self.s), 0)
+        # Requests after the stop are not queued
+        self.assertFalse(self.s.submit('AUTH TOTP smithj 1',
+                                       self.replies.append))
+        self.assertEqual(self.replies, [scheduler.K2_SHUTTING_DOWN] * 3)
+        self.assertEqual(len(self.s), 0)
+        self.assertEqual(self.s.rejected['AUTH'], 0)
+
+    def test_nok(self):
+        lines = scheduler.K2_OVERLOADED.splitlines()
+        self.assertEqual(lines[0], 'NOK')
+        self.assertEqual(json.loads('\n'.join(lines[1:])),
+                         {'module': 'SCHEDULER', 'code': '1',
+                          'details': 'The server is overloaded.  Try again '
+                                     'later.'})
+        self.assertEqual(protocol.nok('X', 2, 'a "b"'),
+                         'NOK\n{\n"module": "X",\n"code": "2",\n'
+                         '"details": "a \\"b\\""\n}\n')
+
+    def test_settings(self):
+        s = settings.K2Settings(self.l)
+        s.loadArgs(('SCHEDULER.BulkQueue', '2'))
+        K2SchedulerSettings.attach(self.s, s)
+        self.assertEqual(self.s.limits['BULK'], 2)
+        s.settingSet('SCHEDULER.AuthQueue', 5)
+        self.assertEqual(self.s.limits['AUTH'], 5)
+
+    if canSkipOrFail:
+        def test_create_badWeights(self):
+            self.assertRaises(ValueError, scheduler.K2Scheduler, self.l,
+                              self.dispatch, {'AUTH': 1})
+            self.assertRaises(ValueError, self.s.configure,
+                              {'AUTH': 1, 'ADMIN': 0, 'BULK': 1})
+
+
+
+# List the tests and create a test suite, for use by the top-level test script.
+tests = ('test_commandClass', 'test_weights', 'test_noStarvation',
+         'test_overloaded', 'test_workers', 'test_error', 'test_error_blank',
+         'test_stop',
+         'test_nok', 'test_settings',
+         )
+skippedTests = ('test_create_badWeights',
+                )
+if canSkipOrFail:
+    K2SchedulerTestSuite = unittest.TestSuite(map(K2SchedulerTests,
+                                                  (tests + skippedTests)))
+else:
+    K2SchedulerTestSuite = unittest.TestSuite(map(K2SchedulerTests, tests))
+
+
+# Allow this set of test cases to be run by themselves.
+if __name__ == "__main__":
+    unittest.main()
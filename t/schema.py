@@ -0,0 +1,129 @@
+'''
+This module contains all of the tests for everything in the
+k2ksm.settings.schema Python module.
+'''
+
+import unittest
+
+# If we're being run directly, then we need to add the parent dir to path
+try:
+    from k2ksm.exceptions import K2SchemaError
+    from k2ksm.settings import schema
+    from t._util import canSkipOrFail
+except:
+    from sys import path
+    path.append('..')
+    from k2ksm.exceptions import K2SchemaError
+    from k2ksm.settings import schema
+    from t._util import canSkipOrFail
+
+
+
+def _positive(value):
+    return (int(value) > 0)
+
+
+def makeSchema(**changes):
+    # A schema with one server-wide and one per-session setting.  Keyword
+    # arguments change the properties of the "size" setting.
+    size = {'description': 'A size',
+            'perSession': False,
+            'mutable': True,
+            'default': 10,
+            'validator': _positive,
+            }
+    size.update(changes)
+    return {'size': size,
+            'name': {'description': 'A name',
+                     'perSession': True,
+                     'mutable': False,
+                     'required': True,
+                     'validator': bool,
+                     },
+            }
+
+
+def makeClass(definition):
+    return schema.K2SchemaMeta('SchemaTest', (schema.K2SchemaSettingsModule,),
+                               {'schema': definition})
+
+
+
+class K2SchemaTests(unittest.TestCase):
+    # All of the tests of the schema classes are in this class.
+
+    def test_accessors(self):
+        cls = makeClass(makeSchema())
+        self.assertEqual(cls.settingsList(), ['name', 'size'])
+        self.assertTrue(cls.nameValid('size'))
+        self.assertFalse(cls.nameValid('other'))
+        self.assertEqual(cls.description('name'), 'A name')
+        self.assertEqual((cls.perSession('size'), cls.perSession('name')),
+                         (False, True))
+        self.assertEqual((cls.mutable('size'), cls.mutable('name')),
+                         (True, False))
+        self.assertEqual((cls.required('size'), cls.required('name')),
+                         (False, True))
+        self.assertEqual((cls.default('size'), cls.default('name')),
+                         (10, None))
+        self.assertTrue(cls.settingValid('size', 5))
+        self.assertFalse(cls.settingValid('size', -5))
+
+    def test_instance(self):
+        # Instances behave like any other K2SettingsModule
+        settings = makeClass(makeSchema())()
+        self.assertEqual(settings['size'], 10)
+        settings['size'] = 20
+        self.assertEqual(settings['size'], 20)
+        self.assertEqual(len(settings), 1)
+
+    def test_override(self):
+        # Methods defined by the class are not replaced
+        cls = schema.K2SchemaMeta('SchemaTest',
+                                  (schema.K2SchemaSettingsModule,),
+                                  {'schema': makeSchema(),
+                                   'default': staticmethod(lambda name: 1)})
+        self.assertEqual(cls.default('size'), 1)
+        self.assertTrue(cls.specs['size'].mutable)
+
+    if canSkipOrFail:
+        def test_unknownName(self):
+            cls = makeClass(makeSchema())
+            self.assertRaises(KeyError, cls.perSession, 'other')
+            self.assertRaises(KeyError, cls.settingValid, 'other', 1)
+
+        def test_badSchema(self):
+            # Mistakes are found when the class is defined
+            self.assertRaises(K2SchemaError, makeClass,
+                              makeSchema(perSession='no'))
+            self.assertRaises(K2SchemaError, makeClass,
+                              makeSchema(validator=None))
+            self.assertRaises(K2SchemaError, makeClass,
+                              makeSchema(defualt=5))
+            definition = makeSchema()
+            del definition['size']['description']
+            self.assertRaises(K2SchemaError, makeClass, definition)
+
+        def test_specReadOnly(self):
+            spec = makeClass(makeSchema()).specs['size']
+            self.assertRaises(AttributeError, setattr, spec, 'default', 5)
+            self.assertRaises(AttributeError, setattr, spec, 'other', 5)
+            self.assertRaises(AttributeError, delattr, spec, 'default')
+
+
+
+# List the tests and create a test suite, for use by the top-level test script.
+tests = ('test_accessors', 'test_instance', 'test_override',
+         )
+skippedTests = ('test_unknownName', 'test_badSchema', 'test_specReadOnly',
+                )
+if canSkipOrFail:
+    K2SchemaTestSuite = unittest.TestSuite(map(K2SchemaTests,
+                                               (tests + skippedTests)))
+else:
+    K2SchemaTestSuite = unittest.TestSuite(map(K2SchemaTests, tests))
+
+
+# Allow this set of test cases to be run by themselves.
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+'''
+This module contains all of the tests for everything in the k2ksm.sessions
+Python module.
+'''
+
+import unittest
+
+# If we're being run directly, then we need to add the parent dir to path
+try:
+    from k2ksm import sessions
+    from t._util import canSkipOrFail
+except:
+    from sys import path
+    path.append('..')
+    from k2ksm import sessions
+    from t._util import canSkipOrFail
+
+
+
+class K2SessionIDsTests(unittest.TestCase):
+    # All of the tests of K2SessionIDs are in this class.
+
+    def setUp(self):
+        self.s = sessions.K2SessionIDs(slotBits=4)
+
+    def test_allocate(self):
+        # IDs are small, distinct and never 0
+        ids = [self.s.allocate() for i in xrange(3)]
+        self.assertEqual(ids, [1, 2, 3])
+        self.assertEqual([self.s.slot(i) for i in ids], [1, 2, 3])
+        self.assertEqual(len(self.s), 3)
+        self.assertEqual(self.s.capacity, 4)
+        self.assertEqual(list(self.s), ids)
+
+    def test_release(self):
+        # Released slots are re-used first, with a new generation
+        (a, b, c) = [self.s.allocate() for i in xrange(3)]
+        self.s.release(b)
+        self.s.release(a)
+        self.assertEqual(len(self.s), 1)
+        d = self.s.allocate()
+        self.assertEqual((self.s.slot(d), d), (1, 16 + 1))
+        e = self.s.allocate()
+        self.assertEqual((self.s.slot(e), e), (2, 16 + 2))
+        self.assertEqual(self.s.capacity, 4)
+        self.assertEqual(list(self.s), [d, e, c])
+
+    def test_stale(self):
+        # Old IDs are not mistaken for the slot's new session
+        a = self.s.allocate()
+        self.s.release(a)
+        b = self.s.allocate()
+        self.assertRaises(KeyError, self.s.slot, a)
+        self.assertRaises(KeyError, self.s.release, a)
+        self.assertFalse(a in self.s)
+        self.assertTrue(b in self.s)
+        for bad in (0, 5, None, 'x', 1.5):
+            self.assertRaises(KeyError, self.s.slot, bad)
+
+    def test_claim(self):
+        # Claimed IDs are kept, and skipped slots are handed out later
+        self.assertEqual(self.s.claim(3 * 16 + 4), 4)
+        self.assertRaises(KeyError, self.s.claim, 3 * 16 + 4)
+        self.assertRaises(KeyError, self.s.claim, 4)
+        self.assertRaises(KeyError, self.s.claim, 0)
+        self.assertRaises(KeyError, self.s.claim, 16)
+        self.assertRaises(KeyError, self.s.claim, -1)
+        self.assertRaises(KeyError, self.s.claim, 'x')
+        self.s.claim(2)
+        self.assertEqual([self.s.allocate() for i in xrange(2)], [1, 3])
+        self.assertEqual(self.s.allocate(), 5)
+        self.assertEqual(len(self.s), 5)
+
+    if canSkipOrFail:
+        def test_full(self):
+            for i in xrange(15):
+                self.s.allocate()
+            self.assertRaises(OverflowError, self.s.allocate)
+            self.s.release(7)
+            self.assertEqual(self.s.allocate(), 16 + 7)
+
+    if canSkipOrFail:
+        def test_create_badBits(self):
+            self.assertRaises(ValueError, sessions.K2SessionIDs, 0)
+
+
+
+# List the tests and create a test suite, for use by the top-level test script.
+tests = ('test_allocate', 'test_release', 'test_stale', 'test_claim',
+         )
+skippedTests = ('test_full', 'test_create_badBits',
+                )
+if canSkipOrFail:
+    K2SessionIDsTestSuite = unittest.TestSuite(map(K2SessionIDsTests,
+                                                   (tests + skippedTests)))
+else:
+    K2SessionIDsTestSuite = unittest.TestSuite(map(K2SessionIDsTests, tests))
+
+
+# Allow this set of test cases to be run by themselves.
+if __name__ == "__main__":
+    unittest.main()
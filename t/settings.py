@@ -3,7 +3,7 @@ This module contains all of the tests for everything in the k2ksm.settings
 Python module.
 '''
 
-from os import close, fdopen, unlink
+from os import close, fdopen, unlink, utime
 import random
 from tempfile import mkstemp
 import unittest
@@ -11,19 +11,62 @@ import unittest
 # If we're being run directly, then we need to add the parent dir to path
 try:
     from k2ksm import logger, settings
-    from k2ksm.exceptions import K2FinalizeError
+    from k2ksm.exceptions import K2FinalizeError, K2SettingsError
     from t._util import canSkipOrFail
+    from t import workload
 except:
     from sys import path
     path.append('..')
     from k2ksm import logger, settings
-    from k2ksm.exceptions import K2FinalizeError
+    from k2ksm.exceptions import K2FinalizeError, K2SettingsError
     from t._util import canSkipOrFail
+    from t import workload
 
     
 
 
 
+class TestSettings(settings.K2SettingsModule):
+    # A simple settings module to register in tests.  "server" is server-wide,
+    # "session" is per-session, and both must be non-negative integers.
+    
+    @staticmethod
+    def settingsList():
+        return ['server', 'session']
+    
+    @staticmethod
+    def nameValid(name):
+        return (name in ('server', 'session'))
+    
+    @staticmethod
+    def description(name):
+        return 'A test setting'
+    
+    @staticmethod
+    def perSession(name):
+        return (name == 'session')
+    
+    @staticmethod
+    def mutable(name):
+        return True
+    
+    @staticmethod
+    def required(name):
+        return False
+    
+    @staticmethod
+    def default(name):
+        return 0
+    
+    @staticmethod
+    def settingValid(name, value):
+        try:
+            return (int(value) >= 0)
+        except:
+            return False
+
+
+
 class K2SettingsTests(unittest.TestCase):
     # All of the tests of the K2Settings are in this class.
     
@@ -41,30 +84,15 @@ class K2SettingsTests(unittest.TestCase):
         where X is a number from 0 to MAX_SETTINGS.  The value of the setting
         is a number from 0 to MAX_VALUE.
         
+        This is a small sample from the L{workload.Workload} generator, which
+        can also make much larger workloads for load testing.
+        
         @return: A 2-dimensional hash of settings.
         @rtype: Hash of hashes
         '''
-        
-        #: A 2-dimensional hash.  The outer key is the module name, the inner
-        # key is the setting name.
-        modules = {}
-        
-        for i in xrange(1, random.randint(1, cls.MAX_ARGS)):
-            moduleString = 'module' + str(random.randint(0, cls.MAX_MODULES))
-            settingString = 'setting' + str(random.randint(0, cls.MAX_SETTINGS))
-            if (    (moduleString in modules)
-                and (settingString in modules[moduleString])
-               ):
-                # Don't duplicate entries.  We've lost this chance; try again!
-                continue
-
-            # (If needed) make the 2nd-level hash, then assign the value
-            if (moduleString not in modules):
-                modules[moduleString] = {}
-            modules[moduleString][settingString] = random.randint(0, \
-                                                    cls.MAX_VALUE)
-            
-        return modules
+        w = workload.Workload(random.random(), cls.MAX_MODULES + 1,
+                              cls.MAX_SETTINGS + 1, cls.MAX_VALUE)
+        return w.makeSettings(random.randint(1, cls.MAX_ARGS) - 1)
     
     @classmethod
     def makeArguments(cls, settings=None):
@@ -158,6 +186,49 @@ class K2SettingsTests(unittest.TestCase):
             args = ('module.setting',)
             self.assertRaises(IndexError, self.s.loadArgs, args)
     
+    def test_loadArgs_argfile(self):
+        # Settings can come from an argfile, mixed with normal arguments
+        w = workload.Workload(random.random(), 5, 10)
+        (fileNum, filePath) = mkstemp(text=True)
+        close(fileNum)
+        w.writeArgfile(filePath)
+        self.s.loadArgs(['module0.extra', '1', '@' + filePath])
+        unlink(filePath)
+        unused = self.s._K2Settings__unusedSettings
+        self.assertEquals(len(unused), 5)
+        self.assertEquals(len(unused['module0']), 11)
+        (module, setting, value) = w.iterSettings().next()
+        self.assertEquals(unused[module][setting], str(value))
+    
+    def test_loadArgs_registered(self):
+        # Settings for registered modules go straight to the module
+        self.s.register('TEST', TestSettings)
+        self.s.loadArgs(('TEST.server', '15', 'other.setting', '1'))
+        self.assertEquals(self.s.settingGet('TEST.server'), '15')
+        self.assertEquals(self.s._K2Settings__unusedSettings.keys(),
+                          ['other'])
+    
+    if canSkipOrFail:
+        def test_loadArgs_invalid(self):
+            # A bad value for one module means no module is changed
+            self.s.register('A', TestSettings)
+            self.s.register('B', TestSettings)
+            self.assertRaises(K2SettingsError, self.s.loadArgs,
+                              ('A.server', '15', 'B.server', '-1',
+                               'other.setting', '1'))
+            self.assertEquals(self.s.settingGet('A.server'), 0)
+            self.assertEquals(len(self.s._K2Settings__unusedSettings), 0)
+    
+    if canSkipOrFail:
+        def test_loadArgs_oddArgfile(self):
+            # An odd list is caught even with an argfile, and nothing is kept
+            (fileNum, filePath) = mkstemp(text=True)
+            close(fileNum)
+            args = ('@' + filePath, 'module.setting')
+            self.assertRaises(IndexError, self.s.loadArgs, args)
+            unlink(filePath)
+            self.assertEquals(len(self.s._K2Settings__unusedSettings), 0)
+    
     if canSkipOrFail:
         def test_loadArgs_finalized(self):
             # We should be able to loadArgs after settings have been finalized
@@ -205,28 +276,233 @@ class K2SettingsTests(unittest.TestCase):
         self.assertEquals(len(self.s._K2Settings__unusedSettings), \
                           len(settingsAll))
     
-    # TODO: Test procesUnused()
+    def test_processUnused(self):
+        # Only registered modules are processed; the rest are kept
+        self.s.register('TEST', TestSettings)
+        self.s.loadArgs(('other.setting', '1'))
+        self.s.processUnused()
+        self.s.processUnused('other')
+        self.assertEquals(self.s._K2Settings__unusedSettings.keys(),
+                          ['other'])
     
-    # TODO: Test register(), we'll probably need to make our own basic class
+    def test_register(self):
+        # Registering picks up settings that were loaded earlier
+        self.s.loadArgs(('TEST.server', '15'))
+        self.s.register('TEST', TestSettings)
+        self.assertEquals(self.s.settingGet('TEST.server'), '15')
+        self.assertEquals(len(self.s._K2Settings__unusedSettings), 0)
+    
+    if canSkipOrFail:
+        def test_register_twice(self):
+            self.s.register('TEST', TestSettings)
+            self.assertRaises(KeyError, self.s.register, 'TEST', TestSettings)
+    
+    if canSkipOrFail:
+        def test_register_invalid(self):
+            # Every bad setting is reported, and the module is not registered
+            self.s.loadArgs(('TEST.server', '-1', 'TEST.bogus', '1',
+                             'TEST.session', '3'))
+            try:
+                self.s.register('TEST', TestSettings)
+                self.fail('K2SettingsError not raised')
+            except K2SettingsError as e:
+                self.assertEquals(e.moduleID, 'TEST')
+                self.assertEquals([error[0] for error in e.errors],
+                                  ['bogus', 'server'])
+            self.assertRaises(KeyError, self.s.settingGet, 'TEST.server')
+            self.assertEquals(len(self.s._K2Settings__unusedSettings['TEST']),
+                              3)
     
     def test_finalize(self):
         # We should be able to finalize an empty object
         self.s.finalize()
         self.assertEquals(len(self.s._K2Settings__unusedSettings), 0)
 
-    # TODO: Test newSession()
+    def test_newSession(self):
+        # IDs are allocated when not given, and carried-over IDs are kept
+        self.s.register('TEST', TestSettings)
+        first = self.s.newSession()
+        second = self.s.newSession()
+        self.assertNotEquals(first.sessionID, second.sessionID)
+        self.assertTrue(self.s.sessionView(second.sessionID) is second)
+        self.s.newSession(12345)
+        self.assertRaises(KeyError, self.s.newSession, 12345)
+        self.assertRaises(KeyError, self.s.newSession, 0)
+        self.assertEquals(sorted(self.s.sessionIDs()),
+                          sorted([first.sessionID, second.sessionID, 12345]))
+    
+    def test_delSession(self):
+        # A deleted session's ID stops working, even once its slot is re-used
+        self.s.register('TEST', TestSettings)
+        sessionID = self.s.newSession().sessionID
+        slot = self.s.sessions.slot(sessionID)
+        self.s.settingSet('TEST.session', 7, sessionID)
+        self.s.delSession(sessionID)
+        other = self.s.newSession().sessionID
+        self.assertEquals(self.s.sessions.slot(other), slot)
+        self.assertRaises(KeyError, self.s.settingGet, 'TEST.session',
+                          sessionID)
+        self.assertRaises(KeyError, self.s.settingSet, 'TEST.session', 1,
+                          sessionID)
+        self.assertRaises(KeyError, self.s.delSession, sessionID)
+        self.assertRaises(ValueError, self.s.delSession, 0)
+        self.assertEquals(self.s.settingGet('TEST.session', other), 0)
     
-    # TODO: Test delSession()
+    def makeSnapshot(self):
+        # Load, register and finalize, then save a snapshot with sessions.
+        # Returns the config path and the snapshot path.
+        (fileNum, configPath) = mkstemp(text=True)
+        configFile = fdopen(fileNum, 'w')
+        configFile.write("[TEST]\nserver=15\n")
+        configFile.close()
+        self.s.loadArgs(('TEST.session', '3'))
+        self.s.loadConfig(configPath)
+        self.s.register('TEST', TestSettings)
+        self.s.finalize()
+        self.s.newSession(1)
+        self.s.settingSet('TEST.session', 7, 1)
+        (fileNum, snapshotPath) = mkstemp()
+        close(fileNum)
+        self.s.snapshot(snapshotPath, sessions=True)
+        return (configPath, snapshotPath)
+    
+    def test_snapshot(self):
+        (configPath, snapshotPath) = self.makeSnapshot()
+        r = settings.K2Settings.restore(logger.K2Logger(''), snapshotPath,
+                                        ('TEST.session', '3'))
+        self.assertTrue(r.finalized)
+        self.assertEquals(r.settingGet('TEST.server'), '15')
+        self.assertEquals(r.settingGet('TEST.session', 1), 7)
+        self.assertEquals(r.state(True), self.s.state(True))
+        unlink(configPath)
+        unlink(snapshotPath)
     
-    # TODO: Test settingGet()
+    def test_snapshot_stale(self):
+        # Changed sources, changed arguments and corrupt files are not used
+        (configPath, snapshotPath) = self.makeSnapshot()
+        emptyLog = logger.K2Logger('')
+        args = ('TEST.session', '3')
+        self.assertEquals(settings.K2Settings.restore(emptyLog, snapshotPath,
+                          ('TEST.session', '4')), None)
+        configFile = open(configPath, 'w')
+        configFile.write("[TEST]\nserver=16\n")
+        configFile.close()
+        utime(configPath, (1, 1))
+        self.assertEquals(settings.K2Settings.restore(emptyLog, snapshotPath,
+                                                      args), None)
+        snapshotFile = open(snapshotPath, 'r+b')
+        snapshotFile.seek(-2, 2)
+        snapshotFile.write('XX')
+        snapshotFile.close()
+        self.assertEquals(settings.K2Settings.restore(emptyLog, snapshotPath,
+                                                      args), None)
+        unlink(configPath)
+        unlink(snapshotPath)
     
-    # TODO: Test settingSet()
+    def test_snapshot_noConfig(self):
+        # A missing config file is stamped as absent, until it appears
+        (fileNum, configPath) = mkstemp(text=True)
+        close(fileNum)
+        unlink(configPath)
+        (fileNum, snapshotPath) = mkstemp()
+        close(fileNum)
+        emptyLog = logger.K2Logger('')
+        self.s.loadArgs(())
+        self.s.loadConfig(configPath)
+        self.s.register('TEST', TestSettings)
+        self.s.finalize()
+        self.s.snapshot(snapshotPath)
+        r = settings.K2Settings.restore(emptyLog, snapshotPath, ())
+        self.assertEquals(r.sources, [configPath])
+        configFile = open(configPath, 'w')
+        configFile.write("[TEST]\nserver=16\n")
+        configFile.close()
+        self.assertEquals(settings.K2Settings.restore(emptyLog, snapshotPath,
+                                                      ()), None)
+        unlink(configPath)
+        unlink(snapshotPath)
+    
+    def test_settingGetSet(self):
+        # Server-wide settings are shared; session settings are not
+        self.s.register('TEST', TestSettings)
+        self.s.newSession(1)
+        self.s.newSession(2)
+        self.s.settingSet('TEST.server', 5, 1)
+        self.s.settingSet('TEST.session', 7, 1)
+        self.assertEquals(self.s.settingGet('TEST.server', 2), 5)
+        self.assertEquals(self.s.settingGet('TEST.session', 1), 7)
+        self.assertEquals(self.s.settingGet('TEST.session', 2), 0)
+        self.assertEquals(self.s.settingGet('TEST.session'), 0)
+    
+    def test_sessionView(self):
+        # Views cache values, and see changes made through settingSet
+        server = TestSettings()
+        self.s.register('TEST', TestSettings, server)
+        view = self.s.newSession(1)
+        self.assertTrue(self.s.sessionView(1) is view)
+        test = view.TEST
+        self.assertEquals((test.server, test.session), (0, 0))
+        self.assertEquals(view['TEST.session'], 0)
+        self.s.settingSet('TEST.session', 7, 1)
+        self.s.settingSet('TEST.server', 5)
+        self.assertEquals(test.session, 7)
+        self.assertEquals(test.server, 0)
+        self.assertEquals(view.TEST.server, 5)
+        
+        # Changes made directly are seen after invalidate()
+        server['server'] = 9
+        self.assertEquals(view.TEST.server, 5)
+        self.s.invalidate('TEST')
+        self.assertEquals(view.TEST.server, 9)
+    
+    if canSkipOrFail:
+        def test_sessionView_unknown(self):
+            self.s.register('TEST', TestSettings)
+            view = self.s.newSession(1)
+            self.assertRaises(AttributeError, getattr, view, 'NOPE')
+            self.assertRaises(AttributeError, getattr, view.TEST, 'nope')
+            self.assertRaises(KeyError, view.__getitem__, 'NOPE.server')
+            self.s.delSession(1)
+            self.assertRaises(KeyError, self.s.sessionView, 1)
+    
+    if canSkipOrFail:
+        def test_settingSet_invalid(self):
+            self.s.register('TEST', TestSettings)
+            self.assertRaises(ValueError, self.s.settingSet, 'TEST.server',
+                              -1)
+            self.assertRaises(AttributeError, self.s.settingSet, 'TEST.x', 1)
+            self.assertRaises(KeyError, self.s.settingGet, 'NOPE.server')
 
 
 class K2SettingsModuleTests(unittest.TestCase):
     # All of the tests of K2SettingsModule are in this class.
     # TODO: Test everything
-    pass
+    
+    if canSkipOrFail:
+        def test_update_invalid(self):
+            # Nothing is changed if any value is invalid
+            m = TestSettings()
+            self.assertRaises(K2SettingsError, m.update,
+                              {'server': 5, 'session': -1})
+            self.assertEquals(len(m), 0)
+    
+    def test_update(self):
+        m = TestSettings()
+        m.update({'server': 5, 'session': 0})
+        self.assertEquals(m['server'], 5)
+        self.assertEquals(len(m), 1)
+    
+    def test_reset(self):
+        # Setting a value back to its default drops the earlier value
+        m = TestSettings()
+        m['server'] = 5
+        m['server'] = 0
+        self.assertEquals(m['server'], 0)
+        self.assertEquals(len(m), 0)
+        m.update({'server': 5})
+        m.update({'server': 0})
+        self.assertEquals(m['server'], 0)
+        self.assertEquals(len(m), 0)
 
 
         
@@ -235,18 +511,30 @@ tests = {}
 tests['K2Settings'] = (
     'test_create',
     'test_loadArgs', 'test_loadArgs_emptyList',
+    'test_loadArgs_argfile', 'test_loadArgs_registered',
     'test_loadConfig',
     'test_load',
+    'test_processUnused',
+    'test_register',
     'test_finalize',
+    'test_newSession', 'test_delSession',
+    'test_snapshot', 'test_snapshot_stale', 'test_snapshot_noConfig',
+    'test_settingGetSet',
+    'test_sessionView',
 )
 tests['K2SettingsModule'] = (
+    'test_update', 'test_reset',
 )
 
 skippableTests = {}
 skippableTests['K2Settings'] = (
-    'test_loadArgs_oddList', 'test_loadArgs_finalized',
+    'test_loadArgs_oddList', 'test_loadArgs_oddArgfile',
+    'test_loadArgs_finalized', 'test_loadArgs_invalid',
+    'test_register_twice', 'test_register_invalid',
+    'test_settingSet_invalid', 'test_sessionView_unknown',
 )
 skippableTests['K2SettingsModule'] = (
+    'test_update_invalid',
 )
 
 if canSkipOrFail:
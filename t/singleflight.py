@@ -0,0 +1,119 @@
+'''
+This module contains all of the tests for everything in the k2ksm.singleflight
+Python module.
+'''
+
+from threading import Event, Thread
+import unittest
+
+# If we're being run directly, then we need to add the parent dir to path
+try:
+    from k2ksm import singleflight
+    from k2ksm.exceptions import K2TimeoutError
+    from t._util import canSkipOrFail
+except:
+    from sys import path
+    path.append('..')
+    from k2ksm import singleflight
+    from k2ksm.exceptions import K2TimeoutError
+    from t._util import canSkipOrFail
+
+
+
+class K2SingleFlightTests(unittest.TestCase):
+    # All of the tests of K2SingleFlight are in this class.
+
+    def setUp(self):
+        self.s = singleflight.K2SingleFlight()
+        self.started = Event()
+        self.gate = Event()
+
+    def slow(self, result=1):
+        # A call that runs until the gate is opened
+        self.started.set()
+        self.gate.wait(5)
+        if (isinstance(result, Exception)):
+            raise result
+        return result
+
+    def shared(self, key, count, function):
+        # Run count calls at once, and return their results or exceptions
+        results = []
+        def run():
+            try:
+                results.append(self.s.do(key, function, 5))
+            except Exception as e:
+                results.append(e)
+        threads = [Thread(target=run) for i in xrange(count)]
+        threads[0].start()
+        self.started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        while (self.s.shared < count - 1):
+            self.gate.wait(0.01)
+        self.gate.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_do(self):
+        self.assertEqual(self.s.do('a', lambda: 5), 5)
+        self.assertEqual(self.s.do('a', lambda: 6), 6)
+        self.assertEqual((self.s.calls, self.s.shared), (2, 0))
+        self.assertEqual(len(self.s), 0)
+
+    def test_shared(self):
+        self.assertEqual(self.shared('a', 3, self.slow), [1, 1, 1])
+        self.assertEqual((self.s.calls, self.s.shared), (1, 2))
+
+    def test_error(self):
+        # Every waiter gets the same exception
+        error = ValueError('bad')
+        results = self.shared('a', 2, lambda: self.slow(error))
+        self.assertTrue(results[0] is error)
+        self.assertTrue(results[1] is error)
+        self.assertEqual(len(self.s), 0)
+
+    def test_maxKeys(self):
+        # Once the table is full, calls are not shared
+        self.s = singleflight.K2SingleFlight(1)
+        thread = Thread(target=self.s.do, args=('a', self.slow))
+        thread.start()
+        self.started.wait(5)
+        self.assertEqual(self.s.do('b', lambda: 2), 2)
+        self.gate.set()
+        thread.join()
+        self.assertEqual((self.s.calls, self.s.overflows), (2, 1))
+
+    def test_timeout(self):
+        thread = Thread(target=self.s.do, args=('a', self.slow))
+        thread.start()
+        self.started.wait(5)
+        self.assertRaises(K2TimeoutError, self.s.do, 'a', self.slow, 0.01)
+        self.gate.set()
+        thread.join()
+        self.assertEqual(self.s.timeouts, 1)
+
+    if canSkipOrFail:
+        def test_create_badMaxKeys(self):
+            self.assertRaises(ValueError, singleflight.K2SingleFlight, 0)
+
+
+
+# List the tests and create a test suite, for use by the top-level test script.
+tests = ('test_do', 'test_shared', 'test_error', 'test_maxKeys',
+         'test_timeout',
+         )
+skippedTests = ('test_create_badMaxKeys',
+                )
+if canSkipOrFail:
+    K2SingleFlightTestSuite = unittest.TestSuite(map(K2SingleFlightTests,
+                                                     (tests + skippedTests)))
+else:
+    K2SingleFlightTestSuite = unittest.TestSuite(map(K2SingleFlightTests,
+                                                     tests))
+
+
+# Allow this set of test cases to be run by themselves.
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+'''
+This module contains all of the tests for everything in the k2ksm.tracing
+Python module.
+'''
+
+import json
+from threading import Thread
+import unittest
+
+# If we're being run directly, then we need to add the parent dir to path
+try:
+    from k2ksm import logger, settings, tracing
+    from k2ksm.settings.k2ksm import K2KSMSettings
+    from t._util import canSkipOrFail
+except:
+    from sys import path
+    path.append('..')
+    from k2ksm import logger, settings, tracing
+    from k2ksm.settings.k2ksm import K2KSMSettings
+    from t._util import canSkipOrFail
+
+
+
+class K2TracerTests(unittest.TestCase):
+    # All of the tests of K2Tracer are in this class.
+
+    def setUp(self):
+        self.t = tracing.K2Tracer(1.0, bufferSize=8)
+
+    def tearDown(self):
+        self.t = None
+
+    def test_span(self):
+        with self.t.span('AUTH', 17) as outer:
+            with self.t.span('crypto') as inner:
+                pass
+        spans = [span for (thread, span) in self.t.spans()]
+        self.assertEqual(spans, [inner, outer])
+        self.assertEqual(inner.parentID, outer.spanID)
+        self.assertEqual(inner.traceID, outer.traceID)
+        self.assertEqual(inner.sessionID, 17)
+        self.assertTrue(outer.end >= inner.end >= inner.start >= outer.start)
+
+    def test_span_unsampled(self):
+        self.t.sampleRate = 0
+        with self.t.span('AUTH') as span:
+            self.assertFalse(span.sampled)
+            self.assertEqual(self.t.header(), None)
+            self.t.sampleRate = 1
+            with self.t.span('crypto') as inner:
+                self.assertFalse(inner.sampled)
+        self.assertEqual(self.t.spans(), [])
+
+    def test_ring(self):
+        # Only the most recent spans are kept
+        for i in xrange(20):
+            with self.t.span(str(i)):
+                pass
+        names = [span.name for (thread, span) in self.t.spans()]
+        self.assertEqual(names, [str(i) for i in xrange(12, 20)])
+
+    def test_header(self):
+        # A header carries the trace and session into another thread
+        results = []
+        def private(header):
+            with self.t.span('private', header=header) as span:
+                results.append(span)
+        with self.t.span('public', 'session1') as public:
+            thread = Thread(target=private, args=(self.t.header(),))
+            thread.start()
+            thread.join()
+        self.assertEqual(results[0].traceID, public.traceID)
+        self.assertEqual(results[0].parentID, public.spanID)
+        self.assertEqual(results[0].sessionID, 'session1')
+
+    def test_exitedThreads(self):
+        # Rings of exited threads are kept until their spans are exported,
+        # and only a few of them are kept
+        def work(name):
+            with self.t.span(name):
+                pass
+        count = tracing.K2_TRACE_DEAD_THREADS + 10
+        for i in xrange(count):
+            thread = Thread(target=work, args=(str(i),))
+            thread.start()
+            thread.join()
+        self.assertEqual(self.t.threadCount(),
+                         tracing.K2_TRACE_DEAD_THREADS + 1)
+        names = [span.name for (thread, span) in self.t.spans()]
+        self.assertEqual(names, [str(i) for i in
+                                 xrange(count - len(names), count)])
+        self.assertEqual(self.t.threadCount(), 0)
+        self.assertEqual(self.t.spans(), [])
+
+    def test_dump(self):
+        with self.t.span('AUTH', 17):
+            pass
+        events = json.loads(self.t.dump())['traceEvents']
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]['name'], 'AUTH')
+        self.assertEqual(events[0]['args']['session'], '17')
+
+    def test_settings(self):
+        # The sample rate follows K2KSM.TraceSampleRate
+        l = logger.K2Logger(self.id())
+        l.logToStderr = False
+        s = settings.K2Settings(l)
+        s.loadArgs(('K2KSM.TraceSampleRate', '0.25'))
+        K2KSMSettings.attach(self.t, s)
+        self.assertEqual(self.t.sampleRate, 0.25)
+        s.settingSet('K2KSM.TraceSampleRate', 0.5)
+        self.assertEqual(self.t.sampleRate, 0.5)
+        s.settingSet('K2KSM.TraceSampleRate', 0)
+        self.assertEqual(self.t.sampleRate, 0.0)
+
+    if canSkipOrFail:
+        def test_create_badBuffer(self):
+            self.assertRaises(ValueError, tracing.K2Tracer, 1.0, 0)
+
+
+
+# List the tests and create a test suite, for use by the top-level test script.
+tests = ('test_span', 'test_span_unsampled', 'test_ring', 'test_header',
+         'test_exitedThreads',
+         'test_dump', 'test_settings',
+         )
+skippedTests = ('test_create_badBuffer',
+                )
+if canSkipOrFail:
+    K2TracerTestSuite = unittest.TestSuite(map(K2TracerTests,
+                                               (tests + skippedTests)))
+else:
+    K2TracerTestSuite = unittest.TestSuite(map(K2TracerTests, tests))
+
+
+# Allow this set of test cases to be run by themselves.
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,448 @@
+'''
+This module generates large, random (but reproducible) settings workloads,
+for load-testing K2Settings.  A workload is made up of:
+
+- Hundreds of synthetic L{K2SettingsModule} subclasses, each with its own
+  settings, some server-wide and some per-session.
+
+- Settings for those modules, which can be streamed to a configuration file
+  or an argfile (to load-test the configuration and argument loaders).
+
+- A stream of session operations: sessions are created, do a mix of
+  settingGet and settingSet calls over their lifetime, and are deleted.  The
+  stream can be written to disk, and replayed against a K2Settings object (to
+  load-test the runtime paths).
+
+Everything is streamed, so workloads of millions of settings or operations
+never need to fit in memory.  The same seed always produces the same
+workload.
+
+This module can also be run directly, to write a workload to disk::
+
+    python t/workload.py --seed 42 --modules 500 --settings 2000 out/
+'''
+
+from hashlib import sha256
+from optparse import OptionParser
+from os import close, path as osPath, unlink
+import random
+from tempfile import mkstemp
+import unittest
+
+# If we're being run directly, then we need to add the parent dir to path
+try:
+    from k2ksm import logger, settings
+except:
+    from sys import path
+    path.append(osPath.join(osPath.dirname(__file__), '..'))
+    from k2ksm import logger, settings
+
+
+
+#: The default seed.
+SEED = 20140515
+
+
+def makeModuleClass(name, settingCount, perSessionRatio, maxValue, rng):
+    '''
+    Make a synthetic K2SettingsModule subclass.  Its settings are named
+    "setting0", "setting1", etc.  Valid values are integers from 0 to
+    C{maxValue}, and the default for every setting is 0.
+
+    @param name: The module name, which is also used as the class name.
+    @param settingCount: The number of settings the module has.
+    @param perSessionRatio: The fraction of settings that are per-session.
+    @param maxValue: The largest valid value.
+    @param rng: The random.Random to use.
+
+    @return: A new subclass of L{K2SettingsModule}.
+    '''
+    names = frozenset(['setting%d' % i for i in xrange(settingCount)])
+    perSession = frozenset(['setting%d' % i for i in xrange(settingCount)
+                            if (rng.random() < perSessionRatio)])
+
+    def settingsList(cls):
+        return sorted(names)
+
+    def nameValid(cls, name):
+        return (name in names)
+
+    def description(cls, name):
+        if (name not in names):
+            raise KeyError(name)
+        return 'Synthetic setting %s.%s' % (cls.__name__, name)
+
+    def perSessionMethod(cls, name):
+        if (name not in names):
+            raise KeyError(name)
+        return (name in perSession)
+
+    def mutable(cls, name):
+        if (name not in names):
+            raise KeyError(name)
+        return True
+
+    def required(cls, name):
+        if (name not in names):
+            raise KeyError(name)
+        return False
+
+    def default(cls, name):
+        if (name not in names):
+            raise KeyError(name)
+        return 0
+
+    def settingValid(cls, name, value):
+        if (name not in names):
+            raise KeyError(name)
+        try:
+            value = int(value)
+        except:
+            return False
+        return (0 <= value <= maxValue)
+
+    return type(name, (settings.K2SettingsModule,), {
+        'settingsList': classmethod(settingsList),
+        'nameValid': classmethod(nameValid),
+        'description': classmethod(description),
+        'perSession': classmethod(perSessionMethod),
+        'mutable': classmethod(mutable),
+        'required': classmethod(required),
+        'default': classmethod(default),
+        'settingValid': classmethod(settingValid),
+        'names': names,
+        'perSessionNames': perSession,
+    })
+
+
+
+class Workload(object):
+    '''
+    A reproducible, randomly-generated settings workload.
+
+    Each part of the workload (modules, settings, operations) has its own
+    random number generator, seeded from the workload's seed, so each part is
+    the same no matter what order the parts are generated in.
+
+    @ivar seed: The seed.
+    @ivar moduleCount: The number of synthetic modules.
+    @ivar settingCount: The number of settings in each module.
+    @ivar maxValue: The largest setting value.
+    @ivar perSessionRatio: The fraction of settings that are per-session.
+    @ivar getRatio: The fraction of session operations that are gets (the
+    rest are sets).
+    @ivar meanLifetime: The average number of operations in a session.
+    @ivar concurrency: The largest number of sessions open at once.
+    '''
+
+
+    def __init__(self, seed=SEED, moduleCount=100, settingCount=100,
+                 maxValue=120, perSessionRatio=0.3, getRatio=0.9,
+                 meanLifetime=20, concurrency=50):
+        self.seed = seed
+        self.moduleCount = moduleCount
+        self.settingCount = settingCount
+        self.maxValue = maxValue
+        self.perSessionRatio = perSessionRatio
+        self.getRatio = getRatio
+        self.meanLifetime = meanLifetime
+        self.concurrency = concurrency
+        self.__modules = None
+
+
+    def rng(self, part):
+        '''
+        Returns a new random number generator for one part of the workload.
+        The seed is an integer made from a hash, since seeding with a string
+        would use Python's string hash, which changes with PYTHONHASHSEED and
+        between 32-bit and 64-bit builds.
+        '''
+        digest = sha256('%s-%s' % (self.seed, part)).hexdigest()
+        return random.Random(int(digest, 16))
+
+
+    def moduleNames(self):
+        '''
+        Returns the names of the synthetic modules.
+        '''
+        return ['module%d' % i for i in xrange(self.moduleCount)]
+
+
+    def modules(self):
+        '''
+        Returns the synthetic modules, as a list of (name, class) tuples.
+        The classes are only made once per workload.
+        '''
+        if (self.__modules == None):
+            rng = self.rng('modules')
+            self.__modules = [(name, makeModuleClass(name, self.settingCount,
+                                                     self.perSessionRatio,
+                                                     self.maxValue, rng))
+                              for name in self.moduleNames()]
+        return self.__modules
+
+
+    def register(self, s):
+        '''
+        Register every synthetic module with a K2Settings object.
+        '''
+        for (name, cls) in self.modules():
+            s.register(name, cls)
+
+
+    def iterSettings(self, count=None):
+        '''
+        Generate settings.  If C{count} is not given, every setting of every
+        module is generated, in order; otherwise C{count} settings are picked
+        at random (and may repeat).
+
+        @return: A generator of (module, setting, value) tuples.
+        '''
+        rng = self.rng('settings')
+        if (count == None):
+            for module in self.moduleNames():
+                for i in xrange(self.settingCount):
+                    yield (module, 'setting%d' % i,
+                           rng.randint(0, self.maxValue))
+            return
+        for i in xrange(count):
+            yield ('module%d' % rng.randint(0, self.moduleCount - 1),
+                   'setting%d' % rng.randint(0, self.settingCount - 1),
+                   rng.randint(0, self.maxValue))
+
+
+    def makeSettings(self, count):
+        '''
+        Returns C{count} random settings (fewer, if any repeat) as a
+        2-dimensional hash.  The outer key is the module name, the inner key
+        is the setting name.
+        '''
+        modules = {}
+        for (module, setting, value) in self.iterSettings(count):
+            modules.setdefault(module, {}).setdefault(setting, value)
+        return modules
+
+
+    def writeConfig(self, path, count=None):
+        '''
+        Stream settings (see L{iterSettings}) to an .ini-style configuration
+        file.  Random settings are grouped by module as they are written, so
+        a module's section may appear more than once.
+
+        @return: The number of settings written.
+        '''
+        configFile = open(path, 'w')
+        written = 0
+        section = None
+        for (module, setting, value) in self.iterSettings(count):
+            if (module != section):
+                configFile.write("[%s]\n" % module)
+                section = module
+            configFile.write("%s=%d\n" % (setting, value))
+            written += 1
+        configFile.close()
+        return written
+
+
+    def writeArgfile(self, path, count=None):
+        '''
+        Stream settings (see L{iterSettings}) to an argfile, for use as an
+        C{@path} argument to L{K2Settings.loadArgs}.
+
+        @return: The number of settings written.
+        '''
+        argfile = open(path, 'w')
+        written = 0
+        for (module, setting, value) in self.iterSettings(count):
+            argfile.write("%s.%s %d\n" % (module, setting, value))
+            written += 1
+        argfile.close()
+        return written
+
+
+    def iterOperations(self, count):
+        '''
+        Generate session operations.  Sessions are numbered from 1.  Each
+        session lives for a random number of operations (exponentially
+        distributed around L{meanLifetime}), and no more than
+        L{concurrency} sessions are open at once.  Sessions still open at the
+        end are deleted.
+
+        @param count: The number of get and set operations to generate.
+
+        @return: A generator of tuples, each one of:
+        ('new', sessionID), ('get', sessionID, name),
+        ('set', sessionID, name, value), ('del', sessionID).
+        '''
+        rng = self.rng('operations')
+        active = []
+        remaining = {}
+        nextSession = 1
+        for i in xrange(count):
+            if (   (len(active) == 0)
+                or (    (len(active) < self.concurrency)
+                    and (rng.random() < 1.0 / self.meanLifetime))
+                ):
+                sessionID = nextSession
+                nextSession += 1
+                active.append(sessionID)
+                remaining[sessionID] = 1 + int(rng.expovariate(
+                    1.0 / self.meanLifetime))
+                yield ('new', sessionID)
+
+            sessionID = rng.choice(active)
+            name = 'module%d.setting%d' % (rng.randint(0, self.moduleCount - 1),
+                                           rng.randint(0,
+                                                       self.settingCount - 1))
+            if (rng.random() < self.getRatio):
+                yield ('get', sessionID, name)
+            else:
+                yield ('set', sessionID, name, rng.randint(0, self.maxValue))
+
+            remaining[sessionID] -= 1
+            if (remaining[sessionID] == 0):
+                active.remove(sessionID)
+                del remaining[sessionID]
+                yield ('del', sessionID)
+
+        for sessionID in active:
+            yield ('del', sessionID)
+
+
+    def writeOperations(self, path, count):
+        '''
+        Stream session operations (see L{iterOperations}) to a file, one per
+        line, with the fields separated by spaces.
+        '''
+        opsFile = open(path, 'w')
+        for op in self.iterOperations(count):
+            opsFile.write(' '.join([str(x) for x in op]) + "\n")
+        opsFile.close()
+
+
+    @staticmethod
+    def readOperations(path):
+        '''
+        Stream session operations back from a file made by
+        L{writeOperations}.
+        '''
+        opsFile = open(path)
+        try:
+            for line in opsFile:
+                fields = line.split()
+                fields[1] = int(fields[1])
+                if (fields[0] == 'set'):
+                    fields[3] = int(fields[3])
+                yield tuple(fields)
+        finally:
+            opsFile.close()
+
+
+    @staticmethod
+    def replay(s, operations):
+        '''
+        Run session operations against a K2Settings object, which must have
+        had the workload's modules registered.
+
+        @return: The number of operations run.
+        '''
+        count = 0
+        for op in operations:
+            if (op[0] == 'get'):
+                s.settingGet(op[2], op[1])
+            elif (op[0] == 'set'):
+                s.settingSet(op[2], op[3], op[1])
+            elif (op[0] == 'new'):
+                s.newSession(op[1])
+            else:
+                s.delSession(op[1])
+            count += 1
+        return count
+
+
+
+class WorkloadTests(unittest.TestCase):
+    # Make sure that the workload generator itself works.
+
+    def setUp(self):
+        self.w = Workload(moduleCount=5, settingCount=10)
+
+    def test_reproducible(self):
+        other = Workload(moduleCount=5, settingCount=10)
+        self.assertEqual(list(self.w.iterOperations(200)),
+                         list(other.iterOperations(200)))
+        self.assertEqual(self.w.makeSettings(20), other.makeSettings(20))
+        self.assertNotEqual(list(Workload(seed=1).iterSettings(20)),
+                            list(self.w.iterSettings(20)))
+        # The same on every build, whatever PYTHONHASHSEED is
+        self.assertEqual(list(self.w.iterSettings(3)),
+                         [('module2', 'setting9', 4),
+                          ('module0', 'setting5', 120),
+                          ('module1', 'setting6', 65)])
+
+    def test_config(self):
+        s = settings.K2Settings(logger.K2Logger(''))
+        self.w.register(s)
+        (fileNum, filePath) = mkstemp(text=True)
+        close(fileNum)
+        try:
+            self.assertEqual(self.w.writeConfig(filePath), 50)
+            s.loadConfig(filePath)
+        finally:
+            unlink(filePath)
+        # Per-session settings from the file only change the server-wide
+        # instance, so check a server-wide setting.
+        for (module, setting, value) in self.w.iterSettings():
+            if (setting not in dict(self.w.modules())[module].perSessionNames):
+                break
+        self.assertEqual(s.settingGet(module + '.' + setting), str(value))
+
+    def test_operations(self):
+        s = settings.K2Settings(logger.K2Logger(''))
+        self.w.register(s)
+        (fileNum, filePath) = mkstemp(text=True)
+        close(fileNum)
+        try:
+            self.w.writeOperations(filePath, 500)
+            ops = list(self.w.readOperations(filePath))
+        finally:
+            unlink(filePath)
+        self.assertEqual(ops, list(self.w.iterOperations(500)))
+        self.assertEqual(len([op for op in ops
+                              if (op[0] in ('get', 'set'))]), 500)
+        self.assertEqual(len([op for op in ops if (op[0] == 'new')]),
+                         len([op for op in ops if (op[0] == 'del')]))
+        self.assertEqual(self.w.replay(s, ops), len(ops))
+
+
+
+# List the tests and create a test suite, for use by the top-level test script.
+tests = ('test_reproducible', 'test_config', 'test_operations',
+         )
+WorkloadTestSuite = unittest.TestSuite(map(WorkloadTests, tests))
+
+
+def main():
+    parser = OptionParser('usage: %prog [options] DIRECTORY')
+    parser.add_option('--seed', dest='seed', default=str(SEED))
+    parser.add_option('--modules', dest='modules', type='int', default=100)
+    parser.add_option('--settings', dest='settings', type='int', default=100,
+                      help='Number of settings per module')
+    parser.add_option('--operations', dest='operations', type='int',
+                      default=1000000)
+    options, args = parser.parse_args()
+    if (len(args) != 1):
+        parser.error('An output directory is needed')
+
+    w = Workload(options.seed, options.modules, options.settings)
+    count = w.writeConfig(osPath.join(args[0], 'workload.ini'))
+    w.writeArgfile(osPath.join(args[0], 'workload.args'))
+    w.writeOperations(osPath.join(args[0], 'workload.ops'),
+                      options.operations)
+    print 'Wrote %d settings and %d operations to %s' % (
+        count, options.operations, args[0])
+
+
+# Allow a workload to be written out from the command line.
+if __name__ == "__main__":
+    main()
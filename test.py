@@ -5,20 +5,64 @@ import unittest
 from sys import exit
 from t import *
 
-# Check to see if we're running in verbose mode
-parser = OptionParser('usage: %prog [-v]')
+# Check to see if we're running in verbose mode, or running benchmarks
+parser = OptionParser('usage: %prog [-v] [--bench [--baseline FILE]]')
 parser.add_option('-v', action='store_true', dest='verbose', default=False,
                    help='Display one line of text for each test')
+parser.add_option('--bench', action='store_true', dest='bench',
+                  default=False,
+                  help='Run the benchmarks instead of the tests')
+parser.add_option('--output', dest='output', default=None, metavar='FILE',
+                  help='Write benchmark results to FILE instead of stdout')
+parser.add_option('--baseline', dest='baseline', default=None,
+                  metavar='FILE',
+                  help='Compare benchmark results to an earlier run')
+parser.add_option('--threshold', dest='threshold', type='float',
+                  default=0.10,
+                  help='Slowdown (as a fraction) that counts as a regression')
+parser.add_option('--samples', dest='samples', type='int', default=30,
+                  help='Number of samples to take for each benchmark')
 options, args = parser.parse_args()
+
+# Benchmarks are run instead of the tests
+if (options.bench == True):
+    from t import bench
+    if (not bench.main(options.output, options.baseline, options.threshold,
+                       options.samples)):
+        exit(1)
+    exit(0)
+
 verbosity = 1
 if (options.verbose == True):
     verbosity = 2
 
 # Assemble all of the test suites
 tests = unittest.TestSuite()
+tests.addTest(audit.K2AuditLogTestSuite)
+tests.addTest(bench.BenchTestSuite)
+tests.addTest(bulk.K2BulkImportTestSuite)
+tests.addTest(bulk.K2BulkExportTestSuite)
+tests.addTest(cache.K2CacheTestSuite)
+tests.addTest(coalesce.K2AuthCoalescerTestSuite)
+tests.addTest(deadline.K2DeadlineTestSuite)
+tests.addTest(directory.K2DirectoryTestSuite)
+tests.addTest(grants.K2GrantTableTestSuite)
+tests.addTest(handoff.K2HandoffTestSuite)
+tests.addTest(keycache.K2KeyCacheTestSuite)
 tests.addTest(logger.K2LoggerTestSuite)
+tests.addTest(metrics.K2MetricsTestSuite)
+tests.addTest(protocol.K2ParserTestSuite)
+tests.addTest(protocol.K2EncoderTestSuite)
+tests.addTest(protocol.K2JSONStreamTestSuite)
+tests.addTest(provision.K2QRRendererTestSuite)
+tests.addTest(scheduler.K2SchedulerTestSuite)
+tests.addTest(schema.K2SchemaTestSuite)
+tests.addTest(sessions.K2SessionIDsTestSuite)
 tests.addTest(settings.K2SettingsTestSuite)
 tests.addTest(settings.K2SettingsModuleTestSuite)
+tests.addTest(singleflight.K2SingleFlightTestSuite)
+tests.addTest(tracing.K2TracerTestSuite)
+tests.addTest(workload.WorkloadTestSuite)
 
 # Configure the runner, and run the tests
 runner = unittest.TextTestRunner(verbosity=verbosity)